@@ -134,8 +134,12 @@ def handle_call(func):
             api, req = func(*args, **kwargs)
             stub_name = _get_stub_name(api)
             with _connect(stub_name) as stub:
-                res = getattr(stub, api)(req, timeout=settings.CLI_TIMEOUT)
-            _print_res(res)
+                if _is_stream(api):
+                    for res in getattr(stub, api)(req):
+                        _print_res(res)
+                else:
+                    res = getattr(stub, api)(req, timeout=settings.CLI_TIMEOUT)
+                    _print_res(res)
         except RpcError as err:
             # pylint: disable=no-member
             json_err = {
@@ -160,6 +164,12 @@ def _get_stub_name(api):
     return 'LightningStub'
 
 
+def _is_stream(api):
+    """ Checks if api streams responses, which are awaited without timeout """
+    return api in ('StreamInvoices', 'StreamPayments', 'StreamTransactions',
+                   'SubscribeInvoices', 'TrackPayment')
+
+
 @contextmanager
 def _connect(stub_class):
     """ Connects to Lighter using gRPC (securely or insecurely) """
@@ -316,8 +326,8 @@ def closechannel(channel_id, force):
     """
     CloseChannel closes a LN channel.
     If the operation succeds it returns the ID of the closing transaction.
-    If the operation takes more than the client timeout, it returns an empty
-    response. The operation could still complete.
+    If the operation takes more than the client timeout, it returns the ID of
+    the closing job, to check its outcome with GetCloseStatus.
     In the other cases the operation will fail with an appropriate message.
     """
     req = pb.CloseChannelRequest(channel_id=channel_id, force=force)
@@ -361,6 +371,18 @@ def decodeinvoice(payment_request, description):
     return 'DecodeInvoice', req
 
 
+@entrypoint.command()
+@argument('job_id', nargs=1)
+@handle_call
+def getclosestatus(job_id):
+    """
+    GetCloseStatus returns the outcome of a CloseChannel call that has taken
+    more than the client timeout, from its job ID.
+    """
+    req = pb.GetCloseStatusRequest(job_id=job_id)
+    return 'GetCloseStatus', req
+
+
 @entrypoint.command()
 @handle_call
 def getinfo():
@@ -368,6 +390,40 @@ def getinfo():
     req = pb.GetInfoRequest()
     return 'GetInfo', req
 
+
+@entrypoint.command()
+@handle_call
+def getmetrics():
+    """
+    GetMetrics returns Lighter's metrics (calls, errors, latencies, node call
+    latencies, background jobs), in Prometheus text format.
+    """
+    req = pb.GetMetricsRequest()
+    return 'GetMetrics', req
+
+
+@entrypoint.command()
+@handle_call
+def getnodehealth():
+    """
+    GetNodeHealth returns the state of the connection to the LN node, as seen
+    by Lighter.
+    """
+    req = pb.GetNodeHealthRequest()
+    return 'GetNodeHealth', req
+
+
+@entrypoint.command()
+@argument('payment_hash', nargs=1)
+@handle_call
+def getpayment(payment_hash):
+    """
+    GetPayment returns the state of a payment started by PayInvoice with
+    no_wait set, from its payment hash.
+    """
+    req = pb.GetPaymentRequest(payment_hash=payment_hash)
+    return 'GetPayment', req
+
 @entrypoint.command()
 @option('--active_only', is_flag=True, help='Whether to return active '
         'channels only (channel is open and peer is online)')
@@ -391,9 +447,13 @@ def listchannels(active_only):
 @option('--paid', is_flag=True, help='Whether to include paid invoices')
 @option('--pending', is_flag=True, help='Whether to include pending invoices')
 @option('--expired', is_flag=True, help='Whether to include expired invoices')
+@option('--cursor', nargs=1, help='Cursor returned by a previous call with '
+        'the same parameters, to get the invoices following it')
+@option('--stream', is_flag=True, help='Stream all the invoices, in chunks '
+        'of max_items invoices (StreamInvoices)')
 @handle_call
 def listinvoices(max_items, search_timestamp, search_order, list_order, paid,
-                 pending, expired):
+                 pending, expired, cursor, stream):
     """
     ListInvoices returns a list of invoices created by the connected LN node.
     """
@@ -404,17 +464,28 @@ def listinvoices(max_items, search_timestamp, search_order, list_order, paid,
         list_order=list_order,
         paid=paid,
         pending=pending,
-        expired=expired)
+        expired=expired,
+        cursor=cursor)
+    if stream:
+        return 'StreamInvoices', req
     return 'ListInvoices', req
 
 
 @entrypoint.command()
+@option('--max_items', nargs=1, type=int, help='Maximum number of payments '
+        'to be returned (default: all)')
+@option('--cursor', nargs=1, help='Cursor returned by a previous call, to '
+        'get the payments following it')
+@option('--stream', is_flag=True, help='Stream all the payments, in chunks '
+        'of max_items payments (StreamPayments)')
 @handle_call
-def listpayments():
+def listpayments(max_items, cursor, stream):
     """
     ListPayments returns a list of invoices the connected LN node has paid.
     """
-    req = pb.ListPaymentsRequest()
+    req = pb.ListPaymentsRequest(max_items=max_items, cursor=cursor)
+    if stream:
+        return 'StreamPayments', req
     return 'ListPayments', req
 
 
@@ -429,13 +500,21 @@ def listpeers():
 
 
 @entrypoint.command()
+@option('--max_items', nargs=1, type=int, help='Maximum number of '
+        'transactions to be returned (default: all)')
+@option('--cursor', nargs=1, help='Cursor returned by a previous call, to '
+        'get the transactions following it')
+@option('--stream', is_flag=True, help='Stream all the transactions, in '
+        'chunks of max_items transactions (StreamTransactions)')
 @handle_call
-def listtransactions():
+def listtransactions(max_items, cursor, stream):
     """
     ListTransactions returns a list of on-chain transactions of the connected
     LN node.
     """
-    req = pb.ListTransactionsRequest()
+    req = pb.ListTransactionsRequest(max_items=max_items, cursor=cursor)
+    if stream:
+        return 'StreamTransactions', req
     return 'ListTransactions', req
 
 
@@ -478,19 +557,26 @@ def openchannel(node_uri, funding_bits, push_bits, private):
         ' match the description hash in the payment request (if present)')
 @option('--cltv_expiry_delta', nargs=1, type=int, help='Delta to use for the '
         'time-lock of the CLTV (absolute) extended to the final hop')
+@option('--no_wait', is_flag=True, help='Whether to return as soon as the '
+        'payment has been submitted, without waiting for its outcome')
 @handle_call
-def payinvoice(payment_request, amount_bits, description, cltv_expiry_delta):
+def payinvoice(payment_request, amount_bits, description, cltv_expiry_delta,
+               no_wait):
     """
     PayInvoice tries to pay a LN invoice from its payment request (BOLT 11).
     An amount can be specified if the invoice doesn't already have it
     included. If a description hash is included in the invoice, its preimage
     must be included in the request.
+    If no_wait is set, it returns as soon as the payment has been submitted
+    (with its payment hash), the payment can then be followed with
+    GetPayment or TrackPayment.
     """
     req = pb.PayInvoiceRequest(
         payment_request=payment_request,
         amount_bits=amount_bits,
         description=description,
-        cltv_expiry_delta=cltv_expiry_delta)
+        cltv_expiry_delta=cltv_expiry_delta,
+        no_wait=no_wait)
     return 'PayInvoice', req
 
 
@@ -509,6 +595,49 @@ def payonchain(address, amount_bits, fee_sat_byte):
     return 'PayOnChain', req
 
 
+@entrypoint.command()
+@option('--seconds', nargs=1, type=int, help='Seconds of stacks sampling')
+@option('--method', nargs=1, help='Name of the method to profile, instead '
+        'of sampling stacks')
+@option('--calls', nargs=1, type=int, help='Number of calls of method to '
+        'profile')
+@handle_call
+def profilelighter(seconds, method, calls):
+    """
+    ProfileLighter starts sampling the stacks of all Lighter threads for the
+    requested seconds or, if method is set, profiling its next calls with
+    cProfile. Results are written in a file in LOGS_DIR, which is returned.
+    Requires the PROFILING configuration option.
+    """
+    req = pb.ProfileLighterRequest(seconds=seconds, method=method, calls=calls)
+    return 'ProfileLighter', req
+
+
+@entrypoint.command()
+@option('--settle_index', nargs=1, type=int, help='Settle index of the last '
+        'received invoice, to resume the stream from')
+@handle_call
+def subscribeinvoices(settle_index):
+    """
+    SubscribeInvoices streams the invoices of the connected LN node as they
+    get paid.
+    """
+    req = pb.SubscribeInvoicesRequest(settle_index=settle_index)
+    return 'SubscribeInvoices', req
+
+
+@entrypoint.command()
+@argument('payment_hash', nargs=1)
+@handle_call
+def trackpayment(payment_hash):
+    """
+    TrackPayment streams the state of a payment started by PayInvoice with
+    no_wait set, until the payment succeeds or fails.
+    """
+    req = pb.TrackPaymentRequest(payment_hash=payment_hash)
+    return 'TrackPayment', req
+
+
 @entrypoint.command()
 @option('--password', prompt='Insert Lighter\'s password',
         hide_input=True, help='Lighter\'s password to decrypt the underlying '
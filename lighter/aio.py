@@ -0,0 +1,164 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+The asyncio server mode for Lighter (GRPC_ASYNC), requiring a grpcio version
+providing grpc.aio
+"""
+
+from asyncio import new_event_loop, run_coroutine_threadsafe
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from logging import getLogger
+from threading import Event, Thread
+from time import monotonic
+
+from grpc import aio
+
+from . import settings as sett
+from .health import HEALTH_METHODS
+from .metrics import timed_handler
+
+LOGGER = getLogger(__name__)
+
+
+class AioServer():
+    """
+    grpc.aio server running on its own event loop thread, exposing the
+    interface of the threaded gRPC server used by Lighter.
+
+    Coroutine handlers run on the event loop, without taking a thread while
+    waiting for the node; synchronous handlers run in a pool of GRPC_WORKERS
+    threads (plus MAX_STREAMS for long-lived streams). Implementations
+    provide coroutines (see their ASYNC_APIS) only for PayInvoice, whose node
+    calls last the longest: all other methods, streams included, are
+    synchronous.
+    """
+
+    def __init__(self, interceptors):
+        self._loop = new_event_loop()
+        thread = Thread(target=self._loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        self._server = self._run(self._create(interceptors))
+
+    async def _create(self, interceptors):
+        """ Creates the server inside the event loop """
+        sett.GRPC_EXECUTOR = ThreadPoolExecutor(
+            max_workers=sett.GRPC_WORKERS + sett.MAX_STREAMS)
+        return aio.server(
+            migration_thread_pool=sett.GRPC_EXECUTOR,
+            interceptors=[AioInterceptor(inter) for inter in interceptors])
+
+    def _run(self, coroutine):
+        """ Runs coroutine in the event loop, waiting for its result """
+        return run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def __getattr__(self, name):
+        """ Handlers and ports are added as on the wrapped server """
+        return getattr(self._server, name)
+
+    def start(self):
+        """ Starts the server """
+        self._run(self._server.start())
+
+    def stop(self, grace):
+        """
+        Stops the server without blocking, returning an Event that is set
+        once it is stopped (as the threaded server does)
+        """
+        stopped = Event()
+
+        async def _stop():
+            await self._server.stop(grace)
+            stopped.set()
+            self._loop.stop()
+
+        run_coroutine_threadsafe(_stop(), self._loop)
+        return stopped
+
+
+class AioInterceptor(aio.ServerInterceptor):
+    """ Runs a Lighter (synchronous) interceptor on the grpc.aio server """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, interceptor):
+        self._interceptor = interceptor
+
+    async def intercept_service(self, continuation, handler_call_details):
+        """
+        Calls the wrapped interceptor, continuing only if it would have
+        """
+        accepted = object()
+        started = monotonic()
+        handler = self._interceptor.intercept_service(
+            lambda _details: accepted, handler_call_details)
+        if handler is accepted and \
+                handler_call_details.method.startswith(HEALTH_METHODS):
+            return await continuation(handler_call_details)
+        if handler is accepted:
+            accepted_at = monotonic()
+            return timed_handler(
+                await continuation(handler_call_details),
+                handler_call_details.method, accepted_at - started,
+                accepted_at)
+        return handler
+
+
+class AbortRequest(Exception):
+    """ Raised by AsyncContext.abort, carries the gRPC status to send """
+
+    def __init__(self, code, details):
+        super().__init__(details)
+        self.code = code
+        self.details = details
+
+
+class AsyncContext():
+    """
+    Wraps a grpc.aio servicer context for the synchronous code shared with
+    the threaded server (e.g. Err), which expects abort to raise
+    """
+
+    def __init__(self, context):
+        self._context = context
+
+    def abort(self, code, details):
+        """ Interrupts the call, see async_method """
+        raise AbortRequest(code, details)
+
+    def is_active(self):
+        """ Whether the call is still in progress """
+        return not self._context.done()
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+
+def async_method(func):
+    """
+    Adapts a coroutine implementation function to the grpc.aio server,
+    aborting the call when the function aborts its AsyncContext
+    """
+
+    @wraps(func)
+    async def wrapper(request, context):
+        try:
+            return await func(request, AsyncContext(context))
+        except AbortRequest as err:
+            await context.abort(err.code, err.details)
+
+    return wrapper
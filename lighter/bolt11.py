@@ -0,0 +1,491 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+The BOLT 11 module for Lighter, decoding payment requests without asking the
+LN node
+"""
+
+from collections import namedtuple
+from functools import lru_cache, reduce
+from hashlib import sha256
+from logging import getLogger
+from operator import xor
+from re import fullmatch
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .errors import Err
+from .utils import convert, Enforcer as Enf
+
+LOGGER = getLogger(__name__)
+
+Invoice = namedtuple('Invoice', [
+    'currency', 'amount_msat', 'timestamp', 'payment_hash', 'description',
+    'description_hash', 'payee', 'expiry', 'min_final_cltv_expiry',
+    'fallback_addr', 'route_hints'])
+
+HopHint = namedtuple('HopHint', [
+    'pubkey', 'short_channel_id', 'fee_base_msat',
+    'fee_proportional_millionths', 'cltv_expiry_delta'])
+
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_VALUES = {char: value for value, char in enumerate(BECH32_CHARSET)}
+BECH32_CONST = 1
+BECH32_GENERATOR = [
+    0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+# XOR of the generator values selected by each 5-bit value
+BECH32_GENERATORS = [
+    reduce(xor, [gen for pos, gen in enumerate(BECH32_GENERATOR)
+                 if top >> pos & 1], 0)
+    for top in range(32)]
+BECH32M_CONST = 0x2bc830a3
+
+# Defaults of the optional fields, as per BOLT 11
+DEFAULT_EXPIRY = 3600
+DEFAULT_MIN_FINAL_CLTV_EXPIRY = 9
+
+# msat in an amount unit, by multiplier
+MULTIPLIERS = {
+    '': 10**11,
+    'm': 10**8,
+    'u': 10**5,
+    'n': 10**2,
+}
+
+# BOLT 11 currency prefix of the networks reported by GetInfo
+CURRENCIES = {
+    'mainnet': 'bc',
+    'testnet': 'tb',
+    'regtest': 'bcrt',
+    'simnet': 'sb',
+}
+
+# Segwit hrp, P2PKH and P2SH version bytes of the fallback addresses
+NETWORKS = {
+    'bc': ('bc', 0, 5),
+    'tb': ('tb', 111, 196),
+    'bcrt': ('bcrt', 111, 196),
+    'sb': ('sb', 63, 123),
+}
+
+TAG_PAYMENT_HASH = 1
+TAG_ROUTE_HINT = 3
+TAG_EXPIRY = 6
+TAG_FALLBACK = 9
+TAG_DESCRIPTION = 13
+TAG_PAYEE = 19
+TAG_DESCRIPTION_HASH = 23
+TAG_MIN_FINAL_CLTV_EXPIRY = 24
+
+# secp256k1 curve parameters
+SECP_P = 2**256 - 2**32 - 977
+SECP_N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+SECP_G = (
+    0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+    0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+
+def decode_invoice(context, request, int_scid=False):
+    """
+    Returns the DecodeInvoiceResponse of a DecodeInvoiceRequest, decoding its
+    payment request locally, or None if it can't be decoded or it isn't for
+    the network of the node (leaving the node to report the error).
+
+    Short channel IDs are given in BOLT 7 format (block x tx x output),
+    or as the integer encoding them if int_scid is set.
+    """
+    try:
+        invoice = decode(request.payment_request)
+    except ValueError as err:
+        LOGGER.debug('Cannot decode payment request locally: %s', err)
+        return None
+    if sett.NODE_NETWORK and \
+            CURRENCIES.get(sett.NODE_NETWORK) != invoice.currency:
+        LOGGER.debug('Payment request is not for %s', sett.NODE_NETWORK)
+        return None
+    if request.description and invoice.description_hash and \
+            sha256(request.description.encode()).hexdigest() != \
+            invoice.description_hash:
+        Err().incorrect_description(context)
+    response = pb.DecodeInvoiceResponse(
+        timestamp=invoice.timestamp,
+        payment_hash=invoice.payment_hash,
+        description=invoice.description,
+        destination_pubkey=invoice.payee,
+        description_hash=invoice.description_hash,
+        expiry_time=invoice.expiry,
+        min_final_cltv_expiry=invoice.min_final_cltv_expiry,
+        fallback_addr=invoice.fallback_addr)
+    if invoice.amount_msat is not None:
+        response.amount_bits = convert(
+            context, Enf.MSATS, invoice.amount_msat)
+    for route in invoice.route_hints:
+        grpc_route = response.route_hints.add()
+        for hop in route:
+            grpc_route.hop_hints.add(
+                pubkey=hop.pubkey,
+                short_channel_id=_format_scid(hop.short_channel_id, int_scid),
+                fee_base_msat=hop.fee_base_msat,
+                fee_proportional_millionths=hop.fee_proportional_millionths,
+                cltv_expiry_delta=hop.cltv_expiry_delta)
+    return response
+
+
+def has_amount_encoded(payment_request):
+    """
+    Checks if a bech32 payment request has an amount encoded, reading its
+    hrp only (a full decode recovers the payee public key, which is slow)
+    """
+    try:
+        hrp, _data = _bech32_decode(payment_request)
+        return _parse_hrp(hrp)[1] is not None
+    except ValueError:
+        # Let the node report the error
+        hrp = payment_request[:payment_request.rfind('1')]
+        return any(char.isdigit() for char in hrp)
+
+
+def get_timestamp(payment_request):
+    """
+    Returns the creation timestamp of a bech32 payment request, without
+    checking its signature. Raises ValueError if it can't be read.
+    """
+    _hrp, data = _bech32_decode(payment_request)
+    if len(data) < 7:
+        raise ValueError('too short')
+    return _to_int(data[:7])
+
+
+@lru_cache(maxsize=sett.DECODE_CACHE_SIZE)
+def decode(payment_request):
+    """
+    Decodes a BOLT 11 payment request, checking its signature, into an
+    Invoice. Raises ValueError if payment_request is invalid.
+    """
+    hrp, data = _bech32_decode(payment_request)
+    currency, amount_msat = _parse_hrp(hrp)
+    if len(data) < 7 + 104:
+        raise ValueError('too short')
+    fields = {
+        'currency': currency,
+        'amount_msat': amount_msat,
+        'timestamp': _to_int(data[:7]),
+        'payment_hash': '',
+        'description': '',
+        'description_hash': '',
+        'payee': '',
+        'expiry': DEFAULT_EXPIRY,
+        'min_final_cltv_expiry': DEFAULT_MIN_FINAL_CLTV_EXPIRY,
+        'fallback_addr': '',
+        'route_hints': [],
+    }
+    pos = 7
+    end = len(data) - 104
+    while pos < end:
+        if pos + 3 > end:
+            raise ValueError('truncated field')
+        tag = data[pos]
+        length = data[pos + 1] * 32 + data[pos + 2]
+        value = data[pos + 3:pos + 3 + length]
+        pos += 3 + length
+        if pos > end:
+            raise ValueError('truncated field')
+        _parse_field(fields, currency, tag, value)
+    if not fields['payment_hash']:
+        raise ValueError('missing payment hash')
+    signature = _convert_bits(data[end:], 5, 8)
+    message = hrp.encode() + bytes(_convert_bits(data[:end], 5, 8, pad=True))
+    pubkey = _recover_pubkey(sha256(message).digest(), signature)
+    if fields['payee'] and fields['payee'] != pubkey.hex():
+        raise ValueError('signature does not match payee')
+    fields['payee'] = pubkey.hex()
+    fields['route_hints'] = tuple(fields['route_hints'])
+    return Invoice(**fields)
+
+
+def _parse_field(fields, currency, tag, value):
+    """ Stores the value of a tagged field, skipping unknown ones """
+    # pylint: disable=too-many-branches
+    if tag == TAG_PAYMENT_HASH:
+        if len(value) == 52 and not fields['payment_hash']:
+            fields['payment_hash'] = _to_bytes(value).hex()
+    elif tag == TAG_DESCRIPTION:
+        if not fields['description']:
+            fields['description'] = _to_bytes(value).decode(
+                'utf-8', errors='replace')
+    elif tag == TAG_DESCRIPTION_HASH:
+        if len(value) == 52 and not fields['description_hash']:
+            fields['description_hash'] = _to_bytes(value).hex()
+    elif tag == TAG_PAYEE:
+        if len(value) == 53 and not fields['payee']:
+            fields['payee'] = _to_bytes(value).hex()
+    elif tag == TAG_EXPIRY:
+        fields['expiry'] = _to_int(value)
+    elif tag == TAG_MIN_FINAL_CLTV_EXPIRY:
+        fields['min_final_cltv_expiry'] = _to_int(value)
+    elif tag == TAG_FALLBACK:
+        if value and not fields['fallback_addr']:
+            fields['fallback_addr'] = _get_fallback_addr(
+                currency, value[0], _to_bytes(value[1:]))
+    elif tag == TAG_ROUTE_HINT:
+        fields['route_hints'].append(_get_route_hint(_to_bytes(value)))
+
+
+def _get_route_hint(data):
+    """ Returns the HopHints of a route hint field """
+    hops = []
+    for pos in range(0, len(data) - len(data) % 51, 51):
+        hop = data[pos:pos + 51]
+        hops.append(HopHint(
+            pubkey=hop[:33].hex(),
+            short_channel_id=int.from_bytes(hop[33:41], 'big'),
+            fee_base_msat=int.from_bytes(hop[41:45], 'big'),
+            fee_proportional_millionths=int.from_bytes(hop[45:49], 'big'),
+            cltv_expiry_delta=int.from_bytes(hop[49:51], 'big')))
+    return tuple(hops)
+
+
+def _format_scid(scid, int_scid):
+    """ Formats a short channel ID """
+    if int_scid:
+        return str(scid)
+    return '{}x{}x{}'.format(
+        scid >> 40, (scid >> 16) & 0xFFFFFF, scid & 0xFFFF)
+
+
+def _get_fallback_addr(currency, version, program):
+    """ Returns the on-chain address of a fallback field, if known """
+    if currency not in NETWORKS:
+        return ''
+    segwit_hrp, p2pkh, p2sh = NETWORKS[currency]
+    if version == 17:
+        return _base58check(bytes([p2pkh]) + program)
+    if version == 18:
+        return _base58check(bytes([p2sh]) + program)
+    if version <= 16:
+        const = BECH32_CONST if version == 0 else BECH32M_CONST
+        return _bech32_encode(
+            segwit_hrp, [version] + _convert_bits(program, 8, 5, pad=True),
+            const)
+    return ''
+
+
+def _parse_hrp(hrp):
+    """ Returns currency and amount (in msat, if any) of a BOLT 11 hrp """
+    match = fullmatch(r'ln([a-z]+?)(?:(\d+)([munp]?))?', hrp)
+    if not match:
+        raise ValueError('invalid hrp')
+    currency, amount, multiplier = match.groups()
+    if amount is None:
+        return currency, None
+    if multiplier == 'p':
+        if int(amount) % 10:
+            raise ValueError('invalid sub-msat amount')
+        return currency, int(amount) // 10
+    return currency, int(amount) * MULTIPLIERS[multiplier]
+
+
+def _bech32_polymod(values):
+    """ Computes the bech32 checksum """
+    chk = 1
+    for value in values:
+        chk = (chk & 0x1ffffff) << 5 ^ value ^ BECH32_GENERATORS[chk >> 25]
+    return chk
+
+
+def _bech32_hrp_expand(hrp):
+    """ Expands the hrp into values for checksum computation """
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+
+def _bech32_decode(bech):
+    """
+    Returns hrp and 5-bit data (without checksum) of a bech32 string, with
+    no length limit
+    """
+    if bech.lower() != bech and bech.upper() != bech:
+        raise ValueError('mixed case')
+    bech = bech.lower()
+    pos = bech.rfind('1')
+    if pos < 1 or pos + 7 > len(bech):
+        raise ValueError('invalid separator position')
+    hrp = bech[:pos]
+    try:
+        data = [BECH32_VALUES[char] for char in bech[pos + 1:]]
+    except KeyError as err:
+        raise ValueError('invalid character') from err
+    if _bech32_polymod(_bech32_hrp_expand(hrp) + data) != BECH32_CONST:
+        raise ValueError('invalid checksum')
+    return hrp, data[:-6]
+
+
+def _bech32_encode(hrp, data, const):
+    """ Encodes hrp and 5-bit data into a bech32 string """
+    values = _bech32_hrp_expand(hrp) + data
+    polymod = _bech32_polymod(values + [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+def _base58check(payload):
+    """ Encodes payload in base58check """
+    alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+    data = payload + sha256(sha256(payload).digest()).digest()[:4]
+    num = int.from_bytes(data, 'big')
+    encoded = ''
+    while num:
+        num, rem = divmod(num, 58)
+        encoded = alphabet[rem] + encoded
+    return '1' * (len(data) - len(data.lstrip(b'\0'))) + encoded
+
+
+def _convert_bits(data, from_bits, to_bits, pad=False):
+    """ Regroups a sequence of from_bits integers into to_bits integers """
+    acc = bits = 0
+    ret = []
+    maxv = (1 << to_bits) - 1
+    for value in data:
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            ret.append((acc >> bits) & maxv)
+    if pad and bits:
+        ret.append((acc << (to_bits - bits)) & maxv)
+    return ret
+
+
+def _to_bytes(data):
+    """ Converts 5-bit data into bytes, dropping the incomplete last byte """
+    return bytes(_convert_bits(data, 5, 8))
+
+
+def _to_int(data):
+    """ Converts 5-bit big endian data into an integer """
+    num = 0
+    for value in data:
+        num = num * 32 + value
+    return num
+
+
+# secp256k1 math keeps the usual short names of the curve formulas
+# pylint: disable=invalid-name,too-many-locals
+
+def _recover_pubkey(digest, signature):
+    """
+    Recovers the compressed public key that produced a BOLT 11 signature
+    (64 bytes r || s, followed by the recovery id) of digest
+    """
+    if len(signature) != 65 or signature[64] > 3:
+        raise ValueError('invalid signature')
+    r = int.from_bytes(bytes(signature[:32]), 'big')
+    s = int.from_bytes(bytes(signature[32:64]), 'big')
+    recid = signature[64]
+    if not 0 < r < SECP_N or not 0 < s < SECP_N:
+        raise ValueError('invalid signature')
+    x = r + SECP_N if recid & 2 else r
+    if x >= SECP_P:
+        raise ValueError('invalid signature')
+    y = pow((pow(x, 3, SECP_P) + 7) % SECP_P, (SECP_P + 1) // 4, SECP_P)
+    if (y * y - x ** 3 - 7) % SECP_P:
+        raise ValueError('invalid signature')
+    if y & 1 != recid & 1:
+        y = SECP_P - y
+    e = int.from_bytes(digest, 'big')
+    r_inv = pow(r, SECP_N - 2, SECP_N)
+    # Q = r^-1 (sR - eG)
+    point = _to_affine(_ec_mul_add(
+        (-e * r_inv) % SECP_N, SECP_G, (s * r_inv) % SECP_N, (x, y)))
+    if point is None:
+        raise ValueError('invalid signature')
+    return bytes([2 + (point[1] & 1)]) + point[0].to_bytes(32, 'big')
+
+
+def _ec_double(point):
+    """ Doubles a point in Jacobian coordinates """
+    x, y, z = point
+    if not y:
+        return (0, 0, 0)
+    ysq = y * y % SECP_P
+    s = 4 * x * ysq % SECP_P
+    m = 3 * x * x % SECP_P
+    nx = (m * m - 2 * s) % SECP_P
+    ny = (m * (s - nx) - 8 * ysq * ysq) % SECP_P
+    nz = 2 * y * z % SECP_P
+    return (nx, ny, nz)
+
+
+def _ec_add(point_a, point_b):
+    """ Adds two points in Jacobian coordinates """
+    if not point_a[2]:
+        return point_b
+    if not point_b[2]:
+        return point_a
+    x1, y1, z1 = point_a
+    x2, y2, z2 = point_b
+    z1sq = z1 * z1 % SECP_P
+    z2sq = z2 * z2 % SECP_P
+    u1 = x1 * z2sq % SECP_P
+    u2 = x2 * z1sq % SECP_P
+    s1 = y1 * z2sq * z2 % SECP_P
+    s2 = y2 * z1sq * z1 % SECP_P
+    if u1 == u2:
+        if s1 != s2:
+            return (0, 0, 0)
+        return _ec_double(point_a)
+    h = (u2 - u1) % SECP_P
+    r = (s2 - s1) % SECP_P
+    h2 = h * h % SECP_P
+    h3 = h * h2 % SECP_P
+    u1h2 = u1 * h2 % SECP_P
+    nx = (r * r - h3 - 2 * u1h2) % SECP_P
+    ny = (r * (u1h2 - nx) - s1 * h3) % SECP_P
+    nz = h * z1 * z2 % SECP_P
+    return (nx, ny, nz)
+
+
+def _ec_mul_add(k1, point1, k2, point2):
+    """
+    Computes k1 * point1 + k2 * point2 (affine points) at once, returning a
+    point in Jacobian coordinates
+    """
+    jac1 = (point1[0], point1[1], 1)
+    jac2 = (point2[0], point2[1], 1)
+    both = _ec_add(jac1, jac2)
+    result = (0, 0, 0)
+    for i in range(max(k1.bit_length(), k2.bit_length()) - 1, -1, -1):
+        result = _ec_double(result)
+        bit1 = (k1 >> i) & 1
+        bit2 = (k2 >> i) & 1
+        if bit1 and bit2:
+            result = _ec_add(result, both)
+        elif bit1:
+            result = _ec_add(result, jac1)
+        elif bit2:
+            result = _ec_add(result, jac2)
+    return result
+
+
+def _to_affine(point):
+    """ Converts a point from Jacobian to affine coordinates """
+    x, y, z = point
+    if not z:
+        return None
+    z_inv = pow(z, SECP_P - 2, SECP_P)
+    return (x * z_inv ** 2 % SECP_P, y * z_inv ** 3 % SECP_P)
+
+
+# pylint: enable=invalid-name,too-many-locals
@@ -0,0 +1,299 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The caching and request coalescing module for Lighter """
+
+from functools import wraps
+from inspect import iscoroutinefunction
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from . import settings as sett
+from .errors import Err
+from .utils import FakeContext, get_node_timeout, set_log_note
+
+LOGGER = getLogger(__name__)
+
+
+def get_nodes_cache(load, lookup):
+    """
+    Returns the NodesCache, creating it with load and lookup if necessary
+    """
+    if not sett.NODES_CACHE:
+        sett.NODES_CACHE = NodesCache(load, lookup, sett.NODES_REFRESH_TIME)
+    return sett.NODES_CACHE
+
+
+class ResponseCache():
+    """
+    Caches the responses of read-only Lightning methods, for the number of
+    seconds set for each method in ttls, keyed on the request.
+
+    Once expired, a response is still served for stale_time seconds while it
+    is being refreshed in background, unless its method is in no_stale.
+    Calls to write methods drop all responses, as they can change the node
+    state, and are notified to the functions in listeners.
+    """
+
+    def __init__(self, ttls, stale_time, listeners=(), no_stale=()):
+        self.ttls = ttls
+        self.stale_time = stale_time
+        self.no_stale = set(no_stale)
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.listeners = list(listeners)
+        self._entries = {}
+        self._refreshing = set()
+        self._generation = 0
+        self._lock = Lock()
+
+    def cached(self, name, func):
+        """ Returns func, serving its responses from cache if it has a TTL """
+        ttl = self.ttls.get(name)
+        if not ttl or iscoroutinefunction(func):
+            return func
+        stale_time = 0 if name in self.no_stale else self.stale_time
+
+        @wraps(func)
+        def wrapper(request, context):
+            key = (name, request.SerializeToString())
+            refresh = False
+            with self._lock:
+                generation = self._generation
+                entry = self._entries.get(key)
+                if entry and monotonic() < entry[1]:
+                    self.hits += 1
+                    set_log_note('cached')
+                    return entry[0]
+                if entry and monotonic() < entry[1] + stale_time:
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        refresh = True
+                else:
+                    entry = None
+                    self.misses += 1
+            if entry:
+                if refresh:
+                    thread = Thread(
+                        target=self._refresh,
+                        args=(key, func, request, ttl, generation))
+                    thread.daemon = True
+                    thread.start()
+                set_log_note('cached, stale')
+                return entry[0]
+            response = func(request, context)
+            self._store(key, response, ttl, generation)
+            return response
+
+        return wrapper
+
+    def invalidating(self, func):
+        """ Returns func, dropping all cached responses once it's called """
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(request, context):
+                try:
+                    return await func(request, context)
+                finally:
+                    self.invalidate()
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(request, context):
+            try:
+                return func(request, context)
+            finally:
+                self.invalidate()
+
+        return wrapper
+
+    def invalidate(self):
+        """
+        Drops all cached responses, including the ones being refreshed, that
+        could have been read before the change
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+        for listener in self.listeners:
+            listener()
+
+    def clear(self):
+        """ Drops all cached responses and resets counters """
+        self.invalidate()
+        with self._lock:
+            self.hits = 0
+            self.stale_hits = 0
+            self.misses = 0
+
+    def _store(self, key, response, ttl, generation):
+        """ Caches response, unless cache has been invalidated meanwhile """
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (response, monotonic() + ttl)
+
+    def _refresh(self, key, func, request, ttl, generation):
+        """ Calls func to replace a stale response """
+        try:
+            self._store(key, func(request, FakeContext()), ttl, generation)
+        except RuntimeError as err:
+            LOGGER.debug('Refreshing %s failed: %s', key[0], err)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class SingleFlight():
+    """
+    Collapses concurrent identical calls of read-only Lightning methods
+    (same method and request) into a single node call, whose response is
+    shared with all callers.
+
+    Callers joining a call in flight wait for it within their own deadline;
+    if the call fails (e.g. because the deadline of its caller was shorter),
+    they call the node on their own.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = Lock()
+
+    def coalesced(self, name, func):
+        """ Returns func, sharing the responses of concurrent calls """
+        if iscoroutinefunction(func):
+            return func
+
+        @wraps(func)
+        def wrapper(request, context):
+            key = (name, request.SerializeToString())
+            while True:
+                with self._lock:
+                    flight = self._flights.get(key)
+                    if not flight:
+                        flight = self._flights[key] = _Flight()
+                        self.calls += 1
+                        break
+                if not flight.done.wait(get_node_timeout(context)):
+                    Err().node_error(context, 'Timeout')
+                if flight.response is not None:
+                    with self._lock:
+                        self.shared += 1
+                    set_log_note('shared')
+                    return flight.response
+            try:
+                flight.response = func(request, context)
+                return flight.response
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        return wrapper
+
+
+class _Flight():  # pylint: disable=too-few-public-methods
+    """ A call in flight, done is set once it has ended """
+
+    def __init__(self):
+        self.done = Event()
+        self.response = None
+
+
+class NodesCache():
+    """
+    Keeps alias and color of the nodes in the network graph, loaded in bulk
+    with load(context), which returns a dict mapping node pubkeys to (alias,
+    color) tuples, or None if the graph can't be read.
+
+    The graph is loaded in background only, never while serving a call:
+    first when Lighter is unlocked (see start), then when older than
+    refresh_time seconds or, if it could not be read, NODES_RETRY_TIME
+    seconds after the last attempt.
+
+    Nodes missing from the loaded copy (newly connected peers, or all of
+    them before the first load completes) are looked up one at a time with
+    lookup(context, pubkey), which returns an (alias, color) tuple, or None
+    if the node is unknown, within the deadline of the call.
+    """
+
+    def __init__(self, load, lookup, refresh_time):
+        self.refresh_time = refresh_time
+        self._load = load
+        self._lookup = lookup
+        self._nodes = {}
+        self._attempted_at = None
+        self._failed = False
+        self._loading = False
+        self._lock = Lock()
+
+    def start(self):
+        """ Loads the graph in background, unless it is being loaded """
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+            self._attempted_at = monotonic()
+        thread = Thread(target=self._refresh)
+        thread.daemon = True
+        thread.start()
+
+    def get_nodes(self, context, pubkeys):
+        """
+        Returns a dict of the nodes with pubkeys, looking up the ones missing
+        from the graph (an unknown node is left out)
+        """
+        with self._lock:
+            nodes = self._nodes
+            reload = not self._loading and (
+                self._attempted_at is None or
+                monotonic() - self._attempted_at >= (
+                    sett.NODES_RETRY_TIME if self._failed
+                    else self.refresh_time))
+        if reload:
+            self.start()
+        found = {}
+        for pubkey in pubkeys:
+            if pubkey not in nodes:
+                try:
+                    node = self._lookup(context, pubkey)
+                except Exception as err:  # pylint: disable=broad-except
+                    # don't keep the call waiting for the other nodes
+                    LOGGER.debug('Looking up node failed: %s', err)
+                    break
+                # unknown nodes are not looked up again until reloaded
+                with self._lock:
+                    nodes[pubkey] = node or ('', '')
+            if nodes[pubkey] != ('', ''):
+                found[pubkey] = nodes[pubkey]
+        return found
+
+    def _refresh(self):
+        """ Loads the graph, replacing the known nodes if it can be read """
+        nodes = None
+        try:
+            nodes = self._load(FakeContext())
+        except RuntimeError as err:
+            LOGGER.debug('Loading nodes failed: %s', err)
+        with self._lock:
+            self._loading = False
+            self._failed = nodes is None
+            if nodes is not None:
+                self._nodes = nodes
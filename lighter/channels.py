@@ -0,0 +1,202 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The channels mirror module for Lighter """
+
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .utils import FakeContext, get_channel_balances
+
+LOGGER = getLogger(__name__)
+
+
+def get_channels_mirror(load, watch=None):
+    """
+    Returns the ChannelsMirror, creating it with the given implementation
+    functions if necessary
+    """
+    if not sett.CHANNELS_MIRROR:
+        sett.CHANNELS_MIRROR = ChannelsMirror(load, watch)
+    return sett.CHANNELS_MIRROR
+
+
+def close_channels_mirror():
+    """ Stops the ChannelsMirror, if any """
+    if sett.CHANNELS_MIRROR:
+        sett.CHANNELS_MIRROR.close()
+    sett.CHANNELS_MIRROR = None
+
+
+def invalidate_channels_mirror():
+    """ Marks the channels of the ChannelsMirror, if any, as outdated """
+    if sett.CHANNELS_MIRROR:
+        sett.CHANNELS_MIRROR.invalidate()
+
+
+class ChannelsMirror():
+    """
+    Keeps in memory the channels of the node, serving ListChannels and
+    ChannelBalance responses without calling the node.
+
+    The implementation provides two functions:
+    - load(context) returns all the channels of the node, as pb.Channel
+    - watch() (optional) yields whenever a channel changes
+
+    Channels are polled every CHANNELS_POLL_TIME seconds, while they are
+    being read, and the new ones are diffed with the mirrored ones; responses
+    and balances are rebuilt only when something changed. Changes signaled by
+    watch and calls to write methods make the next read wait for a new poll.
+    If polling fails for CHANNELS_MAX_AGE seconds, reads call the node,
+    returning its errors.
+    """
+
+    def __init__(self, load, watch=None):
+        self.polls = 0
+        self.changes = 0
+        self._load = load
+        self._watch = watch
+        self._lock = Lock()
+        self._load_lock = Lock()
+        self._stop = Event()
+        self._wake = Event()
+        self._channels = {}
+        self._responses = None
+        self._loaded_at = None
+        self._dirty = False
+        self._last_read = 0
+        self._poller = None
+        self._watcher = None
+
+    def list_channels(self, context, active_only=False):
+        """ Returns a ListChannelsResponse, filtered if active_only is set """
+        responses = self._read(context)
+        return responses[1] if active_only else responses[0]
+
+    def channel_balance(self, context):
+        """ Returns a ChannelBalanceResponse, aggregated on last change """
+        return self._read(context)[2]
+
+    def invalidate(self):
+        """ Makes the next read wait for the node channels to be polled """
+        with self._lock:
+            self._dirty = True
+        self._wake.set()
+
+    def close(self):
+        """ Stops polling and watching the node channels """
+        self._stop.set()
+        self._wake.set()
+
+    def _read(self, context):
+        """ Returns the mirrored responses, polling the node if outdated """
+        called = monotonic()
+        with self._lock:
+            self._last_read = called
+            self._start()
+            responses = self._responses
+            if responses and not self._dirty and \
+                    called - self._loaded_at < sett.CHANNELS_MAX_AGE:
+                return responses
+        return self._poll(context, called)
+
+    def _poll(self, context, called):
+        """
+        Loads the node channels, unless they have been loaded (cleanly) after
+        called, and updates the mirror with them
+        """
+        with self._load_lock:
+            with self._lock:
+                if self._responses and not self._dirty and \
+                        self._loaded_at >= called:
+                    return self._responses
+                self._dirty = False
+            started = monotonic()
+            try:
+                channels = self._load(context)
+            except BaseException:
+                with self._lock:
+                    self._dirty = True
+                raise
+            with self._lock:
+                self.polls += 1
+                self._update(context, channels)
+                self._loaded_at = started
+                return self._responses
+
+    def _update(self, context, channels):
+        """ Diffs channels with the mirrored ones, applying changes """
+        new = {}
+        for channel in channels:
+            new[(channel.channel_id, channel.funding_txid,
+                 channel.remote_pubkey)] = channel
+        changed = len(self._channels.keys() - new.keys())
+        changed += sum(
+            1 for key, channel in new.items()
+            if self._channels.get(key) != channel)
+        if not changed and self._responses:
+            return
+        LOGGER.debug('%s channels changed', changed)
+        self.changes += changed
+        self._channels = new
+        active = [chan for chan in new.values() if chan.active]
+        self._responses = (
+            pb.ListChannelsResponse(channels=list(new.values())),
+            pb.ListChannelsResponse(channels=active),
+            get_channel_balances(context, new.values()))
+
+    def _start(self):
+        """ Starts the polling and watching threads, if not running """
+        if self._stop.is_set():
+            return
+        if not self._poller or not self._poller.is_alive():
+            self._poller = Thread(target=self._run_poller)
+            self._poller.daemon = True
+            self._poller.start()
+        if self._watch and not self._watcher:
+            self._watcher = Thread(target=self._run_watcher)
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    def _run_poller(self):
+        """ Polls the node channels until they stop being read """
+        while not self._stop.is_set():
+            self._wake.wait(sett.CHANNELS_POLL_TIME)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            with self._lock:
+                if monotonic() - self._last_read > sett.CHANNELS_IDLE_TIME:
+                    self._poller = None
+                    return
+            try:
+                self._poll(FakeContext(), monotonic())
+            except RuntimeError as err:
+                LOGGER.debug('Polling channels failed: %s', err)
+
+    def _run_watcher(self):
+        """ Keeps watching node channels, restarting on errors """
+        while not self._stop.is_set():
+            try:
+                for _change in self._watch():
+                    if self._stop.is_set():
+                        return
+                    self.invalidate()
+            except Exception as err:  # pylint: disable=broad-except
+                LOGGER.debug('Watching channels failed: %s', err)
+            self._stop.wait(sett.SUBSCRIBE_RETRY)
@@ -15,6 +15,7 @@
 
 """ The errors module for Lighter """
 
+from functools import lru_cache
 from importlib import import_module
 from logging import getLogger
 from re import sub
@@ -22,6 +23,7 @@ from re import sub
 from grpc import StatusCode
 
 from lighter import settings
+from lighter.metrics import set_abort_code
 
 LOGGER = getLogger(__name__)
 
@@ -66,6 +68,10 @@ ERRORS = {
         'code': 'NOT_FOUND',
         'msg': 'Invoice not found'
     },
+    'job_not_found': {
+        'code': 'NOT_FOUND',
+        'msg': 'Job not found'
+    },
     'missing_parameter': {
         'code': 'INVALID_ARGUMENT',
         'msg': "Parameter '%PARAM%' is necessary"
@@ -90,10 +96,30 @@ ERRORS = {
         'code': 'CANCELLED',
         'msg': 'Invoice payment is pending'
     },
+    'payment_not_found': {
+        'code': 'NOT_FOUND',
+        'msg': 'Payment not found'
+    },
+    'profiling_disabled': {
+        'code': 'FAILED_PRECONDITION',
+        'msg': 'Profiling is disabled, set PROFILING to enable it'
+    },
+    'profiling_running': {
+        'code': 'FAILED_PRECONDITION',
+        'msg': 'A profiling of the same kind is already running'
+    },
     'route_not_found': {
         'code': 'NOT_FOUND',
         'msg': 'Can\'t find route to node'
     },
+    'too_many_jobs': {
+        'code': 'RESOURCE_EXHAUSTED',
+        'msg': 'Too many background jobs, retry later'
+    },
+    'too_many_streams': {
+        'code': 'RESOURCE_EXHAUSTED',
+        'msg': 'Too many open streams, retry later'
+    },
     'unimplemented_method': {
         'code': 'UNIMPLEMENTED',
         'msg': ("The gRPC method '%PARAM%' is not supported for this "
@@ -147,6 +173,7 @@ class Err():  # pylint: disable=too-few-public-methods
                     msg = param
                     LOGGER.error('Unexpected error: %s', msg)
                 LOGGER.error('> %s', msg)
+                set_abort_code(scode)
                 context.abort(scode, msg)
             else:
                 LOGGER.error('Unmapped error key')
@@ -157,9 +184,7 @@ class Err():  # pylint: disable=too-few-public-methods
         """
         Calls the proper function in dictionary or throws an unexpected_error
         """
-        module = import_module('lighter.light_{}'.format(
-            settings.IMPLEMENTATION))
-        for msg, act in module.ERRORS.items():
+        for msg, act in _get_impl_errors(settings.IMPLEMENTATION).items():
             if msg in error:
                 args = [context, act['params']] if 'params' in act \
                     else [context]
@@ -168,3 +193,10 @@ class Err():  # pylint: disable=too-few-public-methods
                 getattr(self, act['fun'])(*args)
         if always_abort:
             self.unexpected_error(context, str(error))
+
+
+@lru_cache(maxsize=None)
+def _get_impl_errors(implementation):
+    """ Returns the errors dictionary of the given implementation module """
+    module = import_module('lighter.light_{}'.format(implementation))
+    return module.ERRORS
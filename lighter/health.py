@@ -0,0 +1,243 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The node health module for Lighter """
+
+from functools import wraps
+from inspect import iscoroutinefunction
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+from grpc_health.v1.health import HealthServicer
+from grpc_health.v1.health_pb2 import HealthCheckResponse
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .errors import Err
+
+LOGGER = getLogger(__name__)
+
+CLOSED = pb.GetNodeHealthResponse.CLOSED
+OPEN = pb.GetNodeHealthResponse.OPEN
+HALF_OPEN = pb.GetNodeHealthResponse.HALF_OPEN
+
+HEALTH_METHODS = '/grpc.health.v1.Health/'
+SERVING = HealthCheckResponse.SERVING
+NOT_SERVING = HealthCheckResponse.NOT_SERVING
+
+
+def get_health_servicer(locked):
+    """
+    Returns a standard gRPC HealthServicer for the server being started,
+    reporting which Lighter services are available.
+
+    The overall ('') and lighter.Lightning statuses are SERVING only while
+    Lighter is unlocked and the node circuit is closed; they are updated by
+    NodeHealth, so health checks never call the node.
+    """
+    servicer = HealthServicer()
+    servicer.set('lighter.Unlocker', SERVING if locked else NOT_SERVING)
+    servicer.set('lighter.Locker', NOT_SERVING if locked else SERVING)
+    sett.HEALTH_SERVICER = servicer
+    circuit = sett.NODE_HEALTH.get_state().circuit if sett.NODE_HEALTH \
+        else CLOSED
+    update_serving_status(OPEN if locked else circuit)
+    return servicer
+
+
+def close_health_servicer():
+    """ Sets all services as NOT_SERVING, before the server is stopped """
+    if sett.HEALTH_SERVICER:
+        sett.HEALTH_SERVICER.enter_graceful_shutdown()
+    sett.HEALTH_SERVICER = None
+
+
+def update_serving_status(circuit):
+    """ Reports whether lighter.Lightning is serving, given circuit """
+    if not sett.HEALTH_SERVICER:
+        return
+    status = SERVING if circuit == CLOSED else NOT_SERVING
+    for service in ('', 'lighter.Lightning'):
+        sett.HEALTH_SERVICER.set(service, status)
+
+
+def close_node_health():
+    """ Stops probing the node, if a NodeHealth is running """
+    if sett.NODE_HEALTH:
+        sett.NODE_HEALTH.close()
+    sett.NODE_HEALTH = None
+
+
+def report_node_failure(error):
+    """ Reports that the node could not be reached """
+    if sett.NODE_HEALTH:
+        sett.NODE_HEALTH.failed(error)
+
+
+def report_node_success():
+    """ Reports that the node answered """
+    if sett.NODE_HEALTH:
+        sett.NODE_HEALTH.succeeded()
+
+
+def GetNodeHealth(request, context):  # pylint: disable=unused-argument
+    """ Returns the state of the connection to the node """
+    if not sett.NODE_HEALTH:
+        return pb.GetNodeHealthResponse()
+    return sett.NODE_HEALTH.get_state()
+
+
+class NodeHealth():
+    """
+    Circuit breaker guarding the calls to the node.
+
+    Implementations report whether the node could be reached. After
+    HEALTH_FAILURES consecutive failures the circuit opens: calls fail
+    immediately, instead of waiting for the node timeout. Every
+    HEALTH_PROBE_TIME seconds the circuit half-opens and probe is called
+    (calls still fail immediately); once the node answers, the circuit
+    closes. The node is also probed when it has not been reached for
+    HEALTH_PROBE_TIME seconds, to notice it is down before clients do.
+    Listeners are called with the new circuit state whenever it changes.
+    """
+
+    def __init__(self, probe, listeners=None):
+        self.trips = 0
+        self._probe = probe
+        self._listeners = listeners or []
+        self._lock = Lock()
+        self._stop = Event()
+        self._circuit = CLOSED
+        self._failures = 0
+        self._last_error = ''
+        self._since = int(time())
+        self._last_success = monotonic()
+        self._reports = 0
+        self._thread = None
+
+    def guarded(self, func):
+        """ Returns func, failing immediately unless the circuit is closed """
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(request, context):
+                self.check(context)
+                return await func(request, context)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(request, context):
+            self.check(context)
+            return func(request, context)
+
+        return wrapper
+
+    def check(self, context):
+        """ Terminates the call if the node is not reachable """
+        with self._lock:
+            if self._circuit == CLOSED:
+                return
+            error = self._last_error
+        Err().node_error(
+            context, 'Unreachable ({}), retrying in background'.format(error))
+
+    def failed(self, error):
+        """ Counts a failed attempt to reach the node """
+        with self._lock:
+            self._reports += 1
+            self._failures += 1
+            self._last_error = str(error)
+            if self._circuit == HALF_OPEN or (
+                    self._circuit == CLOSED and
+                    self._failures >= sett.HEALTH_FAILURES):
+                if self._circuit == CLOSED:
+                    self.trips += 1
+                    LOGGER.warning(
+                        'Node is unreachable (%s), calls to it will fail '
+                        'until it answers again', error)
+                self._set_circuit(OPEN)
+
+    def succeeded(self):
+        """ Resets failures, closing the circuit if it was open """
+        with self._lock:
+            self._reports += 1
+            self._failures = 0
+            self._last_success = monotonic()
+            if self._circuit != CLOSED:
+                LOGGER.warning('Node is reachable again')
+                self._set_circuit(CLOSED)
+
+    def get_state(self):
+        """ Returns the circuit state as a GetNodeHealthResponse """
+        with self._lock:
+            return pb.GetNodeHealthResponse(
+                circuit=self._circuit, failures=self._failures,
+                last_error=self._last_error, since=self._since,
+                trips=self.trips)
+
+    def start(self):
+        """ Starts the probing thread """
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Stops the probing thread """
+        self._stop.set()
+
+    def _set_circuit(self, circuit):
+        """ Changes the circuit state (lock must be held) """
+        if circuit != self._circuit:
+            LOGGER.debug(
+                'Node circuit %s -> %s',
+                pb.GetNodeHealthResponse.Circuit.Name(self._circuit),
+                pb.GetNodeHealthResponse.Circuit.Name(circuit))
+            self._circuit = circuit
+            self._since = int(time())
+            for listener in self._listeners:
+                listener(circuit)
+
+    def _run(self):
+        """ Probes the node while it is unreachable or idle """
+        while not self._stop.wait(sett.HEALTH_PROBE_TIME):
+            with self._lock:
+                if self._circuit == CLOSED and \
+                        monotonic() - self._last_success < \
+                        sett.HEALTH_PROBE_TIME:
+                    continue
+                if self._circuit == OPEN:
+                    self._set_circuit(HALF_OPEN)
+            self._probe_node()
+
+    def _probe_node(self):
+        """
+        Calls probe, counting its outcome unless the implementation already
+        reported it
+        """
+        with self._lock:
+            reports = self._reports
+        try:
+            self._probe()
+        except Exception as err:  # pylint: disable=broad-except
+            with self._lock:
+                reported = self._reports != reports
+            if not reported:
+                self.failed(str(err).strip() or err.__class__.__name__)
+            return
+        with self._lock:
+            reported = self._reports != reports
+        if not reported:
+            self.succeeded()
@@ -0,0 +1,425 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The invoices store module for Lighter """
+
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from time import monotonic, time
+
+from sqlalchemy import and_, create_engine, func, or_, select, \
+    Column, Index, Integer, LargeBinary, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .errors import Err
+from .utils import check_req_params, decode_cursor, encode_cursor
+
+LOGGER = getLogger(__name__)
+
+# max number of SQL variables in a query on old SQLite versions is 999
+QUERY_CHUNK = 500
+
+
+def get_invoices_store():
+    """ Returns the InvoicesStore, opening it if necessary """
+    if not sett.INVOICES_STORE:
+        db_path = Path(sett.DB_DIR).joinpath(sett.INVOICES_DB_NAME)
+        sett.INVOICES_STORE = InvoicesStore(
+            'sqlite:///{}'.format(db_path), sett.IMPLEMENTATION)
+    return sett.INVOICES_STORE
+
+
+def close_invoices_store():
+    """ Closes the InvoicesStore, if open """
+    if sett.INVOICES_STORE:
+        sett.INVOICES_STORE.close()
+    sett.INVOICES_STORE = None
+
+
+def list_invoices(request, context, sync):
+    """
+    Returns the ListInvoicesResponse of a ListInvoicesRequest from the
+    invoices store, syncing it first with sync(context, store)
+    """
+    if not request.max_items:
+        request.max_items = sett.MAX_INVOICES
+    after = _get_cursor_key(context, request)
+    store = get_invoices_store()
+    store.sync(context, sync)
+    invoices, next_key = store.query(request, after)
+    response = pb.ListInvoicesResponse(invoices=invoices)
+    if next_key:
+        response.next_cursor = encode_cursor(next_key)
+    return response
+
+
+def stream_invoices(request, context, sync):
+    """
+    Returns a generator of ListInvoicesResponse chunks of all the invoices
+    requested by a ListInvoicesRequest, syncing the invoices store first with
+    sync(context, store)
+    """
+    if not request.max_items:
+        request.max_items = sett.STREAM_ITEMS
+    request.list_order = request.search_order
+    after = _get_cursor_key(context, request)
+    store = get_invoices_store()
+    store.sync(context, sync)
+    return _stream_invoices(store, request, after)
+
+
+def _stream_invoices(store, request, after):
+    """ Yields the chunks of a StreamInvoices call, querying one at a time """
+    while True:
+        invoices, after = store.query(request, after)
+        response = pb.ListInvoicesResponse(invoices=invoices)
+        if after:
+            response.next_cursor = encode_cursor(after)
+        yield response
+        if not after:
+            return
+
+
+def _get_cursor_key(context, request):
+    """ Returns the (timestamp, payment_hash) key of request.cursor, if any """
+    if not request.cursor:
+        return None
+    key = decode_cursor(context, request.cursor)
+    if len(key) != 2 or not isinstance(key[0], int) or \
+            not isinstance(key[1], str):
+        Err().invalid(context, 'cursor')
+    return key
+
+
+def check_invoice(request, context, sync, lookup):
+    """
+    Returns the CheckInvoiceResponse of a CheckInvoiceRequest from the
+    invoices store.
+
+    Paid and expired invoices are final, so the node is asked only for
+    invoices it could still change, calling lookup(context, payment_hash)
+    (which returns their updated store row, or None), and for unknown ones,
+    syncing the store with sync(context, store). Open invoices are looked up
+    also past expiration, as they may have been paid just before expiring.
+    """
+    check_req_params(context, request, 'payment_hash')
+    store = get_invoices_store()
+    status = store.get_status(request.payment_hash)
+    if status is None:
+        store.sync(context, sync, force=True)
+    elif status == pb.PENDING:
+        row = lookup(context, request.payment_hash)
+        if row:
+            store.save([row])
+    invoice = store.get(request.payment_hash)
+    if invoice is None:
+        Err().invoice_not_found(context)
+    return pb.CheckInvoiceResponse(
+        state=invoice.state, settled=invoice.state == pb.PAID)
+
+
+def invoice_row(invoice, is_open, expires_at=None, node_index=0,
+                node_key=''):
+    """
+    Returns the store row of an Invoice message; is_open tells whether the
+    node could still change its state (not paid nor canceled yet).
+
+    The implementation can add its own index (node_index) and lookup key
+    (node_key) of the invoice.
+    """
+    if expires_at is None:
+        expires_at = invoice.timestamp + invoice.expiry_time
+    return {
+        'payment_hash': invoice.payment_hash,
+        'timestamp': invoice.timestamp,
+        'expires_at': expires_at,
+        'status': pb.PENDING if is_open else invoice.state,
+        'node_index': node_index,
+        'node_key': node_key,
+        'data': invoice.SerializeToString(),
+    }
+
+
+Base = declarative_base()
+
+
+class StoredInvoice(Base):  # pylint: disable=too-few-public-methods
+    """
+    Class that maps the table containing the invoices of the node.
+
+    status is PAID or EXPIRED for final invoices, PENDING for open ones,
+    which are expired once past expires_at.
+    """
+
+    __tablename__ = 'invoices'
+
+    payment_hash = Column(String, primary_key=True)
+    timestamp = Column(Integer, nullable=False)
+    expires_at = Column(Integer, nullable=False)
+    status = Column(Integer, nullable=False)
+    node_index = Column(Integer)
+    node_key = Column(String)
+    data = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        Index('ix_invoices_timestamp', 'timestamp', 'payment_hash'),
+        Index('ix_invoices_status', 'status', 'expires_at'),
+    )
+
+
+class SyncState(Base):  # pylint: disable=too-few-public-methods
+    """ Class that maps the table containing the sync cursors """
+
+    __tablename__ = 'sync_state'
+
+    name = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+
+class InvoicesStore():
+    """
+    Local SQLite mirror of the invoices of the node, indexed by payment
+    hash, creation time and state.
+
+    The implementation keeps it up to date with a sync(context, store)
+    function, which saves the invoices created or changed since the last
+    sync, keeping its own cursors in the store. Final invoices (paid or
+    expired) are never updated.
+
+    The mirror can always be rebuilt from the node: it is emptied when
+    Lighter is switched to another implementation.
+    """
+
+    def __init__(self, url, source):
+        self._engine = create_engine(
+            url, connect_args={'check_same_thread': False})
+        Base.metadata.create_all(self._engine)
+        self._invoices = StoredInvoice.__table__
+        self._state = SyncState.__table__
+        self._sync_lock = Lock()
+        self._write_lock = Lock()
+        self._synced = None
+        if self._get_state('source') != source:
+            self._reset(source)
+
+    def sync(self, context, sync, force=False):
+        """
+        Syncs the store calling sync(context, store), unless synced within
+        INVOICES_SYNC_TIME seconds (or, if forced, since called)
+        """
+        called = monotonic()
+        with self._sync_lock:
+            if self._synced is not None and (
+                    self._synced >= called or not force and
+                    called - self._synced < sett.INVOICES_SYNC_TIME):
+                return
+            started = monotonic()
+            sync(context, self)
+            self._synced = started
+
+    def save(self, rows, cursors=None):
+        """ Adds or updates invoice rows (see invoice_row) and cursors """
+        with self._write_lock, self._engine.begin() as conn:
+            final = set()
+            hashes = [row['payment_hash'] for row in rows]
+            for pos in range(0, len(hashes), QUERY_CHUNK):
+                query = select([self._invoices.c.payment_hash]).where(and_(
+                    self._invoices.c.payment_hash.in_(
+                        hashes[pos:pos + QUERY_CHUNK]),
+                    self._invoices.c.status != pb.PENDING))
+                final.update(res[0] for res in conn.execute(query))
+            rows = [row for row in rows if row['payment_hash'] not in final]
+            if rows:
+                conn.execute(
+                    self._invoices.insert().prefix_with('OR REPLACE'), rows)
+            for name, value in (cursors or {}).items():
+                conn.execute(
+                    self._state.insert().prefix_with('OR REPLACE'),
+                    name=name, value=str(value))
+
+    def set_paid(self, amounts):
+        """
+        Marks as paid the stored invoices of amounts, a {payment_hash:
+        amount_received_bits} dict, returning the payment hashes found
+        """
+        table = self._invoices
+        found = set()
+        hashes = list(amounts)
+        with self._write_lock, self._engine.begin() as conn:
+            for pos in range(0, len(hashes), QUERY_CHUNK):
+                query = select([
+                    table.c.payment_hash, table.c.status, table.c.data]).where(
+                        table.c.payment_hash.in_(
+                            hashes[pos:pos + QUERY_CHUNK]))
+                for payment_hash, status, data in conn.execute(query):
+                    found.add(payment_hash)
+                    if status != pb.PENDING:
+                        continue
+                    invoice = pb.Invoice.FromString(data)
+                    invoice.state = pb.PAID
+                    invoice.amount_received_bits = amounts[payment_hash]
+                    conn.execute(table.update().where(
+                        table.c.payment_hash == payment_hash).values(
+                            status=pb.PAID,
+                            data=invoice.SerializeToString()))
+        return found
+
+    def cursor(self, name):
+        """ Returns the value of a sync cursor (0 if unset) """
+        return int(self._get_state(name) or 0)
+
+    def get(self, payment_hash):
+        """ Returns the Invoice with payment_hash, None if unknown """
+        query = select([
+            self._invoices.c.data, self._invoices.c.status,
+            self._invoices.c.expires_at]).where(
+                self._invoices.c.payment_hash == payment_hash)
+        with self._engine.connect() as conn:
+            res = conn.execute(query).first()
+        if res is None:
+            return None
+        return self._get_invoice(res, int(time()))
+
+    def get_status(self, payment_hash):
+        """
+        Returns the stored status of an invoice (PENDING while the node could
+        still change it, also past expiration), None if unknown
+        """
+        query = select([self._invoices.c.status]).where(
+            self._invoices.c.payment_hash == payment_hash)
+        with self._engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def get_node_key(self, payment_hash):
+        """ Returns the node key of an invoice, None if unknown """
+        query = select([self._invoices.c.node_key]).where(
+            self._invoices.c.payment_hash == payment_hash)
+        with self._engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def get_oldest_open_index(self):
+        """
+        Returns the lowest node index of the invoices that could still
+        change, None if there are none. Expired ones are included for
+        INVOICES_OPEN_GRACE seconds, as they may have been paid just before
+        expiring: nodes that never cancel them would otherwise keep the sync
+        from moving past them.
+        """
+        query = select([func.min(self._invoices.c.node_index)]).where(and_(
+            self._invoices.c.status == pb.PENDING,
+            self._invoices.c.expires_at >=
+            int(time()) - sett.INVOICES_OPEN_GRACE))
+        with self._engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def query(self, request, after=None):
+        """
+        Returns the Invoices requested by a ListInvoicesRequest, seeking the
+        creation time index from search_timestamp or, if given, from the
+        (timestamp, payment_hash) key after, with the key to continue from if
+        more invoices follow (None otherwise)
+        """
+        now = int(time())
+        table = self._invoices
+        status = table.c.status
+        if request.paid or request.expired:
+            # final invoices grow unbounded: keep SQLite from sorting all the
+            # invoices found on the status index, to seek the creation time
+            # index instead
+            status = status + 0
+        states = []
+        if request.paid:
+            states.append(status == pb.PAID)
+        if request.pending:
+            states.append(and_(
+                status == pb.PENDING, table.c.expires_at >= now))
+        if request.expired:
+            states.append(or_(status == pb.EXPIRED, and_(
+                status == pb.PENDING, table.c.expires_at < now)))
+        if not states:
+            return [], None
+        query = select([table.c.data, table.c.status, table.c.expires_at])
+        query = self._seek(query.where(or_(*states)), request, after)
+        # one more invoice tells whether others follow
+        query = query.limit(request.max_items + 1)
+        with self._engine.connect() as conn:
+            invoices = [
+                self._get_invoice(res, now) for res in conn.execute(query)]
+        next_key = None
+        if len(invoices) > request.max_items:
+            invoices = invoices[:request.max_items]
+            next_key = (invoices[-1].timestamp, invoices[-1].payment_hash)
+        if request.list_order != request.search_order:
+            invoices.reverse()
+        return invoices, next_key
+
+    def _seek(self, query, request, after):
+        """
+        Returns query seeking the creation time index in search_order, from
+        search_timestamp or from the (timestamp, payment_hash) key after
+        """
+        table = self._invoices
+        if request.search_order == pb.DESCENDING:
+            if after:
+                query = query.where(and_(
+                    table.c.timestamp <= after[0],
+                    or_(table.c.timestamp < after[0],
+                        table.c.payment_hash < after[1])))
+            elif request.search_timestamp:
+                query = query.where(
+                    table.c.timestamp < request.search_timestamp)
+            return query.order_by(
+                table.c.timestamp.desc(), table.c.payment_hash.desc())
+        if after:
+            query = query.where(and_(
+                table.c.timestamp >= after[0],
+                or_(table.c.timestamp > after[0],
+                    table.c.payment_hash > after[1])))
+        elif request.search_timestamp:
+            query = query.where(table.c.timestamp > request.search_timestamp)
+        return query.order_by(table.c.timestamp, table.c.payment_hash)
+
+    @staticmethod
+    def _get_invoice(res, now):
+        """ Returns the Invoice of a (data, status, expires_at) row """
+        invoice = pb.Invoice()
+        invoice.ParseFromString(res[0])
+        invoice.state = res[1]
+        if res[1] == pb.PENDING and res[2] < now:
+            invoice.state = pb.EXPIRED
+        return invoice
+
+    def _get_state(self, name):
+        """ Returns a value of the sync state, None if unset """
+        query = select([self._state.c.value]).where(
+            self._state.c.name == name)
+        with self._engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def _reset(self, source):
+        """ Empties the store, to be synced from scratch with source """
+        LOGGER.info('Creating invoices store for %s', source)
+        with self._write_lock, self._engine.begin() as conn:
+            conn.execute(self._invoices.delete())
+            conn.execute(self._state.delete())
+            conn.execute(
+                self._state.insert(), name='source', value=str(source))
+
+    def close(self):
+        """ Closes all connections to the store """
+        self._engine.dispose()
@@ -0,0 +1,155 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The background jobs module for Lighter """
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import getLogger
+from threading import Event, Lock
+from uuid import uuid4
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .errors import Err
+from .utils import check_req_params
+
+LOGGER = getLogger(__name__)
+
+
+def get_jobs():
+    """ Returns the process-wide JobRegistry, creating it if necessary """
+    if not sett.JOBS:
+        sett.JOBS = JobRegistry()
+    return sett.JOBS
+
+
+def get_close_status(request, context):
+    """ Returns the GetCloseStatusResponse of a close job """
+    check_req_params(context, request, 'job_id')
+    future = get_jobs().get(request.job_id)
+    if future is None:
+        Err().job_not_found(context)
+    response = pb.GetCloseStatusResponse(completed=future.done())
+    if not response.completed:
+        return response
+    error = future.exception()
+    if error:
+        response.failure = str(error)
+    elif future.result():
+        response.closing_txid = future.result()
+    return response
+
+
+class JobRegistry():
+    """
+    Runs long node operations in background, shared by the whole process.
+
+    Each kind of job (closing channels, making payments) has a bounded pool
+    of JOB_WORKERS[kind] threads of its own, so that one kind can't starve
+    the other; when JOB_QUEUE jobs of a kind are already waiting for a
+    thread, new ones are rejected.
+
+    Jobs can be given an ID, to look up their outcome after the call that
+    started them has returned; the last JOBS_KEPT of them are kept.
+    """
+
+    def __init__(self):
+        self._executors = {
+            kind: ThreadPoolExecutor(max_workers=workers)
+            for kind, workers in sett.JOB_WORKERS.items()}
+        self._jobs = OrderedDict()
+        self._running = {kind: 0 for kind in sett.JOB_WORKERS}
+        self._idle = Event()
+        self._idle.set()
+        self._lock = Lock()
+
+    def run(self, context, kind, func, *args):
+        """
+        Runs func(*args) in background as a job of kind, returning its
+        future, or aborts the call if too many jobs of kind are waiting
+        """
+        with self._lock:
+            if self._running[kind] >= \
+                    sett.JOB_WORKERS[kind] + sett.JOB_QUEUE:
+                full = True
+            else:
+                full = False
+                self._running[kind] += 1
+                self._idle.clear()
+        if full:
+            Err().too_many_jobs(context)
+        done = partial(self._job_done, kind)
+        try:
+            future = self._executors[kind].submit(func, *args)
+        except RuntimeError:
+            done(None)
+            raise
+        future.add_done_callback(done)
+        return future
+
+    def submit(self, context, kind, func, *args):
+        """
+        Runs func(*args) in background as a job of kind, returning the job
+        ID and its future
+        """
+        job_id = uuid4().hex
+        future = self.run(context, kind, func, *args)
+        with self._lock:
+            self._jobs[job_id] = future
+            while len(self._jobs) > sett.JOBS_KEPT:
+                self._jobs.popitem(last=False)
+        return job_id, future
+
+    def get(self, job_id):
+        """ Returns the future of a job, None if unknown """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_load(self):
+        """
+        Returns the number of running jobs and of the queued ones, by kind
+        """
+        with self._lock:
+            return {
+                kind: (min(running, sett.JOB_WORKERS[kind]),
+                       max(running - sett.JOB_WORKERS[kind], 0))
+                for kind, running in self._running.items()}
+
+    def drain(self, timeout):
+        """
+        Waits up to timeout seconds for running jobs to complete, returning
+        whether none is left
+        """
+        if not self._idle.is_set():
+            LOGGER.error('Waiting for %s background jobs to complete...',
+                         self._count())
+        if not self._idle.wait(timeout):
+            LOGGER.error('%s background jobs still running', self._count())
+            return False
+        return True
+
+    def _count(self):
+        """ Returns the number of jobs running or queued """
+        with self._lock:
+            return sum(self._running.values())
+
+    def _job_done(self, kind, _future):
+        """ Keeps count of running jobs """
+        with self._lock:
+            self._running[kind] -= 1
+            if not any(self._running.values()):
+                self._idle.set()
@@ -16,18 +16,37 @@
 """ Implementation of lighter.proto defined methods for c-lightning """
 
 from ast import literal_eval
-from concurrent.futures import TimeoutError as TimeoutFutError, \
-    ThreadPoolExecutor
+from asyncio import IncompleteReadError, LimitOverrunError, \
+    open_unix_connection, TimeoutError as AsyncTimeoutError, wait_for
+from concurrent.futures import TimeoutError as TimeoutFutError
+from contextlib import suppress
 from datetime import datetime
+from functools import partial
+from itertools import count
+from json import dumps, JSONDecodeError, loads
 from logging import getLogger
 from os import environ, path
+from queue import Empty, LifoQueue
+from socket import AF_UNIX, socket, SOCK_STREAM, timeout as SocketTimeout
+from threading import BoundedSemaphore
+from time import time
 
 from . import lighter_pb2 as pb
 from . import settings
-from .utils import check_req_params, command, convert, Enforcer as Enf, \
-    FakeContext, get_channel_balances, get_thread_timeout, get_node_timeout, \
-    handle_thread, has_amount_encoded
+from .bolt11 import decode_invoice, get_timestamp, has_amount_encoded
+from .cache import get_nodes_cache
+from .channels import get_channels_mirror
+from .health import report_node_failure, report_node_success
+from .metrics import timed_node_call
+from .utils import async_command as async_cli_command, check_req_params, \
+    command as cli_command, convert, Enforcer as Enf, FakeContext, \
+    get_thread_timeout, get_node_timeout, paginate, str2bool
 from .errors import Err
+from .invoices import check_invoice, get_invoices_store, invoice_row, \
+    list_invoices, stream_invoices
+from .jobs import get_close_status, get_jobs
+from .payments import get_payment, pay_in_background, track_payment
+from .streams import get_invoices_hub
 
 LOGGER = getLogger(__name__)
 
@@ -96,6 +115,11 @@ ERRORS = {
     }
 }
 
+# APIs with a coroutine variant, used in asyncio server mode (GRPC_ASYNC)
+ASYNC_APIS = {
+    'PayInvoice': '_pay_invoice_async'
+}
+
 
 def update_settings(_dummy):
     """
@@ -104,16 +128,273 @@ def update_settings(_dummy):
     KeyError exception raised by missing dictionary keys in environ
     are left unhandled on purpose and later catched by lighter.start()
     """
-    cl_cli_dir = environ['CL_CLI_DIR']
-    cl_cli = environ['CL_CLI']
-    cl_cli_path = path.join(cl_cli_dir, cl_cli)
     cl_rpc_dir = environ['CL_RPC_DIR']
     cl_rpc = environ['CL_RPC']
-    cl_options = [
-        '--lightning-dir={}'.format(cl_rpc_dir),
-        '--rpc-file={}'.format(cl_rpc), '-k'
-    ]
-    settings.CMD_BASE = [cl_cli_path] + cl_options
+    settings.CL_USE_CLI = str2bool(
+        environ.get('CL_USE_CLI', settings.CL_USE_CLI))
+    disconnect()
+    if settings.CL_USE_CLI:
+        cl_cli_dir = environ['CL_CLI_DIR']
+        cl_cli = environ['CL_CLI']
+        cl_cli_path = path.join(cl_cli_dir, cl_cli)
+        cl_options = [
+            '--lightning-dir={}'.format(cl_rpc_dir),
+            '--rpc-file={}'.format(cl_rpc), '-k'
+        ]
+        settings.CMD_BASE = [cl_cli_path] + cl_options
+    else:
+        settings.CL_POOL = RpcPool(
+            path.join(cl_rpc_dir, cl_rpc), settings.CL_POOL_SIZE)
+
+
+def on_connect():
+    """
+    Loads the network nodes in background and syncs the invoices store once
+    c-lightning is reachable
+    """
+    get_nodes_cache(_load_nodes, _lookup_node).start()
+    try:
+        get_invoices_store().sync(FakeContext(), _sync_invoices)
+    except RuntimeError as err:
+        LOGGER.error('Syncing invoices failed: %s', str(err).strip())
+
+
+def disconnect():
+    """ Closes all connections to the c-lightning JSON-RPC socket """
+    if settings.CL_POOL:
+        settings.CL_POOL.close()
+    settings.CL_POOL = None
+
+
+def command(context, *args_cmd, **kwargs):
+    """
+    Calls c-lightning, through its JSON-RPC socket or, if configured, through
+    lightning-cli.
+
+    Arguments are given in lightning-cli format (method followed by
+    key=value parameters) and the result or error object is returned, just
+    like lightning-cli prints it. Long calls can be made on a dedicated
+    socket connection (pooled=False), not to hold a pooled one.
+    """
+    if settings.CL_USE_CLI:
+        return cli_command(context, *args_cmd, **kwargs)
+    if not settings.CL_POOL:
+        raise RuntimeError
+    method = args_cmd[0]
+    params = _get_params(args_cmd[1:])
+    wait_time = kwargs.get('timeout', get_node_timeout(context))
+    call = settings.CL_POOL.call
+    if not kwargs.get('pooled', True):
+        call = settings.CL_POOL.call_dedicated
+    try:
+        with timed_node_call(method):
+            cl_res = call(method, params, wait_time)
+    except SocketTimeout:
+        # a call exceeding the client deadline doesn't tell if the node is up
+        Err().node_error(context, 'Timeout')
+    except OSError as err:
+        error = 'Connecting to \'{}\': {}'.format(
+            settings.CL_POOL.socket_path, err.strerror or err)
+        report_node_failure(error)
+        Err().node_error(context, error)
+    report_node_success()
+    return _get_result(cl_res)
+
+
+async def async_command(context, *args_cmd, **kwargs):
+    """ Calls c-lightning as command does, without blocking the event loop """
+    if settings.CL_USE_CLI:
+        return await async_cli_command(context, *args_cmd, **kwargs)
+    if not settings.CL_POOL:
+        raise RuntimeError
+    method = args_cmd[0]
+    params = _get_params(args_cmd[1:])
+    wait_time = kwargs.get('timeout', get_node_timeout(context))
+    try:
+        with timed_node_call(method):
+            cl_res = await wait_for(
+                settings.CL_POOL.async_call(method, params), wait_time)
+    except AsyncTimeoutError:
+        # a call exceeding the client deadline doesn't tell if the node is up
+        Err().node_error(context, 'Timeout')
+    except (OSError, IncompleteReadError, LimitOverrunError) as err:
+        error = 'Connecting to \'{}\': {}'.format(
+            settings.CL_POOL.socket_path, getattr(err, 'strerror', None) or
+            err)
+        report_node_failure(error)
+        Err().node_error(context, error)
+    report_node_success()
+    return _get_result(cl_res)
+
+
+def _get_result(cl_res):
+    """ Returns the result or error object of a JSON-RPC response """
+    if 'error' in cl_res:
+        return cl_res['error']
+    cl_res = cl_res.get('result')
+    if cl_res is None or cl_res == "":
+        LOGGER.debug('Empty result from command')
+    return cl_res
+
+
+def _get_params(args):
+    """
+    Builds JSON-RPC named parameters from key=value arguments, parsing values
+    as lightning-cli does (numbers, booleans, null, arrays, objects and quoted
+    strings are JSON literals, anything else is a plain string)
+    """
+    params = {}
+    for arg in args:
+        key, value = arg.split('=', 1)
+        if value.isdigit() or value in ('true', 'false', 'null') or \
+                value[:1] in ('[', '{', '"'):
+            try:
+                value = loads(value)
+            except JSONDecodeError:
+                if len(value) > 1 and value[0] == value[-1] == '"':
+                    value = value[1:-1]
+        params[key] = value
+    return params
+
+
+class RpcPool():
+    """
+    Pool of persistent connections to the c-lightning JSON-RPC socket.
+
+    Each call checks out an idle connection (opening a new one when none is
+    available, up to size connections) and tags its request with a
+    process-wide unique id, so that responses are matched to requests.
+    """
+
+    def __init__(self, socket_path, size):
+        self.socket_path = socket_path
+        self._idle = LifoQueue()
+        self._slots = BoundedSemaphore(size)
+        self._ids = count(1)
+
+    def call(self, method, params, timeout):
+        """
+        Sends a JSON-RPC request and returns the response object, raising
+        socket.timeout if it can't be completed within timeout seconds
+        """
+        deadline = time() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise SocketTimeout('No connection available')
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                conn = _RpcConnection(self.socket_path, timeout)
+            try:
+                response = conn.call(next(self._ids), method, params, deadline)
+            except BaseException:
+                conn.close()
+                raise
+            self._idle.put(conn)
+            return response
+        finally:
+            self._slots.release()
+
+    def call_dedicated(self, method, params, timeout):
+        """ Sends a JSON-RPC request as call does, on a new connection """
+        deadline = time() + timeout
+        conn = _RpcConnection(self.socket_path, timeout)
+        try:
+            return conn.call(next(self._ids), method, params, deadline)
+        finally:
+            conn.close()
+
+    async def async_call(self, method, params):
+        """
+        Sends a JSON-RPC request on a new asyncio connection and returns the
+        response object (timeout is left to the caller)
+        """
+        request = {
+            'jsonrpc': '2.0', 'id': next(self._ids), 'method': method,
+            'params': params}
+        reader, writer = await open_unix_connection(
+            self.socket_path, limit=settings.CL_READ_LIMIT)
+        try:
+            writer.write(dumps(request).encode('utf-8'))
+            await writer.drain()
+            while True:
+                message = await reader.readuntil(b'\n\n')
+                if not message.strip():
+                    continue
+                response = loads(message.decode('utf-8'))
+                # skipping notifications
+                if isinstance(response, dict) and \
+                        response.get('id') == request['id']:
+                    return response
+        finally:
+            writer.close()
+
+    def close(self):
+        """ Closes all idle connections """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+
+class _RpcConnection():
+    """ A connection to the c-lightning JSON-RPC socket """
+
+    def __init__(self, socket_path, timeout):
+        self._sock = socket(AF_UNIX, SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(socket_path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._buffer = b''
+
+    def call(self, req_id, method, params, deadline):
+        """ Sends a request and waits for the response with the same id """
+        request = {
+            'jsonrpc': '2.0', 'id': req_id, 'method': method,
+            'params': params}
+        self._sock.settimeout(_remaining(deadline))
+        self._sock.sendall(dumps(request).encode('utf-8'))
+        while True:
+            response = self._read_message(deadline)
+            # skipping notifications and late responses
+            if isinstance(response, dict) and response.get('id') == req_id:
+                return response
+
+    def _read_message(self, deadline):
+        """ Reads a JSON message (terminated by an empty line) """
+        start = 0
+        while True:
+            end = self._buffer.find(b'\n\n', start)
+            if end >= 0:
+                message = self._buffer[:end]
+                self._buffer = self._buffer[end + 2:]
+                if message.strip():
+                    return loads(message.decode('utf-8'))
+                start = 0
+                continue
+            # the separator could be split between two reads
+            start = max(len(self._buffer) - 1, 0)
+            self._sock.settimeout(_remaining(deadline))
+            data = self._sock.recv(settings.CL_RECV_SIZE)
+            if not data:
+                raise ConnectionResetError('Connection closed by node')
+            self._buffer += data
+
+    def close(self):
+        """ Closes the connection """
+        self._sock.close()
+
+
+def _remaining(deadline):
+    """ Returns the seconds left before deadline, raising if expired """
+    remaining = deadline - time()
+    if remaining <= 0:
+        raise SocketTimeout('Deadline exceeded')
+    return remaining
 
 
 def GetInfo(request, context):  # pylint: disable=unused-argument
@@ -183,41 +464,27 @@ def WalletBalance(request, context):  # pylint: disable=unused-argument
 
 def ChannelBalance(request, context):  # pylint: disable=unused-argument
     """ Returns the off-chain balance in bits available across all channels """
-    # pylint: disable=no-member
-    channels = ListChannels(pb.ListChannelsRequest(), context).channels
-    return get_channel_balances(context, channels)
+    return _get_channels_mirror().channel_balance(context)
 
 
 def ListChannels(request, context):
     """ Returns a list of channels of the running LN node """
-    cl_req = ['listpeers']
-    cl_res = command(context, *cl_req)
-    response = pb.ListChannelsResponse()
-    if 'peers' in cl_res:  # pylint: disable=too-many-nested-blocks
-        for cl_peer in cl_res['peers']:
-            if 'channels' in cl_peer:
-                for cl_chan in cl_peer['channels']:
-                    state = None
-                    if 'state' in cl_chan and 'status' in cl_chan:
-                        state = _get_channel_state(cl_chan)
-                        if state < 0:
-                            continue
-                    _add_channel(context, response, cl_peer, cl_chan,
-                                 state, request.active_only)
-    _handle_error(context, cl_res, always_abort=False)
-    return response
+    return _get_channels_mirror().list_channels(context, request.active_only)
 
 
-def ListPayments(request, context):  # pylint: disable=unused-argument
+def ListInvoices(request, context):
+    """
+    Returns a list of lightning invoices created by the running LN node,
+    from the invoices store
+    """
+    return list_invoices(request, context, _sync_invoices)
+
+
+def ListPayments(request, context):
     """ Returns a list of lightning invoices paid by the running LN node """
-    cl_req = ['listsendpays']
-    cl_res = command(context, *cl_req)
-    response = pb.ListPaymentsResponse()
-    if 'payments' in cl_res:
-        for cl_payment in cl_res['payments']:
-            _add_payment(context, response, cl_payment)
-    _handle_error(context, cl_res, always_abort=False)
-    return response
+    cl_payments = _list_payments(context)
+    return next(_get_payments_pages(
+        context, request, cl_payments, request.max_items))
 
 
 def ListPeers(request, context):  # pylint: disable=unused-argument
@@ -226,7 +493,10 @@ def ListPeers(request, context):  # pylint: disable=unused-argument
     cl_res = command(context, *cl_req)
     _handle_error(context, cl_res, always_abort=False)
     response = pb.ListPeersResponse()
-    if 'peers' in cl_res:
+    if 'peers' in cl_res and cl_res['peers']:
+        nodes = get_nodes_cache(_load_nodes, _lookup_node).get_nodes(
+            context, [peer['id'] for peer in cl_res['peers']
+                      if 'id' in peer and peer.get('connected') is not False])
         for peer in cl_res['peers']:
             # Filtering disconnected peers
             if 'connected' in peer and peer['connected'] is False:
@@ -234,14 +504,8 @@ def ListPeers(request, context):  # pylint: disable=unused-argument
             grpc_peer = response.peers.add()  # pylint: disable=no-member
             if 'id' in peer:
                 grpc_peer.pubkey = peer['id']
-                cl_req = ['listnodes', 'id={}'.format(peer['id'])]
-                cl_res = command(context, *cl_req)
-                if 'nodes' in cl_res and cl_res['nodes']:
-                    node = cl_res['nodes'][0]
-                    if 'alias' in node:
-                        grpc_peer.alias = node['alias']
-                    if 'color' in node:
-                        grpc_peer.color = '#{}'.format(node['color'])
+                if peer['id'] in nodes:
+                    grpc_peer.alias, grpc_peer.color = nodes[peer['id']]
             if 'netaddr' in peer:
                 address = []
                 for addr in peer['netaddr']:
@@ -255,18 +519,20 @@ def CreateInvoice(request, context):
     cl_req = ['invoice']
     if request.min_final_cltv_expiry:
         Err().unimplemented_parameter(context, 'min_final_cltv_expiry')
+    cl_invoice = {'status': 'unpaid'}
     if request.amount_bits:
-        cl_req.append('msatoshi="{}"'.format(
-            convert(
-                context, Enf.MSATS, request.amount_bits,
-                enforce=Enf.LN_PAYREQ)))
+        cl_invoice['msatoshi'] = convert(
+            context, Enf.MSATS, request.amount_bits, enforce=Enf.LN_PAYREQ)
+        cl_req.append('msatoshi="{}"'.format(cl_invoice['msatoshi']))
     else:
         cl_req.append('msatoshi="any"')
     description = ''
     if request.description:
         description = request.description
     cl_req.append('description="{}"'.format(description))
+    cl_invoice['description'] = description
     label = _create_label()
+    cl_invoice['label'] = label
     cl_req.append('label="{}"'.format(label))
     if request.expiry_time:
         cl_req.append('expiry="{}"'.format(request.expiry_time))
@@ -283,29 +549,19 @@ def CreateInvoice(request, context):
     if 'expires_at' in cl_res:
         response.expires_at = cl_res['expires_at']
     _handle_error(context, cl_res, always_abort=False)
+    cl_invoice.update(cl_res)
+    get_invoices_store().save([_get_invoice_row(context, cl_invoice)])
     return response
 
 
 def CheckInvoice(request, context):
-    """ Checks if a LN invoice has been paid """
-    cl_req = ['listinvoices']
-    check_req_params(context, request, 'payment_hash')
-    invoice = None
-    cl_res = command(context, *cl_req)
-    if 'invoices' in cl_res:
-        for inv in cl_res['invoices']:
-            if 'payment_hash' in inv \
-                    and inv['payment_hash'] == request.payment_hash:
-                invoice = inv
-    if not invoice:
-        _handle_error(context, cl_res, always_abort=False)
-        Err().invoice_not_found(context)
-    response = pb.CheckInvoiceResponse()
-    # pylint: disable=no-member
-    response.state = _get_invoice_state(invoice)
-    if response.state == pb.PAID:
-        response.settled = True
-    return response
+    """
+    Checks if a LN invoice has been paid, from the invoices store
+
+    Pending invoices are looked up by label, all invoices are listed only
+    for unknown payment hashes
+    """
+    return check_invoice(request, context, _sync_invoices, _lookup_invoice)
 
 
 def PayInvoice(request, context):
@@ -315,6 +571,65 @@ def PayInvoice(request, context):
     If a description hash is included in the invoice, its preimage must be
     included in the request
     """
+    cl_req = _get_pay_request(request, context)
+    if request.no_wait:
+        return pay_in_background(
+            context, request.payment_request, partial(_pay, cl_req),
+            _check_payment)
+    cl_res = command(context, *cl_req)
+    return _get_pay_response(context, cl_res)
+
+
+async def _pay_invoice_async(request, context):
+    """ PayInvoice for the asyncio server mode """
+    cl_req = _get_pay_request(request, context)
+    if request.no_wait:
+        return pay_in_background(
+            context, request.payment_request, partial(_pay, cl_req),
+            _check_payment)
+    cl_res = await async_command(context, *cl_req)
+    return _get_pay_response(context, cl_res)
+
+
+def _pay(cl_req, update):  # pylint: disable=unused-argument
+    """
+    Background payment job, returns the preimage once pay has completed
+    (pay already retries on its own, on a dedicated socket connection) or
+    None if c-lightning could not be heard (the payment may be in flight)
+    """
+    context = FakeContext()
+    try:
+        cl_res = command(
+            context, *cl_req, timeout=settings.PAY_TIMEOUT, pooled=False)
+    except RuntimeError as err:
+        LOGGER.warning('No outcome from pay: %s', err)
+        return None
+    return _get_pay_response(context, cl_res).payment_preimage
+
+
+def _check_payment(payment_hash):
+    """
+    Returns the GetPaymentResponse of a payment made by pay, from the state
+    of its parts as listed by listsendpays
+    """
+    context = FakeContext()
+    cl_res = command(
+        context, 'listsendpays', 'payment_hash="{}"'.format(payment_hash))
+    _handle_error(context, cl_res, always_abort=False)
+    statuses = set()
+    for cl_payment in cl_res.get('payments', []):
+        if cl_payment.get('status') == 'complete':
+            return pb.GetPaymentResponse(
+                state=pb.SUCCEEDED,
+                payment_preimage=cl_payment.get('payment_preimage'))
+        statuses.add(cl_payment.get('status'))
+    if 'pending' in statuses:
+        return pb.GetPaymentResponse(state=pb.IN_FLIGHT)
+    return pb.GetPaymentResponse(state=pb.FAILED)
+
+
+def _get_pay_request(request, context):
+    """ Checks a PayInvoiceRequest and returns the pay command to call """
     cl_req = ['pay']
     check_req_params(context, request, 'payment_request')
     cl_req.append('bolt11="{}"'.format(request.payment_request))
@@ -339,7 +654,11 @@ def PayInvoice(request, context):
             cl_req.append('maxdelay="{}"'.format(request.cltv_expiry_delta))
         else:
             Err().out_of_range(context, 'cltv_expiry_delta')
-    cl_res = command(context, *cl_req)
+    return cl_req
+
+
+def _get_pay_response(context, cl_res):
+    """ Returns the PayInvoiceResponse of a pay command response """
     response = pb.PayInvoiceResponse()
     if 'payment_preimage' in cl_res:
         response.payment_preimage = cl_res['payment_preimage']
@@ -370,14 +689,56 @@ def PayOnChain(request, context):
     return response
 
 
-def DecodeInvoice(request, context):  # pylint: disable=too-many-branches
+def StreamInvoices(request, context):
+    """ Streams the requested lightning invoices, in chunks """
+    return stream_invoices(request, context, _sync_invoices)
+
+
+def StreamPayments(request, context):
+    """
+    Streams the lightning invoices paid by the running LN node, in chunks
+    """
+    cl_payments = _list_payments(context)
+    return _get_payments_pages(
+        context, request, cl_payments,
+        request.max_items or settings.STREAM_ITEMS)
+
+
+def SubscribeInvoices(request, context):
+    """ Streams paid invoices, resuming from settle_index if requested """
+    hub = get_invoices_hub(_list_settled_invoices, _wait_settled_invoices)
+    return hub.subscribe(context, request.settle_index)
+
+
+def GetPayment(request, context):
+    """ Returns the state of a payment made by PayInvoice with no_wait """
+    return get_payment(request, context)
+
+
+def TrackPayment(request, context):
+    """ Streams the state of a payment made by PayInvoice with no_wait """
+    return track_payment(request, context)
+
+
+def DecodeInvoice(request, context):
     """
     Tries to return information of a LN invoice from its payment request
-    (bolt 11 standard)
+    (bolt 11 standard), decoding it locally when possible
     """
-    cl_req = ['decodepay']
-    response = pb.DecodeInvoiceResponse()
     check_req_params(context, request, 'payment_request')
+    response = decode_invoice(context, request)
+    if response is not None:
+        # as c-lightning does, a description hash must be checked
+        if response.description_hash and not request.description:
+            Err().missing_parameter(context, 'description')
+        return response
+    return _decode_invoice_node(request, context)
+
+
+def _decode_invoice_node(request, context):
+    """ Returns a DecodeInvoiceResponse asking c-lightning to decode """
+    # pylint: disable=too-many-branches
+    cl_req = ['decodepay']
     cl_req.append('bolt11="{}"'.format(request.payment_request))
     if request.description:
         cl_req.append('description="{}"'.format(request.description))
@@ -448,14 +809,12 @@ def CloseChannel(request, context):
     if request.force:
         # setting a 1 second timeout to force an immediate unilateral close
         cl_req.append('unilateraltimeout=1')
-    executor = ThreadPoolExecutor(max_workers=1)
-    future = executor.submit(_close_channel, cl_req, close_timeout)
+    job_id, future = get_jobs().submit(
+        context, 'close', _close_channel, cl_req, close_timeout)
     try:
-        cl_res = future.result(timeout=get_thread_timeout(context))
-        if cl_res:
-            if 'txid' in cl_res:
-                response.closing_txid = cl_res['txid']
-            return response
+        txid = future.result(timeout=get_thread_timeout(context))
+        if txid:
+            response.closing_txid = txid
     except RuntimeError as cl_err:
         try:
             error = literal_eval(str(cl_err))
@@ -463,18 +822,21 @@ def CloseChannel(request, context):
         except (SyntaxError, ValueError):
             Err().report_error(context, str(cl_err))
     except TimeoutFutError:
-        executor.shutdown(wait=False)
-    return pb.CloseChannelResponse()
+        response.job_id = job_id
+    return response
+
+
+def GetCloseStatus(request, context):
+    """ Returns the outcome of a CloseChannel call from its job ID """
+    return get_close_status(request, context)
 
 
 # pylint: disable=too-many-arguments,too-many-branches
-def _add_channel(context, response, cl_peer, cl_chan, state, active_only):
+def _add_channel(context, response, cl_peer, cl_chan, state):
     """ Adds a channel to a ListChannelsResponse """
     connected = True
     if 'connected' in cl_peer:
         connected = cl_peer['connected']
-    if active_only and (not connected or state != pb.OPEN):
-        return
     grpc_chan = response.channels.add()
     grpc_chan.active = connected and state == pb.OPEN
     if state:
@@ -507,6 +869,84 @@ def _add_channel(context, response, cl_peer, cl_chan, state, active_only):
     # pylint: enable=too-many-arguments
 
 
+def _get_channels_mirror():
+    """ Returns the ChannelsMirror, polling c-lightning peers """
+    return get_channels_mirror(_list_channels)
+
+
+def _list_channels(context):
+    """ Returns all channels of c-lightning, from its peers """
+    cl_res = command(context, 'listpeers')
+    response = pb.ListChannelsResponse()
+    if 'peers' in cl_res:
+        for cl_peer in cl_res['peers']:
+            for cl_chan in cl_peer.get('channels', []):
+                state = None
+                if 'state' in cl_chan and 'status' in cl_chan:
+                    state = _get_channel_state(cl_chan)
+                    if state < 0:
+                        continue
+                _add_channel(context, response, cl_peer, cl_chan, state)
+    _handle_error(context, cl_res, always_abort=False)
+    return response.channels
+
+
+def _load_nodes(context):
+    """
+    Returns alias and color of the nodes in the network graph, None if it
+    can't be read
+    """
+    cl_req = ['listnodes']
+    cl_res = command(context, *cl_req)
+    if 'nodes' not in cl_res:
+        return None
+    return {node['nodeid']: _get_node(node) for node in cl_res['nodes']
+            if 'nodeid' in node}
+
+
+def _lookup_node(context, pubkey):
+    """ Returns alias and color of a node, None if unknown """
+    cl_req = ['listnodes', 'id="{}"'.format(pubkey)]
+    cl_res = command(context, *cl_req)
+    _handle_error(context, cl_res, always_abort=False)
+    if not cl_res.get('nodes'):
+        return None
+    return _get_node(cl_res['nodes'][0])
+
+
+def _get_node(cl_node):
+    """ Returns alias and color of a listnodes node """
+    color = ''
+    if 'color' in cl_node:
+        color = '#{}'.format(cl_node['color'])
+    return cl_node.get('alias', ''), color
+
+
+def _list_payments(context):
+    """ Returns the payments of the node, failed ones excluded """
+    cl_req = ['listsendpays']
+    cl_res = command(context, *cl_req)
+    _handle_error(context, cl_res, always_abort=False)
+    return [cl_payment for cl_payment in cl_res.get('payments', [])
+            if cl_payment.get('status') != 'failed']
+
+
+def _get_payments_pages(context, request, cl_payments, size):
+    """
+    Yields the ListPaymentsResponse pages of cl_payments, oldest first,
+    following request.cursor
+    """
+    pages = paginate(
+        context, request, cl_payments,
+        lambda cl_pay: (cl_pay.get('created_at', 0), cl_pay.get('id', 0)),
+        size)
+    for page, next_cursor in pages:
+        response = pb.ListPaymentsResponse(next_cursor=next_cursor)
+        for cl_payment in page:
+            _add_payment(context, response, cl_payment)
+        yield response
+
+
 def _add_payment(context, response, cl_payment):
     """ Adds a payment to a ListPaymentsResponse """
     if 'status' in cl_payment and cl_payment['status'] == 'failed':
@@ -544,9 +984,8 @@ def _add_route_hint(response, cl_route):
             grpc_hop.cltv_expiry_delta = cl_hop['cltv_expiry_delta']
 
 
-@handle_thread
 def _close_channel(cl_req, close_timeout):
-    """ Returns close channel response or raises exception to caller """
+    """ Returns the closing txid (if any) or raises exception to caller """
     cl_res = error = None
     try:
         # adding a little delay to allow implementation to answer before
@@ -562,7 +1001,7 @@ def _close_channel(cl_req, close_timeout):
     if error:
         LOGGER.debug('[ASYNC] CloseChannel terminated with error: %s', error)
         raise RuntimeError(error)
-    return cl_res
+    return cl_res.get('txid')
 
 
 def _create_label():
@@ -571,6 +1010,105 @@ def _create_label():
     return '{}'.format(int(microseconds))
 
 
+def _get_invoice(context, cl_invoice):
+    """ Converts a c-lightning invoice to an Invoice message """
+    invoice = pb.Invoice(state=_get_invoice_state(cl_invoice))
+    if 'msatoshi' in cl_invoice:
+        invoice.amount_bits = convert(
+            context, Enf.MSATS, cl_invoice['msatoshi'])
+    if 'payment_hash' in cl_invoice:
+        invoice.payment_hash = cl_invoice['payment_hash']
+    if 'description' in cl_invoice:
+        invoice.description = cl_invoice['description']
+    if 'bolt11' in cl_invoice:
+        invoice.payment_request = cl_invoice['bolt11']
+        # c-lightning does not report when invoices have been created
+        with suppress(ValueError):
+            invoice.timestamp = get_timestamp(cl_invoice['bolt11'])
+        if invoice.timestamp and 'expires_at' in cl_invoice:
+            invoice.expiry_time = cl_invoice['expires_at'] - invoice.timestamp
+    if 'msatoshi_received' in cl_invoice:
+        invoice.amount_received_bits = convert(
+            context, Enf.MSATS, cl_invoice['msatoshi_received'])
+    return invoice
+
+
+def _get_invoice_row(context, cl_invoice):
+    """ Converts a c-lightning invoice to an invoices store row """
+    return invoice_row(
+        _get_invoice(context, cl_invoice),
+        cl_invoice.get('status', 'unpaid') == 'unpaid',
+        expires_at=cl_invoice.get('expires_at', 0),
+        node_key=cl_invoice.get('label', ''))
+
+
+def _sync_invoices(context, store):
+    """
+    Saves all invoices to the invoices store, as c-lightning can't list
+    only the ones created or changed since the last sync
+    """
+    cl_res = command(context, 'listinvoices')
+    if 'invoices' not in cl_res:
+        _handle_error(context, cl_res, always_abort=True)
+    store.save([
+        _get_invoice_row(context, cl_invoice)
+        for cl_invoice in cl_res['invoices'] if 'payment_hash' in cl_invoice])
+
+
+def _lookup_invoice(context, payment_hash):
+    """
+    Returns the invoices store row of an invoice, asking c-lightning by
+    label, None if not found
+    """
+    label = get_invoices_store().get_node_key(payment_hash)
+    if not label:
+        return None
+    cl_res = command(context, 'listinvoices', 'label="{}"'.format(label))
+    for cl_invoice in cl_res.get('invoices', []):
+        if cl_invoice.get('payment_hash') == payment_hash:
+            return _get_invoice_row(context, cl_invoice)
+    return None
+
+
+def _list_settled_invoices(context, settle_index):
+    """ Returns the invoices paid after pay_index settle_index """
+    cl_res = command(context, 'listinvoices')
+    if 'invoices' not in cl_res:
+        _handle_error(context, cl_res, always_abort=True)
+    settled = []
+    for cl_invoice in cl_res['invoices']:
+        if cl_invoice.get('pay_index', 0) > settle_index:
+            settled.append(
+                (cl_invoice['pay_index'], _get_invoice(context, cl_invoice)))
+    return sorted(settled, key=lambda event: event[0])
+
+
+def _wait_settled_invoices(settle_index):
+    """
+    Yields invoices as they get paid, after pay_index settle_index or from
+    now on
+    """
+    context = FakeContext()
+    if settle_index is None:
+        settled = _list_settled_invoices(context, 0)
+        settle_index = settled[-1][0] if settled else 0
+    while True:
+        try:
+            cl_res = command(
+                context, 'waitanyinvoice',
+                'lastpay_index={}'.format(settle_index),
+                timeout=settings.CL_WAIT_TIMEOUT)
+        except RuntimeError as err:
+            # no payments in the meantime, waiting again
+            if 'Timeout' in str(err):
+                continue
+            raise
+        if 'pay_index' not in cl_res:
+            _handle_error(context, cl_res, always_abort=True)
+        settle_index = cl_res['pay_index']
+        yield settle_index, _get_invoice(context, cl_res)
+
+
 def _get_channel_state(cl_chan):  # pylint: disable=too-many-return-statements
     """
     Maps implementation's channel state to lighter's channel state definition
@@ -16,21 +16,38 @@
 """ Implementation of lighter.proto defined methods for eclair """
 
 from ast import literal_eval
-from concurrent.futures import TimeoutError as TimeoutFutError, \
-    ThreadPoolExecutor
-from fileinput import FileInput
+from asyncio import IncompleteReadError, open_connection, \
+    TimeoutError as AsyncTimeoutError, wait_for
+from base64 import b64encode
+from concurrent.futures import TimeoutError as TimeoutFutError
+from functools import partial
+from http.client import HTTPConnection, HTTPException
+from json import JSONDecodeError, loads
 from logging import getLogger
-from os import environ, path
-from re import sub
+from os import environ
+from queue import Empty, LifoQueue
+from select import select
+from socket import timeout as SocketTimeout
 from string import ascii_lowercase, digits  # pylint: disable=deprecated-module
+from threading import BoundedSemaphore
 from time import time, sleep
+from urllib.parse import urlencode
 
 from . import lighter_pb2 as pb
 from . import settings
+from .bolt11 import decode_invoice, has_amount_encoded
+from .cache import get_nodes_cache
+from .channels import get_channels_mirror
+from .health import report_node_failure, report_node_success
+from .metrics import timed_node_call
 from .errors import Err
-from .utils import check_req_params, command, convert, Enforcer as Enf, \
-    FakeContext, get_channel_balances, get_thread_timeout, get_node_timeout, \
-    handle_thread, has_amount_encoded
+from .invoices import check_invoice, get_invoices_store, invoice_row, \
+    list_invoices, stream_invoices
+from .jobs import get_close_status, get_jobs
+from .payments import get_payment, pay_in_background, track_payment
+from .streams import get_invoices_hub
+from .utils import check_req_params, convert, Enforcer as Enf, \
+    FakeContext, get_thread_timeout, get_node_timeout
 
 LOGGER = getLogger(__name__)
 
@@ -51,9 +68,6 @@ ERRORS = {
     'Connection refused': {
         'fun': 'node_error'
     },
-    'Could not resolve host': {
-        'fun': 'node_error'
-    },
     'is neither a valid Base58 address': {
         'fun': 'invalid',
         'params': 'address'
@@ -67,9 +81,6 @@ ERRORS = {
     'peer sent error: ascii=': {
         'fun': 'openchannel_failed'
     },
-    'Recv failure: Connection reset by peer': {
-        'fun': 'node_error'
-    },
     'route not found': {
         'fun': 'route_not_found'
     },
@@ -82,6 +93,11 @@ ERRORS = {
     }
 }
 
+# APIs with a coroutine variant, used in asyncio server mode (GRPC_ASYNC)
+ASYNC_APIS = {
+    'PayInvoice': '_pay_invoice_async'
+}
+
 
 def update_settings(password):
     """
@@ -92,23 +108,265 @@ def update_settings(password):
     """
     ecl_host = environ.get('ECL_HOST', settings.ECL_HOST)
     ecl_port = environ.get('ECL_PORT', settings.ECL_PORT)
-    ecl_pass = password.decode()
-    settings.ECL_ENV = {'PASSWORD': ecl_pass}
-    ecl_url = '{}:{}'.format(ecl_host, ecl_port)
-    ecl_cli = path.abspath('lighter/eclair-cli')
-    ecl_options = ['-a', ecl_url]
-    with FileInput(files=(ecl_cli), inplace=1) as file:
-        for line in file:
-            line = sub('^# api_password=.*', "api_password=$PASSWORD",
-                       line.rstrip())
-            print(line)
-    settings.CMD_BASE = [ecl_cli] + ecl_options
+    disconnect()
+    settings.ECL_POOL = HttpPool(
+        ecl_host, int(ecl_port), password.decode(), settings.ECL_POOL_SIZE)
+
+
+def on_connect():
+    """ Loads the network nodes in background once eclair is reachable """
+    get_nodes_cache(_load_nodes, _lookup_node).start()
+
+
+def disconnect():
+    """ Closes all connections to the eclair API """
+    if settings.ECL_POOL:
+        settings.ECL_POOL.close()
+    settings.ECL_POOL = None
+
+
+def command(context, *args_cmd, **kwargs):
+    """
+    Calls an eclair API endpoint.
+
+    Arguments are given in eclair-cli format (method followed by
+    --key=value parameters) and the response body is returned, decoded from
+    JSON when possible, just like eclair-cli prints it.
+    """
+    if not settings.ECL_POOL:
+        raise RuntimeError
+    method = args_cmd[0]
+    form = _get_form(args_cmd[1:])
+    wait_time = kwargs.get('timeout', get_node_timeout(context))
+    try:
+        with timed_node_call(method):
+            body = settings.ECL_POOL.call(method, form, wait_time)
+    except SocketTimeout:
+        # a call exceeding the client deadline doesn't tell if the node is up
+        Err().node_error(context, 'Timeout')
+    except (HTTPException, OSError) as err:
+        error = 'Connecting to eclair: {}'.format(
+            getattr(err, 'strerror', None) or err)
+        report_node_failure(error)
+        Err().node_error(context, error)
+    report_node_success()
+    return _get_result(body)
+
+
+async def async_command(context, *args_cmd, **kwargs):
+    """ Calls eclair as command does, without blocking the event loop """
+    if not settings.ECL_POOL:
+        raise RuntimeError
+    method = args_cmd[0]
+    form = _get_form(args_cmd[1:])
+    wait_time = kwargs.get('timeout', get_node_timeout(context))
+    try:
+        with timed_node_call(method):
+            body = await wait_for(
+                settings.ECL_POOL.async_call(method, form), wait_time)
+    except AsyncTimeoutError:
+        # a call exceeding the client deadline doesn't tell if the node is up
+        Err().node_error(context, 'Timeout')
+    except (HTTPException, OSError, IncompleteReadError) as err:
+        error = 'Connecting to eclair: {}'.format(
+            getattr(err, 'strerror', None) or err)
+        report_node_failure(error)
+        Err().node_error(context, error)
+    report_node_success()
+    return _get_result(body)
+
+
+def _get_result(body):
+    """ Decodes a response body from JSON when possible """
+    body = body.decode('utf-8')
+    try:
+        ecl_res = loads(body)
+    except JSONDecodeError:
+        ecl_res = body
+    if ecl_res is None or ecl_res == "":
+        LOGGER.debug('Empty result from command')
+    return ecl_res
+
+
+def _get_form(args):
+    """
+    Builds form fields from --key=value arguments, removing quotes around
+    values as the shell does for eclair-cli
+    """
+    form = []
+    for arg in args:
+        key, value = arg[2:].split('=', 1)
+        if len(value) > 1 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        form.append((key, value))
+    return form
+
+
+class HttpPool():
+    """
+    Pool of keep-alive HTTP connections to the eclair API.
+
+    Each call checks out an idle connection (opening a new one when none is
+    available, up to size connections), which is returned to the pool once
+    the response has been entirely read. Idle connections closed by eclair
+    or left idle for too long are discarded instead of being reused.
+    """
+
+    def __init__(self, host, port, password, size):
+        self.host = host
+        self.port = port
+        auth = b64encode(':{}'.format(password).encode('utf-8'))
+        self._headers = {
+            'Authorization': 'Basic {}'.format(auth.decode()),
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        self._idle = LifoQueue()
+        self._slots = BoundedSemaphore(size)
+
+    def call(self, method, form, timeout):
+        """
+        POSTs form to the method endpoint and returns the response body,
+        raising socket.timeout if it can't be read within timeout seconds
+        """
+        deadline = time() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise SocketTimeout('No connection available')
+        try:
+            conn = self._get_connection(timeout)
+            data = urlencode(form)
+            reused = conn.sock is not None
+            try:
+                try:
+                    self._send(conn, method, data, deadline)
+                except ConnectionError:
+                    # eclair closed the idle connection before it could be
+                    # written to, the request has not been sent and is
+                    # retried once on a new connection. Failures after the
+                    # request has been sent are never retried, as eclair
+                    # may have already executed it
+                    if not reused:
+                        raise
+                    conn.close()
+                    self._send(conn, method, data, deadline)
+                body = self._read(conn, deadline)
+            except BaseException:
+                conn.close()
+                raise
+            self._idle.put((conn, time()))
+            return body
+        finally:
+            self._slots.release()
+
+    def _get_connection(self, timeout):
+        """ Returns a live idle connection or a new one """
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except Empty:
+                return HTTPConnection(self.host, self.port, timeout=timeout)
+            if time() - idle_since < settings.ECL_POOL_IDLE_TIME and \
+                    not _is_readable(conn.sock):
+                return conn
+            conn.close()
+
+    def _send(self, conn, method, data, deadline):
+        """ Sends a request """
+        conn.timeout = _remaining(deadline)
+        if conn.sock:
+            conn.sock.settimeout(conn.timeout)
+        conn.request('POST', '/{}'.format(method), data, self._headers)
+
+    @staticmethod
+    def _read(conn, deadline):
+        """ Reads the response body of the last request in chunks """
+        sock = conn.sock
+        response = conn.getresponse()
+        chunks = []
+        while True:
+            sock.settimeout(_remaining(deadline))
+            chunk = response.read(settings.ECL_READ_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if response.will_close:
+            conn.close()
+        return _check_body(response.status, response.reason, b''.join(chunks))
+
+    async def async_call(self, method, form):
+        """
+        POSTs form to the method endpoint on a new asyncio connection and
+        returns the response body (timeout is left to the caller).
+
+        Only used by PayInvoice, which can wait for eclair for up to
+        PAY_TIMEOUT: a connection of its own keeps it from holding one of
+        the pooled connections meanwhile.
+        """
+        reader, writer = await open_connection(self.host, self.port)
+        try:
+            data = urlencode(form).encode('utf-8')
+            # HTTP/1.0 to have the body delimited by connection close
+            lines = ['POST /{} HTTP/1.0'.format(method),
+                     'Host: {}:{}'.format(self.host, self.port),
+                     'Content-Length: {}'.format(len(data))]
+            for key, value in self._headers.items():
+                lines.append('{}: {}'.format(key, value))
+            lines.extend(['', ''])
+            writer.write('\r\n'.join(lines).encode('utf-8') + data)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, separator, body = response.partition(b'\r\n\r\n')
+        status_line = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+        if not separator or len(status_line) < 2 or \
+                not status_line[0].startswith('HTTP/') or \
+                not status_line[1].isdigit():
+            raise HTTPException('Incomplete response')
+        return _check_body(
+            int(status_line[1]), ''.join(status_line[2:]), body)
+
+    def close(self):
+        """ Closes all idle connections """
+        while True:
+            try:
+                self._idle.get_nowait()[0].close()
+            except Empty:
+                break
+
+
+def _check_body(status, reason, body):
+    """
+    Returns the body of a response: eclair reports errors in the body, an
+    error status with no body is raised
+    """
+    if status >= 400 and not body.strip():
+        raise HTTPException('{} {}'.format(status, reason))
+    return body
+
+
+def _remaining(deadline):
+    """ Returns the seconds left before deadline, raising if expired """
+    remaining = deadline - time()
+    if remaining <= 0:
+        raise SocketTimeout('Deadline exceeded')
+    return remaining
+
+
+def _is_readable(sock):
+    """
+    Checks whether an idle keep-alive socket has something to read, which
+    means it has been closed (or is in an unexpected state) on eclair's side
+    """
+    try:
+        return bool(select([sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
 
 
 def GetInfo(request, context):  # pylint: disable=unused-argument
     """ Returns info about the running LN node """
     ecl_req = ['getinfo']
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+    ecl_res = command(context, *ecl_req)
     response = pb.GetInfoResponse()
     if _def(ecl_res, 'nodeId'):
         response.identity_pubkey = ecl_res['nodeId']
@@ -133,17 +391,21 @@ def GetInfo(request, context):  # pylint: disable=unused-argument
 
 def ChannelBalance(request, context):  # pylint: disable=unused-argument
     """ Returns the off-chain balance in bits available across all channels """
-    # pylint: disable=no-member
-    channels = ListChannels(pb.ListChannelsRequest(), context).channels
-    return get_channel_balances(context, channels)
+    return _get_channels_mirror().channel_balance(context)
 
 
 def ListPeers(request, context):  # pylint: disable=unused-argument
     """ Returns a list of peers connected to the running LN node """
     ecl_req = ['peers']
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+    ecl_res = command(context, *ecl_req)
     _handle_error(context, ecl_res, always_abort=False)
     response = pb.ListPeersResponse()
+    if not ecl_res or not isinstance(ecl_res, list):
+        return response
+    nodes = get_nodes_cache(_load_nodes, _lookup_node).get_nodes(
+        context, [peer['nodeId'] for peer in ecl_res
+                  if _def(peer, 'nodeId') and peer.get('state') !=
+                  'DISCONNECTED'])
     for peer in ecl_res:
         # Filtering disconnected peers
         if _def(peer, 'state') and peer['state'] == 'DISCONNECTED':
@@ -151,29 +413,24 @@ def ListPeers(request, context):  # pylint: disable=unused-argument
         grpc_peer = response.peers.add()  # pylint: disable=no-member
         if _def(peer, 'nodeId'):
             grpc_peer.pubkey = peer['nodeId']
+            if peer['nodeId'] in nodes:
+                grpc_peer.alias, grpc_peer.color = nodes[peer['nodeId']]
         if _def(peer, 'address'):
             grpc_peer.address = peer['address']
-    ecl_req = ['allnodes']
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
-    for node in ecl_res:
-        for peer in response.peers:  # pylint: disable=no-member
-            if 'nodeId' in node and node['nodeId'] == peer.pubkey:
-                if 'alias' in node:
-                    peer.alias = node['alias']
-                if 'rgbColor' in node:
-                    peer.color = node['rgbColor']
     return response
 
 
 def ListChannels(request, context):
     """ Returns a list of channels of the running LN node """
-    ecl_req = ['channels']
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
-    response = pb.ListChannelsResponse()
-    for channel in ecl_res:
-        _add_channel(context, response, channel, request.active_only)
-    _handle_error(context, ecl_res, always_abort=False)
-    return response
+    return _get_channels_mirror().list_channels(context, request.active_only)
+
+
+def ListInvoices(request, context):
+    """
+    Returns a list of lightning invoices created by the running LN node,
+    from the invoices store
+    """
+    return list_invoices(request, context, _sync_invoices)
 
 
 def CreateInvoice(request, context):
@@ -195,7 +452,7 @@ def CreateInvoice(request, context):
         ecl_req.append('--expireIn="{}"'.format(settings.EXPIRY_TIME))
     if request.fallback_addr:
         ecl_req.append('--fallbackAddress="{}"'.format(request.fallback_addr))
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+    ecl_res = command(context, *ecl_req)
     response = pb.CreateInvoiceResponse()
     if _def(ecl_res, 'serialized'):
         response.payment_request = ecl_res['serialized']
@@ -206,24 +463,17 @@ def CreateInvoice(request, context):
     if _def(ecl_res, 'timestamp') and _def(ecl_res, 'expiry'):
         expires_at = int(ecl_res['timestamp']) + int(ecl_res['expiry'])
         response.expires_at = expires_at
+    if response.payment_hash:
+        get_invoices_store().save([_get_invoice_row(context, ecl_res)])
     return response
 
 
 def CheckInvoice(request, context):
-    """ Checks if a LN invoice has been paid """
-    ecl_req = ['getreceivedinfo']
-    check_req_params(context, request, 'payment_hash')
-    ecl_req.append('--paymentHash="{}"'.format(request.payment_hash))
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
-    response = pb.CheckInvoiceResponse()
-    if _def(ecl_res, 'status'):
-        response.state = _get_invoice_state(ecl_res)
-    elif 'Not found' not in ecl_res:
-        Err().invalid(context, 'payment_hash')
-    # pylint: disable=no-member
-    if response.state == pb.PAID:
-        response.settled = True
-    return response
+    """
+    Checks if a LN invoice has been paid, from the invoices store (asking
+    eclair for pending and unknown invoices only)
+    """
+    return check_invoice(request, context, _sync_invoices, _lookup_invoice)
 
 
 def PayInvoice(request, context):
@@ -233,6 +483,36 @@ def PayInvoice(request, context):
     If a description hash is included in the invoice, its preimage must be
     included in the request
     """
+    ecl_req = _get_pay_request(request, context)
+    ecl_res = command(context, *ecl_req)
+    if 'malformed' in ecl_res:
+        Err().invalid(context, 'payment_request')
+    ecl_req = _get_sent_info_request(ecl_res)
+    if request.no_wait:
+        return pay_in_background(
+            context, request.payment_request,
+            partial(_wait_payment, ecl_req), partial(_check_payment, ecl_req))
+    ecl_res = command(context, *ecl_req)
+    return _get_pay_response(context, ecl_res)
+
+
+async def _pay_invoice_async(request, context):
+    """ PayInvoice for the asyncio server mode """
+    ecl_req = _get_pay_request(request, context)
+    ecl_res = await async_command(context, *ecl_req)
+    if 'malformed' in ecl_res:
+        Err().invalid(context, 'payment_request')
+    ecl_req = _get_sent_info_request(ecl_res)
+    if request.no_wait:
+        return pay_in_background(
+            context, request.payment_request,
+            partial(_wait_payment, ecl_req), partial(_check_payment, ecl_req))
+    ecl_res = await async_command(context, *ecl_req)
+    return _get_pay_response(context, ecl_res)
+
+
+def _get_pay_request(request, context):
+    """ Checks a PayInvoiceRequest and returns the payinvoice call to do """
     ecl_req = ['payinvoice']
     check_req_params(context, request, 'payment_request')
     if request.cltv_expiry_delta:
@@ -249,32 +529,119 @@ def PayInvoice(request, context):
     elif not amount_encoded:
         check_req_params(context, request, 'amount_bits')
     # pylint: enable=no-member
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
-    if 'malformed' in ecl_res:
-        Err().invalid(context, 'payment_request')
+    return ecl_req
+
+
+def _get_sent_info_request(ecl_res):
+    """ Returns the getsentinfo call for the id returned by payinvoice """
     ecl_req = ['getsentinfo']
     ecl_req.append('--id="{}"'.format(ecl_res.strip()))
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+    return ecl_req
+
+
+def _wait_payment(ecl_req, update):
+    """
+    Background payment job, polls getsentinfo (at increasing intervals, up to
+    ECL_POLL_TIME) until the payment is no longer pending and returns its
+    preimage, or None if it is still pending after PAY_TIMEOUT or eclair
+    could not be heard
+    """
+    context = FakeContext()
+    deadline = time() + settings.PAY_TIMEOUT
+    interval = settings.ECL_PAY_POLL_TIME
+    while True:
+        try:
+            ecl_res = command(context, *ecl_req)
+        except RuntimeError as err:
+            LOGGER.warning('No outcome from getsentinfo: %s', err)
+            return None
+        if isinstance(ecl_res, list):
+            update(len(ecl_res))
+        if ecl_res and not _is_pending(ecl_res[0]):
+            return _get_pay_response(context, ecl_res).payment_preimage
+        if time() + interval > deadline:
+            return None
+        sleep(interval)
+        interval = min(interval * 2, settings.ECL_POLL_TIME)
+
+
+def _check_payment(ecl_req, _payment_hash):
+    """
+    Returns the GetPaymentResponse of a payment made by payinvoice, from its
+    getsentinfo call
+    """
+    context = FakeContext()
+    ecl_res = command(context, *ecl_req)
+    if not isinstance(ecl_res, list):
+        _handle_error(context, ecl_res, always_abort=True)
+    if ecl_res and _is_pending(ecl_res[0]):
+        return pb.GetPaymentResponse(state=pb.IN_FLIGHT)
+    if ecl_res and _def(ecl_res[0], 'preimage'):
+        return pb.GetPaymentResponse(
+            state=pb.SUCCEEDED, payment_preimage=ecl_res[0]['preimage'])
+    return pb.GetPaymentResponse(state=pb.FAILED)
+
+
+def _is_pending(payment):
+    """ Whether a getsentinfo payment is still pending """
+    return _def(payment, 'status') and payment['status'] == 'PENDING'
+
+
+def _get_pay_response(context, ecl_res):
+    """ Returns the PayInvoiceResponse of a getsentinfo response """
     response = pb.PayInvoiceResponse()
     payment = ecl_res[0]
     if _def(payment, 'preimage'):
         response.payment_preimage = payment['preimage']
     elif _def(payment, 'status') and payment['status'] == 'FAILED':
         Err().payinvoice_failed(context)
-    elif _def(payment, 'status') and payment['status'] == 'PENDING':
+    elif _is_pending(payment):
         Err().payinvoice_pending(context)
     else:
         _handle_error(context, ecl_res, always_abort=True)
     return response
 
 
-def DecodeInvoice(request, context):  # pylint: disable=too-many-branches
+def StreamInvoices(request, context):
+    """ Streams the requested lightning invoices, in chunks """
+    return stream_invoices(request, context, _sync_invoices)
+
+
+def SubscribeInvoices(request, context):
+    """
+    Streams paid invoices, resuming from settle_index if requested.
+    Received payments are polled, settle_index is their timestamp (in ms).
+    """
+    hub = get_invoices_hub(_list_settled_invoices, _wait_settled_invoices)
+    return hub.subscribe(context, request.settle_index)
+
+
+def GetPayment(request, context):
+    """ Returns the state of a payment made by PayInvoice with no_wait """
+    return get_payment(request, context)
+
+
+def TrackPayment(request, context):
+    """ Streams the state of a payment made by PayInvoice with no_wait """
+    return track_payment(request, context)
+
+
+def DecodeInvoice(request, context):
     """ Tries to return information of a LN invoice from its payment request
-        (bolt 11 standard) """
-    ecl_req = ['parseinvoice']
+        (bolt 11 standard), decoding it locally when possible """
     check_req_params(context, request, 'payment_request')
+    response = decode_invoice(context, request)
+    if response is not None:
+        return response
+    return _decode_invoice_node(request, context)
+
+
+def _decode_invoice_node(request, context):
+    """ Returns a DecodeInvoiceResponse asking eclair to decode """
+    # pylint: disable=too-many-branches
+    ecl_req = ['parseinvoice']
     ecl_req.append('--invoice="{}"'.format(request.payment_request))
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+    ecl_res = command(context, *ecl_req)
     if 'invalid payment request' in ecl_res:
         # checking manually as error is not in json
         Err().invalid(context, 'payment_request')
@@ -311,7 +678,7 @@ def OpenChannel(request, context):
     except ValueError:
         Err().invalid(context, 'node_uri')
     ecl_req.append('--uri={}'.format(request.node_uri))
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+    ecl_res = command(context, *ecl_req)
     if 'connected' not in ecl_res:
         Err().connect_failed(context)
     ecl_req = ['open']
@@ -325,14 +692,14 @@ def OpenChannel(request, context):
                     enforce=Enf.PUSH_MSAT, max_precision=Enf.MSATS)))
     if request.private:
         ecl_req.append('--channelFlags=0')
-    ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+    ecl_res = command(context, *ecl_req)
     if 'created channel' not in ecl_res:
         _handle_error(context, ecl_res, always_abort=True)
     ecl_req = ['channel']
     try:
         channel_id = ecl_res.split(' ')[2]
         ecl_req.append('--channelId={}'.format(channel_id))
-        ecl_res = command(context, *ecl_req, env=settings.ECL_ENV)
+        ecl_res = command(context, *ecl_req)
         if _def(ecl_res, 'data'):
             data = ecl_res['data']
             if _def(data, 'commitments'):
@@ -354,18 +721,16 @@ def CloseChannel(request, context):
     if request.force:
         ecl_req = ['forceclose']
     ecl_req.append('--channelId="{}"'.format(request.channel_id))
-    executor = ThreadPoolExecutor(max_workers=1)
-    client_expiry_time = context.time_remaining() + time()
     close_timeout = get_node_timeout(
         context, min_time=settings.CLOSE_TIMEOUT_NODE)
-    future = executor.submit(
-        _close_channel, ecl_req, close_timeout, client_expiry_time)
+    job_id, future = get_jobs().submit(
+        context, 'close', _close_channel, ecl_req, close_timeout)
     try:
         ecl_res = future.result(timeout=get_thread_timeout(context))
         if ecl_res:
             return pb.CloseChannelResponse(closing_txid=ecl_res)
     except TimeoutFutError:
-        executor.shutdown(wait=False)
+        return pb.CloseChannelResponse(job_id=job_id)
     except RuntimeError as ecl_err:
         try:
             error = literal_eval(str(ecl_err))
@@ -375,6 +740,51 @@ def CloseChannel(request, context):
     return pb.CloseChannelResponse()
 
 
+def GetCloseStatus(request, context):
+    """ Returns the outcome of a CloseChannel call from its job ID """
+    return get_close_status(request, context)
+
+
+def _get_channels_mirror():
+    """ Returns the ChannelsMirror, polling eclair channels """
+    return get_channels_mirror(_list_channels)
+
+
+def _list_channels(context):
+    """ Returns all channels of eclair """
+    ecl_res = command(context, 'channels')
+    if not isinstance(ecl_res, list):
+        _handle_error(context, ecl_res)
+    response = pb.ListChannelsResponse()
+    for channel in ecl_res:
+        _add_channel(context, response, channel)
+    return response.channels
+
+
+def _load_nodes(context):
+    """
+    Returns alias and color of the nodes in the network graph, None if it
+    can't be read
+    """
+    ecl_req = ['allnodes']
+    ecl_res = command(context, *ecl_req)
+    if not isinstance(ecl_res, list):
+        return None
+    return {node['nodeId']: (node.get('alias', ''), node.get('rgbColor', ''))
+            for node in ecl_res if _def(node, 'nodeId')}
+
+
+def _lookup_node(context, pubkey):
+    """ Returns alias and color of a node, None if unknown """
+    ecl_req = ['nodes', '--nodeIds={}'.format(pubkey)]
+    ecl_res = command(context, *ecl_req)
+    if not isinstance(ecl_res, list):
+        _handle_error(context, ecl_res, always_abort=True)
+    if not ecl_res:
+        return None
+    return ecl_res[0].get('alias', ''), ecl_res[0].get('rgbColor', '')
+
+
 def _def(dictionary, key):
     """ Checks if key is in dictionary and that it's not None """
     return key in dictionary and dictionary[key] is not None
@@ -387,7 +797,7 @@ def _is_description_hash(description):
         set(description).issubset(allowed_set)
 
 
-def _add_channel(context, response, ecl_chan, active_only):
+def _add_channel(context, response, ecl_chan):
     """ Adds a channel to a ListChannelsResponse """
     # pylint: disable=too-many-branches,too-many-locals,too-many-statements
     state = None
@@ -400,8 +810,6 @@ def _add_channel(context, response, ecl_chan, active_only):
         connected = False
         if ecl_chan['state'] == 'NORMAL':
             connected = True
-    if active_only and not connected:
-        return
     grpc_chan = response.channels.add()
     grpc_chan.active = connected
     if state:
@@ -454,27 +862,31 @@ def _add_channel(context, response, ecl_chan, active_only):
                 grpc_chan.private = True
 
 
-@handle_thread
-def _close_channel(ecl_req, close_timeout, client_expiry_time):
-    """ Returns close channel response or raises exception to caller """
+def _close_channel(ecl_req, close_timeout):
+    """
+    Returns the closing txid (if found within close_timeout) or raises
+    exception to caller
+    """
     ecl_res = error = None
+    txid_deadline = time() + close_timeout
     try:
         # subtracting timeout to close channel call to retrieve closing txid
         close_timeout = close_timeout - settings.IMPL_MIN_TIMEOUT
         if close_timeout < settings.IMPL_MIN_TIMEOUT:
             close_timeout = settings.IMPL_MIN_TIMEOUT
-        ecl_res = command(FakeContext(), *ecl_req, env=settings.ECL_ENV,
+        ecl_res = command(FakeContext(), *ecl_req,
                           timeout=close_timeout)
         if isinstance(ecl_res, str) and ecl_res.strip() == 'ok':
             LOGGER.debug('[ASYNC] CloseChannel terminated with response: %s',
                          ecl_res.strip())
             ecl_req = ['channel', ecl_req[1]]
             ecl_res = None
-            # while client has still time we check if txid is available
-            while client_expiry_time > time() and not ecl_res:
+            # checking if txid is available, also after the client deadline
+            # as the outcome can be looked up with GetCloseStatus
+            while txid_deadline > time() and not ecl_res:
                 sleep(1)
                 ecl_chan = command(
-                    FakeContext(), *ecl_req, env=settings.ECL_ENV,
+                    FakeContext(), *ecl_req,
                     timeout=settings.IMPL_MIN_TIMEOUT)
                 if not _def(ecl_chan, 'data'):
                     continue
@@ -499,6 +911,154 @@ def _close_channel(ecl_req, close_timeout, client_expiry_time):
     return ecl_res
 
 
+def _get_invoice(context, ecl_payment):
+    """ Converts an eclair received payment to an Invoice message """
+    invoice = pb.Invoice(
+        payment_hash=ecl_payment['paymentHash'], state=pb.PAID,
+        amount_received_bits=_get_received_amount(context, ecl_payment))
+    ecl_req = ['getinvoice', '--paymentHash="{}"'.format(
+        ecl_payment['paymentHash'])]
+    _add_invoice_fields(context, invoice, command(context, *ecl_req))
+    return invoice
+
+
+def _get_received_amount(context, ecl_payment):
+    """ Returns the amount of an eclair received payment, in bits """
+    amount = ecl_payment.get('amount', 0)
+    if _def(ecl_payment, 'parts'):
+        amount = sum(part['amount'] for part in ecl_payment['parts'])
+    return convert(context, Enf.MSATS, amount)
+
+
+def _add_invoice_fields(context, invoice, ecl_invoice):
+    """ Adds the fields of an eclair invoice to an Invoice message """
+    if _def(ecl_invoice, 'serialized'):
+        invoice.payment_request = ecl_invoice['serialized']
+    if _def(ecl_invoice, 'amount'):
+        invoice.amount_bits = convert(
+            context, Enf.MSATS, ecl_invoice['amount'])
+    if _def(ecl_invoice, 'timestamp'):
+        invoice.timestamp = ecl_invoice['timestamp']
+    if _def(ecl_invoice, 'expiry'):
+        invoice.expiry_time = ecl_invoice['expiry']
+    if _def(ecl_invoice, 'description'):
+        if _is_description_hash(ecl_invoice['description']):
+            invoice.description_hash = ecl_invoice['description']
+        else:
+            invoice.description = ecl_invoice['description']
+
+
+def _get_invoice_row(context, ecl_invoice, ecl_status=None):
+    """
+    Converts an eclair invoice, with its received info status (if known),
+    to an invoices store row
+    """
+    invoice = pb.Invoice(
+        payment_hash=ecl_invoice['paymentHash'],
+        state=_get_invoice_state({'status': ecl_status}))
+    _add_invoice_fields(context, invoice, ecl_invoice)
+    if invoice.state == pb.PAID and _def(ecl_status, 'amount'):
+        invoice.amount_received_bits = convert(
+            context, Enf.MSATS, ecl_status['amount'])
+    return invoice_row(invoice, invoice.state == pb.PENDING)
+
+
+def _sync_invoices(context, store):
+    """
+    Saves to the invoices store the invoices created and the ones paid since
+    the last sync.
+
+    Payments are read again from the time of the last synced one (more can
+    be received in the same millisecond), in chunks of MAX_INVOICES; eclair
+    is asked for the invoice of a payment only if it is not in the store.
+    """
+    created = store.cursor('created')
+    ecl_res = command(context, 'listinvoices', '--from={}'.format(created))
+    if not isinstance(ecl_res, list):
+        _handle_error(context, ecl_res, always_abort=True)
+    for ecl_invoice in ecl_res:
+        created = max(created, ecl_invoice.get('timestamp', 0))
+    store.save([_get_invoice_row(context, ecl_invoice)
+                for ecl_invoice in ecl_res], {'created': created})
+    received = _list_received(context, store.cursor('received'))
+    for pos in range(0, len(received), settings.MAX_INVOICES):
+        chunk = received[pos:pos + settings.MAX_INVOICES]
+        amounts = {
+            ecl_payment['paymentHash']: _get_received_amount(
+                context, ecl_payment) for _time, ecl_payment in chunk}
+        known = store.set_paid(amounts)
+        store.save(
+            [invoice_row(_get_invoice(context, ecl_payment), False)
+             for _time, ecl_payment in chunk
+             if ecl_payment['paymentHash'] not in known],
+            {'received': chunk[-1][0]})
+
+
+def _lookup_invoice(context, payment_hash):
+    """
+    Returns the invoices store row of an invoice, asking eclair, None if not
+    found
+    """
+    ecl_req = ['getreceivedinfo', '--paymentHash="{}"'.format(payment_hash)]
+    ecl_res = command(context, *ecl_req)
+    if not _def(ecl_res, 'paymentRequest'):
+        return None
+    return _get_invoice_row(
+        context, ecl_res['paymentRequest'], ecl_res.get('status'))
+
+
+def _get_received_time(ecl_payment):
+    """ Returns when a payment has been received, in milliseconds """
+    if _def(ecl_payment, 'parts'):
+        return max(part['timestamp'] for part in ecl_payment['parts'])
+    return ecl_payment['timestamp']
+
+
+def _list_settled_invoices(context, settle_index):
+    """ Returns the invoices paid after settle_index (in ms) """
+    return [(received_time, _get_invoice(context, ecl_payment))
+            for received_time, ecl_payment in _list_received(
+                context, settle_index) if received_time > settle_index]
+
+
+def _list_received(context, since):
+    """
+    Returns the (received time, payment) tuples of the payments received
+    since the given time (in ms, included), in the order they were received
+    """
+    ecl_req = ['audit', '--from={}'.format(since // 1000)]
+    ecl_res = command(context, *ecl_req)
+    if not _def(ecl_res, 'received'):
+        _handle_error(context, ecl_res, always_abort=True)
+    received = [(_get_received_time(ecl_payment), ecl_payment)
+                for ecl_payment in ecl_res['received']]
+    return sorted(
+        [payment for payment in received if payment[0] >= since],
+        key=lambda payment: (payment[0], payment[1]['paymentHash']))
+
+
+def _wait_settled_invoices(settle_index):
+    """
+    Yields invoices as they get paid, since settle_index (in ms, included)
+    or from now on, polling eclair.
+
+    More payments can be received in the same millisecond, so they are told
+    apart by (received time, payment hash).
+    """
+    context = FakeContext()
+    if settle_index is None:
+        settle_index = int(time() * 1000)
+    last = (settle_index, '')
+    while True:
+        for received_time, ecl_payment in _list_received(context, last[0]):
+            key = (received_time, ecl_payment['paymentHash'])
+            if key <= last:
+                continue
+            last = key
+            yield received_time, _get_invoice(context, ecl_payment)
+        sleep(settings.ECL_POLL_TIME)
+
+
 def _get_channel_state(ecl_chan):
     """
     Maps implementation's channel state to lighter's channel state definition
@@ -17,30 +17,49 @@
 
 from binascii import hexlify
 from codecs import encode
-from concurrent.futures import TimeoutError as TimeoutFutError, \
-    ThreadPoolExecutor
-from contextlib import contextmanager, ExitStack, suppress
+from concurrent.futures import TimeoutError as TimeoutFutError
+from contextlib import contextmanager, ExitStack
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
 from logging import getLogger
 from os import environ, path
+from threading import Event, Lock
 
-from grpc import channel_ready_future, composite_channel_credentials, \
-    FutureTimeoutError, metadata_call_credentials, RpcError, secure_channel, \
-    ssl_channel_credentials
+from grpc import channel_ready_future, ChannelConnectivity, \
+    composite_channel_credentials, FutureTimeoutError, intercept_channel, \
+    metadata_call_credentials, RpcError, secure_channel, \
+    ssl_channel_credentials, StatusCode, UnaryUnaryClientInterceptor
+
+try:
+    from grpc import aio
+except ImportError:  # grpcio without asyncio support, see GRPC_ASYNC
+    aio = None
 
 from . import rpc_pb2 as ln
 from . import rpc_pb2_grpc as lnrpc
 from . import lighter_pb2 as pb
 from . import settings
+from .bolt11 import decode_invoice, has_amount_encoded
+from .cache import get_nodes_cache
+from .channels import get_channels_mirror
 from .db import session_scope
 from .errors import Err
+from .health import report_node_failure, report_node_success
+from .invoices import check_invoice, get_invoices_store, invoice_row, \
+    list_invoices, stream_invoices
+from .jobs import get_close_status, get_jobs
+from .metrics import timed_node_call
+from .payments import get_payment, pay_in_background, track_payment
+from .streams import get_invoices_hub
 from .utils import check_password, check_req_params, convert, \
-    Enforcer as Enf, FakeContext, get_channel_balances, get_secret, \
-    get_thread_timeout, get_node_timeout, handle_thread, has_amount_encoded
+    Enforcer as Enf, FakeContext, get_secret, get_thread_timeout, \
+    get_node_timeout, LogDump, paginate
 
 LOGGER = getLogger(__name__)
 
+# RpcError codes meaning that lnd could not be reached
+UNREACHABLE_CODES = (StatusCode.UNAVAILABLE,)
+
 ERRORS = {
     'already connected to peer': {
         'fun': 'connect_failed'
@@ -154,6 +173,11 @@ ERRORS = {
     }
 }
 
+# APIs with a coroutine variant, used in asyncio server mode (GRPC_ASYNC)
+ASYNC_APIS = {
+    'PayInvoice': '_pay_invoice_async'
+}
+
 LND_PAYREQ = {'min_value': 0, 'max_value': 2**32 / 1000, 'unit': Enf.SATS}
 LND_LN_TX = {'min_value': 1, 'max_value': 2**32 / 1000, 'unit': Enf.SATS}
 LND_FUNDING = {'min_value': 20000, 'max_value': 2**24, 'unit': Enf.SATS}
@@ -189,6 +213,26 @@ def update_settings(macaroon):
             settings.LND_CREDS_SSL, auth_creds)
     else:
         LOGGER.info("Connecting to lnd in insecure mode")
+    disconnect()
+    settings.LND_POOL_FULL = ChannelPool(
+        settings.LND_CREDS_FULL, settings.LND_POOL_SIZE)
+    # WalletUnlocker service does not accept macaroons
+    settings.LND_POOL_SSL = ChannelPool(settings.LND_CREDS_SSL, 1)
+
+
+def on_connect():
+    """ Loads the network nodes in background once lnd is reachable """
+    get_nodes_cache(_load_nodes, _lookup_node).start()
+
+
+def disconnect():
+    """ Closes all gRPC channels to lnd """
+    for pool in (settings.LND_POOL_FULL, settings.LND_POOL_SSL):
+        if pool:
+            pool.close()
+    settings.LND_POOL_FULL = settings.LND_POOL_SSL = None
+    # bound to the event loop of the stopped server, will be garbage collected
+    settings.LND_AIO_CHANNEL = None
 
 
 def _metadata_callback(context, callback):  # pylint: disable=unused-argument
@@ -210,25 +254,137 @@ def _handle_rpc_errors(func):
     return wrapper
 
 
+class ChannelPool():
+    """
+    Thread-safe round-robin pool of long-lived gRPC channels to lnd.
+
+    Channels are opened lazily and kept open (with keepalive) across
+    requests, so the TCP + TLS handshake is paid once per channel.
+    """
+
+    def __init__(self, creds, size):
+        self._creds = creds
+        self._lock = Lock()
+        self._next = 0
+        self._slots = [None] * size
+
+    def get(self):
+        """ Returns the next channel slot, opening its channel if needed """
+        with self._lock:
+            index = self._next
+            self._next = (self._next + 1) % len(self._slots)
+            if self._slots[index] is None:
+                self._slots[index] = _ChannelSlot(self._creds)
+            return self._slots[index]
+
+    def reset(self, slot):
+        """ Drops a broken slot so that a new channel will be opened """
+        with self._lock:
+            for index, pooled in enumerate(self._slots):
+                if pooled is slot:
+                    self._slots[index] = None
+        slot.close()
+
+    def close(self):
+        """ Closes all channels of the pool """
+        with self._lock:
+            slots = [slot for slot in self._slots if slot]
+            self._slots = [None] * len(self._slots)
+        for slot in slots:
+            slot.close()
+
+
+class _ChannelSlot():
+    """ A pooled gRPC channel, its connectivity state and cached stubs """
+
+    def __init__(self, creds):
+        self.channel = secure_channel(
+            settings.LND_ADDR, creds, options=settings.LND_CHANNEL_OPTIONS)
+        self.state = None
+        self._stubs = {}
+        self._timed_channel = intercept_channel(
+            self.channel, _NodeCallTimer())
+        self.channel.subscribe(self._update_state, try_to_connect=True)
+
+    def _update_state(self, state):
+        """ Keeps track of the channel connectivity state """
+        self.state = state
+
+    def is_ready(self):
+        """ Whether the channel is currently connected """
+        return self.state == ChannelConnectivity.READY
+
+    def get_stub(self, stub_class):
+        """ Returns a stub of stub_class bound to the channel """
+        stub = self._stubs.get(stub_class)
+        if stub is None:
+            stub = self._stubs[stub_class] = stub_class(self._timed_channel)
+        return stub
+
+    def close(self):
+        """ Closes the channel """
+        self.channel.unsubscribe(self._update_state)
+        self.channel.close()
+
+
+class _NodeCallTimer(UnaryUnaryClientInterceptor):
+    """ Observes the duration of unary calls to lnd """
+
+    # pylint: disable=too-few-public-methods
+
+    def intercept_unary_unary(self, continuation, client_call_details,
+                              request):
+        """ Times the call, by lnd method name """
+        with timed_node_call(client_call_details.method.rsplit('/', 1)[-1]):
+            return continuation(client_call_details, request)
+
+
 @contextmanager
 def _connect(context, stub_class=None, force_no_macaroon=False):
-    """ Securely connects to the lnd node using gRPC """
-    creds = settings.LND_CREDS_FULL
+    """ Gets a stub using a pooled secure gRPC channel to the lnd node """
+    pool = settings.LND_POOL_FULL
     if force_no_macaroon:
-        creds = settings.LND_CREDS_SSL
-    channel = secure_channel(settings.LND_ADDR, creds)
-    future_channel = channel_ready_future(channel)
+        pool = settings.LND_POOL_SSL
+    if pool is None:
+        Err().node_error(context, 'Connection to lnd is not configured')
+    slot = pool.get()
+    if not slot.is_ready():
+        future_channel = channel_ready_future(slot.channel)
+        try:
+            future_channel.result(timeout=get_node_timeout(context))
+        except FutureTimeoutError:
+            # Handle gRPC channel that did not connect, a new one will be
+            # opened by the next request
+            pool.reset(slot)
+            report_node_failure('Failed to dial server')
+            Err().node_error(context, 'Failed to dial server')
+    if stub_class is None:
+        stub_class = lnrpc.LightningStub
     try:
-        future_channel.result(timeout=get_node_timeout(context))
-    except FutureTimeoutError:
-        # Handle gRPC channel that did not connect
-        Err().node_error(context, 'Failed to dial server')
-    else:
-        if stub_class is None:
-            stub_class = lnrpc.LightningStub
-        stub = stub_class(channel)
-        yield stub
-        channel.close()
+        yield slot.get_stub(stub_class)
+    except RpcError as error:
+        code = error.code() if hasattr(error, 'code') else None
+        if code in UNREACHABLE_CODES:
+            report_node_failure(error.details())
+        elif code != StatusCode.DEADLINE_EXCEEDED:
+            # a call exceeding the client deadline doesn't tell if lnd is up
+            report_node_success()
+        raise
+    report_node_success()
+
+
+def _get_aio_stub(context):
+    """
+    Gets a stub using the grpc.aio channel to the lnd node (asyncio server
+    mode), opening it if needed
+    """
+    if not settings.LND_CREDS_FULL:
+        Err().node_error(context, 'Connection to lnd is not configured')
+    if settings.LND_AIO_CHANNEL is None:
+        settings.LND_AIO_CHANNEL = aio.secure_channel(
+            settings.LND_ADDR, settings.LND_CREDS_FULL,
+            options=settings.LND_CHANNEL_OPTIONS)
+    return lnrpc.LightningStub(settings.LND_AIO_CHANNEL)
 
 
 def unlock_node(ctx, password, session=None):
@@ -318,90 +474,31 @@ def WalletBalance(request, context):  # pylint: disable=unused-argument
     return response
 
 
-@_handle_rpc_errors
 def ChannelBalance(request, context):  # pylint: disable=unused-argument
     """ Returns the off-chain balance in bits available across all channels """
-    # pylint: disable=no-member
-    channels = ListChannels(pb.ListChannelsRequest(), context).channels
-    return get_channel_balances(context, channels)
+    return _get_channels_mirror().channel_balance(context)
 
 
-@_handle_rpc_errors
 def ListChannels(request, context):
     """ Returns a list of channels of the running LN node """
-    response = pb.ListChannelsResponse()
-    lnd_req = ln.ListChannelsRequest()
-    with _connect(context) as stub:
-        lnd_res = stub.ListChannels(lnd_req, timeout=get_node_timeout(context))
-        for lnd_chan in lnd_res.channels:
-            _add_channel(context, response, lnd_chan, pb.OPEN,
-                         active_only=request.active_only, open_chan=True)
-        if not request.active_only:
-            lnd_req = ln.PendingChannelsRequest()
-            lnd_res = stub.PendingChannels(
-                lnd_req, timeout=get_node_timeout(context))
-            for lnd_chan in lnd_res.pending_open_channels:
-                _add_channel(context, response, lnd_chan.channel,
-                             pb.PENDING_OPEN)
-            for lnd_chan in lnd_res.pending_closing_channels:
-                _add_channel(context, response, lnd_chan.channel,
-                             pb.PENDING_MUTUAL_CLOSE)
-            for lnd_chan in lnd_res.pending_force_closing_channels:
-                _add_channel(context, response, lnd_chan.channel,
-                             pb.PENDING_FORCE_CLOSE)
-            for lnd_chan in lnd_res.waiting_close_channels:
-                _add_channel(context, response, lnd_chan.channel,
-                             pb.UNKNOWN)
-    return response
+    return _get_channels_mirror().list_channels(context, request.active_only)
 
 
 @_handle_rpc_errors
 def ListInvoices(request, context):
-    """ Returns a list of lightning invoices created by the running LN node """
-    if not request.max_items:
-        request.max_items = settings.MAX_INVOICES
-    response = pb.ListInvoicesResponse()
-    lnd_req = ln.ListInvoiceRequest(
-        reversed=request.search_order,
-        num_max_invoices=request.max_items * settings.INVOICES_TIMES)
-    stop = False
-    with _connect(context) as stub:
-        while True:
-            lnd_res = stub.ListInvoices(
-                lnd_req, timeout=get_node_timeout(context))
-            if not lnd_res.invoices:
-                break
-            if request.search_order:
-                lnd_res.CopyFrom(ln.ListInvoiceResponse(
-                    invoices=reversed(lnd_res.invoices),
-                    first_index_offset=lnd_res.first_index_offset,
-                    last_index_offset=lnd_res.last_index_offset))
-            stop = _parse_invoices(
-                context, response, lnd_res.invoices, request)
-            if stop:
-                break
-            if request.search_order:
-                lnd_req.index_offset = lnd_res.first_index_offset
-            else:
-                lnd_req.index_offset = lnd_res.last_index_offset
-        if request.list_order != request.search_order:
-            # pylint: disable=no-member
-            response.CopyFrom(pb.ListInvoicesResponse(
-                invoices=reversed(response.invoices)))
-            # pylint: enable=no-member
-    return response
+    """
+    Returns a list of lightning invoices created by the running LN node,
+    from the invoices store
+    """
+    return list_invoices(request, context, _sync_invoices)
 
 
 @_handle_rpc_errors
-def ListPayments(request, context):  # pylint: disable=unused-argument
+def ListPayments(request, context):
     """ Returns a list of lightning invoices paid by the running LN node """
-    response = pb.ListPaymentsResponse()
-    lnd_req = ln.ListPaymentsRequest()
-    with _connect(context) as stub:
-        lnd_res = stub.ListPayments(lnd_req, timeout=get_node_timeout(context))
-        for lnd_payment in lnd_res.payments:
-            _add_payment(context, response, lnd_payment)
-    return response
+    lnd_payments = _list_payments(context)
+    return next(_get_payments_pages(
+        context, request, lnd_payments, request.max_items))
 
 
 @_handle_rpc_errors
@@ -411,30 +508,25 @@ def ListPeers(request, context):  # pylint: disable=unused-argument
     lnd_req = ln.ListPeersRequest()
     with _connect(context) as stub:
         lnd_res = stub.ListPeers(lnd_req, timeout=get_node_timeout(context))
-        for lnd_peer in lnd_res.peers:
-            peer = response.peers.add(  # pylint: disable=no-member
-                pubkey=lnd_peer.pub_key,
-                address=lnd_peer.address)
-            lnd_req = ln.NodeInfoRequest(pub_key=lnd_peer.pub_key)
-            with suppress(RpcError):
-                lnd_res = stub.GetNodeInfo(
-                    lnd_req, timeout=get_node_timeout(context))
-                peer.alias = lnd_res.node.alias
-                peer.color = lnd_res.node.color
+    if not lnd_res.peers:
+        return response
+    nodes = get_nodes_cache(_load_nodes, _lookup_node).get_nodes(
+        context, [lnd_peer.pub_key for lnd_peer in lnd_res.peers])
+    for lnd_peer in lnd_res.peers:
+        peer = response.peers.add(  # pylint: disable=no-member
+            pubkey=lnd_peer.pub_key,
+            address=lnd_peer.address)
+        if lnd_peer.pub_key in nodes:
+            peer.alias, peer.color = nodes[lnd_peer.pub_key]
     return response
 
 
 @_handle_rpc_errors
-def ListTransactions(request, context):  # pylint: disable=unused-argument
+def ListTransactions(request, context):
     """ Returns a list of on-chain transactions of the running LN node """
-    response = pb.ListTransactionsResponse()
-    lnd_req = ln.GetTransactionsRequest()
-    with _connect(context) as stub:
-        lnd_res = stub.GetTransactions(
-            lnd_req, timeout=get_node_timeout(context))
-        for lnd_transaction in lnd_res.transactions:
-            _add_transaction(context, response, lnd_transaction)
-    return response
+    lnd_transactions = _list_transactions(context)
+    return next(_get_transactions_pages(
+        context, request, lnd_transactions, request.max_items))
 
 
 @_handle_rpc_errors
@@ -473,23 +565,17 @@ def CreateInvoice(request, context):
             lnd_res = stub.LookupInvoice(
                 lnd_req, timeout=get_node_timeout(context))
             response.expires_at = lnd_res.creation_date + lnd_res.expiry
+            get_invoices_store().save([_get_invoice_row(context, lnd_res)])
     return response
 
 
 @_handle_rpc_errors
 def CheckInvoice(request, context):
-    """ Checks if a LN invoice has been paid """
-    check_req_params(context, request, 'payment_hash')
-    response = pb.CheckInvoiceResponse()
-    lnd_req = ln.PaymentHash(r_hash_str=request.payment_hash)
-    with _connect(context) as stub:
-        lnd_res = stub.LookupInvoice(
-            lnd_req, timeout=get_node_timeout(context))
-        # pylint: disable=no-member
-        response.state = _get_invoice_state(lnd_res)
-        if response.state == pb.PAID:
-            response.settled = True
-    return response
+    """
+    Checks if a LN invoice has been paid, from the invoices store (asking
+    lnd for pending and unknown invoices only)
+    """
+    return check_invoice(request, context, _sync_invoices, _lookup_invoice)
 
 
 @_handle_rpc_errors
@@ -500,9 +586,38 @@ def PayInvoice(request, context):
     If a description hash is included in the invoice, its preimage must be
     included in the request
     """
+    lnd_req = _get_send_request(request, context)
+    if request.no_wait:
+        return pay_in_background(
+            context, request.payment_request,
+            partial(_send_payment, lnd_req), _check_payment)
+    with _connect(context) as stub:
+        lnd_res = stub.SendPaymentSync(
+            lnd_req, timeout=get_node_timeout(context))
+    return _get_pay_response(context, lnd_res)
+
+
+async def _pay_invoice_async(request, context):
+    """ PayInvoice for the asyncio server mode """
+    lnd_req = _get_send_request(request, context)
+    if request.no_wait:
+        return pay_in_background(
+            context, request.payment_request,
+            partial(_send_payment, lnd_req), _check_payment)
+    stub = _get_aio_stub(context)
+    try:
+        with timed_node_call('SendPaymentSync'):
+            lnd_res = await stub.SendPaymentSync(
+                lnd_req, timeout=get_node_timeout(context))
+    except RpcError as error:
+        _handle_error(context, error)
+    return _get_pay_response(context, lnd_res)
+
+
+def _get_send_request(request, context):
+    """ Checks a PayInvoiceRequest and returns the SendRequest to send """
     check_req_params(context, request, 'payment_request')
     amount_encoded = has_amount_encoded(request.payment_request)
-    response = pb.PayInvoiceResponse()
     lnd_req = ln.SendRequest(payment_request=request.payment_request)
     if request.cltv_expiry_delta:
         if Enf.check_value(
@@ -521,13 +636,72 @@ def PayInvoice(request, context):
     elif not amount_encoded:
         check_req_params(context, request, 'amount_bits')
     # pylint: enable=no-member
-    with _connect(context) as stub:
-        lnd_res = stub.SendPaymentSync(
-            lnd_req, timeout=get_node_timeout(context))
-        if lnd_res.payment_preimage:
-            response.payment_preimage = hexlify(lnd_res.payment_preimage)
-        elif lnd_res.payment_error:
-            _handle_error(context, lnd_res.payment_error)
+    return lnd_req
+
+
+def _send_payment(lnd_req, update):  # pylint: disable=unused-argument
+    """
+    Background payment job, pays through the streaming SendPayment (keeping
+    the request stream open until the outcome is received) and returns the
+    payment preimage, or None if lnd could not be heard (the payment may be
+    in flight)
+    """
+    context = FakeContext()
+    received = Event()
+
+    def requests():
+        yield lnd_req
+        received.wait(settings.PAY_TIMEOUT)
+
+    try:
+        with _connect(context) as stub:
+            for lnd_res in stub.SendPayment(
+                    requests(), timeout=settings.PAY_TIMEOUT):
+                return _get_pay_response(context, lnd_res).payment_preimage
+    except RpcError as error:
+        # the payment may have been sent before the node went silent
+        if not hasattr(error, 'code') or error.code() not in (
+                StatusCode.DEADLINE_EXCEEDED, StatusCode.UNAVAILABLE):
+            _handle_error(context, error)
+        LOGGER.warning('No outcome from SendPayment: %s', error.details())
+    finally:
+        received.set()
+    return None
+
+
+def _check_payment(payment_hash):
+    """
+    Returns the GetPaymentResponse of a payment made by SendPayment, as
+    listed by ListPayments (lnd does not list payments that never started)
+    """
+    context = FakeContext()
+    lnd_req = ln.ListPaymentsRequest(include_incomplete=True)
+    try:
+        with _connect(context) as stub:
+            lnd_res = stub.ListPayments(
+                lnd_req, timeout=get_node_timeout(context))
+    except RpcError as error:
+        _handle_error(context, error)
+    for lnd_payment in lnd_res.payments:
+        if lnd_payment.payment_hash != payment_hash:
+            continue
+        if lnd_payment.status == ln.Payment.IN_FLIGHT:
+            return pb.GetPaymentResponse(state=pb.IN_FLIGHT)
+        if lnd_payment.payment_preimage and \
+                lnd_payment.status != ln.Payment.FAILED:
+            return pb.GetPaymentResponse(
+                state=pb.SUCCEEDED,
+                payment_preimage=lnd_payment.payment_preimage)
+    return pb.GetPaymentResponse(state=pb.FAILED)
+
+
+def _get_pay_response(context, lnd_res):
+    """ Returns the PayInvoiceResponse of a SendResponse """
+    response = pb.PayInvoiceResponse()
+    if lnd_res.payment_preimage:
+        response.payment_preimage = hexlify(lnd_res.payment_preimage)
+    elif lnd_res.payment_error:
+        _handle_error(context, lnd_res.payment_error)
     return response
 
 
@@ -554,13 +728,65 @@ def PayOnChain(request, context):
 
 
 @_handle_rpc_errors
+def StreamInvoices(request, context):
+    """ Streams the requested lightning invoices, in chunks """
+    return stream_invoices(request, context, _sync_invoices)
+
+
+@_handle_rpc_errors
+def StreamPayments(request, context):
+    """
+    Streams the lightning invoices paid by the running LN node, in chunks
+    """
+    lnd_payments = _list_payments(context)
+    return _get_payments_pages(
+        context, request, lnd_payments,
+        request.max_items or settings.STREAM_ITEMS)
+
+
+@_handle_rpc_errors
+def StreamTransactions(request, context):
+    """
+    Streams the on-chain transactions of the running LN node, in chunks
+    """
+    lnd_transactions = _list_transactions(context)
+    return _get_transactions_pages(
+        context, request, lnd_transactions,
+        request.max_items or settings.STREAM_ITEMS)
+
+
+def SubscribeInvoices(request, context):
+    """ Streams paid invoices, resuming from settle_index if requested """
+    hub = get_invoices_hub(_list_settled_invoices, _wait_settled_invoices)
+    return hub.subscribe(context, request.settle_index)
+
+
+def GetPayment(request, context):
+    """ Returns the state of a payment made by PayInvoice with no_wait """
+    return get_payment(request, context)
+
+
+def TrackPayment(request, context):
+    """ Streams the state of a payment made by PayInvoice with no_wait """
+    return track_payment(request, context)
+
+
 def DecodeInvoice(request, context):
     """
     Tries to return information of a LN invoice from its payment request
-    (bolt 11 standard)
+    (bolt 11 standard), decoding it locally when possible
     """
-    response = pb.DecodeInvoiceResponse()
     check_req_params(context, request, 'payment_request')
+    response = decode_invoice(context, request, int_scid=True)
+    if response is not None:
+        return response
+    return _decode_invoice_node(request, context)
+
+
+@_handle_rpc_errors
+def _decode_invoice_node(request, context):
+    """ Returns a DecodeInvoiceResponse asking lnd to decode """
+    response = pb.DecodeInvoiceResponse()
     lnd_req = ln.PayReqString(pay_req=request.payment_request)
     with _connect(context) as stub:
         lnd_res = stub.DecodePayReq(lnd_req, timeout=get_node_timeout(context))
@@ -627,7 +853,7 @@ def CloseChannel(request, context):
     channel_id = 0
     try:
         channel_id = int(request.channel_id)
-    except ValueError as err:
+    except ValueError:
         Err().invalid(context, 'channel_id')
     lnd_req = ln.ChanInfoRequest(chan_id=channel_id)
     with _connect(context) as stub:
@@ -637,16 +863,16 @@ def CloseChannel(request, context):
             funding_txid_str=txid, output_index=int(vout))
         lnd_req = ln.CloseChannelRequest(
             channel_point=chan_point, force=request.force)
-        executor = ThreadPoolExecutor(max_workers=1)
         close_time = get_node_timeout(
             context, min_time=settings.CLOSE_TIMEOUT_NODE)
-        future = executor.submit(_close_channel, lnd_req, close_time)
+        job_id, future = get_jobs().submit(
+            context, 'close', _close_channel, lnd_req, close_time)
         try:
             lnd_res = future.result(timeout=get_thread_timeout(context))
             if lnd_res:
                 response.closing_txid = lnd_res
         except TimeoutFutError:
-            executor.shutdown(wait=False)
+            response.job_id = job_id
         except RpcError as err:
             _handle_error(context, err)
         except RuntimeError as err:
@@ -654,12 +880,14 @@ def CloseChannel(request, context):
     return response
 
 
+def GetCloseStatus(request, context):
+    """ Returns the outcome of a CloseChannel call from its job ID """
+    return get_close_status(request, context)
+
+
 # pylint: disable=too-many-arguments
-def _add_channel(context, response, lnd_chan, state, active_only=False,
-                 open_chan=False):
+def _add_channel(context, response, lnd_chan, state, open_chan=False):
     """ Adds an open or pending channel to a ListChannelsResponse """
-    if active_only and not lnd_chan.active:
-        return
     if lnd_chan.ListFields():
         channel = response.channels.add(
             funding_txid=lnd_chan.channel_point.split(':')[0],
@@ -681,51 +909,16 @@ def _add_channel(context, response, lnd_chan, state, active_only=False,
     # pylint: enable=too-many-arguments
 
 
-def _check_timestamp(request, lnd_invoice):
-    """
-    Checks creation_date against search_timestamp to decide if invoice has to
-    be skipped (not added to response)
-    """
-    if not request.search_timestamp:
-        return False
-    if request.list_order:
-        # descending list_order
-        if request.search_order:
-            # descending search_order: use descending list, skip newer invoices
-            # will stop when list reaches max_items size
-            if lnd_invoice.creation_date >= request.search_timestamp:
-                return True
-        else:
-            # ascending search_order: use ascending list, skip older invoices
-            # must flip the list at the end
-            if lnd_invoice.creation_date <= request.search_timestamp:
-                return True
-    else:
-        # ascending list_order
-        if request.search_order:
-            # descending search_order: use descending list, skip newer invoices
-            # must flip the list at the end
-            if lnd_invoice.creation_date >= request.search_timestamp:
-                return True
-        else:
-            # ascending search_order: use ascending list, skip older invoices
-            # will stop when list reaches max_items size
-            if lnd_invoice.creation_date <= request.search_timestamp:
-                return True
-    return False
-
-
-@handle_thread
 def _close_channel(lnd_req, close_timeout):
-    """ Returns close channel response or raises exception to caller """
-    lnd_res = None
+    """ Returns the closing txid (if any) or raises exception to caller """
+    txid = None
     try:
         with _connect(FakeContext()) as stub:
             for lnd_res in stub.CloseChannel(lnd_req, timeout=close_timeout):
                 LOGGER.debug('[ASYNC] CloseChannel released response: %s',
-                             str(lnd_res).replace('\n', ''))
+                             LogDump(lnd_res))
                 if lnd_res.close_pending.txid:
-                    lnd_res = _txid_bytes_to_str(lnd_res.close_pending.txid)
+                    txid = _txid_bytes_to_str(lnd_res.close_pending.txid)
                     break
     except RpcError as err:
         # pylint: disable=no-member
@@ -734,27 +927,7 @@ def _close_channel(lnd_req, close_timeout):
         raise err
     except RuntimeError as err:
         raise err
-    return lnd_res
-
-
-def _parse_invoices(context, response, invoices, request):
-    """
-    Decides, according to the request, if invoice has to be added and which
-    with state (paid, pending, expired)
-    """
-    for lnd_invoice in invoices:
-        if _check_timestamp(request, lnd_invoice):
-            continue
-        invoice_state = _get_invoice_state(lnd_invoice)
-        if request.paid and invoice_state == pb.PAID:
-            _add_invoice(context, response, lnd_invoice, invoice_state)
-        if request.pending and invoice_state == pb.PENDING:
-            _add_invoice(context, response, lnd_invoice, invoice_state)
-        if request.expired and invoice_state == pb.EXPIRED:
-            _add_invoice(context, response, lnd_invoice, invoice_state)
-        if len(response.invoices) == request.max_items:
-            return True
-    return False
+    return txid
 
 
 def _add_invoice(context, response, lnd_invoice, invoice_state):
@@ -776,6 +949,227 @@ def _add_invoice(context, response, lnd_invoice, invoice_state):
             _add_route_hint(invoice, lnd_route)
 
 
+def _get_invoice(context, lnd_invoice, invoice_state):
+    """ Converts an lnd invoice to an Invoice message """
+    response = pb.ListInvoicesResponse()
+    _add_invoice(context, response, lnd_invoice, invoice_state)
+    return response.invoices[0]  # pylint: disable=no-member
+
+
+def _get_invoice_row(context, lnd_invoice):
+    """ Converts an lnd invoice to an invoices store row """
+    invoice = _get_invoice(
+        context, lnd_invoice, _get_invoice_state(lnd_invoice))
+    # pylint: disable=no-member
+    is_open = lnd_invoice.state in (ln.Invoice.OPEN, ln.Invoice.ACCEPTED)
+    return invoice_row(invoice, is_open, node_index=lnd_invoice.add_index)
+
+
+def _sync_invoices(context, store):
+    """
+    Saves to the invoices store the invoices added after the last synced one
+    and the ones that could have changed since (added after the oldest open
+    one, see get_oldest_open_index); add_index is the only paging cursor
+    """
+    add_index = store.cursor('add_index')
+    index_offset = add_index
+    oldest_open = store.get_oldest_open_index()
+    if oldest_open:
+        index_offset = min(index_offset, oldest_open - 1)
+    lnd_req = ln.ListInvoiceRequest(
+        index_offset=index_offset, num_max_invoices=settings.MAX_INVOICES)
+    with _connect(context) as stub:
+        while True:
+            lnd_res = stub.ListInvoices(
+                lnd_req, timeout=get_node_timeout(context))
+            if not lnd_res.invoices:
+                break
+            add_index = max(add_index, lnd_res.last_index_offset)
+            store.save(
+                [_get_invoice_row(context, lnd_invoice)
+                 for lnd_invoice in lnd_res.invoices],
+                {'add_index': add_index})
+            lnd_req.index_offset = lnd_res.last_index_offset
+
+
+def _lookup_invoice(context, payment_hash):
+    """ Returns the invoices store row of an invoice, asking lnd """
+    lnd_req = ln.PaymentHash(r_hash_str=payment_hash)
+    with _connect(context) as stub:
+        lnd_res = stub.LookupInvoice(
+            lnd_req, timeout=get_node_timeout(context))
+    return _get_invoice_row(context, lnd_res)
+
+
+def _list_settled_invoices(context, settle_index):
+    """ Returns the invoices settled after settle_index """
+    settled = []
+    lnd_req = ln.ListInvoiceRequest(num_max_invoices=settings.MAX_INVOICES)
+    try:
+        with _connect(context) as stub:
+            while True:
+                lnd_res = stub.ListInvoices(
+                    lnd_req, timeout=get_node_timeout(context))
+                if not lnd_res.invoices:
+                    break
+                for lnd_invoice in lnd_res.invoices:
+                    if lnd_invoice.state == ln.Invoice.SETTLED and \
+                            lnd_invoice.settle_index > settle_index:
+                        settled.append((
+                            lnd_invoice.settle_index,
+                            _get_invoice(context, lnd_invoice, pb.PAID)))
+                lnd_req.index_offset = lnd_res.last_index_offset
+    except RpcError as error:
+        _handle_error(context, error)
+    return sorted(settled, key=lambda event: event[0])
+
+
+def _wait_settled_invoices(settle_index):
+    """
+    Yields invoices as they get settled, after settle_index or from now on
+    """
+    context = FakeContext()
+    lnd_req = ln.InvoiceSubscription(settle_index=settle_index or 0)
+    with _connect(context) as stub:
+        lnd_res = stub.SubscribeInvoices(lnd_req)
+    try:
+        for lnd_invoice in lnd_res:
+            # skipping newly added invoices
+            if lnd_invoice.state == ln.Invoice.SETTLED:
+                yield lnd_invoice.settle_index, _get_invoice(
+                    context, lnd_invoice, pb.PAID)
+    finally:
+        lnd_res.cancel()
+
+
+def _get_channels_mirror():
+    """ Returns the ChannelsMirror, watching lnd channel events """
+    return get_channels_mirror(_list_channels, _watch_channels)
+
+
+def _list_channels(context):
+    """ Returns all open and pending channels of lnd """
+    response = pb.ListChannelsResponse()
+    try:
+        with _connect(context) as stub:
+            lnd_res = stub.ListChannels(
+                ln.ListChannelsRequest(), timeout=get_node_timeout(context))
+            for lnd_chan in lnd_res.channels:
+                _add_channel(
+                    context, response, lnd_chan, pb.OPEN, open_chan=True)
+            lnd_res = stub.PendingChannels(
+                ln.PendingChannelsRequest(),
+                timeout=get_node_timeout(context))
+            for lnd_chan in lnd_res.pending_open_channels:
+                _add_channel(context, response, lnd_chan.channel,
+                             pb.PENDING_OPEN)
+            for lnd_chan in lnd_res.pending_closing_channels:
+                _add_channel(context, response, lnd_chan.channel,
+                             pb.PENDING_MUTUAL_CLOSE)
+            for lnd_chan in lnd_res.pending_force_closing_channels:
+                _add_channel(context, response, lnd_chan.channel,
+                             pb.PENDING_FORCE_CLOSE)
+            for lnd_chan in lnd_res.waiting_close_channels:
+                _add_channel(context, response, lnd_chan.channel,
+                             pb.UNKNOWN)
+    except RpcError as error:
+        _handle_error(context, error)
+    return response.channels
+
+
+def _watch_channels():
+    """
+    Yields whenever a channel is opened, closed, activated or deactivated
+    """
+    context = FakeContext()
+    lnd_req = ln.ChannelEventSubscription()
+    with _connect(context) as stub:
+        for _lnd_event in stub.SubscribeChannelEvents(lnd_req):
+            yield
+
+
+def _load_nodes(context):
+    """
+    Returns alias and color of the nodes in the network graph, None if it
+    can't be read
+    """
+    lnd_req = ln.ChannelGraphRequest()
+    try:
+        with _connect(context) as stub:
+            # reading the whole graph can take longer than a usual call (it
+            # is loaded in background)
+            lnd_res = stub.DescribeGraph(
+                lnd_req, timeout=get_node_timeout(
+                    context, min_time=settings.IMPL_MAX_TIMEOUT))
+    except RpcError as err:
+        LOGGER.debug('Reading network graph failed: %s', err)
+        return None
+    return {
+        lnd_node.pub_key: (lnd_node.alias, lnd_node.color)
+        for lnd_node in lnd_res.nodes}
+
+
+def _lookup_node(context, pubkey):
+    """ Returns alias and color of a node, None if lnd doesn't know it """
+    lnd_req = ln.NodeInfoRequest(pub_key=pubkey)
+    try:
+        with _connect(context) as stub:
+            lnd_res = stub.GetNodeInfo(
+                lnd_req, timeout=get_node_timeout(context))
+    except RpcError as err:
+        if hasattr(err, 'code') and err.code() == StatusCode.NOT_FOUND:
+            return None
+        raise
+    return lnd_res.node.alias, lnd_res.node.color
+
+
+def _list_payments(context):
+    """ Returns the payments of the node """
+    lnd_req = ln.ListPaymentsRequest()
+    with _connect(context) as stub:
+        lnd_res = stub.ListPayments(lnd_req, timeout=get_node_timeout(context))
+    return lnd_res.payments
+
+
+def _get_payments_pages(context, request, lnd_payments, size):
+    """
+    Yields the ListPaymentsResponse pages of lnd_payments, oldest first,
+    following request.cursor
+    """
+    pages = paginate(
+        context, request, lnd_payments,
+        lambda lnd_pay: (lnd_pay.creation_date, lnd_pay.payment_hash), size)
+    for page, next_cursor in pages:
+        response = pb.ListPaymentsResponse(next_cursor=next_cursor)
+        for lnd_payment in page:
+            _add_payment(context, response, lnd_payment)
+        yield response
+
+
+def _list_transactions(context):
+    """ Returns the on-chain transactions of the node """
+    lnd_req = ln.GetTransactionsRequest()
+    with _connect(context) as stub:
+        lnd_res = stub.GetTransactions(
+            lnd_req, timeout=get_node_timeout(context))
+    return lnd_res.transactions
+
+
+def _get_transactions_pages(context, request, lnd_transactions, size):
+    """
+    Yields the ListTransactionsResponse pages of lnd_transactions, oldest
+    first, following request.cursor
+    """
+    pages = paginate(
+        context, request, lnd_transactions,
+        lambda lnd_tx: (lnd_tx.time_stamp, lnd_tx.tx_hash), size)
+    for page, next_cursor in pages:
+        response = pb.ListTransactionsResponse(next_cursor=next_cursor)
+        for lnd_transaction in page:
+            _add_transaction(context, response, lnd_transaction)
+        yield response
+
+
 def _add_payment(context, response, lnd_payment):
     """ Adds a payment to a ListPaymentsResponse """
     if lnd_payment.ListFields():
@@ -17,26 +17,44 @@
 
 from concurrent.futures import TimeoutError as TimeoutFutError, \
     ThreadPoolExecutor
+from functools import partial
 from importlib import import_module
 from logging import getLogger
 from threading import Thread
-from time import sleep
+from time import monotonic, sleep
 
-from grpc import server, ServerInterceptor, ssl_server_credentials, \
-    StatusCode, unary_unary_rpc_method_handler
+from grpc import GenericRpcHandler, server, ServerInterceptor, \
+    ssl_server_credentials, StatusCode, unary_stream_rpc_method_handler, \
+    unary_unary_rpc_method_handler
+from grpc_health.v1.health_pb2_grpc import add_HealthServicer_to_server
 
 from . import lighter_pb2_grpc as pb_grpc
 from . import lighter_pb2 as pb
 from . import settings as sett
+from .cache import ResponseCache, SingleFlight
+from .channels import close_channels_mirror, invalidate_channels_mirror
 from .db import get_mac_params_from_db, init_db, is_db_ok, session_scope
 from .errors import Err
-from .macaroons import check_macaroons, get_baker
+from .health import close_health_servicer, close_node_health, \
+    get_health_servicer, GetNodeHealth, HEALTH_METHODS, NodeHealth, \
+    update_serving_status
+from .macaroons import check_macaroons, get_baker, MacaroonCache
+from .metrics import GetMetrics, start_metrics_server, timed_handler
+from .invoices import close_invoices_store
+from .payments import close_payments_tracker
+from .profiler import Profiler, ProfileLighter
+from .streams import close_invoices_hub
 from .utils import check_connection, check_password, check_req_params, \
     Crypter, detect_impl_secret, FakeContext, get_secret, get_start_options, \
     handle_keyboardinterrupt, handle_logs, ScryptParams
 
 LOGGER = getLogger(__name__)
 
+# Lightning service methods served by Lighter itself, without the node
+LIGHTER_METHODS = {
+    'GetMetrics': GetMetrics, 'GetNodeHealth': GetNodeHealth,
+    'ProfileLighter': ProfileLighter}
+
 
 class UnlockerServicer(pb_grpc.UnlockerServicer):
     """
@@ -111,42 +129,123 @@ class LockerServicer(pb_grpc.LockerServicer):
         password = request.password
         with session_scope(context) as session:
             check_password(context, session, password)
+        close_health_servicer()
         sett.RUNTIME_SERVER.stop(sett.GRPC_GRACE_TIME)
+        if sett.MAC_CACHE:
+            sett.MAC_CACHE.clear()
+        if sett.RESPONSE_CACHE:
+            sett.RESPONSE_CACHE.clear()
+        sett.NODES_CACHE = None
+        close_node_health()
+        close_channels_mirror()
+        close_invoices_hub()
+        close_invoices_store()
+        close_payments_tracker()
+        # Closes implementation connections, they carry secrets
+        mod = import_module('lighter.light_{}'.format(sett.IMPLEMENTATION))
+        disconnect = getattr(mod, 'disconnect', None)
+        if disconnect:
+            disconnect()
         restart_thread = Thread(target=start)
         restart_thread.daemon = True
         restart_thread.start()
         sett.MAC_ROOT_KEY = None
         sett.RUNTIME_BAKER = None
-        sett.ECL_ENV = None
         sett.LND_MAC = None
         return pb.LockLighterResponse()
 
 
-class LightningServicer():  # pylint: disable=too-few-public-methods
+class LightningServicer(GenericRpcHandler):
     """
     LightningServicer provides an implementation of the methods of the
     Lightning service.
 
-    Not deriving from the protobuf generated class to allow dynamic dispatching
+    Not deriving from the protobuf generated class to allow dynamic
+    dispatching: handlers of the methods defined by the Lightning service are
+    built once, from the implementation module, so that serving a request
+    only requires a dictionary lookup.
+
+    Concurrent identical calls of read-only methods are coalesced by a
+    SingleFlight and their responses are served from a ResponseCache, which
+    write methods invalidate (along with the channels mirror). While the node
+    is unreachable, calls fail immediately (see NodeHealth).
     """
 
-    def __getattr__(self, name):
-        """ Dispatches gRPC request dynamically. """
+    # pylint: disable=too-few-public-methods
 
-        @handle_logs
-        def dispatcher(request, context):
-            # Importing module for specific implementation
-            module = import_module('lighter.light_{}'.format(
-                sett.IMPLEMENTATION))
-            # Searching client requested function in module
-            try:
-                func = getattr(module, name)
-            except AttributeError:
-                Err().unimplemented_method(context, name)
-            # Return requested function if implemented
-            return func(request, context)
+    def __init__(self):
+        module = import_module('lighter.light_{}'.format(sett.IMPLEMENTATION))
+        service = pb.DESCRIPTOR.services_by_name['Lightning']
+        async_apis = {}
+        if sett.GRPC_ASYNC:
+            async_apis = getattr(module, 'ASYNC_APIS', {})
+        cache = ResponseCache(
+            sett.CACHE_TTLS, sett.CACHE_STALE_TIME,
+            listeners=[invalidate_channels_mirror],
+            no_stale=sett.CACHE_NO_STALE)
+        sett.RESPONSE_CACHE = cache
+        flights = SingleFlight()
+        sett.SINGLE_FLIGHT = flights
+        health = NodeHealth(
+            partial(_probe_node, module), listeners=[update_serving_status])
+        sett.NODE_HEALTH = health
+        health.start()
+        self._handlers = {}
+        for method in service.methods:
+            path = '/{}/{}'.format(service.full_name, method.name)
+            if method.name in LIGHTER_METHODS:
+                self._handlers[path] = _method_handler(
+                    method, handle_logs(LIGHTER_METHODS[method.name]))
+                continue
+            func = getattr(module, method.name, None)
+            if method.name in async_apis:
+                from .aio import async_method
+                func = async_method(
+                    getattr(module, async_apis[method.name]))
+                func.__name__ = method.name
+            if func and method.name not in sett.HEALTH_UNGUARDED:
+                func = health.guarded(func)
+            if not func:
+                func = _unimplemented_method(method.name)
+            elif method.name in sett.CACHE_INVALIDATORS:
+                func = cache.invalidating(func)
+            elif not method.server_streaming and \
+                    sett.ALL_PERMS[path]['action'] == 'read':
+                func = cache.cached(
+                    method.name, flights.coalesced(method.name, func))
+            self._handlers[path] = _method_handler(method, handle_logs(func))
+
+    def service(self, handler_call_details):
+        """ Returns the RpcMethodHandler of the requested method, if any """
+        return self._handlers.get(handler_call_details.method)
+
+
+def _probe_node(module):
+    """ Calls GetInfo to check if the node is reachable """
+    module.GetInfo(pb.GetInfoRequest(), FakeContext())
+
+
+def _unimplemented_method(name):
+    """ Returns a function that terminates calls to an unimplemented method """
+    def terminate(_ignored_request, context):
+        """ Terminates gRPC call, method is not implemented """
+        Err().unimplemented_method(context, name)
 
-        return dispatcher
+    terminate.__name__ = name
+    return terminate
+
+
+def _method_handler(method, func):
+    """ Returns the RpcMethodHandler of a Lightning service method """
+    request_class = getattr(pb, method.input_type.name)
+    response_class = getattr(pb, method.output_type.name)
+    if method.server_streaming:
+        return unary_stream_rpc_method_handler(
+            func, request_deserializer=request_class.FromString,
+            response_serializer=response_class.SerializeToString)
+    return unary_unary_rpc_method_handler(
+        func, request_deserializer=request_class.FromString,
+        response_serializer=response_class.SerializeToString)
 
 
 def _access_denied_terminator():
@@ -168,7 +267,7 @@ def _service_locked_terminator():
     return unary_unary_rpc_method_handler(terminate)
 
 
-def _request_accepted(handler):
+def _request_accepted(handler, mac_cache=None):
     """
     Checks if request is authorized: it is defined in ALL_PERMS and
     macaroons are disabled or macaroons correctly verify.
@@ -178,7 +277,8 @@ def _request_accepted(handler):
         return False
     if sett.DISABLE_MACAROONS:
         return True
-    return check_macaroons(handler.invocation_metadata, handler.method)
+    return check_macaroons(
+        handler.invocation_metadata, handler.method, mac_cache)
 
 
 class RuntimeInterceptor(ServerInterceptor):
@@ -191,11 +291,20 @@ class RuntimeInterceptor(ServerInterceptor):
 
     def __init__(self):
         self._terminator = _access_denied_terminator()
+        # verified macaroons cache, cleared by LockLighter
+        self._mac_cache = MacaroonCache(sett.MAC_CACHE_SIZE)
+        sett.MAC_CACHE = self._mac_cache
 
     def intercept_service(self, continuation, handler_call_details):
         """ Intercepts gRPC request to decide if request is authorized """
-        if _request_accepted(handler_call_details):
+        if handler_call_details.method.startswith(HEALTH_METHODS):
             return continuation(handler_call_details)
+        started = monotonic()
+        if _request_accepted(handler_call_details, self._mac_cache):
+            accepted = monotonic()
+            return timed_handler(
+                continuation(handler_call_details),
+                handler_call_details.method, accepted - started, accepted)
         return self._terminator
 
 
@@ -214,22 +323,35 @@ class UnlockerInterceptor(ServerInterceptor):
         Intercepts gRPC request to eventually inform client that service is
         locked
         """
-        if handler_call_details.method == '/lighter.Unlocker/UnlockLighter':
+        if handler_call_details.method.startswith(HEALTH_METHODS):
             return continuation(handler_call_details)
+        if handler_call_details.method == '/lighter.Unlocker/UnlockLighter':
+            return timed_handler(
+                continuation(handler_call_details),
+                handler_call_details.method, 0, monotonic())
         return self._terminator
 
 
 def _create_server(interceptors):
-    """ Creates a gRPC server in insecure or secure mode """
+    """
+    Creates a gRPC server (threaded or, if GRPC_ASYNC is set, asyncio
+    based) in insecure or secure mode
+    """
+    if sett.GRPC_ASYNC:
+        try:
+            from .aio import AioServer
+        except ImportError as err:
+            raise RuntimeError(
+                'GRPC_ASYNC requires grpcio with asyncio support (>= 1.32)'
+            ) from err
+        grpc_server = AioServer(interceptors)
+    else:
+        sett.GRPC_EXECUTOR = ThreadPoolExecutor(
+            max_workers=sett.GRPC_WORKERS + sett.MAX_STREAMS)
+        grpc_server = server(sett.GRPC_EXECUTOR, interceptors=interceptors)
     if sett.INSECURE_CONNECTION:
-        grpc_server = server(
-            ThreadPoolExecutor(max_workers=sett.GRPC_WORKERS),
-            interceptors=interceptors)
         grpc_server.add_insecure_port(sett.LIGHTER_ADDR)
     else:
-        grpc_server = server(
-            ThreadPoolExecutor(max_workers=sett.GRPC_WORKERS),
-            interceptors=interceptors)
         with open(sett.SERVER_KEY, 'rb') as key:
             private_key = key.read()
         with open(sett.SERVER_CRT, 'rb') as cert:
@@ -248,6 +370,7 @@ def _serve_unlocker():
     """
     grpc_server = _create_server([UnlockerInterceptor()])
     pb_grpc.add_UnlockerServicer_to_server(UnlockerServicer(), grpc_server)
+    add_HealthServicer_to_server(get_health_servicer(True), grpc_server)
     grpc_server.start()
     _log_listening('Unlocker service')
     LOGGER.info('Waiting for password to unlock Lightning service...')
@@ -260,8 +383,9 @@ def _serve_runtime():
     LockerServicer
     """
     grpc_server = _create_server([RuntimeInterceptor()])
-    pb_grpc.add_LightningServicer_to_server(LightningServicer(), grpc_server)
+    grpc_server.add_generic_rpc_handlers((LightningServicer(),))
     pb_grpc.add_LockerServicer_to_server(LockerServicer(), grpc_server)
+    add_HealthServicer_to_server(get_health_servicer(False), grpc_server)
     sett.RUNTIME_SERVER = grpc_server
     grpc_server.start()
     _log_listening('Lightning service')
@@ -285,6 +409,7 @@ def _unlocker_wait(grpc_server):
     """ Waits a signal to stop the UnlockerServicer """
     while not sett.UNLOCKER_STOP:
         sleep(1)
+    close_health_servicer()
     grpc_server.stop(0)
     sett.UNLOCKER_STOP = False
 
@@ -308,6 +433,9 @@ def start():
     try:
         get_start_options(warning=True)
         init_db()
+        start_metrics_server()
+        if sett.PROFILING:
+            sett.PROFILER = Profiler()
         with session_scope(FakeContext()) as session:
             if not is_db_ok(session):
                 raise RuntimeError(
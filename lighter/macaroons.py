@@ -16,12 +16,16 @@
 """ Macaroons management (creation and validation) class """
 
 from codecs import decode
+from collections import OrderedDict
+from datetime import datetime
 from logging import getLogger
+from threading import Lock
 
 from macaroonbakery.bakery import AuthInitError, Bakery, canonical_ops, \
     DischargeRequiredError, LATEST_VERSION, MemoryKeyStore, \
     MemoryOpsStore, Op, PermissionDenied
-from macaroonbakery.checkers import context_with_operations, AuthContext
+from macaroonbakery.checkers import context_with_operations, AuthContext, \
+    expiry_time
 from pymacaroons import Macaroon
 from pymacaroons.exceptions import MacaroonDeserializationException
 
@@ -47,23 +51,86 @@ MACAROONS = {
 }
 
 
-def check_macaroons(metadata, method):
-    """ Checks if metadata contains valid macaroons """
+class MacaroonCache():
+    """
+    Bounded LRU cache of successfully verified macaroons, keyed on the
+    macaroon (as sent by the client) and the required permission.
+
+    Entries of macaroons with time-before caveats are dropped once expired.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def is_verified(self, key):
+        """ Returns whether key has been verified and is not expired yet """
+        with self._lock:
+            if key in self._entries:
+                expiry = self._entries[key]
+                if expiry is None or datetime.utcnow() < expiry:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True
+                del self._entries[key]
+            self.misses += 1
+            return False
+
+    def add(self, key, expiry):
+        """ Adds a verified key, evicting the least recently used one """
+        if self.max_size < 1:
+            return
+        with self._lock:
+            self._entries[key] = expiry
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Removes all entries and resets counters """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def check_macaroons(metadata, method, cache=None):
+    """
+    Checks if metadata contains valid macaroons, using cache (if given) to
+    skip the verification of already verified ones
+    """
     num_mac = 0
+    value = None
     for data in metadata:
         if data.key == 'macaroon':
             num_mac = num_mac + 1
-            try:
-                serialized_macaroon = decode(data.value, 'hex')
-                macaroon = Macaroon.deserialize(serialized_macaroon)
-            except (MacaroonDeserializationException, ValueError):
-                LOGGER.error('- Cannot deserialize macaroon')
-                return False
+            value = data.value
     if num_mac != 1:
         LOGGER.error(
             '- Wrong number of macaroons, 1 required, %s received', num_mac)
         return False
-    return _validate_macaroon(macaroon, settings.ALL_PERMS[method])
+    if not value:
+        LOGGER.error('- Empty macaroon')
+        return False
+    required_perm = settings.ALL_PERMS[method]
+    key = (value, required_perm['entity'], required_perm['action'])
+    if cache and cache.is_verified(key):
+        return True
+    try:
+        serialized_macaroon = decode(value, 'hex')
+        macaroon = Macaroon.deserialize(serialized_macaroon)
+    except (MacaroonDeserializationException, ValueError):
+        LOGGER.error('- Cannot deserialize macaroon')
+        return False
+    if not _validate_macaroon(macaroon, required_perm):
+        return False
+    if cache:
+        namespace = settings.RUNTIME_BAKER.checker.namespace()
+        cache.add(key, expiry_time(namespace, macaroon.caveats))
+    return True
 
 
 def _validate_macaroon(macaroon, required_perm):
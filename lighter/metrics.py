@@ -0,0 +1,389 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The metrics module for Lighter """
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from inspect import isasyncgenfunction, iscoroutinefunction
+from logging import getLogger
+from threading import Lock, Thread
+from time import monotonic
+
+from grpc import RpcMethodHandler
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+
+LOGGER = getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS = {
+    'lighter_requests_total': (
+        'counter', 'gRPC calls received'),
+    'lighter_request_errors_total': (
+        'counter', 'gRPC calls terminated with an error, by status code'),
+    'lighter_request_duration_seconds': (
+        'histogram', 'Duration of gRPC calls'),
+    'lighter_requests_in_flight': (
+        'gauge', 'gRPC calls being served'),
+    'lighter_node_call_duration_seconds': (
+        'histogram', 'Duration of calls to the node, by implementation call'),
+    'lighter_jobs_running': (
+        'gauge', 'Background jobs submitted and not completed'),
+    'lighter_jobs_queued': (
+        'gauge', 'Background jobs waiting for a free worker'),
+    'lighter_grpc_queued': (
+        'gauge', 'gRPC calls waiting for a free worker thread'),
+    'lighter_component_events_total': (
+        'counter', 'Events counted by caches, mirrors and node health'),
+}
+
+# Request metadata key asking for the timing breakdown of the call
+TIMING_HEADER = 'lighter-timing'
+# Trailing metadata key of the timing breakdown
+TIMING_TRAILER = 'server-timing'
+
+# Seconds spent in each stage of the call being served
+_STAGES = ContextVar('stages', default=None)
+# Status code the call being served has been aborted with
+_ABORT_CODE = ContextVar('abort_code', default=None)
+
+# Event counters of the components kept in settings, by settings name
+COMPONENT_EVENTS = {
+    'MAC_CACHE': ('hits', 'misses'),
+    'RESPONSE_CACHE': ('hits', 'stale_hits', 'misses'),
+    'SINGLE_FLIGHT': ('calls', 'shared'),
+    'CHANNELS_MIRROR': ('polls', 'changes'),
+    'NODE_HEALTH': ('trips',),
+}
+
+
+class MetricsRegistry():
+    """
+    Thread-safe registry of counters, gauges and histograms, identified by a
+    name in METRICS and a set of labels.
+
+    Collectors are called on render, returning (name, labels, value) samples
+    of metrics that are read from elsewhere rather than updated here.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        """ Adds value to a counter or gauge """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Adds an observation to a histogram """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if not histogram:
+                histogram = self._histograms[key] = \
+                    [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[1] += value
+
+    def add_collector(self, collector):
+        """ Registers a function returning samples to render """
+        self._collectors.append(collector)
+
+    def clear(self):
+        """ Drops all values and histograms """
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """ Returns all metrics in Prometheus text exposition format """
+        samples = {}
+        with self._lock:
+            for (name, labels), value in sorted(self._values.items()):
+                samples.setdefault(name, []).append(
+                    _format_sample(name, labels, value))
+            for (name, labels), (buckets, total) in \
+                    sorted(self._histograms.items()):
+                samples.setdefault(name, []).extend(
+                    _format_histogram(name, labels, buckets, total))
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append(_format_sample(
+                    name, tuple(sorted(labels.items())), value))
+        lines = []
+        for name in sorted(samples):
+            kind, description = METRICS[name]
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(samples[name])
+        return '\n'.join(lines) + '\n'
+
+
+def _format_sample(name, labels, value):
+    """ Returns a sample line in Prometheus text format """
+    if not labels:
+        return '{} {}'.format(name, value)
+    pairs = ','.join(
+        '{}="{}"'.format(label, str(val).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n')) for label, val in labels)
+    return '{}{{{}}} {}'.format(name, pairs, value)
+
+
+def _format_histogram(name, labels, buckets, total):
+    """ Returns the sample lines of a histogram """
+    lines = []
+    count = 0
+    bounds = LATENCY_BUCKETS + ('+Inf',)
+    for bound, observations in zip(bounds, buckets):
+        count += observations
+        lines.append(_format_sample(
+            name + '_bucket', labels + (('le', bound),), count))
+    lines.append(_format_sample(name + '_sum', labels, round(total, 6)))
+    lines.append(_format_sample(name + '_count', labels, count))
+    return lines
+
+
+def _collect_jobs():
+    """ Returns samples of the background jobs load """
+    if not sett.JOBS:
+        return []
+    samples = []
+    for kind, (running, queued) in sorted(sett.JOBS.get_load().items()):
+        samples.append(('lighter_jobs_running', {'kind': kind}, running))
+        samples.append(('lighter_jobs_queued', {'kind': kind}, queued))
+    return samples
+
+
+def _collect_executor():
+    """ Returns samples of the gRPC calls waiting for a worker thread """
+    if not sett.GRPC_EXECUTOR:
+        return []
+    # the executor doesn't expose its queue depth
+    queue = sett.GRPC_EXECUTOR._work_queue  # pylint: disable=protected-access
+    return [('lighter_grpc_queued', {}, queue.qsize())]
+
+
+def _collect_components():
+    """ Returns samples of the counters kept by components in settings """
+    samples = []
+    for component, events in COMPONENT_EVENTS.items():
+        instance = getattr(sett, component)
+        if not instance:
+            continue
+        for event in events:
+            samples.append((
+                'lighter_component_events_total',
+                {'component': component.lower(), 'event': event},
+                getattr(instance, event)))
+    return samples
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.add_collector(_collect_jobs)
+REGISTRY.add_collector(_collect_executor)
+REGISTRY.add_collector(_collect_components)
+
+
+def call_started(method):
+    """ Counts a gRPC call, returning its start time """
+    REGISTRY.inc('lighter_requests_total', method=method)
+    REGISTRY.inc('lighter_requests_in_flight', method=method)
+    _ABORT_CODE.set(None)
+    return monotonic()
+
+
+def call_ended(method, started, code=None):
+    """ Observes the duration of a gRPC call, counting its error code """
+    duration = monotonic() - started
+    add_stage('handler', duration)
+    REGISTRY.inc('lighter_requests_in_flight', -1, method=method)
+    REGISTRY.observe(
+        'lighter_request_duration_seconds', duration, method=method)
+    if code is not None:
+        REGISTRY.inc('lighter_request_errors_total', method=method, code=code)
+
+
+def set_abort_code(code):
+    """ Records the status code the call being served is aborted with """
+    _ABORT_CODE.set(code)
+
+
+def get_abort_code():
+    """
+    Returns the name of the status code the call being served has been
+    aborted with, UNKNOWN if it failed without being aborted
+    """
+    code = _ABORT_CODE.get()
+    return code.name if code is not None else 'UNKNOWN'
+
+
+@contextmanager
+def timed_node_call(call):
+    """ Observes the duration of a call to the node """
+    started = monotonic()
+    try:
+        yield
+    finally:
+        duration = monotonic() - started
+        add_stage('node', duration)
+        REGISTRY.observe(
+            'lighter_node_call_duration_seconds', duration,
+            implementation=sett.IMPLEMENTATION, call=call)
+
+
+def add_stage(stage, seconds):
+    """ Adds seconds to a stage of the call being timed, if any """
+    stages = _STAGES.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0) + seconds
+
+
+def timed_handler(handler, method, auth_time, accepted):
+    """
+    Returns handler with its calls timed by stage: auth (given auth_time),
+    dispatch (since accepted, until the call starts running), handler, node,
+    convert and serialize.
+
+    Responses are serialized by the returned behavior, to time it. The
+    breakdown is logged at debug level and, if the client sent the
+    TIMING_HEADER metadata, returned as TIMING_TRAILER trailing metadata
+    (in server-timing format, durations in milliseconds).
+    """
+    if not isinstance(handler, RpcMethodHandler) or \
+            handler.request_streaming:
+        return handler
+    serialize = handler.response_serializer or (lambda response: response)
+
+    def start():
+        stages = {'auth': auth_time, 'dispatch': monotonic() - accepted}
+        _STAGES.set(stages)
+        return stages
+
+    if handler.unary_stream:
+        behavior = handler.unary_stream
+        if isasyncgenfunction(behavior):
+            return handler
+
+        def unary_stream(request, context):
+            stages = start()
+            try:
+                for response in behavior(request, context):
+                    yield _serialize(stages, serialize, response)
+            finally:
+                _end_timing(stages, method, context)
+
+        return handler._replace(
+            unary_stream=unary_stream, response_serializer=None)
+
+    behavior = handler.unary_unary
+    if iscoroutinefunction(behavior):
+        async def async_unary_unary(request, context):
+            stages = start()
+            try:
+                response = await behavior(request, context)
+                return _serialize(stages, serialize, response)
+            finally:
+                _end_timing(stages, method, context)
+
+        return handler._replace(
+            unary_unary=async_unary_unary, response_serializer=None)
+
+    def unary_unary(request, context):
+        stages = start()
+        try:
+            return _serialize(
+                stages, serialize, behavior(request, context))
+        finally:
+            _end_timing(stages, method, context)
+
+    return handler._replace(unary_unary=unary_unary, response_serializer=None)
+
+
+def _serialize(stages, serialize, response):
+    """ Serializes response, timing it """
+    started = monotonic()
+    data = serialize(response)
+    stages['serialize'] = \
+        stages.get('serialize', 0) + monotonic() - started
+    return data
+
+
+def _end_timing(stages, method, context):
+    """ Logs the timing breakdown, sending it to the client if asked """
+    _STAGES.set(None)
+    timing = ', '.join(
+        '{};dur={:.3f}'.format(stage, seconds * 1000)
+        for stage, seconds in stages.items())
+    LOGGER.debug('Timing of %s: %s', method, timing)
+    for key, _value in context.invocation_metadata():
+        if key == TIMING_HEADER:
+            context.set_trailing_metadata(((TIMING_TRAILER, timing),))
+            break
+
+
+def GetMetrics(request, context):  # pylint: disable=unused-argument
+    """ Returns all metrics in Prometheus text format """
+    return pb.GetMetricsResponse(metrics=REGISTRY.render())
+
+
+def start_metrics_server():
+    """ Serves metrics over HTTP on METRICS_PORT, if set and not serving """
+    if not sett.METRICS_PORT or sett.METRICS_SERVER:
+        return
+    try:
+        httpd = ThreadingHTTPServer(
+            (sett.METRICS_HOST, int(sett.METRICS_PORT)), _MetricsHandler)
+    except (OSError, ValueError) as err:
+        raise RuntimeError(
+            'Cannot serve metrics on port {}: {}'.format(
+                sett.METRICS_PORT, err)) from err
+    httpd.daemon_threads = True
+    thread = Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    sett.METRICS_SERVER = httpd
+    LOGGER.info('Metrics available on http://%s:%s/metrics',
+                sett.METRICS_HOST, sett.METRICS_PORT)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """ Answers GET /metrics requests with the rendered metrics """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Sends the metrics, or a 404 for other paths """
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """ Logs requests at debug level, instead of printing them """
+        LOGGER.debug('Metrics request: ' + format, *args)
@@ -0,0 +1,251 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The background payments module for Lighter """
+
+from collections import OrderedDict
+from logging import getLogger
+from threading import Condition, Event, Thread
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .bolt11 import decode
+from .errors import Err, ERRORS
+from .jobs import get_jobs
+from .streams import stream_slot
+from .utils import check_req_params
+
+LOGGER = getLogger(__name__)
+
+
+def get_payments_tracker():
+    """ Returns the running PaymentsTracker, creating it if necessary """
+    if not sett.PAYMENTS_TRACKER:
+        sett.PAYMENTS_TRACKER = PaymentsTracker()
+    return sett.PAYMENTS_TRACKER
+
+
+def close_payments_tracker():
+    """ Stops the running PaymentsTracker, if any """
+    if sett.PAYMENTS_TRACKER:
+        sett.PAYMENTS_TRACKER.close()
+    sett.PAYMENTS_TRACKER = None
+
+
+def pay_in_background(context, payment_request, job, check):
+    """
+    Submits job to pay payment_request in background (check confirming its
+    outcome with the node, if needed) and returns the PayInvoiceResponse
+    carrying its payment hash
+    """
+    try:
+        payment_hash = decode(payment_request).payment_hash
+    except ValueError:
+        Err().invalid(context, 'payment_request')
+    get_payments_tracker().submit(context, payment_hash, job, check)
+    return pb.PayInvoiceResponse(payment_hash=payment_hash)
+
+
+def get_payment(request, context):
+    """ Returns the GetPaymentResponse of a background payment """
+    check_req_params(context, request, 'payment_hash')
+    response = get_payments_tracker().get(request.payment_hash)
+    if response is None:
+        Err().payment_not_found(context)
+    return response
+
+
+def track_payment(request, context):
+    """ Yields the state of a background payment as it changes """
+    check_req_params(context, request, 'payment_hash')
+    tracker = get_payments_tracker()
+    if tracker.get(request.payment_hash) is None:
+        Err().payment_not_found(context)
+    return tracker.track(context, request.payment_hash)
+
+
+class PaymentsTracker():
+    """
+    Makes payments as background jobs, so that no gRPC worker thread waits
+    for them, and keeps track of their state by payment hash.
+
+    Payments are made by jobs provided by the implementation: job(update)
+    pays and returns the payment preimage, raising RuntimeError if the
+    payment fails, and can call update(attempts) to report its progress.
+    If the outcome is not known when the job ends (the node timed out or the
+    payment is still pending), the job returns None: the payment stays in
+    flight and check(payment_hash) asks the node about it every
+    PAYMENTS_CHECK_TIME seconds, until it returns a GetPaymentResponse that
+    is no longer IN_FLIGHT (raising if the node can't tell).
+
+    The outcome of the last PAYMENTS_KEPT completed payments is kept.
+    """
+
+    def __init__(self):
+        self._payments = OrderedDict()
+        self._completed = 0
+        self._changed = Condition()
+        self._stop = Event()
+        self._unknown = {}
+        self._checker = None
+
+    def submit(self, context, payment_hash, job, check):
+        """
+        Runs job in background, unless a payment with the same hash is
+        already in flight. Returns whether job has been submitted
+        """
+        with self._changed:
+            payment = self._payments.pop(payment_hash, None)
+            if payment and payment.state == pb.IN_FLIGHT:
+                self._payments[payment_hash] = payment
+                return False
+            if payment:
+                self._completed -= 1
+            self._payments[payment_hash] = pb.GetPaymentResponse(
+                state=pb.IN_FLIGHT)
+            self._changed.notify_all()
+        try:
+            get_jobs().run(
+                context, 'payment', self._run, payment_hash, job, check)
+        except BaseException:
+            with self._changed:
+                del self._payments[payment_hash]
+                self._changed.notify_all()
+            raise
+        return True
+
+    def get(self, payment_hash):
+        """ Returns the GetPaymentResponse of a payment, None if unknown """
+        with self._changed:
+            payment = self._payments.get(payment_hash)
+            if payment is None:
+                return None
+            response = pb.GetPaymentResponse()
+            response.CopyFrom(payment)
+            return response
+
+    def track(self, context, payment_hash):
+        """
+        Yields the state of a payment, then every change, until it completes
+        or the client goes away, holding one of the MAX_STREAMS slots
+        """
+        with stream_slot(context):
+            done = Event()
+            context.add_callback(done.set)
+            last = None
+            while not done.is_set() and not self._stop.is_set():
+                with self._changed:
+                    payment = self.get(payment_hash)
+                    # payment dropped to keep only the last completed ones
+                    if payment is None:
+                        return
+                    if payment == last:
+                        self._changed.wait(1)
+                        continue
+                last = payment
+                yield payment
+                if payment.state != pb.IN_FLIGHT:
+                    return
+
+    def _run(self, payment_hash, job, check):
+        """ Runs a payment job, recording its outcome """
+        def update(attempts):
+            self._update(payment_hash, attempts=attempts)
+
+        try:
+            preimage = job(update)
+        except Exception as err:  # pylint: disable=broad-except
+            self._complete(payment_hash, pb.GetPaymentResponse(
+                state=pb.FAILED, failure=str(err)))
+            return
+        if preimage:
+            self._complete(payment_hash, pb.GetPaymentResponse(
+                state=pb.SUCCEEDED, payment_preimage=preimage))
+            return
+        LOGGER.info('Payment %s outcome is unknown, asking the node',
+                    payment_hash)
+        with self._changed:
+            self._unknown[payment_hash] = check
+            if self._checker is None:
+                self._checker = Thread(target=self._check_unknown)
+                self._checker.daemon = True
+                self._checker.start()
+
+    def _check_unknown(self):
+        """
+        Asks the node the outcome of unknown payments every
+        PAYMENTS_CHECK_TIME seconds, until none is left
+        """
+        while not self._stop.wait(sett.PAYMENTS_CHECK_TIME):
+            with self._changed:
+                unknown = list(self._unknown.items())
+                if not unknown:
+                    self._checker = None
+                    return
+            for payment_hash, check in unknown:
+                try:
+                    response = check(payment_hash)
+                except Exception as err:  # pylint: disable=broad-except
+                    LOGGER.warning(
+                        'Cannot check payment %s: %s', payment_hash, err)
+                    continue
+                if response.state == pb.IN_FLIGHT:
+                    continue
+                with self._changed:
+                    del self._unknown[payment_hash]
+                self._complete(payment_hash, response)
+
+    def _complete(self, payment_hash, response):
+        """ Records the final state of a payment """
+        if response.state == pb.SUCCEEDED:
+            LOGGER.info('Payment %s succeeded', payment_hash)
+            self._update(
+                payment_hash, state=pb.SUCCEEDED,
+                payment_preimage=response.payment_preimage)
+        else:
+            failure = response.failure or ERRORS['payinvoice_failed']['msg']
+            LOGGER.info('Payment %s failed: %s', payment_hash, failure)
+            self._update(payment_hash, state=pb.FAILED, failure=failure)
+        # payment changed balances
+        if sett.RESPONSE_CACHE:
+            sett.RESPONSE_CACHE.invalidate()
+
+    def _update(self, payment_hash, **fields):
+        """ Updates the state of a payment, dropping old completed ones """
+        with self._changed:
+            payment = self._payments.get(payment_hash)
+            if payment is None or payment.state != pb.IN_FLIGHT:
+                return
+            for field, value in fields.items():
+                setattr(payment, field, value)
+            if payment.state != pb.IN_FLIGHT:
+                self._completed += 1
+                self._drop_completed()
+            self._changed.notify_all()
+
+    def _drop_completed(self):
+        """ Drops the oldest completed payments over PAYMENTS_KEPT """
+        for payment_hash in list(self._payments):
+            if self._completed <= sett.PAYMENTS_KEPT:
+                return
+            if self._payments[payment_hash].state != pb.IN_FLIGHT:
+                del self._payments[payment_hash]
+                self._completed -= 1
+
+    def close(self):
+        """ Ends all streams, payments in flight are no longer tracked """
+        self._stop.set()
+        with self._changed:
+            self._changed.notify_all()
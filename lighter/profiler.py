@@ -0,0 +1,237 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The profiler module for Lighter """
+
+from collections import Counter
+from cProfile import Profile
+from logging import getLogger
+from os import path
+from pstats import Stats
+from sys import _current_frames
+from threading import enumerate as enumerate_threads, get_ident, Lock, \
+    Thread, Timer
+from time import monotonic, sleep, strftime
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .errors import Err
+
+LOGGER = getLogger(__name__)
+
+
+def ProfileLighter(request, context):
+    """
+    Starts sampling the stacks of all threads for the requested seconds or,
+    if a method is requested, profiling its next calls made within them
+    """
+    if not sett.PROFILER:
+        Err().profiling_disabled(context)
+    seconds = request.seconds or sett.PROFILE_TIME
+    if seconds > sett.PROFILE_MAX_TIME:
+        Err().out_of_range(context, 'seconds')
+    if request.method:
+        service = pb.DESCRIPTOR.services_by_name['Lightning']
+        method = service.methods_by_name.get(request.method)
+        if not method or method.server_streaming:
+            Err().invalid(context, 'method')
+        calls = request.calls or 1
+        if calls > sett.PROFILE_MAX_CALLS:
+            Err().out_of_range(context, 'calls')
+        file_path = sett.PROFILER.profile_calls(
+            request.method, calls, seconds)
+    else:
+        file_path = sett.PROFILER.sample(seconds)
+    if not file_path:
+        Err().profiling_running(context)
+    return pb.ProfileLighterResponse(file=file_path)
+
+
+def profile_on_signal(_signo, _stack_frame):
+    """ Starts sampling the stacks of all threads for PROFILE_TIME seconds """
+    if not sett.PROFILER:
+        LOGGER.warning('Profiling is disabled, set PROFILING to enable it')
+        return
+    if not sett.PROFILER.sample(sett.PROFILE_TIME):
+        LOGGER.warning('Stacks are already being sampled')
+
+
+def profiled_call(method, func, args, kwargs):
+    """ Calls func, profiling it if the next calls of method are wanted """
+    if not sett.PROFILER or sett.PROFILER.method != method:
+        return func(*args, **kwargs)
+    return sett.PROFILER.call(method, func, args, kwargs)
+
+
+class Profiler():
+    """
+    On-demand profiler of the running server.
+
+    sample() collects the stacks of all threads every PROFILE_INTERVAL
+    seconds, in a background thread, and writes them in LOGS_DIR in collapsed
+    format (a 'thread;frame;frame count' line per stack, as read by
+    flamegraph.pl and speedscope).
+    profile_calls() runs the next calls of a method, made within some
+    seconds, under cProfile, writing their aggregated stats in LOGS_DIR (in
+    pstats format) once they end.
+    Calls served by coroutines are not profiled.
+    """
+
+    def __init__(self):
+        self.method = None
+        self._lock = Lock()
+        self._sampler = None
+        self._calls = 0
+        self._until = 0
+        self._running = 0
+        self._stats = None
+        self._stats_path = None
+
+    def sample(self, seconds):
+        """
+        Starts sampling stacks for seconds, returning the path of the file
+        that will be written, or None if already sampling
+        """
+        with self._lock:
+            if self._sampler and self._sampler.is_alive():
+                return None
+            file_path = _get_path('stacks', 'folded')
+            self._sampler = Thread(
+                target=self._sample, args=(seconds, file_path))
+            self._sampler.daemon = True
+            self._sampler.start()
+        LOGGER.info('Sampling stacks for %ss into %s', seconds, file_path)
+        return file_path
+
+    def profile_calls(self, method, calls, seconds):
+        """
+        Starts profiling the next calls of method made within seconds,
+        returning the path of the file that will be written, or None if
+        already profiling calls
+        """
+        file_path = None
+        with self._lock:
+            ended = self._end()
+            if not self.method:
+                file_path = self._stats_path = _get_path(method, 'pstats')
+                self._calls = calls
+                self._until = monotonic() + seconds
+                self.method = method
+        _write_stats(ended)
+        if not file_path:
+            return None
+        timer = Timer(seconds, self._expire)
+        timer.daemon = True
+        timer.start()
+        LOGGER.info('Profiling the next %s %s calls (for %ss) into %s',
+                    calls, method, seconds, file_path)
+        return file_path
+
+    def call(self, method, func, args, kwargs):
+        """ Calls func, under cProfile if method calls are still wanted """
+        profile = None
+        with self._lock:
+            ended = self._end()
+            if method == self.method and self._calls:
+                profile = Profile()
+                self._calls -= 1
+                self._running += 1
+        _write_stats(ended)
+        if not profile:
+            return func(*args, **kwargs)
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._add_stats(profile)
+
+    def _add_stats(self, profile):
+        """ Aggregates the stats of a call, writing them after the last one """
+        with self._lock:
+            self._running -= 1
+            if self._stats:
+                self._stats.add(profile)
+            else:
+                self._stats = Stats(profile)
+            ended = self._end()
+        _write_stats(ended)
+
+    def _expire(self):
+        """ Stops profiling calls if seconds have passed """
+        with self._lock:
+            ended = self._end()
+        _write_stats(ended)
+
+    def _end(self):
+        """
+        Stops profiling calls once no more are wanted (or seconds have
+        passed) and none is running, returning method, stats and file path
+        to write, if stopped (to be called holding the lock)
+        """
+        if monotonic() >= self._until:
+            self._calls = 0
+        if not self.method or self._calls or self._running:
+            return None
+        ended = self.method, self._stats, self._stats_path
+        self.method = self._stats = None
+        return ended
+
+    def _sample(self, seconds, file_path):
+        """ Samples the stacks of the other threads, then writes them """
+        own = get_ident()
+        stacks = Counter()
+        deadline = monotonic() + seconds
+        while monotonic() < deadline:
+            names = {thread.ident: thread.name
+                     for thread in enumerate_threads()}
+            for ident, frame in _current_frames().items():
+                if ident != own:
+                    stacks[_collapse(names.get(ident, ident), frame)] += 1
+            sleep(sett.PROFILE_INTERVAL)
+        with open(file_path, 'w', encoding='utf-8') as file:
+            for stack, count in sorted(stacks.items()):
+                file.write('{} {}\n'.format(stack, count))
+        LOGGER.info('Stacks written to %s', file_path)
+
+
+def _write_stats(ended):
+    """ Writes the stats of ended profiling of calls, if any """
+    if not ended:
+        return
+    method, stats, file_path = ended
+    if not stats:
+        LOGGER.info('No %s calls profiled, %s not written', method, file_path)
+        return
+    stats.dump_stats(file_path)
+    LOGGER.info('Profile written to %s', file_path)
+
+
+def _collapse(thread_name, frame):
+    """ Returns the stack of frame, root first, as a collapsed line """
+    frames = []
+    while frame:
+        code = frame.f_code
+        frames.append('{} ({}:{})'.format(
+            code.co_name, path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+    frames.append(str(thread_name).replace(' ', '_'))
+    return ';'.join(reversed(frames))
+
+
+def _get_path(name, extension):
+    """ Returns the path of a new profile file in LOGS_DIR """
+    return path.join(
+        path.abspath(sett.LOGS_DIR), 'profile-{}-{}.{}'.format(
+            name, strftime('%Y%m%d-%H%M%S'), extension))
@@ -42,6 +42,8 @@ MACAROONS_DIR = path.join(L_DATA, 'macaroons')
 MAC_ADMIN = 'admin.macaroon'
 MAC_READONLY = 'readonly.macaroon'
 MAC_INVOICES = 'invoices.macaroon'
+MAC_CACHE = None
+MAC_CACHE_SIZE = 128
 
 # Security settings
 MAC_ROOT_KEY = None
@@ -64,10 +66,115 @@ ALEMBIC_CFG = 'migrations/alembic.ini'
 # Server settings
 ONE_DAY_IN_SECONDS = 60 * 60 * 24
 GRPC_WORKERS = 10
+GRPC_ASYNC = 0
 GRPC_GRACE_TIME = 40
+# Pool of threads serving the gRPC calls of the last created server
+GRPC_EXECUTOR = None
 UNLOCKER_STOP = False
 RUNTIME_SERVER = None
-THREADS = []
+INVOICES_HUB = None
+# Number of settled invoices kept to resume subscriptions
+SUBSCRIBE_BUFFER = 200
+# Seconds to wait before reopening a failed node subscription
+SUBSCRIBE_RETRY = 3
+# Number of long-lived streams (SubscribeInvoices, TrackPayment) served at the
+# same time, each holding a gRPC worker thread (the server has GRPC_WORKERS
+# threads for the other calls, plus MAX_STREAMS)
+MAX_STREAMS = 5
+
+# Invoices store settings
+INVOICES_STORE = None
+INVOICES_DB_NAME = 'invoices.db'
+# Seconds ListInvoices is served from the invoices store before syncing it
+# with the node again
+INVOICES_SYNC_TIME = 1
+# Seconds after expiration open invoices are still re-read when syncing the
+# invoices store (then they are asked to the node only when checked)
+INVOICES_OPEN_GRACE = 3600
+
+# Background jobs settings
+JOBS = None
+# Number of long node operations run at the same time in background, by kind
+# (each kind has a pool of threads of its own)
+JOB_WORKERS = {'close': 4, 'payment': 16}
+# Number of jobs of a kind waiting for a thread, further ones are rejected
+JOB_QUEUE = 100
+# Number of jobs whose outcome can be looked up by ID
+JOBS_KEPT = 1000
+
+# Background payments settings
+PAYMENTS_TRACKER = None
+# Number of completed payments whose outcome is kept
+PAYMENTS_KEPT = 1000
+# Seconds a background payment is waited for before asking the node about
+# its outcome
+PAY_TIMEOUT = 600
+# Seconds between checks of background payments whose outcome is unknown
+PAYMENTS_CHECK_TIME = 30
+
+# Response cache settings
+RESPONSE_CACHE = None
+# Seconds responses of read-only methods are cached for (0 disables caching)
+CACHE_TTLS = {
+    'GetInfo': 10,
+    'ListPeers': 10,
+    'WalletBalance': 3,
+}
+# Seconds an expired response is still served while being refreshed
+CACHE_STALE_TIME = 30
+# Methods whose expired responses are never served (balances)
+CACHE_NO_STALE = ['WalletBalance']
+SINGLE_FLIGHT = None
+# Methods whose calls drop cached responses
+CACHE_INVALIDATORS = [
+    'CloseChannel', 'NewAddress', 'OpenChannel', 'PayInvoice', 'PayOnChain']
+NODES_CACHE = None
+# Seconds alias and color of the network nodes are kept before reloading
+# them in background
+NODES_REFRESH_TIME = 300
+# Seconds to wait before loading again the network nodes, if it failed
+NODES_RETRY_TIME = 30
+
+# Channels mirror settings
+CHANNELS_MIRROR = None
+# Seconds between polls of the node channels, while they are being read
+CHANNELS_POLL_TIME = 3
+# Seconds channels are served from memory since the last successful poll
+CHANNELS_MAX_AGE = 30
+# Seconds without reads after which node channels stop being polled
+CHANNELS_IDLE_TIME = 300
+
+# Node health settings
+NODE_HEALTH = None
+# Standard gRPC health service of the running server
+HEALTH_SERVICER = None
+# Consecutive failed attempts to reach the node after which calls needing it
+# fail immediately
+HEALTH_FAILURES = 3
+# Seconds between probes of the node, while it is unreachable or idle
+HEALTH_PROBE_TIME = 5
+# Methods served without calling the node (from the invoices store, the
+# channels mirror, background jobs or local decoding), which don't fail while
+# the node is unreachable
+HEALTH_UNGUARDED = [
+    'ChannelBalance', 'DecodeInvoice', 'GetCloseStatus', 'GetPayment',
+    'ListChannels', 'ListInvoices', 'StreamInvoices', 'TrackPayment']
+
+# Metrics settings
+METRICS_HOST = '127.0.0.1'
+# Local port serving metrics in Prometheus text format (disabled if empty)
+METRICS_PORT = ''
+METRICS_SERVER = None
+
+# Profiling settings
+PROFILING = 0
+# Seconds of stacks sampling (default of ProfileLighter and SIGUSR1)
+PROFILE_TIME = 30
+PROFILE_MAX_TIME = 600
+PROFILE_MAX_CALLS = 1000
+# Seconds between stacks samples
+PROFILE_INTERVAL = 0.01
+PROFILER = None
 
 # cliter settings
 CLI_HOST = '127.0.0.1'
@@ -89,11 +196,29 @@ CMD_BASE = []
 # c-lightning specific settings
 CL_CLI = 'lightning-cli'
 CL_RPC = 'lightning-rpc'
+CL_USE_CLI = 0
+CL_POOL = None
+CL_POOL_SIZE = 4
+# Max size of a JSON-RPC response read in asyncio server mode
+CL_READ_LIMIT = 2**26
+CL_RECV_SIZE = 65536
+# Seconds waitanyinvoice blocks before being reissued
+CL_WAIT_TIMEOUT = 300
 
 # eclair specific settings
 ECL_HOST = 'localhost'
 ECL_PORT = 8080
-ECL_ENV = ''
+ECL_POOL = None
+ECL_POOL_SIZE = 4
+ECL_READ_SIZE = 65536
+# Seconds after which an idle pooled connection is discarded instead of reused
+# (eclair closes idle connections after 60 seconds by default)
+ECL_POOL_IDLE_TIME = 30
+# Seconds between checks for received payments
+ECL_POLL_TIME = 3
+# Seconds before the first check of a payment made in background, doubled at
+# every following check (up to ECL_POLL_TIME)
+ECL_PAY_POLL_TIME = 0.2
 
 # lnd specific settings
 LND_HOST = 'localhost'
@@ -103,15 +228,35 @@ LND_ADDR = ''
 LND_CREDS_SSL = ''
 LND_CREDS_FULL = ''
 LND_MAC = ''
+LND_POOL_FULL = None
+LND_POOL_SSL = None
+LND_POOL_SIZE = 2
+LND_AIO_CHANNEL = None
+# lnd (grpc-go defaults) sends GOAWAY too_many_pings to clients pinging more
+# often than every 5 minutes or pinging with no active calls
+LND_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 360000),
+    ('grpc.keepalive_timeout_ms', 20000),
+    ('grpc.keepalive_permit_without_calls', 0),
+    ('grpc.http2.max_pings_without_data', 0),
+    # each pooled channel must own its TCP connection
+    ('grpc.use_local_subchannel_pool', 1),
+]
 
 # Common settings
+# Number of decoded payment requests kept in memory
+DECODE_CACHE_SIZE = 256
+# Network of the node (as reported by GetInfo), payment requests of other
+# networks are not decoded locally
+NODE_NETWORK = None
 IMPL_MIN_TIMEOUT = 2
 IMPL_MAX_TIMEOUT = 180
 RESPONSE_RESERVED_TIME = 0.3
 THREAD_TIMEOUT = 3
 CLOSE_TIMEOUT_NODE = 15
 MAX_INVOICES = 200
-INVOICES_TIMES = 3
+# Default number of entries in each message of Stream* methods
+STREAM_ITEMS = 200
 EXPIRY_TIME = 420
 
 # Logging settings
@@ -122,6 +267,11 @@ LOG_TIMEFMT = '%Y-%m-%d %H:%M:%S %z'
 LOG_TIMEFMT_SIMPLE = '%d %b %H:%M:%S'
 LOG_LEVEL_CONSOLE = 'INFO'
 LOG_LEVEL_FILE = 'DEBUG'
+LOGS_FORMAT = 'text'
+# Maximum length of the full responses written to debug logs
+LOG_DUMP_MAX = 4096
+# QueueListener writing the records queued by the server threads
+LOG_LISTENER = None
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -135,6 +285,10 @@ LOGGING = {
             'format': '%(asctime)s %(levelname).3s: %(message)s',
             'datefmt': LOG_TIMEFMT_SIMPLE
         },
+        'json': {
+            '()': 'lighter.utils.JsonFormatter',
+            'datefmt': LOG_TIMEFMT
+        },
     },
     'handlers': {
         'console': {
@@ -185,6 +339,22 @@ ALL_PERMS = {
         'entity': 'info',
         'action': 'read'
     },
+    '/lighter.Lightning/GetCloseStatus': {
+        'entity': 'channel',
+        'action': 'read'
+    },
+    '/lighter.Lightning/GetMetrics': {
+        'entity': 'lock',
+        'action': 'write'
+    },
+    '/lighter.Lightning/GetNodeHealth': {
+        'entity': 'info',
+        'action': 'read'
+    },
+    '/lighter.Lightning/GetPayment': {
+        'entity': 'payment',
+        'action': 'read'
+    },
     '/lighter.Lightning/ListChannels': {
         'entity': 'channel',
         'action': 'read'
@@ -225,6 +395,30 @@ ALL_PERMS = {
         'entity': 'transaction',
         'action': 'write'
     },
+    '/lighter.Lightning/ProfileLighter': {
+        'entity': 'lock',
+        'action': 'write'
+    },
+    '/lighter.Lightning/StreamInvoices': {
+        'entity': 'invoice',
+        'action': 'read'
+    },
+    '/lighter.Lightning/StreamPayments': {
+        'entity': 'payment',
+        'action': 'read'
+    },
+    '/lighter.Lightning/StreamTransactions': {
+        'entity': 'transaction',
+        'action': 'read'
+    },
+    '/lighter.Lightning/SubscribeInvoices': {
+        'entity': 'invoice',
+        'action': 'read'
+    },
+    '/lighter.Lightning/TrackPayment': {
+        'entity': 'payment',
+        'action': 'read'
+    },
     '/lighter.Lightning/UnlockNode': {
         'entity': 'unlock',
         'action': 'write'
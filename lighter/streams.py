@@ -0,0 +1,213 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The streams module for Lighter """
+
+from collections import deque
+from contextlib import contextmanager
+from logging import getLogger
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+
+from . import lighter_pb2 as pb
+from . import settings as sett
+from .errors import Err
+
+LOGGER = getLogger(__name__)
+
+
+class _StreamSlots():
+    """ Counts the long-lived streams being served """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.used = 0
+
+    def acquire(self):
+        """
+        Takes a slot, returns False if MAX_STREAMS are in use (the gRPC
+        server has MAX_STREAMS threads more than GRPC_WORKERS for them)
+        """
+        with self._lock:
+            if self.used >= sett.MAX_STREAMS:
+                return False
+            self.used += 1
+            return True
+
+    def release(self):
+        """ Frees a slot """
+        with self._lock:
+            self.used -= 1
+
+
+STREAM_SLOTS = _StreamSlots()
+
+
+@contextmanager
+def stream_slot(context):
+    """
+    Holds one of the MAX_STREAMS slots while serving a long-lived stream,
+    which keeps a gRPC worker thread busy until it ends, aborting the call
+    if none is free
+    """
+    if not STREAM_SLOTS.acquire():
+        Err().too_many_streams(context)
+    try:
+        yield
+    finally:
+        STREAM_SLOTS.release()
+
+
+def get_invoices_hub(list_settled, wait_settled):
+    """
+    Returns the running InvoicesHub, creating it with the given
+    implementation functions if necessary
+    """
+    if not sett.INVOICES_HUB:
+        sett.INVOICES_HUB = InvoicesHub(list_settled, wait_settled)
+    return sett.INVOICES_HUB
+
+
+def close_invoices_hub():
+    """ Stops the running InvoicesHub, if any """
+    if sett.INVOICES_HUB:
+        sett.INVOICES_HUB.close()
+    sett.INVOICES_HUB = None
+
+
+class InvoicesHub():
+    """
+    Fans out paid invoices, received from a single node subscription, to any
+    number of subscribers.
+
+    The implementation provides two functions, both dealing with
+    (settle_index, pb.Invoice) tuples in increasing settle_index order:
+    - list_settled(context, settle_index) returns the invoices paid after
+      settle_index, without blocking
+    - wait_settled(settle_index) yields the invoices paid after settle_index
+      (or from now on, if None) as they get paid; it can also yield again
+      invoices with settle_index, if it is not unique
+
+    Invoices are told apart by (settle_index, payment_hash), as some
+    implementations (eclair) use the time of payment as settle_index.
+
+    The last SUBSCRIBE_BUFFER invoices are kept, so that most resuming
+    subscribers do not need to ask the node for the ones they missed.
+    """
+
+    def __init__(self, list_settled, wait_settled):
+        self._list_settled = list_settled
+        self._wait_settled = wait_settled
+        self._lock = Lock()
+        self._stop = Event()
+        self._subscribers = []
+        self._events = deque(maxlen=sett.SUBSCRIBE_BUFFER)
+        self._last_key = None
+        self._thread = None
+
+    def subscribe(self, context, settle_index):
+        """
+        Yields SubscribeInvoicesResponse messages, starting with the invoices
+        paid after settle_index (if set), until client goes away
+        """
+        with stream_slot(context):
+            yield from self._subscribe(context, settle_index)
+
+    def _subscribe(self, context, settle_index):
+        """ Yields the messages of a subscription """
+        queue = Queue()
+        done = Event()
+        context.add_callback(done.set)
+        with self._lock:
+            self._subscribers.append(queue)
+            self._start()
+            events = list(self._events)
+        try:
+            last = None
+            for index, invoice in self._get_missed(
+                    context, settle_index, events):
+                last = _get_key(index, invoice)
+                yield pb.SubscribeInvoicesResponse(
+                    invoice=invoice, settle_index=index)
+            while not done.is_set() and not self._stop.is_set():
+                try:
+                    index, invoice = queue.get(timeout=1)
+                except Empty:
+                    continue
+                key = _get_key(index, invoice)
+                # skipping invoices paid before settle_index or already sent
+                # while resuming
+                if index <= settle_index or last and key <= last:
+                    continue
+                last = key
+                yield pb.SubscribeInvoicesResponse(
+                    invoice=invoice, settle_index=index)
+        finally:
+            with self._lock:
+                self._subscribers.remove(queue)
+
+    def _get_missed(self, context, settle_index, events):
+        """ Returns the invoices paid after settle_index """
+        if not settle_index:
+            return []
+        if events and events[0][0] <= settle_index:
+            return [event for event in events if event[0] > settle_index]
+        # buffer does not reach back enough, asking the node
+        missed = {_get_key(*event): event
+                  for event in self._list_settled(context, settle_index)}
+        missed.update((_get_key(*event), event) for event in events)
+        return [missed[key] for key in sorted(missed)
+                if key[0] > settle_index]
+
+    def _start(self):
+        """ Starts the node subscription thread, if not running """
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """ Keeps a node subscription open, reopening it on errors """
+        while not self._stop.is_set():
+            settle_index = self._last_key[0] if self._last_key else None
+            try:
+                for index, invoice in self._wait_settled(settle_index):
+                    self._publish(index, invoice)
+                    if self._stop.is_set():
+                        return
+            except Exception as err:  # pylint: disable=broad-except
+                LOGGER.error('Invoices subscription failed: %s', err)
+            self._stop.wait(sett.SUBSCRIBE_RETRY)
+
+    def _publish(self, index, invoice):
+        """ Sends a paid invoice to all subscribers """
+        key = _get_key(index, invoice)
+        with self._lock:
+            if self._last_key is not None and key <= self._last_key:
+                return
+            self._last_key = key
+            self._events.append((index, invoice))
+            for queue in self._subscribers:
+                queue.put((index, invoice))
+
+    def close(self):
+        """ Stops the node subscription and ends all streams """
+        self._stop.set()
+
+
+def _get_key(index, invoice):
+    """ Returns the key ordering and identifying a paid invoice """
+    return index, invoice.payment_hash
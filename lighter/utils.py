@@ -15,36 +15,187 @@
 
 """ The utils module for Lighter """
 
+from asyncio import create_subprocess_exec, \
+    TimeoutError as AsyncTimeoutError, wait_for
+from atexit import register
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from contextlib import suppress
+from copy import copy
 from decimal import Decimal, InvalidOperation
 from functools import wraps
 from importlib import import_module
+from inspect import iscoroutinefunction, isgenerator
 from json import dumps, loads, JSONDecodeError
-from logging import getLogger
+from logging import Formatter, getLogger
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
 from marshal import dumps as mdumps, loads as mloads
 from os import environ as env, path
+from queue import SimpleQueue
 from subprocess import PIPE, Popen, TimeoutExpired
-from threading import active_count, current_thread
-from time import sleep, strftime, time
+from threading import local
+from time import monotonic, sleep, strftime, time
+
+from google.protobuf.message import Message
+from google.protobuf.text_format import PrintMessage
 
 from . import lighter_pb2 as pb
 
 from . import __version__, settings as sett
 from .db import get_secret_from_db, get_token_from_db
 from .errors import Err
+from .metrics import add_stage, call_ended, call_started, get_abort_code
+from .profiler import profiled_call
 
 LOGGER = getLogger(__name__)
 
+# Per-thread state of the gRPC call being served
+_CALL = local()
+
+
+def update_logger(queued=False):
+    """
+    Activate logs on file.
 
-def update_logger():
-    """ Activate logs on file """
+    If queued, records are handed over to a QueueListener thread, which
+    formats and writes them, so that calls do not wait on the log writes.
+    """
     sett.LOGS_LEVEL = env.get('LOGS_LEVEL', sett.LOG_LEVEL_CONSOLE).upper()
     sett.LOGGING['handlers']['console']['level'] = sett.LOGS_LEVEL
     sett.LOGS_DIR = env.get('LOGS_DIR', sett.LOGS_DIR)
     log_path = path.join(path.abspath(sett.LOGS_DIR), sett.LOGS_LIGHTER)
     sett.LOGGING['handlers']['file']['filename'] = log_path
+    sett.LOGS_FORMAT = env.get('LOGS_FORMAT', sett.LOGS_FORMAT).lower()
+    if sett.LOGS_FORMAT not in ('text', 'json'):
+        raise RuntimeError(
+            'Unsupported LOGS_FORMAT "{}"'.format(sett.LOGS_FORMAT))
+    if sett.LOGS_FORMAT == 'json':
+        sett.LOGGING['handlers']['console']['formatter'] = 'json'
+        sett.LOGGING['handlers']['file']['formatter'] = 'json'
+    stop_log_listener()
     dictConfig(sett.LOGGING)
+    if queued:
+        _start_log_listener()
+
+
+def _start_log_listener():
+    """ Moves the root logger handlers behind a queue """
+    root = getLogger()
+    queue = SimpleQueue()
+    sett.LOG_LISTENER = QueueListener(
+        queue, *root.handlers, respect_handler_level=True)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_RecordQueueHandler(queue))
+    sett.LOG_LISTENER.start()
+    register(stop_log_listener)
+
+
+def stop_log_listener():
+    """ Writes the queued records and stops the QueueListener, if any """
+    if sett.LOG_LISTENER:
+        sett.LOG_LISTENER.stop()
+    sett.LOG_LISTENER = None
+
+
+class _RecordQueueHandler(QueueHandler):
+    """
+    QueueHandler formatting the message of records as they are logged, as
+    the standard one does, except for records with LogDump arguments, which
+    are formatted by the listener thread only for the handlers emitting them
+    """
+
+    def prepare(self, record):
+        """
+        Returns a copy of record with its message (unless it dumps) and
+        exception already formatted
+        """
+        record = copy(record)
+        if not isinstance(record.args, tuple) or not any(
+                isinstance(arg, LogDump) for arg in record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXC_FORMATTER.formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_EXC_FORMATTER = Formatter()
+
+
+class JsonFormatter(Formatter):
+    """ Formats records as JSON objects, one per line """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'line': record.lineno,
+            'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return dumps(entry)
+
+
+class LogDump():
+    """
+    Message to be logged on a single line and truncated to LOG_DUMP_MAX
+    characters; it is converted to text only if a handler emits the record.
+
+    Protobuf messages are formatted field by field, stopping once
+    LOG_DUMP_MAX characters are written, so large responses are never
+    formatted whole.
+    """
+
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        out = _DumpWriter(sett.LOG_DUMP_MAX)
+        try:
+            if isinstance(self.message, Message):
+                PrintMessage(self.message, out, as_one_line=True)
+            else:
+                out.write(str(self.message))
+        except _DumpFull:
+            return '{}... (truncated)'.format(out.getvalue())
+        return out.getvalue()
+
+
+class _DumpFull(Exception):
+    """ Raised by _DumpWriter once its size is exceeded """
+
+
+class _DumpWriter():
+    """ Text stream keeping at most size characters, on a single line """
+
+    __slots__ = ('_chunks', '_free')
+
+    def __init__(self, size):
+        self._chunks = []
+        self._free = size
+
+    def write(self, text):
+        """ Appends text, raising _DumpFull if it doesn't fit """
+        text = text.replace('\n', ' ')
+        self._chunks.append(text[:self._free])
+        self._free -= len(text)
+        if self._free < 0:
+            raise _DumpFull()
+
+    def getvalue(self):
+        """ Returns the text written """
+        return ''.join(self._chunks)
 
 
 def log_intro():
@@ -84,6 +235,7 @@ def check_connection():
         if not info:
             sleep(3)
             continue
+        sett.NODE_NETWORK = info.network or None
         if info.identity_pubkey:
             LOGGER.info(
                 'Connection to node "%s" successful', info.identity_pubkey)
@@ -92,6 +244,10 @@ def check_connection():
                 'Using %s version %s', sett.IMPLEMENTATION, info.version)
         else:
             LOGGER.info('Using %s', sett.IMPLEMENTATION)
+    # Lets the implementation prepare its caches, now that node is reachable
+    on_connect = getattr(module, 'on_connect', None)
+    if on_connect:
+        on_connect()
 
 
 def get_start_options(warning=False):
@@ -99,7 +255,9 @@ def get_start_options(warning=False):
     sett.IMPLEMENTATION = env['IMPLEMENTATION'].lower()
     bool_opt = {
         'INSECURE_CONNECTION': sett.INSECURE_CONNECTION,
-        'DISABLE_MACAROONS': sett.DISABLE_MACAROONS}
+        'DISABLE_MACAROONS': sett.DISABLE_MACAROONS,
+        'GRPC_ASYNC': sett.GRPC_ASYNC,
+        'PROFILING': sett.PROFILING}
     for opt, def_val in bool_opt.items():
         setattr(sett, opt, str2bool(env.get(opt, def_val)))
     sett.PORT = env.get('PORT', sett.PORT)
@@ -116,12 +274,40 @@ def get_start_options(warning=False):
     else:
         sett.MACAROONS_DIR = env.get('MACAROONS_DIR', sett.MACAROONS_DIR)
     sett.DB_DIR = env.get('DB_DIR', sett.DB_DIR)
+    sett.METRICS_PORT = env.get('METRICS_PORT', sett.METRICS_PORT)
+    if 'CACHE_TTLS' in env:
+        sett.CACHE_TTLS = _get_cache_ttls(env['CACHE_TTLS'])
+    max_streams = str(env.get('MAX_STREAMS') or sett.MAX_STREAMS).strip()
+    if not max_streams.isdigit():
+        raise RuntimeError(
+            "Invalid MAX_STREAMS '{}', a number is expected".format(
+                max_streams))
+    sett.MAX_STREAMS = int(max_streams)
     if sett.IMPLEMENTATION == 'eclair':
         sett.IMPL_SEC_TYPE = 'password'
     if sett.IMPLEMENTATION == 'lnd':
         sett.IMPL_SEC_TYPE = 'macaroon'
 
 
+def _get_cache_ttls(value):
+    """
+    Returns the response cache TTLs, overriding the default ones with the
+    given 'Method:seconds' comma-separated pairs
+    """
+    ttls = dict(sett.CACHE_TTLS)
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        method, _sep, ttl = pair.partition(':')
+        method = method.strip()
+        if method not in ttls or not ttl.strip().isdigit():
+            raise RuntimeError(
+                "Invalid CACHE_TTLS entry '{}', cacheable methods are: "
+                '{}'.format(pair.strip(), ', '.join(sorted(ttls))))
+        ttls[method] = int(ttl)
+    return ttls
+
+
 def detect_impl_secret(session):
     """ Detects if implementation has a secret stored """
     if sett.IMPLEMENTATION == 'clightning':
@@ -194,6 +380,32 @@ def command(context, *args_cmd, **kwargs):
     except TimeoutExpired:
         proc.kill()
         Err().node_error(context, 'Timeout')
+    return _get_cli_response(context, out, err)
+
+
+async def async_command(context, *args_cmd, **kwargs):
+    """
+    Given a command, calls a cli interface without blocking the event loop
+    (asyncio server mode)
+    """
+    if not sett.CMD_BASE:
+        raise RuntimeError
+    cmd = sett.CMD_BASE + list(args_cmd)
+    envi = kwargs.get('env', None)
+    wait_time = kwargs.get('timeout', get_node_timeout(context))
+    proc = await create_subprocess_exec(
+        *cmd, env=envi, stdout=PIPE, stderr=PIPE)
+    out = err = b''
+    try:
+        out, err = await wait_for(proc.communicate(), wait_time)
+    except AsyncTimeoutError:
+        proc.kill()
+        Err().node_error(context, 'Timeout')
+    return _get_cli_response(context, out, err)
+
+
+def _get_cli_response(context, out, err):
+    """ Decodes the output of a cli interface """
     out = out.decode('utf-8')
     err = err.decode('utf-8')
     res = None
@@ -260,7 +472,9 @@ def convert(context, unit, amount, enforce=None,
         # output: converting from ln node to lighter (converts only)
         source = unit
         target = Enforcer.BITS
+    started = monotonic()
     result = _convert_value(context, source, target, amount, max_precision)
+    add_stage('convert', monotonic() - started)
     if enforce:
         Enforcer.check_value(context, result, enforce)
     return result
@@ -295,6 +509,47 @@ def check_req_params(context, request, *parameters):
             Err().missing_parameter(context, param)
 
 
+def encode_cursor(key):
+    """ Returns the opaque continuation cursor of a sort key """
+    return urlsafe_b64encode(dumps(list(key)).encode()).decode()
+
+
+def decode_cursor(context, cursor):
+    """ Returns the sort key of a continuation cursor, if valid """
+    key = None
+    try:
+        key = loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        pass
+    if not isinstance(key, list):
+        Err().invalid(context, 'cursor')
+    return tuple(key)
+
+
+def paginate(context, request, entries, key, size):
+    """
+    Yields the pages of entries sorted by key, following request.cursor, as
+    (page, next_cursor) tuples; pages have at most size entries (all the
+    remaining ones if size is 0), next_cursor is empty for the last one
+    """
+    if request.cursor:
+        after = decode_cursor(context, request.cursor)
+        try:
+            entries = [entry for entry in entries if key(entry) > after]
+        except TypeError:
+            Err().invalid(context, 'cursor')
+    entries = sorted(entries, key=key)
+    size = size or len(entries) or 1
+    pos = 0
+    while True:
+        page = entries[pos:pos + size]
+        pos += size
+        if pos >= len(entries):
+            yield page, ''
+            return
+        yield page, encode_cursor(key(page[-1]))
+
+
 def get_node_timeout(context, min_time=sett.IMPL_MIN_TIMEOUT):
     """
     Calculates timeout to use when calling LN node considering client's
@@ -334,74 +589,119 @@ def handle_keyboardinterrupt(func):
 
             LOGGER.error('Keyboard interrupt detected.')
             if close_event:
-                while not close_event.is_set() or sett.THREADS:
-                    LOGGER.error('Waiting for %s threads to complete...',
-                                 active_count())
-                    sleep(3)
-            LOGGER.info('All threads shutdown correctly')
+                close_event.wait()
+            # waiting for closes and payments still running in background
+            if not sett.JOBS or sett.JOBS.drain(sett.GRPC_GRACE_TIME):
+                LOGGER.info('All threads shutdown correctly')
             raise RuntimeError
 
     return wrapper
 
 
 def handle_logs(func):
-    """ Logs gRPC call request and response """
+    """ Logs gRPC call request and response, updating call metrics """
+    method = func.__name__
+
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start_time = time()
+            peer = _log_request(args)
+            started = call_started(method)
+            try:
+                response = await func(*args, **kwargs)
+            except BaseException:
+                call_ended(method, started, get_abort_code())
+                raise
+            call_ended(method, started)
+            _log_response(response, peer, start_time)
+            return response
+
+        return async_wrapper
 
     @wraps(func)
     def wrapper(*args, **kwargs):
         start_time = time()
-        peer = user_agent = 'unknown'
-        request = args[0]
-        context = args[1]
-        if len(args) == 3:
-            request = args[1]
-            context = args[2]
-        with suppress(ValueError):
-            peer = context.peer().split(':', 1)[1]
-        for data in context.invocation_metadata():
-            if data.key == 'user-agent':
-                user_agent = data.value
-        LOGGER.info('< %-24s %s %s',
-                    request.DESCRIPTOR.name, peer, user_agent)
-        response = func(*args, **kwargs)
-        response_name = response.DESCRIPTOR.name
-        stop_time = time()
-        call_time = round(stop_time - start_time, 3)
-        LOGGER.info('> %-24s %s %2.3fs',
-                    response_name, peer, call_time)
-        LOGGER.debug('Full response: %s', str(response).replace('\n', ' '))
-        return response
-
-    return wrapper
-
-
-def handle_thread(func):
-    """ Adds and removes async threads from global list """
-
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        sett.THREADS.append(current_thread())
+        peer = _log_request(args)
+        started = call_started(method)
         try:
-            res = func(*args, **kwargs)
-            sett.THREADS.remove(current_thread())
-            return res
-        except Exception as exc:
-            sett.THREADS.remove(current_thread())
-            raise exc
+            response = profiled_call(method, func, args, kwargs)
+        except BaseException:
+            call_ended(method, started, get_abort_code())
+            raise
+        if isgenerator(response):
+            return _log_stream(
+                response, peer, start_time, (method, started))
+        call_ended(method, started)
+        _log_response(response, peer, start_time)
+        return response
 
     return wrapper
 
 
-def has_amount_encoded(payment_request):
-    """ Checks if a bech32 payment request has an amount encoded """
-    separator = payment_request.rfind('1')
-    hrp = payment_request[:separator]
-    return _has_numbers(set(hrp))
+def _log_request(args):
+    """ Logs a gRPC call request, returning the peer """
+    peer = user_agent = 'unknown'
+    request = args[0]
+    context = args[1]
+    if len(args) == 3:
+        request = args[1]
+        context = args[2]
+    with suppress(ValueError):
+        peer = context.peer().split(':', 1)[1]
+    for data in context.invocation_metadata():
+        if data.key == 'user-agent':
+            user_agent = data.value
+    LOGGER.info('< %-24s %s %s',
+                request.DESCRIPTOR.name, peer, user_agent)
+    _CALL.note = None
+    return peer
+
+
+def set_log_note(note):
+    """ Sets a note to log along with the response of the current call """
+    _CALL.note = note
+
+
+def _log_response(response, peer, start_time):
+    """ Logs a gRPC call response """
+    response_name = response.DESCRIPTOR.name
+    stop_time = time()
+    call_time = round(stop_time - start_time, 3)
+    note = getattr(_CALL, 'note', None)
+    if note:
+        LOGGER.info('> %-24s %s %2.3fs (%s)',
+                    response_name, peer, call_time, note)
+    else:
+        LOGGER.info('> %-24s %s %2.3fs',
+                    response_name, peer, call_time)
+    LOGGER.debug('Full response: %s', LogDump(response))
 
 
-def _has_numbers(input_string):
-    """ Checks if string contains any number """
-    return any(char.isdigit() for char in input_string)
+def _log_stream(responses, peer, start_time, call):
+    """
+    Logs the responses of a server-streaming gRPC call, given as call its
+    method and start time
+    """
+    method, started = call
+    count = 0
+    code = None
+    try:
+        for response in responses:
+            count += 1
+            LOGGER.debug('Streamed response: %s', LogDump(response))
+            yield response
+    except GeneratorExit:
+        code = 'CANCELLED'
+        raise
+    except BaseException:
+        code = get_abort_code()
+        raise
+    finally:
+        call_ended(method, started, code)
+        call_time = round(time() - start_time, 3)
+        LOGGER.info('> %-24s %s %2.3fs',
+                    'Stream of {}'.format(count), peer, call_time)
 
 
 def get_channel_balances(context, channels):
@@ -18,11 +18,12 @@
 import sys
 
 from os import environ
-from signal import signal, SIGTERM
+from signal import signal, SIGTERM, SIGUSR1
 
 from lighter.utils import handle_keyboardinterrupt, log_intro, log_outro, \
     update_logger
 from lighter.lighter import start
+from lighter.profiler import profile_on_signal
 
 environ["GRPC_SSL_CIPHER_SUITES"] = (
     "HIGH+ECDSA:"
@@ -36,11 +37,12 @@ def sigterm_handler(_signo, _stack_frame):
 
 
 signal(SIGTERM, sigterm_handler)
+signal(SIGUSR1, profile_on_signal)
 
 
 @handle_keyboardinterrupt
 def main():
-    update_logger()
+    update_logger(queued=True)
     log_intro()
     start()
     log_outro()
@@ -104,11 +104,11 @@ if __name__ == '__main__':
         packages=['lighter'],
         install_requires=[
             'Click~=7.0',
-            'grpcio~=1.22.1',
+            'grpcio~=1.32.0',
             'protobuf~=3.9.2',
         ],
         setup_requires=[
-            'grpcio-tools~=1.25.0',
+            'grpcio-tools~=1.32.0',
             'wheel~=0.33.6'
         ],
         entry_points={
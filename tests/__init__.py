@@ -17,7 +17,24 @@
 
 from os import path as osp
 from sys import path as spa
+from unittest.mock import Mock
 
 test_dir = osp.dirname(osp.realpath(__file__))
 proj_dir = osp.dirname(test_dir)
 spa.append(proj_dir)
+
+
+class CoroutineMock(Mock):
+    """ Mock of a coroutine function, for Python < 3.8 (no AsyncMock)
+
+    Calls return a coroutine: the call is recorded (and return_value or
+    side_effect applied) when it's awaited.
+    """
+
+    def __call__(self, *args, **kwargs):
+        async def _await():
+            return super(CoroutineMock, self).__call__(*args, **kwargs)
+        return _await()
+
+    def _get_child_mock(self, **kwargs):
+        return Mock(**kwargs)
@@ -0,0 +1,103 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Benchmark of DecodeInvoice, comparing the local BOLT 11 decoder (without and
+with its cache) to the node.
+
+Usage: python3 -m tests.bench_decode [payment_request ...]
+
+The node is asked only if IMPLEMENTATION is set, along with the variables
+Lighter uses to connect to it (plus ECL_PASS for eclair and LND_MAC_PATH,
+if required, for lnd). Payment requests default to some test ones, the node
+may reject them if they're not for its network.
+"""
+
+from importlib import import_module
+from os import environ
+from sys import argv
+from timeit import timeit
+
+from lighter import lighter_pb2 as pb, settings
+from lighter.bolt11 import decode, decode_invoice
+from lighter.utils import FakeContext
+from tests import fixtures_clightning as fix_cl, fixtures_eclair as fix_ecl
+
+PAY_REQS = [
+    fix_ecl.PARSEINVOICE['serialized'],
+    fix_ecl.PARSEINVOICE_D_HASH['serialized'],
+    fix_cl.INVOICE['bolt11'],
+    fix_cl.PAYMENTS['payments'][-1]['bolt11'],
+]
+
+ROUNDS = 200
+
+
+def _local_cold(request):
+    decode.cache_clear()
+    decode_invoice(FakeContext(), request)
+
+
+def _local_cached(request):
+    decode_invoice(FakeContext(), request)
+
+
+def _get_node_decoder():
+    """ Returns the node-backed decoding function, if a node is configured """
+    if 'IMPLEMENTATION' not in environ:
+        return None
+    settings.IMPLEMENTATION = environ['IMPLEMENTATION'].lower()
+    module = import_module('lighter.light_{}'.format(settings.IMPLEMENTATION))
+    secret = None
+    if settings.IMPLEMENTATION == 'eclair':
+        secret = environ['ECL_PASS'].encode()
+    if settings.IMPLEMENTATION == 'lnd' and environ.get('LND_MAC_PATH'):
+        with open(environ['LND_MAC_PATH'], 'rb') as file:
+            secret = file.read()
+    module.update_settings(secret)
+
+    def node_decode(request):
+        module._decode_invoice_node(  # pylint: disable=protected-access
+            request, FakeContext())
+
+    return node_decode
+
+
+def _bench(func, request):
+    """ Returns the mean time of a call, in ms """
+    func(request)
+    return timeit(lambda: func(request), number=ROUNDS) / ROUNDS * 1000
+
+
+def main():
+    """ Runs the benchmark and prints a line per payment request """
+    paths = [('local', _local_cold), ('local cached', _local_cached)]
+    node_decode = _get_node_decoder()
+    if node_decode:
+        paths.append(('node', node_decode))
+    print('{:<14}'.format('pay_req') + ''.join(
+        '{:>14}'.format(name) for name, _func in paths))
+    for pay_req in argv[1:] or PAY_REQS:
+        request = pb.DecodeInvoiceRequest(payment_request=pay_req)
+        times = []
+        for _name, func in paths:
+            try:
+                times.append('{:>11.3f} ms'.format(_bench(func, request)))
+            except RuntimeError as err:
+                times.append('{:>14}'.format(str(err)[:13]))
+        print('{:<14}'.format(pay_req[:11] + '...') + ''.join(times))
+
+
+if __name__ == '__main__':
+    main()
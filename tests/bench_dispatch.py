@@ -0,0 +1,139 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Benchmark of the dispatching of Lightning service calls, comparing a lookup
+of the implementation function at every call (as Lighter did before) to a
+handler built once, both wrapped by handle_logs only, and to the handler
+LightningServicer actually serves.
+
+Usage: python3 -m tests.bench_dispatch [rounds]
+
+Calls go straight to the handlers (no network, logging disabled) and reach a
+no-op implementation of GetInfo and ListPayments, so that only Lighter's own
+overhead is measured. The servicer handler adds the node circuit breaker,
+the response cache (disabled here) and the coalescing of read-only calls.
+"""
+
+import logging
+import sys
+
+from importlib import import_module
+from sys import argv
+from timeit import timeit
+from types import ModuleType
+
+from lighter import lighter_pb2 as pb, settings
+from lighter.errors import Err
+from lighter.health import close_node_health
+from lighter.lighter import LightningServicer
+from lighter.utils import handle_logs
+
+IMPLEMENTATION = 'bench'
+
+ROUNDS = 200000
+
+
+class _Context():
+    """ Minimal gRPC server context """
+
+    @staticmethod
+    def peer():
+        """ Returns the client address """
+        return 'ipv4:127.0.0.1:50000'
+
+    @staticmethod
+    def invocation_metadata():
+        """ Returns the call metadata """
+        return ()
+
+    @staticmethod
+    def abort(code, details):
+        """ Terminates the call """
+        raise RuntimeError('{}: {}'.format(code, details))
+
+
+class _Details():  # pylint: disable=too-few-public-methods
+    """ Handler call details of a method """
+
+    def __init__(self, method):
+        self.method = '/lighter.Lightning/{}'.format(method)
+
+
+def _get_module():
+    """ Returns a no-op implementation module, registered for import """
+    module = ModuleType('lighter.light_{}'.format(IMPLEMENTATION))
+
+    def GetInfo(_request, _context):
+        return pb.GetInfoResponse()
+
+    def ListPayments(_request, _context):
+        return pb.ListPaymentsResponse()
+
+    module.GetInfo = GetInfo
+    module.ListPayments = ListPayments
+    sys.modules[module.__name__] = module
+    return module
+
+
+def _lookup_dispatcher(name):
+    """ Returns a dispatcher looking the implementation up at every call """
+
+    @handle_logs
+    def dispatcher(request, context):
+        module = import_module('lighter.light_{}'.format(
+            settings.IMPLEMENTATION))
+        try:
+            func = getattr(module, name)
+        except AttributeError:
+            Err().unimplemented_method(context, name)
+        return func(request, context)
+
+    return dispatcher
+
+
+def _bench(func, request, rounds):
+    """ Returns the mean time of a call, in us """
+    context = _Context()
+    func(request, context)
+    return timeit(lambda: func(request, context), number=rounds) / rounds \
+        * 1000000
+
+
+def main():
+    """ Runs the benchmark and prints a line per method """
+    rounds = int(argv[1]) if len(argv) > 1 else ROUNDS
+    logging.disable(logging.CRITICAL)
+    module = _get_module()
+    settings.IMPLEMENTATION = IMPLEMENTATION
+    settings.CACHE_TTLS = {}
+    servicer = LightningServicer()
+    print('{:<14}{:>14}{:>14}{:>14}'.format(
+        'method', 'lookup', 'built once', 'servicer'))
+    try:
+        for method, request in (('GetInfo', pb.GetInfoRequest()),
+                                ('ListPayments', pb.ListPaymentsRequest())):
+            times = [
+                _bench(_lookup_dispatcher(method), request, rounds),
+                _bench(handle_logs(getattr(module, method)), request, rounds),
+                _bench(servicer.service(_Details(method)).unary_unary,
+                       request, rounds)]
+            print('{:<14}'.format(method) + ''.join(
+                '{:>11.2f} us'.format(time) for time in times))
+    finally:
+        close_node_health()
+
+
+if __name__ == '__main__':
+    main()
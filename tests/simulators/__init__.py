@@ -0,0 +1,384 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Simulators of the LN nodes Lighter talks to, to load test Lighter offline.
+
+Each simulator serves the node API Lighter uses (lnd gRPC, c-lightning
+JSON-RPC socket and lightning-cli, eclair HTTP API) from a NodeData, with the
+latency and errors of a Behavior. See python3 -m tests.simulators --help.
+"""
+
+from hashlib import sha256
+from random import Random
+from threading import Condition, Lock
+from time import sleep, time
+
+from tests import fixtures_clightning as fix_cl, fixtures_eclair as fix_ecl
+
+# Payment requests given to invoices (their content is not checked)
+PAY_REQS = [
+    fix_ecl.PARSEINVOICE['serialized'],
+    fix_ecl.PARSEINVOICE_D_HASH['serialized'],
+    fix_cl.INVOICE['bolt11'],
+    fix_cl.PAYMENTS['payments'][-1]['bolt11'],
+]
+
+# Seconds between the creation of consecutive generated invoices
+INVOICE_SPACING = 1
+INVOICE_EXPIRY = 3600
+BLOCKHEIGHT = 600000
+
+ERROR_MESSAGE = 'Simulated failure'
+
+
+class Behavior():
+    """
+    Latency and failures of the calls to a simulator.
+
+    Each call waits latency seconds (or the ones given for its method in
+    method_latency), plus up to jitter seconds, then fails with probability
+    error_rate.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, method_latency=None,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.method_latency = method_latency or {}
+        self.calls = 0
+        self.failures = 0
+        self._random = Random(seed)
+        self._lock = Lock()
+
+    def call(self, method):
+        """ Waits the latency of method, returning whether it must fail """
+        with self._lock:
+            self.calls += 1
+            delay = self.method_latency.get(method, self.latency)
+            if self.jitter:
+                delay += self._random.uniform(0, self.jitter)
+            fails = self._random.random() < self.error_rate
+            if fails:
+                self.failures += 1
+        if delay:
+            sleep(delay)
+        return fails
+
+
+class NodeData():
+    """
+    Dataset of a simulated node, in implementation-neutral dicts.
+
+    Generated invoices are derived from their index when read, so millions
+    of them take no memory: their payment hash embeds the index (to be looked
+    up) and one in three is paid, the others expire INVOICE_EXPIRY seconds
+    after creation. Invoices created while running are kept in memory and
+    get paid settle_after seconds after creation (never, if None).
+    Channels, payments, transactions and graph nodes are generated at start.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(self, channels=100, invoices=1000, payments=100,
+                 transactions=100, nodes=1000, settle_after=None, seed=0):
+        self.started = int(time())
+        self.settle_after = settle_after
+        self.pubkey = _get_pubkey(seed, 'node')
+        self._seed = seed
+        self._hash_prefix = sha256(
+            'invoices {}'.format(seed).encode()).hexdigest()[:48]
+        self._generated = invoices
+        self._generated_paid = invoices // 3
+        self._created = []
+        self._labels = {}
+        self._lock = Lock()
+        self._invoices_changed = Condition(self._lock)
+        self._channels_changed = Condition(self._lock)
+        self.channels = [self._get_channel(i) for i in range(channels)]
+        self.peers = {
+            chan['peer']: '10.0.{}.{}:9735'.format(i // 250, i % 250 + 1)
+            for i, chan in enumerate(self.channels)}
+        self.nodes = list(self.peers) + [
+            _get_pubkey(seed, 'graph {}'.format(i))
+            for i in range(max(nodes - len(self.peers), 0))]
+        self.payments = [
+            self._get_payment(i, PAY_REQS[i % len(PAY_REQS)])
+            for i in range(payments)]
+        self.transactions = [
+            self._get_transaction(i) for i in range(transactions)]
+
+    @property
+    def total_invoices(self):
+        """ Number of generated and created invoices """
+        return self._generated + len(self._created)
+
+    def get_info(self):
+        """ Returns the node info """
+        return {
+            'pubkey': self.pubkey, 'alias': 'lighter-simulator',
+            'color': '3399ff', 'version': 'simulator',
+            'blockheight': BLOCKHEIGHT + (int(time()) - self.started) // 600,
+            'network': 'regtest', 'address': '127.0.0.1', 'port': 9735}
+
+    def get_invoice(self, index):
+        """ Returns the invoice with the given index (from 1), if any """
+        if index < 1:
+            return None
+        if index <= self._generated:
+            return self._get_generated_invoice(index)
+        with self._lock:
+            if index - self._generated > len(self._created):
+                return None
+            created = self._created[index - self._generated - 1]
+        return self._get_created_invoice(index, created)
+
+    def list_invoices(self, start=1, count=None):
+        """ Yields up to count invoices, from index start """
+        stop = self.total_invoices + 1
+        if count is not None:
+            stop = min(stop, start + count)
+        for index in range(max(start, 1), stop):
+            yield self.get_invoice(index)
+
+    def list_invoices_since(self, timestamp):
+        """ Yields the invoices created at or after timestamp """
+        first = self._generated + 1 - \
+            (self.started - timestamp) // INVOICE_SPACING
+        for invoice in self.list_invoices(max(first, 1)):
+            if invoice['created_at'] >= timestamp:
+                yield invoice
+
+    def find_invoice(self, payment_hash):
+        """ Returns the invoice with the given payment hash, if any """
+        if len(payment_hash) != 64 or \
+                not payment_hash.startswith(self._hash_prefix):
+            return None
+        try:
+            return self.get_invoice(int(payment_hash[48:], 16))
+        except ValueError:
+            return None
+
+    def find_invoice_by_label(self, label):
+        """ Returns the invoice with the given label, if any """
+        index = self._labels.get(label)
+        if index is None and label.startswith('sim') and \
+                label[3:].isdigit() and int(label[3:]) <= self._generated:
+            index = int(label[3:])
+        return self.get_invoice(index) if index else None
+
+    def add_invoice(self, amount_msat, description, expiry, label=None):
+        """ Creates an invoice, returning it """
+        with self._invoices_changed:
+            index = self._generated + len(self._created) + 1
+            created = {
+                'amount_msat': amount_msat, 'description': description,
+                'expiry': expiry or INVOICE_EXPIRY, 'created_at': time(),
+                'label': label or 'sim{}'.format(index)}
+            self._created.append(created)
+            self._labels[created['label']] = index
+            self._invoices_changed.notify_all()
+        return self._get_created_invoice(index, created)
+
+    def list_paid_invoices(self, after=0, since=None):
+        """
+        Yields the paid invoices with a pay index greater than after (and,
+        if since is given, paid at or after that timestamp)
+        """
+        if since is not None:
+            # index of the first generated invoice paid since then
+            first = self._generated - \
+                (self.started - since) // INVOICE_SPACING
+            after = max(after, min(-(-first // 3) - 1, self._generated_paid))
+        for pay_index in range(after + 1, self._generated_paid + 1):
+            yield self._get_generated_invoice(pay_index * 3)
+        first = max(after - self._generated_paid, 0)
+        with self._lock:
+            created = list(enumerate(self._created))[first:]
+        for position, invoice in created:
+            invoice = self._get_created_invoice(
+                self._generated + position + 1, invoice)
+            if invoice['status'] != 'paid':
+                break
+            if since is None or invoice['paid_at'] >= since:
+                yield invoice
+
+    def last_pay_index(self):
+        """ Returns the pay index of the last paid invoice """
+        pay_index = self._generated_paid
+        for invoice in self.list_paid_invoices(self._generated_paid):
+            pay_index = invoice['pay_index']
+        return pay_index
+
+    def wait_paid_invoice(self, after, timeout):
+        """
+        Returns the first invoice paid with a pay index greater than after,
+        waiting up to timeout seconds for it, None if not paid in time
+        """
+        deadline = time() + timeout
+        while True:
+            for invoice in self.list_paid_invoices(after):
+                return invoice
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            with self._invoices_changed:
+                self._invoices_changed.wait(min(remaining, 0.5))
+
+    def pay(self, payment_request, amount_msat=None):
+        """ Pays a payment request, returning the payment """
+        with self._lock:
+            payment = self._get_payment(
+                len(self.payments), payment_request, amount_msat)
+            payment['created_at'] = int(time())
+            self.payments.append(payment)
+        return payment
+
+    def get_channel(self, channel_id):
+        """
+        Returns the channel with the given ID (channel ID, short channel ID
+        or lnd numeric ID), if any
+        """
+        with self._lock:
+            for channel in self.channels:
+                if channel_id in (channel['channel_id'], channel['scid'],
+                                  str(channel['chan_id'])):
+                    return channel
+        return None
+
+    def open_channel(self, peer, capacity_sat, push_msat=0, private=False):
+        """ Opens a channel, returning it (pending) """
+        with self._channels_changed:
+            channel = self._get_channel(len(self.channels))
+            channel.update(
+                peer=peer, capacity_sat=capacity_sat,
+                local_msat=capacity_sat * 1000 - push_msat, private=private,
+                state='pending_open', active=False)
+            self.channels.append(channel)
+            self.peers.setdefault(peer, '10.1.0.1:9735')
+            self._channels_changed.notify_all()
+        return channel
+
+    def close_channel(self, channel, force=False):
+        """ Starts closing a channel, returning its closing txid """
+        with self._channels_changed:
+            channel['state'] = 'force_closing' if force else 'closing'
+            channel['active'] = False
+            channel['closing_txid'] = _get_hash(
+                self._seed, 'close {}'.format(channel['index']))
+            self._channels_changed.notify_all()
+        return channel['closing_txid']
+
+    def wait_channels_change(self, timeout):
+        """
+        Waits up to timeout seconds for a channel to be opened or closed,
+        returning whether it happened
+        """
+        with self._channels_changed:
+            return self._channels_changed.wait(timeout)
+
+    def _get_generated_invoice(self, index):
+        """ Returns the generated invoice with the given index """
+        created_at = self.started - \
+            (self._generated - index + 1) * INVOICE_SPACING
+        invoice = self._get_base_invoice(index, created_at)
+        invoice.update(
+            amount_msat=(1000 + index % 100000) * 1000,
+            description='Invoice {}'.format(index), expiry=INVOICE_EXPIRY)
+        if index % 3 == 0:
+            invoice.update(
+                status='paid', pay_index=index // 3,
+                paid_at=created_at + INVOICE_SPACING,
+                received_msat=invoice['amount_msat'])
+        elif created_at + INVOICE_EXPIRY < time():
+            invoice['status'] = 'expired'
+        return invoice
+
+    def _get_created_invoice(self, index, created):
+        """ Returns an invoice created while running """
+        invoice = self._get_base_invoice(index, int(created['created_at']))
+        invoice.update(
+            amount_msat=created['amount_msat'], label=created['label'],
+            description=created['description'], expiry=created['expiry'])
+        if self.settle_after is not None and \
+                created['created_at'] + self.settle_after <= time():
+            invoice.update(
+                status='paid',
+                pay_index=self._generated_paid + index - self._generated,
+                paid_at=int(created['created_at'] + self.settle_after),
+                received_msat=created['amount_msat'] or 1000)
+        elif invoice['created_at'] + invoice['expiry'] < time():
+            invoice['status'] = 'expired'
+        return invoice
+
+    def _get_base_invoice(self, index, created_at):
+        """ Returns the fields an invoice derives from its index """
+        return {
+            'index': index, 'label': 'sim{}'.format(index),
+            'payment_hash': '{}{:016x}'.format(self._hash_prefix, index),
+            'preimage': _get_hash(self._seed, 'preimage {}'.format(index)),
+            'payment_request': PAY_REQS[index % len(PAY_REQS)],
+            'created_at': created_at, 'status': 'unpaid', 'pay_index': 0,
+            'paid_at': 0, 'received_msat': 0}
+
+    def _get_channel(self, index):
+        """ Returns a generated channel """
+        block, tx_index = BLOCKHEIGHT - 1000 + index // 100, index % 100
+        capacity_sat = 1000000 + (index % 50) * 100000
+        return {
+            'index': index,
+            'peer': _get_pubkey(self._seed, 'peer {}'.format(index // 2)),
+            'funding_txid': _get_hash(self._seed, 'funding {}'.format(index)),
+            'output_index': 0,
+            'channel_id': _get_hash(self._seed, 'channel {}'.format(index)),
+            'scid': '{}x{}x0'.format(block, tx_index),
+            'chan_id': (block << 40) | (tx_index << 16),
+            'capacity_sat': capacity_sat,
+            'local_msat': capacity_sat * 1000 * (index % 10) // 10,
+            'state': 'open', 'active': index % 7 != 0,
+            'private': index % 5 == 0, 'closing_txid': ''}
+
+    def _get_payment(self, index, payment_request, amount_msat=None):
+        """ Returns a payment """
+        amount_msat = amount_msat or (500 + index % 10000) * 1000
+        preimage = _get_hash(self._seed, 'payment {}'.format(index))
+        return {
+            'index': index, 'payment_request': payment_request,
+            'payment_hash': sha256(bytes.fromhex(preimage)).hexdigest(),
+            'preimage': preimage, 'amount_msat': amount_msat,
+            'fee_msat': index % 1000,
+            'created_at': self.started - 60 * (100000 - index),
+            'destination': _get_pubkey(self._seed, 'payee')}
+
+    def _get_transaction(self, index):
+        """ Returns an on-chain transaction """
+        return {
+            'txid': _get_hash(self._seed, 'transaction {}'.format(index)),
+            'amount_sat': (index % 2 * 2 - 1) * (10000 + index),
+            'fee_sat': 200 + index % 100,
+            'blockheight': BLOCKHEIGHT - 2000 + index,
+            'block_hash': _get_hash(self._seed, 'block {}'.format(index)),
+            'time': self.started - 600 * (2000 - index),
+            'address': 'bcrt1qsimulator{}'.format(index)}
+
+
+def _get_hash(seed, name):
+    """ Returns a hex SHA256 digest, unique for seed and name """
+    return sha256('{} {}'.format(seed, name).encode()).hexdigest()
+
+
+def _get_pubkey(seed, name):
+    """ Returns a fake compressed public key, unique for seed and name """
+    return '02' + _get_hash(seed, name)
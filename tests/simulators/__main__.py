@@ -0,0 +1,132 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Runs a node simulator, to load test Lighter with no node and no network.
+
+Usage: python3 -m tests.simulators {lnd,clightning,eclair} [options]
+
+The variables to point Lighter to the simulator are printed once it's up.
+"""
+
+from argparse import ArgumentParser
+from functools import partial
+from os import makedirs, path
+from tempfile import mkdtemp
+from time import sleep
+
+from tests.simulators import Behavior, clightning, eclair, lnd, NodeData
+
+DEFAULT_PORTS = {'lnd': 10009, 'clightning': None, 'eclair': 8080}
+
+
+def _get_method_latency(values):
+    """ Parses METHOD=SECONDS values """
+    method_latency = {}
+    for value in values:
+        method, _sep, seconds = value.partition('=')
+        method_latency[method] = float(seconds)
+    return method_latency
+
+
+def _parse_args():
+    """ Returns the command line arguments """
+    parser = ArgumentParser(
+        prog='python3 -m tests.simulators',
+        description='Serves a simulated LN node for Lighter to use')
+    parser.add_argument('implementation', choices=sorted(DEFAULT_PORTS))
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, help='default 10009 for lnd, '
+                        '8080 for eclair (0 picks a free one)')
+    parser.add_argument('--dir', help='where to put the lnd TLS certificate '
+                        'or the c-lightning socket (default a temporary one)')
+    parser.add_argument('--password', default='simulator',
+                        help='eclair API password (default %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to each call (default 0)')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='maximum random seconds added to each call')
+    parser.add_argument('--method-latency', action='append', default=[],
+                        metavar='METHOD=SECONDS',
+                        help='latency of a method, instead of --latency')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of calls failing (default 0)')
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--invoices', type=int, default=1000)
+    parser.add_argument('--payments', type=int, default=100)
+    parser.add_argument('--transactions', type=int, default=100)
+    parser.add_argument('--nodes', type=int, default=1000,
+                        help='nodes in the network graph (default 1000)')
+    parser.add_argument('--settle-after', type=float, metavar='SECONDS',
+                        help='seconds after which created invoices get paid '
+                        '(default never)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated data and behavior')
+    return parser.parse_args()
+
+
+def main():
+    """ Starts the requested simulator and serves until interrupted """
+    args = _parse_args()
+    data = NodeData(
+        channels=args.channels, invoices=args.invoices,
+        payments=args.payments, transactions=args.transactions,
+        nodes=args.nodes, settle_after=args.settle_after, seed=args.seed)
+    behavior = Behavior(
+        latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate,
+        method_latency=_get_method_latency(args.method_latency),
+        seed=args.seed)
+    work_dir = args.dir or mkdtemp(prefix='lighter-simulator-')
+    makedirs(work_dir, exist_ok=True)
+    work_dir = path.abspath(work_dir)
+    port = args.port
+    if port is None:
+        port = DEFAULT_PORTS[args.implementation]
+    if args.implementation == 'lnd':
+        grpc_server, port = lnd.serve(
+            data, behavior, args.host, port, work_dir)
+        stop = partial(grpc_server.stop, None)
+        env = {'LND_HOST': args.host, 'LND_PORT': port,
+               'LND_CERT_DIR': work_dir, 'LND_CERT': lnd.CERT}
+    elif args.implementation == 'clightning':
+        rpc_server = clightning.serve(data, behavior, work_dir)
+        stop = rpc_server.shutdown
+        env = {'CL_RPC_DIR': work_dir, 'CL_RPC': clightning.RPC_FILE,
+               'CL_CLI_DIR': work_dir, 'CL_CLI': clightning.CLI_FILE}
+    else:
+        httpd = eclair.serve(data, behavior, args.host, port, args.password)
+        port = httpd.server_address[1]
+        stop = httpd.shutdown
+        env = {'ECL_HOST': args.host, 'ECL_PORT': port}
+    print('Simulating {} with {} channels and {} invoices, set:'.format(
+        args.implementation, len(data.channels), data.total_invoices))
+    print('IMPLEMENTATION={}'.format(args.implementation))
+    for name, value in env.items():
+        print('{}={}'.format(name, value))
+    if args.implementation == 'eclair':
+        print('and store {} as eclair password (make secure)'.format(
+            args.password))
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    stop()
+    print('Served {} calls, {} failed on purpose'.format(
+        behavior.calls, behavior.failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+c-lightning simulator, answering the JSON-RPC commands Lighter sends on the
+lightning-rpc unix socket, plus a lightning-cli stand-in calling it
+"""
+
+from collections import namedtuple
+from hashlib import sha256
+from json import dumps, JSONDecoder
+from os import chmod, path, remove
+from select import select
+from socket import MSG_PEEK
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from sys import executable
+from threading import Thread
+from time import time
+
+from tests.simulators import ERROR_MESSAGE, INVOICE_EXPIRY
+
+RPC_FILE = 'lightning-rpc'
+CLI_FILE = 'lightning-cli'
+
+# Items of a list result written to the socket at a time
+WRITE_ITEMS = 1000
+# Seconds between checks of whether a waitanyinvoice caller is still there
+POLL_TIME = 0.5
+
+# lightning-cli stand-in, it calls the socket and prints the result or error
+CLI_SCRIPT = '''#!{executable}
+""" lightning-cli stand-in of the c-lightning simulator """
+
+from json import dumps, loads
+from os import path
+from socket import AF_UNIX, socket, SOCK_STREAM
+from sys import argv, exit as sys_exit
+
+options = {{'--lightning-dir': '.', '--rpc-file': '{rpc_file}'}}
+args = []
+for arg in argv[1:]:
+    if arg.startswith('--'):
+        key, _sep, value = arg.partition('=')
+        options[key] = value
+    elif arg != '-k':
+        args.append(arg)
+params = {{}}
+for arg in args[1:]:
+    key, value = arg.split('=', 1)
+    if value.isdigit() or value in ('true', 'false', 'null') or \\
+            value[:1] in ('[', '{{', '"'):
+        try:
+            value = loads(value)
+        except ValueError:
+            value = value.strip('"')
+    params[key] = value
+sock = socket(AF_UNIX, SOCK_STREAM)
+sock.connect(path.join(options['--lightning-dir'], options['--rpc-file']))
+sock.sendall(dumps(
+    {{'jsonrpc': '2.0', 'id': 1, 'method': args[0], 'params': params}}
+).encode('utf-8'))
+buffer = b''
+while not buffer.endswith(b'\\n\\n'):
+    data = sock.recv(65536)
+    if not data:
+        break
+    buffer += data
+response = loads(buffer.decode('utf-8'))
+if 'error' in response:
+    print(dumps(response['error'], indent=2))
+    sys_exit(1)
+print(dumps(response['result'], indent=2))
+'''
+
+# A result with a list of items, written a chunk at a time
+ListResult = namedtuple('ListResult', ['key', 'items'])
+
+CHANNEL_STATES = {
+    'open': ('CHANNELD_NORMAL', 'Funding transaction locked.'),
+    'pending_open': ('CHANNELD_AWAITING_LOCKIN', 'Funding needs more confs.'),
+    'closing': ('CLOSINGD_COMPLETE', 'Tracking mutual close transaction'),
+    'force_closing': (
+        'AWAITING_UNILATERAL', 'Tracking our own unilateral close'),
+}
+
+
+class RpcError(Exception):
+    """ A JSON-RPC error, with its code and message """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class CLightningSimulator():
+    """ Commands of the c-lightning simulator """
+
+    # pylint: disable=unused-argument
+
+    def __init__(self, data, behavior):
+        self.data = data
+        self.behavior = behavior
+        self._addresses = 0
+
+    def call(self, method, params, sock):
+        """ Returns the result of a command, raising RpcError on errors """
+        func = getattr(self, 'cmd_{}'.format(method), None)
+        if not func:
+            raise RpcError(-32601, 'Unknown command \'{}\''.format(method))
+        if self.behavior.call(method):
+            raise RpcError(-1, ERROR_MESSAGE)
+        if isinstance(params, list):
+            raise RpcError(-32602, 'Positional parameters not supported')
+        try:
+            return func(sock, **params)
+        except TypeError as err:
+            raise RpcError(-32602, str(err))
+
+    def cmd_getinfo(self, sock):
+        info = self.data.get_info()
+        return {
+            'id': info['pubkey'], 'alias': info['alias'],
+            'color': info['color'], 'version': info['version'],
+            'blockheight': info['blockheight'], 'network': info['network'],
+            'num_peers': len(self.data.peers),
+            'address': [{'type': 'ipv4', 'address': info['address'],
+                         'port': info['port']}],
+            'binding': []}
+
+    def cmd_newaddr(self, sock, addresstype='p2sh-segwit'):
+        self._addresses += 1
+        prefix = 'bcrt1q' if addresstype == 'bech32' else '2N'
+        return {addresstype: '{}simulator{}'.format(prefix, self._addresses)}
+
+    def cmd_listfunds(self, sock):
+        return {
+            'outputs': [
+                {'txid': transaction['txid'], 'output': 0,
+                 'value': abs(transaction['amount_sat']),
+                 'address': transaction['address'], 'status': 'confirmed'}
+                for transaction in self.data.transactions
+                if transaction['amount_sat'] > 0],
+            'channels': []}
+
+    def cmd_listpeers(self, sock, id=None, level=None):
+        # pylint: disable=redefined-builtin
+        peers = {}
+        for pubkey, address in self.data.peers.items():
+            if id in (None, pubkey):
+                peers[pubkey] = {
+                    'id': pubkey, 'connected': False, 'netaddr': [address],
+                    'channels': []}
+        for chan in self.data.channels:
+            peer = peers.get(chan['peer'])
+            if not peer:
+                continue
+            peer['connected'] = peer['connected'] or chan['active']
+            peer['channels'].append(_get_channel(chan))
+        return {'peers': list(peers.values())}
+
+    def cmd_invoice(self, sock, msatoshi, label, description,
+                    expiry=None, fallbacks=None, preimage=None):
+        if self.data.find_invoice_by_label(label):
+            raise RpcError(900, 'Duplicate label \'{}\''.format(label))
+        amount_msat = 0 if msatoshi == 'any' else int(msatoshi)
+        invoice = self.data.add_invoice(
+            amount_msat, description, int(expiry or INVOICE_EXPIRY), label)
+        return {
+            'payment_hash': invoice['payment_hash'],
+            'expires_at': invoice['created_at'] + invoice['expiry'],
+            'bolt11': invoice['payment_request']}
+
+    def cmd_listinvoices(self, sock, label=None):
+        if label is not None:
+            invoice = self.data.find_invoice_by_label(label)
+            return {'invoices': [_get_invoice(invoice)] if invoice else []}
+        return ListResult(
+            'invoices', map(_get_invoice, self.data.list_invoices()))
+
+    def cmd_waitanyinvoice(self, sock, lastpay_index=0):
+        while True:
+            invoice = self.data.wait_paid_invoice(
+                int(lastpay_index), POLL_TIME)
+            if invoice:
+                return _get_invoice(invoice)
+            if _is_closed(sock):
+                return None
+
+    def cmd_pay(self, sock, bolt11, msatoshi=None, **kwargs):
+        return _get_payment(
+            self.data.pay(bolt11, int(msatoshi) if msatoshi else None))
+
+    def cmd_listsendpays(self, sock, bolt11=None, payment_hash=None):
+        return ListResult(
+            'payments', map(_get_payment, self.data.payments))
+
+    def cmd_withdraw(self, sock, destination, satoshi, feerate=None,
+                     minconf=None):
+        txid = sha256('{} {} {}'.format(
+            destination, satoshi, time()).encode()).hexdigest()
+        return {'tx': '02000000' + txid, 'txid': txid}
+
+    def cmd_decodepay(self, sock, bolt11, description=None):
+        return {
+            'currency': 'bcrt', 'created_at': int(time()),
+            'expiry': INVOICE_EXPIRY, 'payee': self.data.get_info()['pubkey'],
+            'msatoshi': 1000000, 'amount_msat': '1000000msat',
+            'description': 'Simulated payment request',
+            'min_final_cltv_expiry': 10,
+            'payment_hash': sha256(bolt11.encode()).hexdigest(),
+            'signature': '30' * 35}
+
+    def cmd_connect(self, sock, id, host=None, port=None):
+        # pylint: disable=redefined-builtin
+        pubkey, _sep, address = id.partition('@')
+        self.data.peers.setdefault(
+            pubkey, address or '{}:{}'.format(host, port or 9735))
+        return {'id': pubkey}
+
+    def cmd_fundchannel(self, sock, id, amount, feerate=None, announce=True,
+                        minconf=None):
+        # pylint: disable=redefined-builtin
+        if id not in self.data.peers:
+            raise RpcError(-1, 'Unknown peer')
+        chan = self.data.open_channel(
+            id, int(amount), private=announce in (False, 'false'))
+        return {
+            'tx': '02000000' + chan['funding_txid'],
+            'txid': chan['funding_txid'], 'channel_id': chan['channel_id']}
+
+    def cmd_close(self, sock, id, force=None, timeout=None,
+                  unilateraltimeout=None):
+        # pylint: disable=redefined-builtin
+        chan = self.data.get_channel(id)
+        if not chan:
+            for chan in self.data.channels:
+                if chan['peer'] == id and chan['state'] == 'open':
+                    break
+            else:
+                raise RpcError(-1, 'Short channel ID not found: \'{}\''.format(
+                    id))
+        if chan['state'] != 'open':
+            raise RpcError(-1, 'Channel is in state {}'.format(
+                CHANNEL_STATES[chan['state']][0]))
+        unilateral = bool(force) or bool(unilateraltimeout) and \
+            not chan['active']
+        txid = self.data.close_channel(chan, unilateral)
+        return {
+            'tx': '02000000' + txid, 'txid': txid,
+            'type': 'unilateral' if unilateral else 'mutual'}
+
+    def cmd_listnodes(self, sock, id=None):
+        # pylint: disable=redefined-builtin
+        return ListResult('nodes', (
+            {'nodeid': pubkey, 'alias': 'node{}'.format(index),
+             'color': '{:06x}'.format(index % 0x1000000),
+             'last_timestamp': self.data.started, 'addresses': []}
+            for index, pubkey in enumerate(self.data.nodes)
+            if id in (None, pubkey)))
+
+
+class _RpcHandler(StreamRequestHandler):
+    """ Answers the JSON-RPC requests sent on a connection """
+
+    def handle(self):
+        """ Reads concatenated JSON requests, answering each in turn """
+        decoder = JSONDecoder()
+        buffer = ''
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buffer += data.decode('utf-8')
+            while True:
+                buffer = buffer.lstrip()
+                try:
+                    request, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    break
+                buffer = buffer[end:]
+                self._answer(request)
+
+    def _answer(self, request):
+        """ Writes the response of a request """
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            result = self.server.simulator.call(
+                request.get('method'), request.get('params') or {},
+                self.request)
+        except RpcError as err:
+            response['error'] = {'code': err.code, 'message': err.message}
+            self.wfile.write((dumps(response) + '\n\n').encode('utf-8'))
+            return
+        if result is None:
+            return
+        if not isinstance(result, ListResult):
+            response['result'] = result
+            self.wfile.write((dumps(response) + '\n\n').encode('utf-8'))
+            return
+        response['result'] = {result.key: []}
+        head, tail = dumps(response).rsplit('[]', 1)
+        self.wfile.write(head.encode('utf-8') + b'[')
+        chunk = []
+        separator = ''
+        for item in result.items:
+            chunk.append(dumps(item))
+            if len(chunk) == WRITE_ITEMS:
+                self.wfile.write((separator + ', '.join(chunk)).encode())
+                chunk, separator = [], ', '
+        if chunk:
+            self.wfile.write((separator + ', '.join(chunk)).encode())
+        self.wfile.write(('] ' + tail + '\n\n').encode('utf-8'))
+
+
+def _is_closed(sock):
+    """ Whether the other end has closed the connection """
+    readable, _writable, _errors = select([sock], [], [], 0)
+    return bool(readable) and not sock.recv(1, MSG_PEEK)
+
+
+def _get_channel(chan):
+    """ Returns a channel as listed by listpeers """
+    state, status = CHANNEL_STATES[chan['state']]
+    capacity_msat = chan['capacity_sat'] * 1000
+    return {
+        'state': state, 'status': ['{}:{}'.format(state, status)],
+        'short_channel_id': chan['scid'], 'channel_id': chan['channel_id'],
+        'funding_txid': chan['funding_txid'], 'private': chan['private'],
+        'msatoshi_to_us': chan['local_msat'],
+        'msatoshi_total': capacity_msat,
+        'to_us_msat': '{}msat'.format(chan['local_msat']),
+        'total_msat': '{}msat'.format(capacity_msat),
+        'our_to_self_delay': 144, 'their_to_self_delay': 144,
+        'our_channel_reserve_satoshis': chan['capacity_sat'] // 100,
+        'their_channel_reserve_satoshis': chan['capacity_sat'] // 100}
+
+
+def _get_invoice(invoice):
+    """ Returns an invoice as listed by listinvoices """
+    cl_invoice = {
+        'label': invoice['label'], 'bolt11': invoice['payment_request'],
+        'payment_hash': invoice['payment_hash'], 'status': invoice['status'],
+        'description': invoice['description'],
+        'expires_at': invoice['created_at'] + invoice['expiry']}
+    if invoice['amount_msat']:
+        cl_invoice['msatoshi'] = invoice['amount_msat']
+        cl_invoice['amount_msat'] = '{}msat'.format(invoice['amount_msat'])
+    if invoice['status'] == 'paid':
+        cl_invoice.update(
+            pay_index=invoice['pay_index'],
+            msatoshi_received=invoice['received_msat'],
+            amount_received_msat='{}msat'.format(invoice['received_msat']),
+            paid_at=invoice['paid_at'], payment_preimage=invoice['preimage'])
+    return cl_invoice
+
+
+def _get_payment(payment):
+    """ Returns a payment as listed by listsendpays """
+    return {
+        'id': payment['index'] + 1, 'payment_hash': payment['payment_hash'],
+        'destination': payment['destination'],
+        'msatoshi': payment['amount_msat'],
+        'msatoshi_sent': payment['amount_msat'] + payment['fee_msat'],
+        'created_at': payment['created_at'], 'status': 'complete',
+        'payment_preimage': payment['preimage'],
+        'bolt11': payment['payment_request']}
+
+
+def write_cli(cli_dir):
+    """ Writes the lightning-cli stand-in in cli_dir, returning its path """
+    cli_path = path.join(cli_dir, CLI_FILE)
+    with open(cli_path, 'w') as file:
+        file.write(CLI_SCRIPT.format(executable=executable, rpc_file=RPC_FILE))
+    chmod(cli_path, 0o755)
+    return cli_path
+
+
+def serve(data, behavior, rpc_dir):
+    """
+    Starts the c-lightning simulator on the lightning-rpc socket in rpc_dir
+    (and writes a lightning-cli there), returning the socket server
+    """
+    socket_path = path.join(rpc_dir, RPC_FILE)
+    if path.exists(socket_path):
+        remove(socket_path)
+    rpc_server = ThreadingUnixStreamServer(socket_path, _RpcHandler)
+    rpc_server.daemon_threads = True
+    rpc_server.simulator = CLightningSimulator(data, behavior)
+    write_cli(rpc_dir)
+    thread = Thread(target=rpc_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return rpc_server
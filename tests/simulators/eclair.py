@@ -0,0 +1,356 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+eclair simulator, answering the HTTP API calls Lighter makes (POST /<method>
+with form parameters, authenticated with basic auth)
+"""
+
+from base64 import b64decode
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from threading import Thread
+from time import time
+from urllib.parse import parse_qsl
+
+from tests.simulators import ERROR_MESSAGE, INVOICE_EXPIRY
+
+REGTEST_HASH = \
+    '06226e46111a0b59caaf126043eb5bbf28c34f3a5e332a1fc7b2b73cf188910f'
+
+# Items of a list response written at a time
+WRITE_ITEMS = 1000
+
+CHANNEL_STATES = {
+    'open': 'NORMAL',
+    'pending_open': 'WAIT_FOR_FUNDING_CONFIRMED',
+    'closing': 'CLOSING',
+    'force_closing': 'CLOSING',
+}
+
+
+class ApiError(Exception):
+    """ An eclair API error, with its HTTP status """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class EclairSimulator():
+    """ API methods of the eclair simulator """
+
+    # pylint: disable=invalid-name
+
+    def __init__(self, data, behavior, password):
+        self.data = data
+        self.behavior = behavior
+        self.password = password
+        self._payments = {}
+
+    def call(self, method, params):
+        """
+        Returns the JSON-serializable result of an API method (a generator
+        for long lists), raising ApiError on errors
+        """
+        func = getattr(self, 'api_{}'.format(method), None)
+        if not func:
+            raise ApiError('The requested resource could not be found.', 404)
+        if self.behavior.call(method):
+            raise ApiError(ERROR_MESSAGE, 500)
+        try:
+            return func(**params)
+        except TypeError as err:
+            raise ApiError(str(err))
+
+    def api_getinfo(self):
+        info = self.data.get_info()
+        return {
+            'nodeId': info['pubkey'], 'alias': info['alias'],
+            'chainHash': REGTEST_HASH, 'blockHeight': info['blockheight'],
+            'publicAddresses': ['{}:{}'.format(
+                info['address'], info['port'])]}
+
+    def api_peers(self):
+        active = {
+            chan['peer'] for chan in self.data.channels if chan['active']}
+        return [
+            {'nodeId': pubkey, 'address': address,
+             'state': 'CONNECTED' if pubkey in active else 'DISCONNECTED',
+             'channels': 1}
+            for pubkey, address in self.data.peers.items()]
+
+    def api_channels(self, nodeId=None):
+        return (
+            self._get_channel(chan) for chan in self.data.channels
+            if nodeId in (None, chan['peer']))
+
+    def api_channel(self, channelId):
+        chan = self.data.get_channel(channelId)
+        if not chan:
+            raise ApiError('channel {} not found'.format(channelId))
+        return self._get_channel(chan)
+
+    def api_allnodes(self):
+        return (
+            {'nodeId': pubkey, 'alias': 'node{}'.format(index),
+             'rgbColor': '#{:06x}'.format(index % 0x1000000),
+             'timestamp': self.data.started, 'addresses': []}
+            for index, pubkey in enumerate(self.data.nodes))
+
+    def api_nodes(self, nodeIds=None):
+        pubkeys = set(nodeIds.split(',')) if nodeIds else None
+        return [node for node in self.api_allnodes()
+                if pubkeys is None or node['nodeId'] in pubkeys]
+
+    def api_createinvoice(self, description, amountMsat=None, expireIn=None,
+                          fallbackAddress=None):
+        invoice = self.data.add_invoice(
+            int(amountMsat or 0), description, int(expireIn or 0))
+        return self._get_invoice(invoice)
+
+    def api_getinvoice(self, paymentHash):
+        invoice = self.data.find_invoice(paymentHash)
+        if not invoice:
+            raise ApiError('invoice not found', 404)
+        return self._get_invoice(invoice)
+
+    def api_listinvoices(self, **params):
+        return map(self._get_invoice, self.data.list_invoices_since(
+            int(params.get('from', 0))))
+
+    def api_getreceivedinfo(self, paymentHash):
+        invoice = self.data.find_invoice(paymentHash)
+        if not invoice:
+            raise ApiError('cannot find payment', 404)
+        status = {'type': 'pending'}
+        if invoice['status'] == 'paid':
+            status = {'type': 'received', 'amount': invoice['received_msat'],
+                      'receivedAt': invoice['paid_at'] * 1000}
+        elif invoice['status'] == 'expired':
+            status = {'type': 'expired'}
+        return {
+            'paymentRequest': self._get_invoice(invoice),
+            'paymentPreimage': invoice['preimage'],
+            'createdAt': invoice['created_at'] * 1000, 'status': status}
+
+    def api_audit(self, **params):
+        return {
+            'sent': [], 'relayed': [],
+            'received': [
+                {'paymentHash': invoice['payment_hash'],
+                 'parts': [{'amount': invoice['received_msat'],
+                            'fromChannelId': '00' * 32,
+                            'timestamp': invoice['paid_at'] * 1000}]}
+                for invoice in self.data.list_paid_invoices(
+                    since=int(params.get('from', 0)))]}
+
+    def api_payinvoice(self, invoice, amountMsat=None):
+        payment = self.data.pay(invoice, int(amountMsat or 0) or None)
+        payment_id = sha256('payment {}'.format(
+            payment['index']).encode()).hexdigest()
+        payment_id = '{}-{}-{}-{}-{}'.format(
+            payment_id[:8], payment_id[8:12], payment_id[12:16],
+            payment_id[16:20], payment_id[20:32])
+        self._payments[payment_id] = payment
+        return payment_id
+
+    def api_getsentinfo(self, id):
+        # pylint: disable=redefined-builtin
+        payment = self._payments.get(id)
+        if not payment:
+            return []
+        return [{
+            'id': id, 'paymentHash': payment['payment_hash'],
+            'preimage': payment['preimage'],
+            'amount': payment['amount_msat'],
+            'createdAt': payment['created_at'] * 1000, 'status': 'SUCCEEDED'}]
+
+    def api_parseinvoice(self, invoice):
+        return {
+            'prefix': 'lnbcrt', 'timestamp': int(time()),
+            'nodeId': self.data.get_info()['pubkey'],
+            'serialized': invoice, 'description': 'Simulated payment request',
+            'paymentHash': sha256(invoice.encode()).hexdigest(),
+            'expiry': INVOICE_EXPIRY, 'minFinalCltvExpiry': 9,
+            'amount': 1000000}
+
+    def api_connect(self, uri):
+        pubkey, _sep, address = uri.partition('@')
+        self.data.peers.setdefault(pubkey, address)
+        return 'connected'
+
+    def api_open(self, nodeId, fundingSatoshis, pushMsat=None,
+                 channelFlags=None, **params):
+        if nodeId not in self.data.peers:
+            raise ApiError('peer {} not found'.format(nodeId))
+        chan = self.data.open_channel(
+            nodeId, int(fundingSatoshis), int(pushMsat or 0),
+            channelFlags == '0')
+        return 'created channel {}'.format(chan['channel_id'])
+
+    def api_close(self, channelId, **params):
+        return self._close(channelId, False)
+
+    def api_forceclose(self, channelId):
+        return self._close(channelId, True)
+
+    def _close(self, channel_id, force):
+        """ Closes a channel """
+        chan = self.data.get_channel(channel_id)
+        if not chan:
+            raise ApiError('channel {} not found'.format(channel_id))
+        if chan['state'] != 'open':
+            raise ApiError('closing already in progress')
+        self.data.close_channel(chan, force)
+        return 'ok'
+
+    def _get_invoice(self, invoice):
+        """ Returns an invoice as listed by listinvoices """
+        ecl_invoice = {
+            'prefix': 'lnbcrt', 'timestamp': invoice['created_at'],
+            'nodeId': self.data.pubkey,
+            'serialized': invoice['payment_request'],
+            'description': invoice['description'],
+            'paymentHash': invoice['payment_hash'],
+            'expiry': invoice['expiry'], 'minFinalCltvExpiry': 9}
+        if invoice['amount_msat']:
+            ecl_invoice['amount'] = invoice['amount_msat']
+        return ecl_invoice
+
+    def _get_channel(self, chan):
+        """ Returns a channel as listed by channels """
+        capacity_msat = chan['capacity_sat'] * 1000
+        reserve = chan['capacity_sat'] // 100
+        data = {
+            'commitments': {
+                'commitInput': {'outPoint': '{}:{}'.format(
+                    chan['funding_txid'], chan['output_index'])},
+                'localParams': {
+                    'nodeId': self.data.pubkey, 'toSelfDelay': 144,
+                    'channelReserveSatoshis': reserve},
+                'remoteParams': {
+                    'nodeId': chan['peer'], 'toSelfDelay': 144,
+                    'channelReserveSatoshis': reserve},
+                'localCommit': {'index': 1, 'spec': {
+                    'toLocalMsat': chan['local_msat'],
+                    'toRemoteMsat': capacity_msat - chan['local_msat']}},
+                'channelFlags': 0 if chan['private'] else 1},
+            'shortChannelId': chan['scid']}
+        if chan['state'] == 'closing':
+            data['mutualClosePublished'] = [{'txid': chan['closing_txid']}]
+        elif chan['state'] == 'force_closing':
+            data['localCommitPublished'] = {
+                'commitTx': {'txid': chan['closing_txid']}}
+        state = CHANNEL_STATES[chan['state']]
+        if state == 'NORMAL' and not chan['active']:
+            state = 'OFFLINE'
+        return {
+            'nodeId': chan['peer'], 'channelId': chan['channel_id'],
+            'state': state, 'data': data}
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    """ Answers POST /<method> requests """
+
+    protocol_version = 'HTTP/1.1'
+    # not to delay small responses until the previous write is acknowledged
+    disable_nagle_algorithm = True
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Calls the requested method, sending its JSON response """
+        simulator = self.server.simulator
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        if not self._is_authorized(simulator.password):
+            self._send(401, 'The supplied authentication is invalid')
+            return
+        try:
+            result = simulator.call(self.path.strip('/'), params)
+        except ApiError as err:
+            self._send(err.status, {'error': err.message})
+            return
+        if isinstance(result, (dict, list, str)):
+            self._send(200, result)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if self.request_version == 'HTTP/1.0':
+            self.close_connection = True
+            self.end_headers()
+            self._write_list(result, self.wfile.write)
+            return
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self._write_list(result, self._write_chunk)
+        self._write_chunk(b'')
+
+    def _is_authorized(self, password):
+        """ Checks the basic auth password of the request """
+        kind, _sep, credentials = self.headers.get(
+            'Authorization', '').partition(' ')
+        if kind != 'Basic':
+            return False
+        try:
+            _user, _sep, given = b64decode(credentials).decode().partition(
+                ':')
+        except ValueError:
+            return False
+        return given == password
+
+    def _send(self, status, result):
+        """ Sends a whole JSON response """
+        body = dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        """ Writes a chunk of a chunked response """
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode() + data +
+                         b'\r\n')
+
+    @staticmethod
+    def _write_list(items, write):
+        """ Writes a JSON list of items, a few at a time """
+        chunk = []
+        separator = '['
+        for item in items:
+            chunk.append(dumps(item))
+            if len(chunk) == WRITE_ITEMS:
+                write((separator + ', '.join(chunk)).encode('utf-8'))
+                chunk, separator = [], ', '
+        if chunk or separator == '[':
+            write((separator + ', '.join(chunk)).encode('utf-8'))
+        write(b']')
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """ Requests are not logged """
+
+
+def serve(data, behavior, host, port, password):
+    """
+    Starts the eclair simulator on host:port, returning the HTTP server
+    """
+    httpd = ThreadingHTTPServer((host, port), _ApiHandler)
+    httpd.daemon_threads = True
+    httpd.simulator = EclairSimulator(data, behavior, password)
+    thread = Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
@@ -0,0 +1,406 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+lnd simulator, serving over TLS the gRPC calls of the Lightning service
+Lighter makes (macaroons are not checked)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from hashlib import sha256
+from inspect import isgeneratorfunction
+from os import path
+from subprocess import run, PIPE
+from time import time
+
+from grpc import server, ssl_server_credentials, StatusCode
+
+from lighter import rpc_pb2 as ln, rpc_pb2_grpc as lnrpc
+from tests.simulators import BLOCKHEIGHT, ERROR_MESSAGE, INVOICE_EXPIRY
+
+CERT = 'tls.cert'
+KEY = 'tls.key'
+
+# Invoices returned by ListInvoices when num_max_invoices is not set
+DEFAULT_MAX_INVOICES = 100
+# Seconds between checks of whether a streaming call is still active
+POLL_TIME = 0.5
+
+
+def _simulated(func):
+    """ Applies the simulator behavior to a servicer method """
+    name = func.__name__
+
+    def _check(servicer, context):
+        if servicer.behavior.call(name):
+            context.abort(StatusCode.UNKNOWN, ERROR_MESSAGE)
+
+    if isgeneratorfunction(func):
+        @wraps(func)
+        def stream_wrapper(servicer, request, context):
+            _check(servicer, context)
+            yield from func(servicer, request, context)
+
+        return stream_wrapper
+
+    @wraps(func)
+    def wrapper(servicer, request, context):
+        _check(servicer, context)
+        return func(servicer, request, context)
+
+    return wrapper
+
+
+class LightningSimulator(lnrpc.LightningServicer):
+    """ Lightning service of the lnd simulator """
+
+    # pylint: disable=invalid-name,no-self-use,unused-argument
+
+    def __init__(self, data, behavior):
+        self.data = data
+        self.behavior = behavior
+        self._addresses = 0
+
+    @_simulated
+    def GetInfo(self, request, context):
+        info = self.data.get_info()
+        return ln.GetInfoResponse(
+            identity_pubkey=info['pubkey'], alias=info['alias'],
+            color='#' + info['color'], version=info['version'],
+            block_height=info['blockheight'], synced_to_chain=True,
+            num_peers=len(self.data.peers),
+            num_active_channels=sum(
+                1 for chan in self.data.channels if chan['active']),
+            uris=['{}@{}:{}'.format(
+                info['pubkey'], info['address'], info['port'])],
+            chains=[ln.Chain(chain='bitcoin', network=info['network'])])
+
+    @_simulated
+    def NewAddress(self, request, context):
+        self._addresses += 1
+        prefix = 'bcrt1q' if request.type == 0 else '2N'
+        return ln.NewAddressResponse(
+            address='{}simulator{}'.format(prefix, self._addresses))
+
+    @_simulated
+    def WalletBalance(self, request, context):
+        return ln.WalletBalanceResponse(
+            total_balance=150000000, confirmed_balance=100000000,
+            unconfirmed_balance=50000000)
+
+    @_simulated
+    def ListChannels(self, request, context):
+        return ln.ListChannelsResponse(channels=[
+            _get_channel(chan) for chan in self.data.channels
+            if chan['state'] == 'open'])
+
+    @_simulated
+    def PendingChannels(self, request, context):
+        response = ln.PendingChannelsResponse()
+        for chan in self.data.channels:
+            pending = _get_pending_channel(chan)
+            if chan['state'] == 'pending_open':
+                response.pending_open_channels.add(channel=pending)
+            elif chan['state'] == 'closing':
+                response.pending_closing_channels.add(
+                    channel=pending, closing_txid=chan['closing_txid'])
+            elif chan['state'] == 'force_closing':
+                response.pending_force_closing_channels.add(
+                    channel=pending, closing_txid=chan['closing_txid'],
+                    maturity_height=BLOCKHEIGHT + 144)
+        return response
+
+    @_simulated
+    def ListPeers(self, request, context):
+        return ln.ListPeersResponse(peers=[
+            ln.Peer(pub_key=pubkey, address=address)
+            for pubkey, address in self.data.peers.items()])
+
+    @_simulated
+    def ConnectPeer(self, request, context):
+        if request.addr.pubkey in self.data.peers:
+            context.abort(
+                StatusCode.UNKNOWN, 'already connected to peer: {}'.format(
+                    request.addr.pubkey))
+        self.data.peers[request.addr.pubkey] = request.addr.host
+        return ln.ConnectPeerResponse()
+
+    @_simulated
+    def AddInvoice(self, request, context):
+        invoice = self.data.add_invoice(
+            request.value * 1000, request.memo, request.expiry)
+        return ln.AddInvoiceResponse(
+            r_hash=bytes.fromhex(invoice['payment_hash']),
+            payment_request=invoice['payment_request'],
+            add_index=invoice['index'])
+
+    @_simulated
+    def LookupInvoice(self, request, context):
+        invoice = self.data.find_invoice(
+            request.r_hash_str or request.r_hash.hex())
+        if not invoice:
+            context.abort(StatusCode.UNKNOWN, 'unable to locate invoice')
+        return _get_invoice(invoice)
+
+    @_simulated
+    def ListInvoices(self, request, context):
+        count = request.num_max_invoices or DEFAULT_MAX_INVOICES
+        if request.reversed:
+            stop = request.index_offset or self.data.total_invoices + 1
+            start = max(stop - count, 1)
+            count = stop - start
+        else:
+            start = request.index_offset + 1
+        invoices = list(self.data.list_invoices(start, count))
+        response = ln.ListInvoiceResponse(invoices=[
+            _get_invoice(invoice) for invoice in invoices
+            if not request.pending_only or invoice['status'] == 'unpaid'])
+        if invoices:
+            response.first_index_offset = invoices[0]['index']
+            response.last_index_offset = invoices[-1]['index']
+        return response
+
+    @_simulated
+    def SubscribeInvoices(self, request, context):
+        after = request.settle_index or self.data.last_pay_index()
+        while context.is_active():
+            invoice = self.data.wait_paid_invoice(after, POLL_TIME)
+            if invoice:
+                after = invoice['pay_index']
+                yield _get_invoice(invoice)
+
+    @_simulated
+    def SendPaymentSync(self, request, context):
+        return self._pay(request)
+
+    def SendPayment(self, request_iterator, context):
+        for request in request_iterator:
+            if self.behavior.call('SendPayment'):
+                yield ln.SendResponse(payment_error=ERROR_MESSAGE)
+                continue
+            yield self._pay(request)
+
+    @_simulated
+    def ListPayments(self, request, context):
+        return ln.ListPaymentsResponse(payments=[
+            ln.Payment(
+                payment_hash=payment['payment_hash'],
+                value=payment['amount_msat'] // 1000,
+                value_sat=payment['amount_msat'] // 1000,
+                value_msat=payment['amount_msat'],
+                creation_date=payment['created_at'],
+                fee=payment['fee_msat'] // 1000,
+                fee_sat=payment['fee_msat'] // 1000,
+                fee_msat=payment['fee_msat'],
+                payment_preimage=payment['preimage'],
+                payment_request=payment['payment_request'],
+                status=ln.Payment.SUCCEEDED)
+            for payment in self.data.payments])
+
+    @_simulated
+    def DecodePayReq(self, request, context):
+        return ln.PayReq(
+            destination=self.data.get_info()['pubkey'],
+            payment_hash=sha256(request.pay_req.encode()).hexdigest(),
+            num_satoshis=1000, timestamp=int(time()), expiry=INVOICE_EXPIRY,
+            description='Simulated payment request', cltv_expiry=40)
+
+    @_simulated
+    def GetTransactions(self, request, context):
+        return ln.TransactionDetails(transactions=[
+            ln.Transaction(
+                tx_hash=transaction['txid'],
+                amount=transaction['amount_sat'],
+                num_confirmations=BLOCKHEIGHT - transaction['blockheight'] + 1,
+                block_hash=transaction['block_hash'],
+                block_height=transaction['blockheight'],
+                time_stamp=transaction['time'],
+                total_fees=transaction['fee_sat'],
+                dest_addresses=[transaction['address']])
+            for transaction in self.data.transactions])
+
+    @_simulated
+    def SendCoins(self, request, context):
+        return ln.SendCoinsResponse(txid=sha256('{} {} {}'.format(
+            request.addr, request.amount, time()).encode()).hexdigest())
+
+    @_simulated
+    def OpenChannelSync(self, request, context):
+        chan = self.data.open_channel(
+            request.node_pubkey_string or request.node_pubkey.hex(),
+            request.local_funding_amount, request.push_sat * 1000,
+            request.private)
+        return ln.ChannelPoint(
+            funding_txid_bytes=bytes.fromhex(chan['funding_txid'])[::-1],
+            output_index=chan['output_index'])
+
+    @_simulated
+    def GetChanInfo(self, request, context):
+        chan = self.data.get_channel(str(request.chan_id))
+        if not chan:
+            context.abort(StatusCode.UNKNOWN, 'edge not found')
+        return ln.ChannelEdge(
+            channel_id=chan['chan_id'], chan_point=_get_chan_point(chan),
+            capacity=chan['capacity_sat'],
+            node1_pub=self.data.get_info()['pubkey'], node2_pub=chan['peer'])
+
+    @_simulated
+    def CloseChannel(self, request, context):
+        point = request.channel_point
+        txid = point.funding_txid_str or point.funding_txid_bytes[::-1].hex()
+        for chan in self.data.channels:
+            if chan['funding_txid'] == txid and \
+                    chan['output_index'] == point.output_index:
+                break
+        else:
+            context.abort(StatusCode.UNKNOWN, 'unable to find arbitrator')
+        if chan['state'] != 'open':
+            context.abort(StatusCode.UNKNOWN, 'channel is already closing')
+        closing_txid = self.data.close_channel(chan, request.force)
+        yield ln.CloseStatusUpdate(close_pending=ln.PendingUpdate(
+            txid=bytes.fromhex(closing_txid)[::-1]))
+
+    @_simulated
+    def SubscribeChannelEvents(self, request, context):
+        while context.is_active():
+            if self.data.wait_channels_change(POLL_TIME):
+                yield ln.ChannelEventUpdate(
+                    type=ln.ChannelEventUpdate.OPEN_CHANNEL)
+
+    @_simulated
+    def DescribeGraph(self, request, context):
+        return ln.ChannelGraph(nodes=[
+            _get_node(index, pubkey)
+            for index, pubkey in enumerate(self.data.nodes)])
+
+    @_simulated
+    def GetNodeInfo(self, request, context):
+        if request.pub_key not in self.data.nodes:
+            context.abort(StatusCode.NOT_FOUND, 'unable to find node')
+        return ln.NodeInfo(node=_get_node(
+            self.data.nodes.index(request.pub_key), request.pub_key))
+
+    def _pay(self, request):
+        """ Pays a SendRequest, returning its SendResponse """
+        payment = self.data.pay(
+            request.payment_request, request.amt * 1000 or None)
+        return ln.SendResponse(
+            payment_preimage=bytes.fromhex(payment['preimage']),
+            payment_hash=bytes.fromhex(payment['payment_hash']))
+
+
+class WalletUnlockerSimulator(lnrpc.WalletUnlockerServicer):
+    """ WalletUnlocker service of the lnd simulator, the wallet is unlocked """
+
+    # pylint: disable=invalid-name,no-self-use,unused-argument
+
+    def UnlockWallet(self, request, context):
+        context.abort(
+            StatusCode.UNIMPLEMENTED, 'unknown service lnrpc.WalletUnlocker')
+
+
+def _get_chan_point(chan):
+    """ Returns the channel point of a channel, as a string """
+    return '{}:{}'.format(chan['funding_txid'], chan['output_index'])
+
+
+def _get_channel(chan):
+    """ Returns the Channel message of an open channel """
+    capacity = chan['capacity_sat']
+    local = chan['local_msat'] // 1000
+    return ln.Channel(
+        active=chan['active'], remote_pubkey=chan['peer'],
+        channel_point=_get_chan_point(chan), chan_id=chan['chan_id'],
+        capacity=capacity, local_balance=local,
+        remote_balance=capacity - local, csv_delay=144,
+        private=chan['private'], local_chan_reserve_sat=capacity // 100,
+        remote_chan_reserve_sat=capacity // 100)
+
+
+def _get_pending_channel(chan):
+    """ Returns the PendingChannel message of a channel """
+    capacity = chan['capacity_sat']
+    local = chan['local_msat'] // 1000
+    return ln.PendingChannelsResponse.PendingChannel(
+        remote_node_pub=chan['peer'], channel_point=_get_chan_point(chan),
+        capacity=capacity, local_balance=local,
+        remote_balance=capacity - local,
+        local_chan_reserve_sat=capacity // 100,
+        remote_chan_reserve_sat=capacity // 100)
+
+
+def _get_node(index, pubkey):
+    """ Returns the LightningNode of the graph node with index """
+    return ln.LightningNode(
+        pub_key=pubkey, alias='node{}'.format(index),
+        color='#{:06x}'.format(index % 0x1000000))
+
+
+def _get_invoice(invoice):
+    """ Returns the Invoice message of an invoice """
+    state = {
+        'paid': ln.Invoice.SETTLED, 'unpaid': ln.Invoice.OPEN,
+        'expired': ln.Invoice.CANCELED}[invoice['status']]
+    return ln.Invoice(
+        memo=invoice['description'],
+        r_preimage=bytes.fromhex(invoice['preimage']),
+        r_hash=bytes.fromhex(invoice['payment_hash']),
+        value=invoice['amount_msat'] // 1000,
+        settled=invoice['status'] == 'paid',
+        creation_date=invoice['created_at'],
+        settle_date=invoice['paid_at'],
+        payment_request=invoice['payment_request'],
+        expiry=invoice['expiry'], add_index=invoice['index'],
+        settle_index=invoice['pay_index'],
+        amt_paid_sat=invoice['received_msat'] // 1000,
+        amt_paid_msat=invoice['received_msat'], state=state)
+
+
+def create_tls_cert(cert_dir):
+    """
+    Creates a self-signed certificate for localhost in cert_dir, if missing,
+    returning its and its key paths
+    """
+    cert_path = path.join(cert_dir, CERT)
+    key_path = path.join(cert_dir, KEY)
+    if not path.exists(cert_path) or not path.exists(key_path):
+        run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt',
+             'ec_paramgen_curve:prime256v1', '-nodes', '-days', '365',
+             '-subj', '/CN=localhost', '-addext',
+             'subjectAltName=DNS:localhost,IP:127.0.0.1',
+             '-keyout', key_path, '-out', cert_path],
+            stdout=PIPE, stderr=PIPE, check=True)
+    return cert_path, key_path
+
+
+def serve(data, behavior, host, port, cert_dir, workers=10):
+    """
+    Starts the lnd simulator on host:port, with a TLS certificate in
+    cert_dir, returning the gRPC server and the bound port
+    """
+    cert_path, key_path = create_tls_cert(cert_dir)
+    with open(cert_path, 'rb') as file:
+        cert = file.read()
+    with open(key_path, 'rb') as file:
+        key = file.read()
+    grpc_server = server(ThreadPoolExecutor(max_workers=workers))
+    lnrpc.add_LightningServicer_to_server(
+        LightningSimulator(data, behavior), grpc_server)
+    lnrpc.add_WalletUnlockerServicer_to_server(
+        WalletUnlockerSimulator(), grpc_server)
+    bound_port = grpc_server.add_secure_port(
+        '{}:{}'.format(host, port), ssl_server_credentials(((key, cert),)))
+    grpc_server.start()
+    return grpc_server, bound_port
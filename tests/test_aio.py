@@ -0,0 +1,125 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for aio module """
+
+from asyncio import run
+from importlib import import_module
+from unittest import TestCase
+from unittest.mock import ANY, Mock, patch
+
+from grpc import StatusCode
+
+from lighter import settings
+from tests import CoroutineMock
+
+MOD = import_module('lighter.aio')
+
+
+class AioTests(TestCase):
+    """ Tests for aio module """
+
+    @patch('lighter.aio.aio.server')
+    def test_AioServer(self, mocked_server):
+        aio_server = mocked_server.return_value
+        aio_server.start = CoroutineMock()
+        aio_server.stop = CoroutineMock()
+        interceptor = Mock()
+        grpc_server = MOD.AioServer([interceptor])
+        kwargs = mocked_server.call_args[1]
+        self.assertEqual(
+            kwargs['migration_thread_pool']._max_workers,
+            settings.GRPC_WORKERS + settings.MAX_STREAMS)
+        self.assertEqual(
+            kwargs['migration_thread_pool'], settings.GRPC_EXECUTOR)
+        self.assertIsInstance(kwargs['interceptors'][0], MOD.AioInterceptor)
+        # Wrapped server methods
+        grpc_server.add_insecure_port('addr')
+        aio_server.add_insecure_port.assert_called_once_with('addr')
+        grpc_server.start()
+        aio_server.start.assert_called_once_with()
+        stopped = grpc_server.stop(3)
+        self.assertEqual(stopped.wait(5), True)
+        aio_server.stop.assert_called_once_with(3)
+        settings.GRPC_EXECUTOR = None
+
+    @patch('lighter.aio.timed_handler', autospec=True)
+    def test_AioInterceptor(self, mocked_timed):
+        details = Mock(method='/lighter.Lightning/GetInfo')
+        continuation = CoroutineMock()
+        continuation.return_value = 'handler'
+        # Accepted request
+        interceptor = Mock()
+        interceptor.intercept_service.side_effect = \
+            lambda cont, det: cont(det)
+        aio_interceptor = MOD.AioInterceptor(interceptor)
+        res = run(aio_interceptor.intercept_service(continuation, details))
+        continuation.assert_called_once_with(details)
+        mocked_timed.assert_called_once_with(
+            'handler', '/lighter.Lightning/GetInfo', ANY, ANY)
+        self.assertEqual(res, mocked_timed.return_value)
+        # Health check, not timed
+        reset_mocks(vars())
+        details.method = '/grpc.health.v1.Health/Check'
+        res = run(aio_interceptor.intercept_service(continuation, details))
+        self.assertEqual(res, 'handler')
+        assert not mocked_timed.called
+        # Refused request
+        reset_mocks(vars())
+        interceptor.intercept_service.side_effect = None
+        interceptor.intercept_service.return_value = 'terminator'
+        res = run(aio_interceptor.intercept_service(continuation, details))
+        assert not continuation.called
+        self.assertEqual(res, 'terminator')
+
+    def test_AsyncContext(self):
+        aio_context = Mock()
+        context = MOD.AsyncContext(aio_context)
+        with self.assertRaises(MOD.AbortRequest) as err:
+            context.abort(StatusCode.NOT_FOUND, 'details')
+        self.assertEqual(err.exception.code, StatusCode.NOT_FOUND)
+        self.assertEqual(err.exception.details, 'details')
+        assert not aio_context.abort.called
+        aio_context.done.return_value = False
+        self.assertEqual(context.is_active(), True)
+        self.assertEqual(context.peer(), aio_context.peer.return_value)
+
+    def test_async_method(self):
+        aio_context = Mock()
+        aio_context.abort = CoroutineMock()
+
+        async def func(request, context):
+            self.assertIsInstance(context, MOD.AsyncContext)
+            if request == 'abort':
+                context.abort(StatusCode.NOT_FOUND, 'details')
+            return 'response'
+
+        handler = MOD.async_method(func)
+        self.assertEqual(handler.__name__, 'func')
+        res = run(handler('request', aio_context))
+        self.assertEqual(res, 'response')
+        assert not aio_context.abort.called
+        # Abort case
+        run(handler('abort', aio_context))
+        aio_context.abort.assert_called_once_with(
+            StatusCode.NOT_FOUND, 'details')
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
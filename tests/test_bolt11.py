@@ -0,0 +1,211 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for bolt11 module """
+
+from importlib import import_module
+from unittest import TestCase
+from unittest.mock import patch
+
+from lighter import lighter_pb2 as pb, settings
+from tests import fixtures_clightning as fix_cl
+from tests import fixtures_eclair as fix_ecl
+
+MOD = import_module('lighter.bolt11')
+CTX = 'context'
+
+# BOLT 11 example, with description hash
+PAY_REQ_HASH = fix_ecl.PARSEINVOICE_D_HASH['serialized']
+DESCRIPTION = (
+    'One piece of chocolate cake, one icecream cone, one pickle, one slice '
+    'of swiss cheese, one slice of salami, one lollypop, one piece of cherry '
+    'pie, one sausage, one cupcake, and one slice of watermelon')
+# Invoice with 3 route hints
+PAY_REQ_ROUTES = fix_cl.PAYMENTS['payments'][-1]['bolt11']
+# Invoice without amount
+PAY_REQ_NO_AMT = \
+    fix_ecl.GETRECEIVEDINFO_PENDING['paymentRequest']['serialized']
+
+
+class Bolt11Tests(TestCase):
+    """ Tests for bolt11 module """
+
+    def test_decode_invoice(self):
+        # Description case
+        request = pb.DecodeInvoiceRequest(
+            payment_request=fix_ecl.PARSEINVOICE['serialized'])
+        res = MOD.decode_invoice(CTX, request)
+        self.assertEqual(res.amount_bits, 1.5)
+        self.assertEqual(res.timestamp, 1557759146)
+        self.assertEqual(
+            res.payment_hash, fix_ecl.PARSEINVOICE['paymentHash'])
+        self.assertEqual(
+            res.description, fix_ecl.PARSEINVOICE['description'])
+        self.assertEqual(
+            res.destination_pubkey, fix_ecl.PARSEINVOICE['nodeId'])
+        self.assertEqual(res.expiry_time, 10800)
+        self.assertEqual(res.min_final_cltv_expiry, 40)
+        # Description hash case, with matching description
+        request = pb.DecodeInvoiceRequest(
+            payment_request=PAY_REQ_HASH, description=DESCRIPTION)
+        res = MOD.decode_invoice(CTX, request)
+        self.assertEqual(res.amount_bits, 20000)
+        self.assertEqual(
+            res.description_hash, fix_ecl.PARSEINVOICE_D_HASH['description'])
+        self.assertEqual(res.description, '')
+        self.assertEqual(res.expiry_time, MOD.DEFAULT_EXPIRY)
+        # Route hints case
+        request = pb.DecodeInvoiceRequest(payment_request=PAY_REQ_ROUTES)
+        res = MOD.decode_invoice(CTX, request)
+        self.assertEqual(len(res.route_hints), 3)
+        hop = res.route_hints[0].hop_hints[0]
+        self.assertEqual(hop.short_channel_id, '1514069x26x0')
+        self.assertEqual(hop.fee_base_msat, 1000)
+        self.assertEqual(hop.fee_proportional_millionths, 100)
+        self.assertEqual(hop.cltv_expiry_delta, 144)
+        res = MOD.decode_invoice(CTX, request, int_scid=True)
+        self.assertEqual(
+            res.route_hints[0].hop_hints[0].short_channel_id,
+            '1664736470756884480')
+        # No amount case
+        request = pb.DecodeInvoiceRequest(payment_request=PAY_REQ_NO_AMT)
+        res = MOD.decode_invoice(CTX, request)
+        self.assertEqual(res.amount_bits, 0)
+        # Invalid payment request case
+        request = pb.DecodeInvoiceRequest(payment_request='lntb1invalid')
+        res = MOD.decode_invoice(CTX, request)
+        self.assertEqual(res, None)
+
+    @patch('lighter.bolt11.Err')
+    def test_decode_invoice_description(self, mocked_err):
+        mocked_err().incorrect_description.side_effect = Exception()
+        request = pb.DecodeInvoiceRequest(
+            payment_request=PAY_REQ_HASH, description='cake')
+        with self.assertRaises(Exception):
+            MOD.decode_invoice(CTX, request)
+        mocked_err().incorrect_description.assert_called_once_with(CTX)
+
+    def test_decode_invoice_network(self):
+        request = pb.DecodeInvoiceRequest(
+            payment_request=fix_ecl.PARSEINVOICE['serialized'])
+        settings.NODE_NETWORK = 'testnet'
+        res = MOD.decode_invoice(CTX, request)
+        self.assertEqual(res.timestamp, 1557759146)
+        # Other network case, left to the node
+        settings.NODE_NETWORK = 'mainnet'
+        res = MOD.decode_invoice(CTX, request)
+        self.assertEqual(res, None)
+        settings.NODE_NETWORK = None
+
+    @patch('lighter.bolt11.decode', autospec=True)
+    def test_has_amount_encoded(self, mocked_decode):
+        res = MOD.has_amount_encoded(PAY_REQ_HASH)
+        self.assertEqual(res, True)
+        # signature is not checked
+        assert not mocked_decode.called
+        res = MOD.has_amount_encoded(PAY_REQ_NO_AMT)
+        self.assertEqual(res, False)
+        # Not decodable payment request cases
+        res = MOD.has_amount_encoded('lntb5n1pw3mupk')
+        self.assertEqual(res, True)
+        res = MOD.has_amount_encoded('lntb1pw3mumupk')
+        self.assertEqual(res, False)
+
+    def test_decode(self):
+        res = MOD.decode(fix_cl.INVOICE['bolt11'])
+        self.assertEqual(res.currency, 'tb')
+        self.assertEqual(res.amount_msat, 777)
+        self.assertEqual(res.payment_hash, fix_cl.INVOICE['payment_hash'])
+        self.assertEqual(res.description, 'deded')
+        self.assertEqual(
+            res.fallback_addr, '2Mwfzt2fAqRSDUaMLFwjtkTukVUBJB4kDqv')
+        self.assertEqual(res.min_final_cltv_expiry, 10)
+        self.assertEqual(res.route_hints, ())
+        # Uppercase case
+        res = MOD.decode(PAY_REQ_HASH.upper())
+        self.assertEqual(
+            res.payee, fix_ecl.PARSEINVOICE_D_HASH['nodeId'])
+        # Mixed case
+        with self.assertRaises(ValueError):
+            MOD.decode('L' + PAY_REQ_HASH[1:])
+        # Wrong checksum case
+        with self.assertRaises(ValueError):
+            MOD.decode(PAY_REQ_HASH[:-1] + 'q')
+        # Invalid character case
+        with self.assertRaises(ValueError):
+            MOD.decode(PAY_REQ_HASH[:-1] + 'b')
+        # Tampered data (valid checksum) case, signed by someone else
+        hrp, data = MOD._bech32_decode(PAY_REQ_HASH)
+        data[10] ^= 1
+        res = MOD.decode(MOD._bech32_encode(hrp, data, MOD.BECH32_CONST))
+        self.assertNotEqual(
+            res.payee, fix_ecl.PARSEINVOICE_D_HASH['nodeId'])
+        # Too short case
+        with self.assertRaises(ValueError):
+            MOD.decode(MOD._bech32_encode('lnbc', [0] * 20, MOD.BECH32_CONST))
+
+    def test_get_timestamp(self):
+        res = MOD.get_timestamp(fix_cl.INVOICE['bolt11'])
+        self.assertEqual(res, 1533232508)
+        # Invalid checksum case
+        with self.assertRaises(ValueError):
+            MOD.get_timestamp(PAY_REQ_HASH[:-1] + 'q')
+        # Too short case
+        with self.assertRaises(ValueError):
+            MOD.get_timestamp(
+                MOD._bech32_encode('lnbc', [0] * 5, MOD.BECH32_CONST))
+
+    def test_parse_hrp(self):
+        self.assertEqual(MOD._parse_hrp('lnbc'), ('bc', None))
+        self.assertEqual(MOD._parse_hrp('lnbcrt60p'), ('bcrt', 6))
+        self.assertEqual(MOD._parse_hrp('lntb77u'), ('tb', 7700000))
+        self.assertEqual(MOD._parse_hrp('lnbc20m'), ('bc', 2000000000))
+        self.assertEqual(MOD._parse_hrp('lnbc1500n'), ('bc', 150000))
+        self.assertEqual(MOD._parse_hrp('lnbc2'), ('bc', 200000000000))
+        # Sub-msat amount case
+        with self.assertRaises(ValueError):
+            MOD._parse_hrp('lnbc1p')
+        # Invalid hrp cases
+        with self.assertRaises(ValueError):
+            MOD._parse_hrp('bc20m')
+        with self.assertRaises(ValueError):
+            MOD._parse_hrp('lnbc20x')
+
+    def test_get_fallback_addr(self):
+        program = bytes.fromhex('751e76e8199196d454941c45d1b3a323f1433bd6')
+        res = MOD._get_fallback_addr('bc', 17, program)
+        self.assertEqual(res, '1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH')
+        res = MOD._get_fallback_addr('bc', 0, program)
+        self.assertEqual(res, 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4')
+        res = MOD._get_fallback_addr('tb', 18, program)
+        self.assertEqual(res[0], '2')
+        # Unknown version case
+        res = MOD._get_fallback_addr('bc', 19, program)
+        self.assertEqual(res, '')
+        # Unknown network case
+        res = MOD._get_fallback_addr('xx', 17, program)
+        self.assertEqual(res, '')
+
+    def test_format_scid(self):
+        scid = 1514068 << 40 | 65 << 16 | 1
+        res = MOD._format_scid(scid, False)
+        self.assertEqual(res, '1514068x65x1')
+        res = MOD._format_scid(scid, True)
+        self.assertEqual(res, str(scid))
+
+    def test_recover_pubkey(self):
+        with self.assertRaises(ValueError):
+            MOD._recover_pubkey(bytes(32), [1] * 64 + [4])
+        with self.assertRaises(ValueError):
+            MOD._recover_pubkey(bytes(32), [0] * 64 + [0])
@@ -0,0 +1,360 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for cache module """
+
+from asyncio import run
+from importlib import import_module
+from unittest import TestCase
+from threading import Event, Thread
+from time import sleep
+from unittest.mock import Mock, patch
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+from lighter.utils import FakeContext
+
+MOD = import_module('lighter.cache')
+CTX = 'context'
+
+
+class CacheTests(TestCase):
+    """ Tests for cache module """
+
+    @patch('lighter.cache.Thread', autospec=True)
+    @patch('lighter.cache.set_log_note', autospec=True)
+    @patch('lighter.cache.monotonic', autospec=True)
+    def test_cached(self, mocked_time, mocked_note, mocked_thread):
+        cache = MOD.ResponseCache({'GetInfo': 10, 'ListPeers': 0}, 30)
+        func = Mock(return_value=pb.GetInfoResponse(alias='a'))
+        # Method without TTL case
+        self.assertEqual(cache.cached('ListPeers', func), func)
+        self.assertEqual(cache.cached('PayInvoice', func), func)
+        wrapped = cache.cached('GetInfo', func)
+        request = pb.GetInfoRequest()
+        # Miss case
+        mocked_time.return_value = 100
+        res = wrapped(request, CTX)
+        func.assert_called_once_with(request, CTX)
+        self.assertEqual(res, func.return_value)
+        self.assertEqual(cache.misses, 1)
+        assert not mocked_note.called
+        # Hit case
+        reset_mocks(vars())
+        mocked_time.return_value = 109
+        res = wrapped(request, CTX)
+        assert not func.called
+        self.assertEqual(res, pb.GetInfoResponse(alias='a'))
+        self.assertEqual(cache.hits, 1)
+        mocked_note.assert_called_once_with('cached')
+        # Stale case, refreshed once in background
+        reset_mocks(vars())
+        mocked_time.return_value = 111
+        res = wrapped(request, CTX)
+        wrapped(request, CTX)
+        assert not func.called
+        self.assertEqual(res, pb.GetInfoResponse(alias='a'))
+        self.assertEqual(cache.stale_hits, 2)
+        mocked_note.assert_called_with('cached, stale')
+        mocked_thread.assert_called_once_with(
+            target=cache._refresh,
+            args=(('GetInfo', b''), func, request, 10, 0))
+        mocked_thread.return_value.start.assert_called_once_with()
+        # Expired case
+        reset_mocks(vars())
+        mocked_time.return_value = 141
+        wrapped(request, CTX)
+        func.assert_called_once_with(request, CTX)
+        self.assertEqual(cache.misses, 2)
+        # Coroutine case
+        async def coro(request, context):
+            return 'response'
+
+        self.assertEqual(cache.cached('GetInfo', coro), coro)
+        # Method never served stale case
+        reset_mocks(vars())
+        cache = MOD.ResponseCache(
+            {'WalletBalance': 3}, 30, no_stale=['WalletBalance'])
+        func = Mock(return_value=pb.WalletBalanceResponse(balance=1))
+        wrapped = cache.cached('WalletBalance', func)
+        request = pb.WalletBalanceRequest()
+        mocked_time.return_value = 100
+        wrapped(request, CTX)
+        mocked_time.return_value = 104
+        wrapped(request, CTX)
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(cache.stale_hits, 0)
+        assert not mocked_thread.called
+
+    def test_invalidating(self):
+        listener = Mock()
+        cache = MOD.ResponseCache({'GetInfo': 10}, 30, listeners=[listener])
+        info = Mock(return_value=pb.GetInfoResponse())
+        cached_info = cache.cached('GetInfo', info)
+        cached_info(pb.GetInfoRequest(), CTX)
+        func = Mock(return_value='response')
+        wrapped = cache.invalidating(func)
+        res = wrapped('request', CTX)
+        func.assert_called_once_with('request', CTX)
+        self.assertEqual(res, 'response')
+        cached_info(pb.GetInfoRequest(), CTX)
+        self.assertEqual(info.call_count, 2)
+        listener.assert_called_once_with()
+        # Failed call case
+        func.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            wrapped('request', CTX)
+        cached_info(pb.GetInfoRequest(), CTX)
+        self.assertEqual(info.call_count, 3)
+        # Coroutine case
+        async def coro(request, context):
+            return 'response'
+
+        wrapped = cache.invalidating(coro)
+        self.assertEqual(run(wrapped('request', CTX)), 'response')
+        cached_info(pb.GetInfoRequest(), CTX)
+        self.assertEqual(info.call_count, 4)
+
+    def test_clear(self):
+        cache = MOD.ResponseCache({'GetInfo': 10}, 30)
+        cache.hits = cache.stale_hits = cache.misses = 3
+        cache._store('key', 'response', 10, 0)
+        cache.clear()
+        self.assertEqual(cache._entries, {})
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.stale_hits, 0)
+        self.assertEqual(cache.misses, 0)
+
+    def test_store(self):
+        cache = MOD.ResponseCache({'GetInfo': 10}, 30)
+        cache._store('key', 'response', 10, 0)
+        self.assertEqual(cache._entries['key'][0], 'response')
+        # Invalidated meanwhile case
+        cache.invalidate()
+        cache._store('key', 'response', 10, 0)
+        self.assertEqual(cache._entries, {})
+
+    @patch('lighter.cache.FakeContext', autospec=True)
+    def test_refresh(self, mocked_ctx):
+        cache = MOD.ResponseCache({'GetInfo': 10}, 30)
+        key = ('GetInfo', b'')
+        cache._refreshing.add(key)
+        func = Mock(return_value='response')
+        cache._refresh(key, func, 'request', 10, 0)
+        func.assert_called_once_with('request', mocked_ctx.return_value)
+        self.assertEqual(cache._entries[key][0], 'response')
+        self.assertEqual(cache._refreshing, set())
+        # Error case
+        cache._refreshing.add(key)
+        func.side_effect = RuntimeError()
+        cache._refresh(key, func, 'request', 10, 0)
+        self.assertEqual(cache._refreshing, set())
+
+    @patch('lighter.cache.set_log_note', autospec=True)
+    def test_coalesced(self, mocked_note):
+        flights = MOD.SingleFlight()
+        started = Event()
+        release = Event()
+
+        def func(request, context):
+            started.set()
+            release.wait(5)
+            if request.active_only:
+                raise RuntimeError()
+            return pb.ListChannelsResponse()
+
+        wrapped = flights.coalesced('ListChannels', Mock(wraps=func))
+        self.assertEqual(wrapped.__wrapped__.call_count, 0)
+        results = []
+
+        def call(request):
+            try:
+                results.append(wrapped(request, FakeContext()))
+            except RuntimeError as err:
+                results.append(err)
+
+        # Concurrent identical calls case
+        request = pb.ListChannelsRequest()
+        threads = [Thread(target=call, args=(request,)) for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(wrapped.__wrapped__.call_count, 1)
+        self.assertEqual(results, [pb.ListChannelsResponse()] * 3)
+        self.assertEqual(flights.calls, 1)
+        self.assertEqual(flights.shared, 2)
+        mocked_note.assert_called_with('shared')
+        self.assertEqual(flights._flights, {})
+        # Failed call case, waiters call on their own
+        reset_mocks(vars())
+        wrapped.__wrapped__.reset_mock()
+        started.clear()
+        release.clear()
+        results.clear()
+        request = pb.ListChannelsRequest(active_only=True)
+        threads = [Thread(target=call, args=(request,)) for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(wrapped.__wrapped__.call_count, 2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(flights._flights, {})
+        # Coroutine case
+        async def coro(request, context):
+            return 'response'
+
+        self.assertEqual(flights.coalesced('ListChannels', coro), coro)
+
+    @patch('lighter.cache.get_node_timeout', autospec=True)
+    @patch('lighter.cache.Err')
+    def test_coalesced_timeout(self, mocked_err, mocked_time):
+        flights = MOD.SingleFlight()
+        mocked_time.return_value = 0.01
+        mocked_err().node_error.side_effect = RuntimeError()
+        flights._flights[('GetInfo', b'')] = MOD._Flight()
+        wrapped = flights.coalesced('GetInfo', Mock())
+        with self.assertRaises(RuntimeError):
+            wrapped(pb.GetInfoRequest(), CTX)
+        mocked_time.assert_called_once_with(CTX)
+        mocked_err().node_error.assert_called_once_with(CTX, 'Timeout')
+        assert not wrapped.__wrapped__.called
+
+
+    @patch('lighter.cache.NodesCache', autospec=True)
+    def test_get_nodes_cache(self, mocked_cache):
+        settings.NODES_CACHE = None
+        load = Mock()
+        lookup = Mock()
+        res = MOD.get_nodes_cache(load, lookup)
+        mocked_cache.assert_called_once_with(
+            load, lookup, settings.NODES_REFRESH_TIME)
+        self.assertEqual(res, mocked_cache.return_value)
+        # Existing cache case
+        reset_mocks(vars())
+        res = MOD.get_nodes_cache(load, lookup)
+        assert not mocked_cache.called
+        self.assertEqual(res, mocked_cache.return_value)
+        settings.NODES_CACHE = None
+
+    @patch('lighter.cache.Thread', autospec=True)
+    @patch('lighter.cache.monotonic', autospec=True)
+    def test_start_nodes(self, mocked_time, mocked_thread):
+        mocked_time.return_value = 100
+        cache = MOD.NodesCache(Mock(), Mock(), 300)
+        cache.start()
+        mocked_thread.assert_called_once_with(target=cache._refresh)
+        mocked_thread.return_value.start.assert_called_once_with()
+        self.assertEqual(cache._attempted_at, 100)
+        self.assertEqual(cache._loading, True)
+        # Already loading case
+        reset_mocks(vars())
+        cache.start()
+        assert not mocked_thread.called
+
+    @patch('lighter.cache.Thread', autospec=True)
+    @patch('lighter.cache.monotonic', autospec=True)
+    def test_get_nodes(self, mocked_time, mocked_thread):
+        settings.NODES_RETRY_TIME = 30
+        load = Mock()
+        lookup = Mock(return_value=('new', '#000000'))
+        cache = MOD.NodesCache(load, lookup, 300)
+        # Not loaded yet case, loaded in background and looked up
+        mocked_time.return_value = 100
+        res = cache.get_nodes(CTX, ['new'])
+        mocked_thread.assert_called_once_with(target=cache._refresh)
+        lookup.assert_called_once_with(CTX, 'new')
+        assert not load.called
+        self.assertEqual(res, {'new': ('new', '#000000')})
+        # Fresh nodes case, looked up nodes are kept
+        reset_mocks(vars())
+        cache._loading = False
+        cache._nodes.update({'pubkey': ('alias', '#3399ff')})
+        mocked_time.return_value = 399
+        res = cache.get_nodes(CTX, ['pubkey', 'new'])
+        assert not mocked_thread.called
+        assert not lookup.called
+        self.assertEqual(res, {
+            'pubkey': ('alias', '#3399ff'), 'new': ('new', '#000000')})
+        # Old nodes case, reloaded once in background
+        mocked_time.return_value = 400
+        res = cache.get_nodes(CTX, ['pubkey'])
+        mocked_thread.assert_called_once_with(target=cache._refresh)
+        self.assertEqual(res, {'pubkey': ('alias', '#3399ff')})
+        reset_mocks(vars())
+        cache.get_nodes(CTX, ['pubkey'])
+        assert not mocked_thread.called
+        # Unknown node case, not looked up again
+        lookup.return_value = None
+        self.assertEqual(cache.get_nodes(CTX, ['unknown']), {})
+        self.assertEqual(cache.get_nodes(CTX, ['unknown']), {})
+        lookup.assert_called_once_with(CTX, 'unknown')
+        # Failed lookup case, other nodes are not looked up
+        reset_mocks(vars())
+        lookup.side_effect = RuntimeError()
+        res = cache.get_nodes(CTX, ['missing', 'other', 'pubkey'])
+        lookup.assert_called_once_with(CTX, 'missing')
+        self.assertEqual(res, {})
+        # Unreadable graph case, loaded again after NODES_RETRY_TIME
+        reset_mocks(vars())
+        cache._loading = False
+        cache._failed = True
+        cache._attempted_at = 400
+        mocked_time.return_value = 429
+        cache.get_nodes(CTX, [])
+        assert not mocked_thread.called
+        mocked_time.return_value = 430
+        cache.get_nodes(CTX, [])
+        mocked_thread.assert_called_once_with(target=cache._refresh)
+
+    @patch('lighter.cache.FakeContext', autospec=True)
+    def test_refresh_nodes(self, mocked_ctx):
+        load = Mock(return_value={'pubkey': ('alias', '')})
+        cache = MOD.NodesCache(load, Mock(), 300)
+        cache._loading = True
+        cache._refresh()
+        load.assert_called_once_with(mocked_ctx.return_value)
+        self.assertEqual(cache._nodes, {'pubkey': ('alias', '')})
+        self.assertEqual(cache._loading, False)
+        self.assertEqual(cache._failed, False)
+        # Unreadable graph case, previous nodes are kept
+        cache._loading = True
+        load.return_value = None
+        cache._refresh()
+        self.assertEqual(cache._nodes, {'pubkey': ('alias', '')})
+        self.assertEqual(cache._loading, False)
+        self.assertEqual(cache._failed, True)
+        # Error case
+        cache._loading = True
+        cache._failed = False
+        load.side_effect = RuntimeError()
+        cache._refresh()
+        self.assertEqual(cache._loading, False)
+        self.assertEqual(cache._failed, True)
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
@@ -0,0 +1,219 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for channels module """
+
+from importlib import import_module
+from time import monotonic
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+from lighter.utils import FakeContext
+
+MOD = import_module('lighter.channels')
+CTX = 'context'
+
+
+def _channel(channel_id, local_balance=1, active=True):
+    return pb.Channel(
+        channel_id=channel_id, local_balance=local_balance, active=active,
+        state=pb.OPEN)
+
+
+class ChannelsTests(TestCase):
+    """ Tests for channels module """
+
+    @patch('lighter.channels.ChannelsMirror', autospec=True)
+    def test_get_channels_mirror(self, mocked_mirror):
+        settings.CHANNELS_MIRROR = None
+        res = MOD.get_channels_mirror('load', 'watch')
+        mocked_mirror.assert_called_once_with('load', 'watch')
+        self.assertEqual(res, mocked_mirror.return_value)
+        # Existing mirror case
+        reset_mocks(vars())
+        res = MOD.get_channels_mirror('load')
+        assert not mocked_mirror.called
+        self.assertEqual(res, mocked_mirror.return_value)
+        settings.CHANNELS_MIRROR = None
+
+    def test_close_channels_mirror(self):
+        mirror = Mock()
+        settings.CHANNELS_MIRROR = mirror
+        MOD.close_channels_mirror()
+        mirror.close.assert_called_once_with()
+        self.assertEqual(settings.CHANNELS_MIRROR, None)
+        # No mirror case
+        MOD.close_channels_mirror()
+        self.assertEqual(settings.CHANNELS_MIRROR, None)
+
+    def test_invalidate_channels_mirror(self):
+        mirror = Mock()
+        settings.CHANNELS_MIRROR = mirror
+        MOD.invalidate_channels_mirror()
+        mirror.invalidate.assert_called_once_with()
+        settings.CHANNELS_MIRROR = None
+        # No mirror case
+        MOD.invalidate_channels_mirror()
+
+    @patch('lighter.channels.ChannelsMirror._start', autospec=True)
+    def test_ChannelsMirror(self, mocked_start):
+        load = Mock(return_value=[
+            _channel('a', 3), _channel('b', 4, active=False)])
+        mirror = MOD.ChannelsMirror(load)
+        # First read case, node is called
+        res = mirror.list_channels(CTX)
+        load.assert_called_once_with(CTX)
+        self.assertEqual([chan.channel_id for chan in res.channels],
+                         ['a', 'b'])
+        mocked_start.assert_called_once_with(mirror)
+        # Read from memory case, with active filter
+        reset_mocks(vars())
+        res = mirror.list_channels(CTX, active_only=True)
+        assert not load.called
+        self.assertEqual([chan.channel_id for chan in res.channels], ['a'])
+        res = mirror.channel_balance(CTX)
+        assert not load.called
+        self.assertEqual(res.balance, 7)
+        self.assertEqual(res.out_tot_now, 3)
+        # Invalidated case
+        reset_mocks(vars())
+        load.return_value = [_channel('a', 5)]
+        mirror.invalidate()
+        res = mirror.channel_balance(CTX)
+        load.assert_called_once_with(CTX)
+        self.assertEqual(res.balance, 5)
+        self.assertEqual(mirror.polls, 2)
+        # Too old case
+        reset_mocks(vars())
+        mirror._loaded_at -= settings.CHANNELS_MAX_AGE
+        mirror.list_channels(CTX)
+        load.assert_called_once_with(CTX)
+        # Error case, next read calls the node again
+        reset_mocks(vars())
+        mirror.invalidate()
+        load.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            mirror.list_channels(CTX)
+        load.side_effect = None
+        mirror.list_channels(CTX)
+        self.assertEqual(load.call_count, 2)
+
+    def test_poll(self):
+        load = Mock(return_value=[_channel('a')])
+        mirror = MOD.ChannelsMirror(load)
+        called = monotonic()
+        res = mirror._poll(CTX, called)
+        load.assert_called_once_with(CTX)
+        self.assertEqual(res, mirror._responses)
+        # Loaded after call case
+        reset_mocks(vars())
+        res = mirror._poll(CTX, called)
+        assert not load.called
+        self.assertEqual(res, mirror._responses)
+
+    def test_update(self):
+        mirror = MOD.ChannelsMirror(Mock())
+        mirror._update(CTX, [_channel('a'), _channel('b')])
+        self.assertEqual(mirror.changes, 2)
+        responses = mirror._responses
+        # Unchanged case, responses are kept
+        mirror._update(CTX, [_channel('a'), _channel('b')])
+        self.assertEqual(mirror.changes, 2)
+        self.assertIs(mirror._responses, responses)
+        # Updated, added and removed channels case
+        mirror._update(CTX, [_channel('a', 2), _channel('c')])
+        self.assertEqual(mirror.changes, 5)
+        self.assertEqual(
+            [chan.channel_id for chan in mirror._responses[0].channels],
+            ['a', 'c'])
+        self.assertEqual(mirror._responses[2].balance, 3)
+        # No channels case
+        mirror = MOD.ChannelsMirror(Mock())
+        mirror._update(CTX, [])
+        self.assertEqual(mirror._responses[0], pb.ListChannelsResponse())
+        self.assertEqual(mirror._responses[2], pb.ChannelBalanceResponse())
+
+    @patch('lighter.channels.Thread', autospec=True)
+    def test_start(self, mocked_thread):
+        mirror = MOD.ChannelsMirror(Mock(), Mock())
+        mirror._start()
+        self.assertEqual(mocked_thread.call_count, 2)
+        self.assertEqual(mocked_thread.return_value.start.call_count, 2)
+        # Running threads case
+        reset_mocks(vars())
+        mocked_thread.return_value.is_alive.return_value = True
+        mirror._start()
+        assert not mocked_thread.called
+        # Closed mirror case
+        mirror._poller = None
+        mirror.close()
+        mirror._start()
+        assert not mocked_thread.called
+
+    @patch('lighter.channels.LOGGER', autospec=True)
+    def test_run_poller(self, mocked_log):
+        load = Mock(side_effect=RuntimeError('node error'))
+        mirror = MOD.ChannelsMirror(load)
+        mirror._last_read = monotonic()
+        settings.CHANNELS_POLL_TIME = 0
+
+        def failing_load(context):
+            self.assertIsInstance(context, FakeContext)
+            mirror._last_read = 0
+            raise RuntimeError('node error')
+
+        load.side_effect = failing_load
+        mirror._poller = 'poller'
+        # Polling until idle case
+        mirror._run_poller()
+        load.assert_called_once()
+        assert mocked_log.debug.called
+        self.assertEqual(mirror._poller, None)
+        # Closed case
+        reset_mocks(vars())
+        mirror.close()
+        mirror._run_poller()
+        assert not load.called
+        settings.CHANNELS_POLL_TIME = 3
+
+    @patch('lighter.channels.LOGGER', autospec=True)
+    def test_run_watcher(self, mocked_log):
+        calls = []
+
+        def watch():
+            calls.append(1)
+            if len(calls) == 1:
+                yield
+                raise RuntimeError('node error')
+            mirror.close()
+            yield
+
+        settings.SUBSCRIBE_RETRY = 0
+        mirror = MOD.ChannelsMirror(Mock(), watch)
+        mirror._run_watcher()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(mirror._dirty, True)
+        assert mocked_log.debug.called
+        settings.SUBSCRIBE_RETRY = 3
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
@@ -24,6 +24,7 @@ from grpc import StatusCode
 
 from lighter import errors, settings
 from lighter.errors import ERRORS
+from lighter.metrics import get_abort_code
 
 MOD = import_module('lighter.errors')
 
@@ -44,6 +45,7 @@ class ErrorsTests(TestCase):
             else:
                 msg = 'param'
             context.abort.assert_called_once_with(sc, msg)
+            self.assertEqual(get_abort_code(), sc.name)
         # Error case
         reset_mocks(vars())
         context = Mock()
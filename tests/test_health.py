@@ -0,0 +1,255 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for health module """
+
+from asyncio import run
+from importlib import import_module
+from time import monotonic
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from grpc_health.v1.health_pb2 import HealthCheckRequest
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+
+MOD = import_module('lighter.health')
+CTX = 'context'
+
+
+class HealthTests(TestCase):
+    """ Tests for health module """
+
+    def test_get_health_servicer(self):
+        # Locked case
+        settings.NODE_HEALTH = None
+        res = MOD.get_health_servicer(True)
+        self.assertEqual(settings.HEALTH_SERVICER, res)
+        self.assertEqual(_status(res, ''), MOD.NOT_SERVING)
+        self.assertEqual(_status(res, 'lighter.Lightning'), MOD.NOT_SERVING)
+        self.assertEqual(_status(res, 'lighter.Unlocker'), MOD.SERVING)
+        self.assertEqual(_status(res, 'lighter.Locker'), MOD.NOT_SERVING)
+        # Unlocked case
+        res = MOD.get_health_servicer(False)
+        self.assertEqual(_status(res, ''), MOD.SERVING)
+        self.assertEqual(_status(res, 'lighter.Lightning'), MOD.SERVING)
+        self.assertEqual(_status(res, 'lighter.Unlocker'), MOD.NOT_SERVING)
+        self.assertEqual(_status(res, 'lighter.Locker'), MOD.SERVING)
+        # Unlocked case, with unreachable node
+        settings.NODE_HEALTH = Mock()
+        settings.NODE_HEALTH.get_state.return_value = \
+            pb.GetNodeHealthResponse(circuit=MOD.OPEN)
+        res = MOD.get_health_servicer(False)
+        self.assertEqual(_status(res, 'lighter.Lightning'), MOD.NOT_SERVING)
+        settings.NODE_HEALTH = None
+        settings.HEALTH_SERVICER = None
+
+    def test_close_health_servicer(self):
+        servicer = Mock()
+        settings.HEALTH_SERVICER = servicer
+        MOD.close_health_servicer()
+        servicer.enter_graceful_shutdown.assert_called_once_with()
+        self.assertEqual(settings.HEALTH_SERVICER, None)
+        # Not running case
+        MOD.close_health_servicer()
+        self.assertEqual(settings.HEALTH_SERVICER, None)
+
+    def test_update_serving_status(self):
+        servicer = Mock()
+        settings.HEALTH_SERVICER = servicer
+        MOD.update_serving_status(MOD.HALF_OPEN)
+        servicer.set.assert_any_call('', MOD.NOT_SERVING)
+        servicer.set.assert_any_call('lighter.Lightning', MOD.NOT_SERVING)
+        reset_mocks(vars())
+        MOD.update_serving_status(MOD.CLOSED)
+        servicer.set.assert_any_call('', MOD.SERVING)
+        servicer.set.assert_any_call('lighter.Lightning', MOD.SERVING)
+        settings.HEALTH_SERVICER = None
+        # Not running case
+        MOD.update_serving_status(MOD.CLOSED)
+
+    def test_close_node_health(self):
+        health = Mock()
+        settings.NODE_HEALTH = health
+        MOD.close_node_health()
+        health.close.assert_called_once_with()
+        self.assertEqual(settings.NODE_HEALTH, None)
+        # Not running case
+        MOD.close_node_health()
+        self.assertEqual(settings.NODE_HEALTH, None)
+
+    def test_report_node_failure(self):
+        health = Mock()
+        settings.NODE_HEALTH = health
+        MOD.report_node_failure('error')
+        health.failed.assert_called_once_with('error')
+        settings.NODE_HEALTH = None
+        # Not running case
+        MOD.report_node_failure('error')
+
+    def test_report_node_success(self):
+        health = Mock()
+        settings.NODE_HEALTH = health
+        MOD.report_node_success()
+        health.succeeded.assert_called_once_with()
+        settings.NODE_HEALTH = None
+        # Not running case
+        MOD.report_node_success()
+
+    def test_GetNodeHealth(self):
+        health = Mock()
+        settings.NODE_HEALTH = health
+        res = MOD.GetNodeHealth('request', CTX)
+        self.assertEqual(res, health.get_state.return_value)
+        settings.NODE_HEALTH = None
+        # Not running case
+        res = MOD.GetNodeHealth('request', CTX)
+        self.assertEqual(res, pb.GetNodeHealthResponse())
+
+    @patch('lighter.health.Err')
+    def test_guarded(self, mocked_err):
+        mocked_err().node_error.side_effect = Exception()
+        health = MOD.NodeHealth(Mock())
+        func = Mock(return_value='response')
+        wrapped = health.guarded(func)
+        self.assertEqual(wrapped('request', CTX), 'response')
+        func.assert_called_once_with('request', CTX)
+        # Open circuit case
+        reset_mocks(vars())
+        for _ in range(settings.HEALTH_FAILURES):
+            health.failed('Timeout')
+        with self.assertRaises(Exception):
+            wrapped('request', CTX)
+        assert not func.called
+        mocked_err().node_error.assert_called_once_with(
+            CTX, 'Unreachable (Timeout), retrying in background')
+        # Coroutine case
+        async def coro(request, context):
+            return 'response'
+
+        health.succeeded()
+        wrapped = health.guarded(coro)
+        self.assertEqual(run(wrapped('request', CTX)), 'response')
+
+    @patch('lighter.health.LOGGER', autospec=True)
+    def test_failed_succeeded(self, mocked_log):
+        health = MOD.NodeHealth(Mock())
+        # Failures under threshold case
+        for _ in range(settings.HEALTH_FAILURES - 1):
+            health.failed('Timeout')
+        res = health.get_state()
+        self.assertEqual(res.circuit, MOD.CLOSED)
+        self.assertEqual(res.failures, settings.HEALTH_FAILURES - 1)
+        self.assertEqual(res.last_error, 'Timeout')
+        # Success resets failures case
+        health.succeeded()
+        self.assertEqual(health.get_state().failures, 0)
+        assert not mocked_log.warning.called
+        # Tripping case
+        for _ in range(settings.HEALTH_FAILURES):
+            health.failed('Timeout')
+        res = health.get_state()
+        self.assertEqual(res.circuit, MOD.OPEN)
+        self.assertEqual(res.trips, 1)
+        self.assertEqual(mocked_log.warning.call_count, 1)
+        # Failed probe case, circuit opens again
+        health._circuit = MOD.HALF_OPEN
+        health.failed('Timeout')
+        res = health.get_state()
+        self.assertEqual(res.circuit, MOD.OPEN)
+        self.assertEqual(res.trips, 1)
+        # Node answering case
+        health.succeeded()
+        res = health.get_state()
+        self.assertEqual(res.circuit, MOD.CLOSED)
+        self.assertEqual(mocked_log.warning.call_count, 2)
+        # Listeners case
+        listener = Mock()
+        health = MOD.NodeHealth(Mock(), listeners=[listener])
+        for _ in range(settings.HEALTH_FAILURES):
+            health.failed('Timeout')
+        listener.assert_called_once_with(MOD.OPEN)
+        health.failed('Timeout')
+        listener.assert_called_once_with(MOD.OPEN)
+        health.succeeded()
+        listener.assert_called_with(MOD.CLOSED)
+
+    @patch('lighter.health.Thread', autospec=True)
+    def test_start_close(self, mocked_thread):
+        health = MOD.NodeHealth(Mock())
+        health.start()
+        mocked_thread.assert_called_once_with(target=health._run)
+        mocked_thread.return_value.start.assert_called_once_with()
+        health.close()
+        self.assertEqual(health._stop.is_set(), True)
+
+    def test_run(self):
+        probe = Mock()
+        health = MOD.NodeHealth(probe)
+        settings.HEALTH_PROBE_TIME = 0.01
+        # Open circuit case, it half-opens and node is probed
+        health._circuit = MOD.OPEN
+
+        def probe_node():
+            self.assertEqual(health._circuit, MOD.HALF_OPEN)
+            health.close()
+
+        health._probe_node = Mock(side_effect=probe_node)
+        health._run()
+        health._probe_node.assert_called_once_with()
+        # Recently reached node case, not probed
+        health = MOD.NodeHealth(probe)
+        health._last_success = monotonic() + 60
+        health._stop.wait = Mock(side_effect=[False, True])
+        health._probe_node = Mock()
+        health._run()
+        assert not health._probe_node.called
+        settings.HEALTH_PROBE_TIME = 5
+
+    def test_probe_node(self):
+        probe = Mock()
+        health = MOD.NodeHealth(probe)
+        # Unreported failure case
+        probe.side_effect = RuntimeError('Timeout')
+        health._probe_node()
+        self.assertEqual(health.get_state().failures, 1)
+        self.assertEqual(health.get_state().last_error, 'Timeout')
+        # Failure already reported by the implementation case
+        probe.side_effect = lambda: health.failed('Failed to dial')
+        health._probe_node()
+        self.assertEqual(health.get_state().failures, 2)
+        # Unreported success case
+        probe.side_effect = None
+        health._probe_node()
+        self.assertEqual(health.get_state().failures, 0)
+        # Half-open case, node answering
+        health._circuit = MOD.HALF_OPEN
+        health._probe_node()
+        self.assertEqual(health.get_state().circuit, MOD.CLOSED)
+
+
+def _status(servicer, service):
+    """ Returns the status servicer reports for service """
+    request = HealthCheckRequest(service=service)
+    return servicer.Check(request, Mock()).status
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
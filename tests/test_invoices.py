@@ -0,0 +1,407 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for invoices module """
+
+from importlib import import_module
+from os import path
+from tempfile import TemporaryDirectory
+from time import time
+from unittest import TestCase
+from unittest.mock import call, Mock, patch
+
+from sqlalchemy import event
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+from lighter.utils import encode_cursor
+
+MOD = import_module('lighter.invoices')
+CTX = 'context'
+NOW = int(time())
+
+
+def _row(payment_hash, timestamp, state=pb.PENDING, is_open=True,
+         expiry=3600, node_index=0):
+    invoice = pb.Invoice(
+        payment_hash=payment_hash, timestamp=timestamp, expiry_time=expiry,
+        state=state)
+    return MOD.invoice_row(invoice, is_open, node_index=node_index)
+
+
+class InvoicesTests(TestCase):
+    """ Tests for invoices module """
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.url = 'sqlite:///{}'.format(
+            path.join(self.tmp_dir.name, 'invoices.db'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch('lighter.invoices.InvoicesStore', autospec=True)
+    def test_get_invoices_store(self, mocked_store):
+        settings.INVOICES_STORE = None
+        settings.IMPLEMENTATION = 'lnd'
+        settings.DB_DIR = self.tmp_dir.name
+        res = MOD.get_invoices_store()
+        mocked_store.assert_called_once_with(
+            'sqlite:///{}'.format(path.join(
+                self.tmp_dir.name, settings.INVOICES_DB_NAME)), 'lnd')
+        self.assertEqual(res, mocked_store.return_value)
+        # Open store case
+        reset_mocks(vars())
+        res = MOD.get_invoices_store()
+        assert not mocked_store.called
+        self.assertEqual(res, mocked_store.return_value)
+        # Closing case
+        MOD.close_invoices_store()
+        mocked_store.return_value.close.assert_called_once_with()
+        self.assertEqual(settings.INVOICES_STORE, None)
+        MOD.close_invoices_store()
+        self.assertEqual(settings.INVOICES_STORE, None)
+
+    @patch('lighter.invoices.get_invoices_store', autospec=True)
+    def test_list_invoices(self, mocked_get_store):
+        store = mocked_get_store.return_value
+        store.query.return_value = ([pb.Invoice(payment_hash='a')], None)
+        sync = Mock()
+        request = pb.ListInvoicesRequest(paid=True)
+        res = MOD.list_invoices(request, CTX, sync)
+        store.sync.assert_called_once_with(CTX, sync)
+        store.query.assert_called_once_with(request, None)
+        self.assertEqual(request.max_items, settings.MAX_INVOICES)
+        self.assertEqual(res, pb.ListInvoicesResponse(
+            invoices=[pb.Invoice(payment_hash='a')]))
+        # Cursor case
+        reset_mocks(vars())
+        store.query.return_value = ([pb.Invoice(payment_hash='b')], (9, 'b'))
+        request.cursor = encode_cursor((7, 'a'))
+        res = MOD.list_invoices(request, CTX, sync)
+        store.query.assert_called_once_with(request, (7, 'a'))
+        self.assertEqual(res.next_cursor, encode_cursor((9, 'b')))
+
+    @patch('lighter.invoices.get_invoices_store', autospec=True)
+    def test_stream_invoices(self, mocked_get_store):
+        store = mocked_get_store.return_value
+        store.query.side_effect = [
+            ([pb.Invoice(payment_hash='a')], (7, 'a')),
+            ([pb.Invoice(payment_hash='b')], None)]
+        sync = Mock()
+        request = pb.ListInvoicesRequest(
+            paid=True, list_order=pb.DESCENDING)
+        res = MOD.stream_invoices(request, CTX, sync)
+        store.sync.assert_called_once_with(CTX, sync)
+        assert not store.query.called
+        self.assertEqual(list(res), [
+            pb.ListInvoicesResponse(
+                invoices=[pb.Invoice(payment_hash='a')],
+                next_cursor=encode_cursor((7, 'a'))),
+            pb.ListInvoicesResponse(invoices=[pb.Invoice(payment_hash='b')])])
+        store.query.assert_has_calls(
+            [call(request, None), call(request, (7, 'a'))])
+        self.assertEqual(request.max_items, settings.STREAM_ITEMS)
+        self.assertEqual(request.list_order, pb.ASCENDING)
+
+    @patch('lighter.invoices.Err')
+    def test_get_cursor_key(self, mocked_err):
+        request = pb.ListInvoicesRequest()
+        self.assertEqual(MOD._get_cursor_key(CTX, request), None)
+        request.cursor = encode_cursor((7, 'a'))
+        self.assertEqual(MOD._get_cursor_key(CTX, request), (7, 'a'))
+        # Invalid cursor case
+        mocked_err().invalid.side_effect = Exception()
+        request.cursor = encode_cursor(('a', 7))
+        with self.assertRaises(Exception):
+            MOD._get_cursor_key(CTX, request)
+        mocked_err().invalid.assert_called_once_with(CTX, 'cursor')
+
+    @patch('lighter.invoices.get_invoices_store', autospec=True)
+    @patch('lighter.invoices.Err')
+    @patch('lighter.invoices.check_req_params', autospec=True)
+    def test_check_invoice(self, mocked_check_par, mocked_err,
+                           mocked_get_store):
+        store = mocked_get_store.return_value
+        sync = Mock()
+        lookup = Mock()
+        request = pb.CheckInvoiceRequest(payment_hash='hash')
+        # Final invoice case, node is not asked
+        store.get_status.return_value = pb.PAID
+        store.get.return_value = pb.Invoice(state=pb.PAID)
+        res = MOD.check_invoice(request, CTX, sync, lookup)
+        mocked_check_par.assert_called_once_with(CTX, request, 'payment_hash')
+        store.get_status.assert_called_once_with('hash')
+        assert not store.sync.called
+        assert not lookup.called
+        self.assertEqual(
+            res, pb.CheckInvoiceResponse(state=pb.PAID, settled=True))
+        # Pending invoice case, looked up
+        reset_mocks(vars())
+        store.get_status.return_value = pb.PENDING
+        store.get.return_value = pb.Invoice(state=pb.EXPIRED)
+        res = MOD.check_invoice(request, CTX, sync, lookup)
+        lookup.assert_called_once_with(CTX, 'hash')
+        store.save.assert_called_once_with([lookup.return_value])
+        assert not store.sync.called
+        self.assertEqual(res, pb.CheckInvoiceResponse(state=pb.EXPIRED))
+        # Unknown invoice case, store is synced
+        reset_mocks(vars())
+        store.get_status.return_value = None
+        store.get.return_value = pb.Invoice(state=pb.PENDING)
+        res = MOD.check_invoice(request, CTX, sync, lookup)
+        store.sync.assert_called_once_with(CTX, sync, force=True)
+        assert not lookup.called
+        self.assertEqual(res, pb.CheckInvoiceResponse(state=pb.PENDING))
+        # Invoice not found case
+        reset_mocks(vars())
+        store.get.return_value = None
+        mocked_err().invoice_not_found.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD.check_invoice(request, CTX, sync, lookup)
+        mocked_err().invoice_not_found.assert_called_once_with(CTX)
+
+    @patch('lighter.invoices.get_invoices_store', autospec=True)
+    def test_check_invoice_paid_before_expiry(self, mocked_get_store):
+        store = MOD.InvoicesStore(self.url, 'lnd')
+        mocked_get_store.return_value = store
+        # Invoice paid just before expiring, checked after
+        store.save([_row('a', NOW - 7200, node_index=1)])
+        self.assertEqual(store.get('a').state, pb.EXPIRED)
+        lookup = Mock(return_value=_row(
+            'a', NOW - 7200, state=pb.PAID, is_open=False, node_index=1))
+        request = pb.CheckInvoiceRequest(payment_hash='a')
+        res = MOD.check_invoice(request, CTX, Mock(), lookup)
+        lookup.assert_called_once_with(CTX, 'a')
+        self.assertEqual(
+            res, pb.CheckInvoiceResponse(state=pb.PAID, settled=True))
+        # Final invoice is not looked up again
+        reset_mocks(vars())
+        res = MOD.check_invoice(request, CTX, Mock(), lookup)
+        assert not lookup.called
+        self.assertEqual(res.state, pb.PAID)
+        store.close()
+
+    def test_invoice_row(self):
+        invoice = pb.Invoice(
+            payment_hash='hash', timestamp=1000, expiry_time=60,
+            state=pb.PAID)
+        res = MOD.invoice_row(invoice, False, node_key='label')
+        self.assertEqual(res['payment_hash'], 'hash')
+        self.assertEqual(res['timestamp'], 1000)
+        self.assertEqual(res['expires_at'], 1060)
+        self.assertEqual(res['status'], pb.PAID)
+        self.assertEqual(res['node_key'], 'label')
+        self.assertEqual(pb.Invoice.FromString(res['data']), invoice)
+        # Open invoice with explicit expiration case
+        res = MOD.invoice_row(invoice, True, expires_at=2000, node_index=3)
+        self.assertEqual(res['expires_at'], 2000)
+        self.assertEqual(res['status'], pb.PENDING)
+        self.assertEqual(res['node_index'], 3)
+
+    def test_InvoicesStore(self):
+        store = MOD.InvoicesStore(self.url, 'lnd')
+        self.assertEqual(store.get('a'), None)
+        self.assertEqual(store.cursor('add_index'), 0)
+        store.save([
+            _row('a', NOW - 100, node_index=1),
+            _row('b', NOW - 7200, node_index=2),
+            _row('c', NOW - 50, state=pb.PAID, is_open=False, node_index=3)],
+                   {'add_index': 3})
+        self.assertEqual(store.cursor('add_index'), 3)
+        self.assertEqual(store.get('a').state, pb.PENDING)
+        # Open invoices past expiration are expired
+        self.assertEqual(store.get('b').state, pb.EXPIRED)
+        self.assertEqual(store.get('c').state, pb.PAID)
+        self.assertEqual(store.get_oldest_open_index(), 1)
+        # Final invoices are never updated
+        store.save([
+            _row('a', NOW - 100, state=pb.PAID, is_open=False, node_index=1),
+            _row('c', NOW - 50, node_index=3)])
+        self.assertEqual(store.get('a').state, pb.PAID)
+        self.assertEqual(store.get('c').state, pb.PAID)
+        # Expired invoices are re-read until the node makes them final, for
+        # INVOICES_OPEN_GRACE seconds (then they are looked up when checked)
+        self.assertEqual(store.get_status('b'), pb.PENDING)
+        settings.INVOICES_OPEN_GRACE = 7200
+        self.assertEqual(store.get_oldest_open_index(), 2)
+        settings.INVOICES_OPEN_GRACE = 1800
+        self.assertEqual(store.get_oldest_open_index(), None)
+        self.assertEqual(store.get_status('b'), pb.PENDING)
+        settings.INVOICES_OPEN_GRACE = 7200
+        store.save([
+            _row('b', NOW - 7200, state=pb.EXPIRED, is_open=False,
+                 node_index=2)])
+        self.assertEqual(store.get_status('b'), pb.EXPIRED)
+        self.assertEqual(store.get_oldest_open_index(), None)
+        settings.INVOICES_OPEN_GRACE = 3600
+        self.assertEqual(store.get_status('d'), None)
+        store.close()
+        # Reopening the store keeps its content
+        store = MOD.InvoicesStore(self.url, 'lnd')
+        self.assertEqual(store.get('c').state, pb.PAID)
+        store.close()
+        # Switching implementation empties the store
+        store = MOD.InvoicesStore(self.url, 'eclair')
+        self.assertEqual(store.get('c'), None)
+        self.assertEqual(store.cursor('add_index'), 0)
+        store.close()
+
+    def test_InvoicesStore_set_paid(self):
+        store = MOD.InvoicesStore(self.url, 'eclair')
+        store.save([
+            _row('a', NOW - 100),
+            _row('b', NOW - 7200),
+            _row('c', NOW - 50, state=pb.PAID, is_open=False)])
+        res = store.set_paid({'a': 7, 'b': 8, 'c': 9, 'd': 10})
+        self.assertEqual(res, {'a', 'b', 'c'})
+        for payment_hash, amount in (('a', 7), ('b', 8)):
+            invoice = store.get(payment_hash)
+            self.assertEqual(invoice.state, pb.PAID)
+            self.assertEqual(invoice.amount_received_bits, amount)
+            self.assertEqual(store.get_status(payment_hash), pb.PAID)
+        # Final invoices are never updated
+        self.assertEqual(store.get('c').amount_received_bits, 0)
+        self.assertEqual(store.get('d'), None)
+        store.close()
+
+    def test_InvoicesStore_node_key(self):
+        store = MOD.InvoicesStore(self.url, 'clightning')
+        invoice = pb.Invoice(payment_hash='a', timestamp=NOW)
+        store.save([MOD.invoice_row(
+            invoice, True, expires_at=NOW + 60, node_key='label')])
+        self.assertEqual(store.get_node_key('a'), 'label')
+        self.assertEqual(store.get_node_key('b'), None)
+        store.close()
+
+    def test_InvoicesStore_query(self):
+        store = MOD.InvoicesStore(self.url, 'lnd')
+        store.save([
+            _row('a', NOW - 400, state=pb.PAID, is_open=False),
+            _row('b', NOW - 300),
+            _row('c', NOW - 200, expiry=60),
+            _row('d', NOW - 100, state=pb.EXPIRED, is_open=False),
+            _row('e', NOW - 50, state=pb.PAID, is_open=False)])
+
+        def query(after=None, **kwargs):
+            kwargs.setdefault('max_items', 10)
+            request = pb.ListInvoicesRequest(**kwargs)
+            invoices, self.next_key = store.query(request, after)
+            return [inv.payment_hash for inv in invoices]
+
+        self.assertEqual(
+            query(paid=True, pending=True, expired=True),
+            ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(query(paid=True), ['a', 'e'])
+        self.assertEqual(query(pending=True), ['b'])
+        self.assertEqual(query(expired=True), ['c', 'd'])
+        self.assertEqual(query(), [])
+        # Ascending search from search_timestamp
+        self.assertEqual(
+            query(paid=True, pending=True, expired=True,
+                  search_timestamp=NOW - 300, max_items=2), ['c', 'd'])
+        # Descending search, descending list
+        self.assertEqual(
+            query(paid=True, pending=True, expired=True,
+                  search_timestamp=NOW - 100, search_order=pb.DESCENDING,
+                  list_order=pb.DESCENDING, max_items=2), ['c', 'b'])
+        # Descending search, ascending list
+        self.assertEqual(
+            query(paid=True, pending=True, expired=True,
+                  search_order=pb.DESCENDING, max_items=2), ['d', 'e'])
+        # Ascending search, descending list
+        self.assertEqual(
+            query(paid=True, list_order=pb.DESCENDING), ['e', 'a'])
+        self.assertEqual(self.next_key, None)
+        # Continuation cases
+        all_states = {'paid': True, 'pending': True, 'expired': True}
+        self.assertEqual(query(max_items=2, **all_states), ['a', 'b'])
+        self.assertEqual(self.next_key, (NOW - 300, 'b'))
+        self.assertEqual(
+            query(after=self.next_key, max_items=2, **all_states),
+            ['c', 'd'])
+        self.assertEqual(
+            query(after=self.next_key, max_items=2, **all_states), ['e'])
+        self.assertEqual(self.next_key, None)
+        self.assertEqual(
+            query(after=(NOW - 100, 'd'), search_order=pb.DESCENDING,
+                  list_order=pb.DESCENDING, max_items=2, **all_states),
+            ['c', 'b'])
+        self.assertEqual(self.next_key, (NOW - 300, 'b'))
+        # Invoices created at the same time case
+        store.save([_row('f', NOW - 300)])
+        self.assertEqual(
+            query(after=(NOW - 300, 'b'), max_items=1, **all_states), ['f'])
+        store.close()
+
+    def test_InvoicesStore_query_plan(self):
+        store = MOD.InvoicesStore(self.url, 'lnd')
+        plans = []
+
+        def explain(conn, cursor, statement, parameters, context, many):
+            if statement.startswith('SELECT invoices.data'):
+                plans.append(' '.join(
+                    str(row[-1]) for row in cursor.connection.execute(
+                        'EXPLAIN QUERY PLAN ' + statement, parameters)))
+
+        event.listen(store._engine, 'before_cursor_execute', explain)
+        for order in (pb.ASCENDING, pb.DESCENDING):
+            request = pb.ListInvoicesRequest(
+                paid=True, pending=True, expired=True, max_items=10,
+                search_timestamp=NOW, search_order=order)
+            store.query(request)
+            store.query(request, (NOW, 'a'))
+        self.assertEqual(len(plans), 4)
+        for plan in plans:
+            self.assertIn('USING INDEX ix_invoices_timestamp', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+        store.close()
+
+    def test_InvoicesStore_sync(self):
+        store = MOD.InvoicesStore(self.url, 'lnd')
+        sync = Mock()
+        store.sync(CTX, sync)
+        sync.assert_called_once_with(CTX, store)
+        # Recently synced store case
+        reset_mocks(vars())
+        store.sync(CTX, sync)
+        assert not sync.called
+        # Forced sync case
+        store.sync(CTX, sync, force=True)
+        sync.assert_called_once_with(CTX, store)
+        # Sync interval elapsed case
+        reset_mocks(vars())
+        settings.INVOICES_SYNC_TIME = 0
+        store.sync(CTX, sync)
+        sync.assert_called_once_with(CTX, store)
+        settings.INVOICES_SYNC_TIME = 1
+        # Failed sync case, store is synced again on next call
+        reset_mocks(vars())
+        store = MOD.InvoicesStore(self.url, 'lnd')
+        sync.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            store.sync(CTX, sync)
+        sync.side_effect = None
+        store.sync(CTX, sync)
+        self.assertEqual(sync.call_count, 2)
+        store.close()
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
@@ -0,0 +1,145 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for jobs module """
+
+from concurrent.futures import Future
+from importlib import import_module
+from threading import Event
+from unittest import TestCase
+from unittest.mock import patch
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+
+MOD = import_module('lighter.jobs')
+CTX = 'context'
+
+
+class JobsTests(TestCase):
+    """ Tests for jobs module """
+
+    @patch('lighter.jobs.JobRegistry', autospec=True)
+    def test_get_jobs(self, mocked_registry):
+        settings.JOBS = None
+        res = MOD.get_jobs()
+        mocked_registry.assert_called_once_with()
+        self.assertEqual(res, mocked_registry.return_value)
+        # Existing registry case
+        reset_mocks(vars())
+        res = MOD.get_jobs()
+        assert not mocked_registry.called
+        self.assertEqual(res, mocked_registry.return_value)
+        settings.JOBS = None
+
+    @patch('lighter.jobs.get_jobs', autospec=True)
+    @patch('lighter.jobs.Err')
+    @patch('lighter.jobs.check_req_params', autospec=True)
+    def test_get_close_status(self, mocked_check_par, mocked_err,
+                              mocked_get_jobs):
+        future = Future()
+        mocked_get_jobs.return_value.get.return_value = future
+        request = pb.GetCloseStatusRequest(job_id='job')
+        # Running job case
+        res = MOD.get_close_status(request, CTX)
+        mocked_check_par.assert_called_once_with(CTX, request, 'job_id')
+        mocked_get_jobs.return_value.get.assert_called_once_with('job')
+        self.assertEqual(res, pb.GetCloseStatusResponse())
+        # Completed job case
+        future.set_result('txid')
+        res = MOD.get_close_status(request, CTX)
+        self.assertEqual(res, pb.GetCloseStatusResponse(
+            completed=True, closing_txid='txid'))
+        # Completed job without txid case
+        future = Future()
+        future.set_result(None)
+        mocked_get_jobs.return_value.get.return_value = future
+        res = MOD.get_close_status(request, CTX)
+        self.assertEqual(res, pb.GetCloseStatusResponse(completed=True))
+        # Failed job case
+        future = Future()
+        future.set_exception(RuntimeError('closing failed'))
+        mocked_get_jobs.return_value.get.return_value = future
+        res = MOD.get_close_status(request, CTX)
+        self.assertEqual(res, pb.GetCloseStatusResponse(
+            completed=True, failure='closing failed'))
+        # Unknown job case
+        reset_mocks(vars())
+        mocked_get_jobs.return_value.get.return_value = None
+        mocked_err().job_not_found.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD.get_close_status(request, CTX)
+        mocked_err().job_not_found.assert_called_once_with(CTX)
+
+    def test_JobRegistry(self):
+        release = Event()
+        registry = MOD.JobRegistry()
+        self.assertEqual(registry.drain(0), True)
+        # Running jobs
+        future = registry.run(CTX, 'payment', release.wait, 5)
+        job_id, job_future = registry.submit(CTX, 'close', lambda: 'txid')
+        self.assertEqual(registry.get(job_id), job_future)
+        self.assertEqual(job_future.result(5), 'txid')
+        self.assertEqual(registry.get('unknown'), None)
+        self.assertEqual(
+            registry.get_load(), {'close': (0, 0), 'payment': (1, 0)})
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(registry.drain(0.01), False)
+        # Completed jobs
+        release.set()
+        self.assertEqual(future.result(5), True)
+        self.assertEqual(registry.drain(5), True)
+        # Only the last JOBS_KEPT jobs are kept
+        settings.JOBS_KEPT = 2
+        job_ids = [
+            registry.submit(CTX, 'close', lambda: None)[0] for _ in range(3)]
+        self.assertEqual(registry.get(job_ids[0]), None)
+        self.assertNotEqual(registry.get(job_ids[1]), None)
+        self.assertNotEqual(registry.get(job_ids[2]), None)
+        settings.JOBS_KEPT = 1000
+        self.assertEqual(registry.drain(5), True)
+
+    @patch('lighter.jobs.Err')
+    def test_JobRegistry_saturated(self, mocked_err):
+        settings.JOB_WORKERS = {'close': 1, 'payment': 1}
+        settings.JOB_QUEUE = 1
+        release = Event()
+        registry = MOD.JobRegistry()
+        futures = [registry.run(CTX, 'payment', release.wait, 5)
+                   for _ in range(2)]
+        self.assertEqual(
+            registry.get_load(), {'close': (0, 0), 'payment': (1, 1)})
+        # Queue of payments is full
+        mocked_err().too_many_jobs.side_effect = Exception()
+        with self.assertRaises(Exception):
+            registry.run(CTX, 'payment', release.wait, 5)
+        mocked_err().too_many_jobs.assert_called_once_with(CTX)
+        # Other kinds of jobs still run
+        future = registry.run(CTX, 'close', lambda: 'txid')
+        self.assertEqual(future.result(5), 'txid')
+        release.set()
+        for future in futures:
+            self.assertEqual(future.result(5), True)
+        self.assertEqual(registry.drain(5), True)
+        settings.JOB_WORKERS = {'close': 4, 'payment': 16}
+        settings.JOB_QUEUE = 100
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
@@ -14,15 +14,22 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Tests for light_clightning module """
 
+import socket
+
+from asyncio import run, sleep as sleep_async, start_unix_server
 from concurrent.futures import TimeoutError as TimeoutFutError
 from importlib import import_module
+from json import dumps, loads
+from os import path
+from tempfile import TemporaryDirectory
+from time import time
 from unittest import TestCase
-from unittest.mock import Mock, patch
+from unittest.mock import ANY, call, Mock, patch
 
 from lighter import lighter_pb2 as pb
 from lighter import light_clightning, settings
 from lighter.utils import Enforcer as Enf
-from tests import fixtures_clightning as fix
+from tests import CoroutineMock, fixtures_clightning as fix
 
 MOD = import_module('lighter.light_clightning')
 CTX = 'context'
@@ -31,13 +38,29 @@ CTX = 'context'
 class LightClightningTests(TestCase):
     """ Tests for light_clightning module """
 
-    def test_update_settings(self):
-        # Correct case
+    @patch('lighter.light_clightning.RpcPool', autospec=True)
+    @patch('lighter.light_clightning.disconnect', autospec=True)
+    def test_update_settings(self, mocked_disconnect, mocked_pool):
+        # Correct case, socket mode
+        values = {
+            'CL_RPC': 'lightning-rpc',
+            'CL_RPC_DIR': '/path/'
+        }
+        with patch.dict('os.environ', values):
+            MOD.update_settings(None)
+        mocked_disconnect.assert_called_once_with()
+        mocked_pool.assert_called_once_with(
+            '/path/lightning-rpc', settings.CL_POOL_SIZE)
+        self.assertEqual(settings.CL_POOL, mocked_pool.return_value)
+        self.assertEqual(settings.CL_USE_CLI, False)
+        # Correct case, cli mode
+        reset_mocks(vars())
         values = {
             'CL_CLI': 'lightning-cli',
             'CL_CLI_DIR': '/path',
             'CL_RPC': 'lightning-rpc',
-            'CL_RPC_DIR': '/path/'
+            'CL_RPC_DIR': '/path/',
+            'CL_USE_CLI': '1'
         }
         with patch.dict('os.environ', values):
             MOD.update_settings(None)
@@ -46,14 +69,277 @@ class LightClightningTests(TestCase):
                 values['CL_RPC_DIR']), '--rpc-file={}'.format(
                     values['CL_RPC']), '-k'
         ])
+        assert not mocked_pool.called
+        self.assertEqual(settings.CL_USE_CLI, True)
         # Missing variable
         reset_mocks(vars())
         settings.CMD_BASE = ''
-        values = {}
+        values = {'CL_USE_CLI': '1'}
         with patch.dict('os.environ', values):
             with self.assertRaises(KeyError):
                 MOD.update_settings(None)
         self.assertEqual(settings.CMD_BASE, '')
+        settings.CL_USE_CLI = 0
+
+    @patch('lighter.light_clightning.LOGGER', autospec=True)
+    @patch('lighter.light_clightning.get_invoices_store', autospec=True)
+    @patch('lighter.light_clightning.get_nodes_cache', autospec=True)
+    def test_on_connect(self, mocked_cache, mocked_store, mocked_log):
+        MOD.on_connect()
+        mocked_cache.assert_called_once_with(
+            MOD._load_nodes, MOD._lookup_node)
+        mocked_cache.return_value.start.assert_called_once_with()
+        store = mocked_store.return_value
+        self.assertEqual(store.sync.call_count, 1)
+        self.assertEqual(store.sync.call_args[0][1], MOD._sync_invoices)
+        assert not mocked_log.error.called
+        # Error case
+        reset_mocks(vars())
+        store.sync.side_effect = RuntimeError('error')
+        MOD.on_connect()
+        assert mocked_log.error.called
+
+    def test_disconnect(self):
+        pool = Mock()
+        settings.CL_POOL = pool
+        MOD.disconnect()
+        pool.close.assert_called_once_with()
+        self.assertEqual(settings.CL_POOL, None)
+        # No pool
+        MOD.disconnect()
+        self.assertEqual(settings.CL_POOL, None)
+
+    @patch('lighter.light_clightning.report_node_success', autospec=True)
+    @patch('lighter.light_clightning.report_node_failure', autospec=True)
+    @patch('lighter.light_clightning.timed_node_call', autospec=True)
+    @patch('lighter.light_clightning.Err')
+    @patch('lighter.light_clightning.get_node_timeout', autospec=True)
+    @patch('lighter.light_clightning.cli_command', autospec=True)
+    def test_command(self, mocked_cli, mocked_timeout, mocked_err,
+                     mocked_timed, mocked_failure, mocked_success):
+        mocked_err().node_error.side_effect = Exception()
+        mocked_timeout.return_value = 7
+        pool = Mock()
+        settings.CL_POOL = pool
+        # CLI mode
+        settings.CL_USE_CLI = 1
+        res = MOD.command(CTX, 'getinfo', timeout=3)
+        mocked_cli.assert_called_once_with(CTX, 'getinfo', timeout=3)
+        self.assertEqual(res, mocked_cli.return_value)
+        assert not pool.call.called
+        settings.CL_USE_CLI = 0
+        # Result case
+        reset_mocks(vars())
+        pool.call.return_value = {'id': 1, 'result': {'id': 'abc'}}
+        res = MOD.command(CTX, 'listpeers', 'level=info')
+        pool.call.assert_called_once_with('listpeers', {'level': 'info'}, 7)
+        self.assertEqual(res, {'id': 'abc'})
+        mocked_timed.assert_called_once_with('listpeers')
+        mocked_success.assert_called_once_with()
+        # Error case
+        reset_mocks(vars())
+        error = {'code': -1, 'message': 'an error'}
+        pool.call.return_value = {'id': 2, 'error': error}
+        res = MOD.command(CTX, 'pay', 'bolt11="lntb1"', timeout=3)
+        pool.call.assert_called_once_with('pay', {'bolt11': 'lntb1'}, 3)
+        self.assertEqual(res, error)
+        # Dedicated connection case
+        reset_mocks(vars())
+        pool.call_dedicated.return_value = {'id': 3, 'result': {}}
+        MOD.command(CTX, 'pay', 'bolt11="lntb1"', timeout=3, pooled=False)
+        pool.call_dedicated.assert_called_once_with(
+            'pay', {'bolt11': 'lntb1'}, 3)
+        assert not pool.call.called
+        # Timeout case
+        reset_mocks(vars())
+        pool.call.side_effect = socket.timeout()
+        with self.assertRaises(Exception):
+            MOD.command(CTX, 'getinfo')
+        mocked_err().node_error.assert_called_once_with(CTX, 'Timeout')
+        assert not mocked_failure.called
+        assert not mocked_success.called
+        # Connection error case
+        reset_mocks(vars())
+        pool.call.side_effect = FileNotFoundError(2, 'No such file')
+        with self.assertRaises(Exception):
+            MOD.command(CTX, 'getinfo')
+        assert mocked_err().node_error.called
+        # Not configured case
+        reset_mocks(vars())
+        settings.CL_POOL = None
+        with self.assertRaises(RuntimeError):
+            MOD.command(CTX, 'getinfo')
+
+    @patch('lighter.light_clightning.Err')
+    @patch('lighter.light_clightning.get_node_timeout', autospec=True)
+    @patch('lighter.light_clightning.async_cli_command', autospec=True)
+    def test_async_command(self, mocked_cli, mocked_timeout, mocked_err):
+        mocked_err().node_error.side_effect = Exception()
+        mocked_timeout.return_value = 7
+        pool = Mock()
+        pool.async_call = CoroutineMock()
+        settings.CL_POOL = pool
+        # CLI mode
+        settings.CL_USE_CLI = 1
+        res = run(MOD.async_command(CTX, 'getinfo', timeout=3))
+        mocked_cli.assert_called_once_with(CTX, 'getinfo', timeout=3)
+        self.assertEqual(res, mocked_cli.return_value)
+        assert not pool.async_call.called
+        settings.CL_USE_CLI = 0
+        # Result case
+        reset_mocks(vars())
+        pool.async_call.return_value = {'id': 1, 'result': {'id': 'abc'}}
+        res = run(MOD.async_command(CTX, 'pay', 'bolt11="lntb1"'))
+        pool.async_call.assert_called_once_with('pay', {'bolt11': 'lntb1'})
+        self.assertEqual(res, {'id': 'abc'})
+        # Timeout case
+        reset_mocks(vars())
+
+        async def slow_call(*_args):
+            await sleep_async(1)
+
+        pool.async_call = slow_call
+        with self.assertRaises(Exception):
+            run(MOD.async_command(CTX, 'getinfo', timeout=0.01))
+        mocked_err().node_error.assert_called_once_with(CTX, 'Timeout')
+        # Connection error case
+        reset_mocks(vars())
+        pool.async_call = CoroutineMock(
+            side_effect=FileNotFoundError(2, 'No such file'))
+        with self.assertRaises(Exception):
+            run(MOD.async_command(CTX, 'getinfo'))
+        assert mocked_err().node_error.called
+        # Not configured case
+        settings.CL_POOL = None
+        with self.assertRaises(RuntimeError):
+            run(MOD.async_command(CTX, 'getinfo'))
+
+    def test_get_result(self):
+        res = MOD._get_result({'id': 1, 'result': {'id': 'abc'}})
+        self.assertEqual(res, {'id': 'abc'})
+        error = {'code': -1, 'message': 'an error'}
+        res = MOD._get_result({'id': 1, 'error': error})
+        self.assertEqual(res, error)
+        res = MOD._get_result({'id': 1})
+        self.assertEqual(res, None)
+
+    def test_get_params(self):
+        args = [
+            'msatoshi="any"', 'msatoshi2=any', 'riskfactor=1', 'a=true',
+            'b=null', 'fallbacks=["addr"]', 'label="a b"', 'c=1.5',
+            'd="unterminated', 'e={"k": 1}', 'f=x=y'
+        ]
+        res = MOD._get_params(args)
+        self.assertEqual(res, {
+            'msatoshi': 'any', 'msatoshi2': 'any', 'riskfactor': 1,
+            'a': True, 'b': None, 'fallbacks': ['addr'], 'label': 'a b',
+            'c': '1.5', 'd': '"unterminated', 'e': {'k': 1}, 'f': 'x=y'
+        })
+
+    @patch('lighter.light_clightning._RpcConnection', autospec=True)
+    def test_RpcPool(self, mocked_conn):
+        pool = MOD.RpcPool('/path/lightning-rpc', 1)
+        # New connection case
+        mocked_conn.return_value.call.return_value = {'id': 1}
+        res = pool.call('getinfo', {}, 5)
+        mocked_conn.assert_called_once_with('/path/lightning-rpc', 5)
+        args = mocked_conn.return_value.call.call_args[0]
+        self.assertEqual(args[:3], (1, 'getinfo', {}))
+        self.assertEqual(res, {'id': 1})
+        # Idle connection reused, ids are increasing
+        reset_mocks(vars())
+        pool.call('getinfo', {}, 5)
+        assert not mocked_conn.called
+        self.assertEqual(mocked_conn.return_value.call.call_args[0][0], 2)
+        # Failed call, connection is dropped
+        reset_mocks(vars())
+        mocked_conn.return_value.call.side_effect = socket.timeout()
+        with self.assertRaises(socket.timeout):
+            pool.call('getinfo', {}, 5)
+        mocked_conn.return_value.close.assert_called_once_with()
+        reset_mocks(vars())
+        mocked_conn.return_value.call.side_effect = None
+        pool.call('getinfo', {}, 5)
+        mocked_conn.assert_called_once_with('/path/lightning-rpc', 5)
+        # Pool exhausted
+        reset_mocks(vars())
+        pool._slots.acquire()
+        with self.assertRaises(socket.timeout):
+            pool.call('getinfo', {}, 0.01)
+        assert not mocked_conn.return_value.call.called
+        pool._slots.release()
+        # Dedicated connection, not kept
+        reset_mocks(vars())
+        pool._slots.acquire()
+        res = pool.call_dedicated('pay', {}, 5)
+        mocked_conn.assert_called_once_with('/path/lightning-rpc', 5)
+        self.assertEqual(mocked_conn.return_value.call.call_args[0][1], 'pay')
+        mocked_conn.return_value.close.assert_called_once_with()
+        pool._slots.release()
+        # Close
+        reset_mocks(vars())
+        pool.close()
+        mocked_conn.return_value.close.assert_called_once_with()
+
+    def test_RpcPool_async_call(self):
+        requests = []
+
+        async def handle(reader, writer):
+            request = loads((await reader.readuntil(b'}}')).decode())
+            requests.append(request)
+            # a notification precedes the response
+            writer.write(b'{"method": "log"}\n\n\n\n')
+            writer.write(dumps({'jsonrpc': '2.0', 'id': request['id'],
+                                'result': {'a': 1}}).encode() + b'\n\n')
+            writer.close()
+
+        async def call(socket_path):
+            node = await start_unix_server(handle, socket_path)
+            async with node:
+                pool = MOD.RpcPool(socket_path, 1)
+                return await pool.async_call('getinfo', {'k': 'v'})
+
+        with TemporaryDirectory() as tmp_dir:
+            res = run(call(path.join(tmp_dir, 'lightning-rpc')))
+        self.assertEqual(res, {'jsonrpc': '2.0', 'id': 1, 'result': {'a': 1}})
+        self.assertEqual(requests, [{
+            'jsonrpc': '2.0', 'id': 1, 'method': 'getinfo',
+            'params': {'k': 'v'}}])
+
+    @patch('lighter.light_clightning.socket', autospec=True)
+    def test_RpcConnection(self, mocked_socket):
+        sock = mocked_socket.return_value
+        conn = MOD._RpcConnection('/path/lightning-rpc', 5)
+        sock.connect.assert_called_once_with('/path/lightning-rpc')
+        # Response split across reads, a foreign id is skipped
+        sock.recv.side_effect = [
+            b'{"jsonrpc": "2.0", "id": 6, "result": {}}\n', b'\n{"id": 7,',
+            b' "result": {"a": 1}}\n', b'\n'
+        ]
+        res = conn.call(7, 'getinfo', {}, time() + 5)
+        self.assertEqual(res, {'id': 7, 'result': {'a': 1}})
+        sent = loads(sock.sendall.call_args[0][0].decode())
+        self.assertEqual(sent, {
+            'jsonrpc': '2.0', 'id': 7, 'method': 'getinfo', 'params': {}})
+        # Connection closed by node
+        reset_mocks(vars())
+        sock.recv.side_effect = [b'']
+        with self.assertRaises(ConnectionResetError):
+            conn.call(8, 'getinfo', {}, time() + 5)
+        # Deadline exceeded
+        reset_mocks(vars())
+        with self.assertRaises(socket.timeout):
+            conn.call(9, 'getinfo', {}, time() - 1)
+        assert not sock.sendall.called
+        # Close
+        conn.close()
+        sock.close.assert_called_once_with()
+        # Failed connection
+        reset_mocks(vars())
+        sock.connect.side_effect = ConnectionRefusedError()
+        with self.assertRaises(ConnectionRefusedError):
+            MOD._RpcConnection('/path/lightning-rpc', 5)
+        sock.close.assert_called_once_with()
 
     @patch('lighter.light_clightning._handle_error', autospec=True)
     @patch('lighter.light_clightning.command', autospec=True)
@@ -154,122 +440,87 @@ class LightClightningTests(TestCase):
         mocked_handle.assert_called_once_with(
             CTX, fix.BADRESPONSE, always_abort=False)
 
-    @patch('lighter.light_clightning.get_channel_balances', autospec=True)
-    @patch('lighter.light_clightning.ListChannels', autospec=True)
-    def test_ChannelBalance(self, mocked_ListChannels, mocked_get_chan_bal):
-        mocked_get_chan_bal.return_value = pb.ChannelBalanceResponse()
+    @patch('lighter.light_clightning._get_channels_mirror', autospec=True)
+    def test_ChannelBalance(self, mocked_mirror):
         res = MOD.ChannelBalance('request', CTX)
-        self.assertEqual(res, pb.ChannelBalanceResponse())
+        mirror = mocked_mirror.return_value
+        mirror.channel_balance.assert_called_once_with(CTX)
+        self.assertEqual(res, mirror.channel_balance.return_value)
 
-    @patch('lighter.light_clightning._handle_error', autospec=True)
-    @patch('lighter.light_clightning._add_channel', autospec=True)
-    @patch('lighter.light_clightning._get_channel_state', autospec=True)
-    @patch('lighter.light_clightning.command', autospec=True)
-    def test_ListChannels(self, mocked_command, mocked_state, mocked_add,
-                          mocked_handle):
-        api = 'listpeers'
-        # Correct case: request.active_only = False
-        request = pb.ListChannelsRequest()
-        mocked_command.return_value = fix.LISTPEERS
-        mocked_state.return_value = pb.OPEN
-        res = MOD.ListChannels(request, CTX)
-        mocked_command.assert_called_once_with(CTX, api)
-        assert mocked_add.called
-        mocked_handle.assert_called_once_with(
-            CTX, fix.LISTPEERS, always_abort=False)
-        # Correct case: request.active_only = True
-        reset_mocks(vars())
+    @patch('lighter.light_clightning._get_channels_mirror', autospec=True)
+    def test_ListChannels(self, mocked_mirror):
         request = pb.ListChannelsRequest(active_only=True)
-        mocked_command.return_value = fix.LISTPEERS
-        res = MOD.ListChannels(request, CTX)
-        mocked_command.assert_called_once_with(CTX, api)
-        mocked_handle.assert_called_once_with(
-            CTX, fix.LISTPEERS, always_abort=False)
-        # No channels case
-        reset_mocks(vars())
-        mocked_command.return_value = fix.LISTPEERS_EMPTY
-        res = MOD.ListChannels('request', CTX)
-        mocked_command.assert_called_once_with(CTX, api)
-        assert not mocked_add.called
-        mocked_handle.assert_called_once_with(
-            CTX, fix.LISTPEERS_EMPTY, always_abort=False)
-        self.assertEqual(res, pb.ListChannelsResponse())
-        # Negative state case (closed channel)
-        reset_mocks(vars())
-        request = pb.ListChannelsRequest()
-        mocked_command.return_value = fix.LISTPEERS
-        mocked_state.return_value = -1
         res = MOD.ListChannels(request, CTX)
-        mocked_command.assert_called_once_with(CTX, api)
-        assert not mocked_add.called
-        mocked_handle.assert_called_once_with(
-            CTX, fix.LISTPEERS, always_abort=False)
-        # Error case
-        reset_mocks(vars())
-        mocked_command.return_value = fix.BADRESPONSE
-        res = MOD.ListChannels('request', CTX)
-        mocked_command.assert_called_once_with(CTX, api)
-        assert not mocked_add.called
-        mocked_handle.assert_called_once_with(
-            CTX, fix.BADRESPONSE, always_abort=False)
+        mirror = mocked_mirror.return_value
+        mirror.list_channels.assert_called_once_with(CTX, True)
+        self.assertEqual(res, mirror.list_channels.return_value)
 
-    @patch('lighter.light_clightning._handle_error', autospec=True)
-    @patch('lighter.light_clightning._add_payment', autospec=True)
-    @patch('lighter.light_clightning.command', autospec=True)
-    def test_ListPayments(self, mocked_command, mocked_add, mocked_handle):
-        api = 'listsendpays'
-        # Correct case
-        request = pb.ListPaymentsRequest()
-        mocked_command.return_value = fix.PAYMENTS
+    @patch('lighter.light_clightning.list_invoices', autospec=True)
+    def test_ListInvoices(self, mocked_list):
+        request = pb.ListInvoicesRequest(paid=True)
+        res = MOD.ListInvoices(request, CTX)
+        mocked_list.assert_called_once_with(
+            request, CTX, MOD._sync_invoices)
+        self.assertEqual(res, mocked_list.return_value)
+
+    @patch('lighter.light_clightning._get_payments_pages', autospec=True)
+    @patch('lighter.light_clightning._list_payments', autospec=True)
+    def test_ListPayments(self, mocked_list, mocked_pages):
+        request = pb.ListPaymentsRequest(max_items=2)
+        mocked_pages.return_value = iter(['page'])
         res = MOD.ListPayments(request, CTX)
-        mocked_command.assert_called_once_with(CTX, api)
-        assert mocked_add.called
-        # Error case
-        reset_mocks(vars())
-        mocked_command.return_value = fix.BADRESPONSE
-        res = MOD.ListPayments('request', CTX)
-        mocked_command.assert_called_once_with(CTX, api)
-        assert not mocked_add.called
-        mocked_handle.assert_called_once_with(
-            CTX, fix.BADRESPONSE, always_abort=False)
+        mocked_list.assert_called_once_with(CTX)
+        mocked_pages.assert_called_once_with(
+            CTX, request, mocked_list.return_value, 2)
+        self.assertEqual(res, 'page')
 
+    @patch('lighter.light_clightning.get_nodes_cache', autospec=True)
     @patch('lighter.light_clightning._handle_error', autospec=True)
     @patch('lighter.light_clightning.command', autospec=True)
-    def test_ListPeers(self, mocked_command, mocked_handle):
+    def test_ListPeers(self, mocked_command, mocked_handle, mocked_cache):
         listpeers = 'listpeers'
-        listnodes = 'listnodes'
+        nodes = mocked_cache.return_value.get_nodes
+        nodes.return_value = {
+            fix.LISTPEERS['peers'][1]['id']: ('lighter', '#3399ff')}
         # Correct case
-        mocked_command.side_effect = [fix.LISTPEERS, fix.LISTNODES]
+        mocked_command.return_value = fix.LISTPEERS
         res = MOD.ListPeers('request', CTX)
-        self.assertEqual(mocked_command.call_count, 2)
+        mocked_command.assert_called_once_with(CTX, listpeers)
         mocked_handle.assert_called_once_with(
             CTX, fix.LISTPEERS, always_abort=False)
+        mocked_cache.assert_called_once_with(MOD._load_nodes, MOD._lookup_node)
+        nodes.assert_called_once_with(CTX, [fix.LISTPEERS['peers'][1]['id']])
         self.assertEqual(res.peers[0].pubkey, fix.LISTPEERS['peers'][1]['id'])
         self.assertEqual(res.peers[0].alias, 'lighter')
+        self.assertEqual(res.peers[0].color, '#3399ff')
         self.assertEqual(res.peers[0].address, '54.236.55.50:9735')
         # No peers case
         reset_mocks(vars())
-        mocked_command.side_effect = [fix.LISTPEERS_EMPTY, fix.LISTNODES]
+        mocked_command.return_value = fix.LISTPEERS_EMPTY
         res = MOD.ListPeers('request', CTX)
         mocked_command.assert_called_once_with(CTX, listpeers)
         mocked_handle.assert_called_once_with(
             CTX, fix.LISTPEERS_EMPTY, always_abort=False)
+        assert not nodes.called
         self.assertEqual(res, pb.ListPeersResponse())
         # Error case
         reset_mocks(vars())
-        mocked_command.side_effect = [fix.BADRESPONSE, fix.LISTNODES]
+        mocked_command.return_value = fix.BADRESPONSE
         res = MOD.ListPeers('request', CTX)
         mocked_command.assert_called_once_with(CTX, listpeers)
         mocked_handle.assert_called_once_with(
             CTX, fix.BADRESPONSE, always_abort=False)
 
+    @patch('lighter.light_clightning._get_invoice_row', autospec=True)
+    @patch('lighter.light_clightning.get_invoices_store', autospec=True)
     @patch('lighter.light_clightning._handle_error', autospec=True)
     @patch('lighter.light_clightning.command', autospec=True)
     @patch('lighter.light_clightning._create_label', autospec=True)
     @patch('lighter.light_clightning.convert', autospec=True)
     @patch('lighter.light_clightning.Err')
     def test_CreateInvoice(self, mocked_err, mocked_conv, mocked_label,
-                           mocked_command, mocked_handle):
+                           mocked_command, mocked_handle, mocked_store,
+                           mocked_get_row):
         # Correct case
         request = pb.CreateInvoiceRequest(
             amount_bits=7,
@@ -292,6 +543,12 @@ class LightClightningTests(TestCase):
         self.assertEqual(res.payment_hash, fix.INVOICE['payment_hash'])
         self.assertEqual(res.payment_request, fix.INVOICE['bolt11'])
         self.assertEqual(res.expires_at, fix.INVOICE['expires_at'])
+        cl_invoice = dict(
+            fix.INVOICE, label='label', status='unpaid', msatoshi=700000,
+            description='funny')
+        mocked_get_row.assert_called_once_with(CTX, cl_invoice)
+        mocked_store.return_value.save.assert_called_once_with(
+            [mocked_get_row.return_value])
         # Correct case: donation invoice (missing amount_bits)
         reset_mocks(vars())
         request = pb.CreateInvoiceRequest(description='funny')
@@ -355,77 +612,13 @@ class LightClightningTests(TestCase):
             CTX, fix.BADRESPONSE, always_abort=False)
         self.assertEqual(res, 'not set')
 
-    @patch('lighter.light_clightning._get_invoice_state', autospec=True)
-    @patch('lighter.light_clightning._handle_error', autospec=True)
-    @patch('lighter.light_clightning.Err')
-    @patch('lighter.light_clightning.command', autospec=True)
-    @patch('lighter.light_clightning.check_req_params', autospec=True)
-    def test_CheckInvoice(self, mocked_check_par, mocked_command, mocked_err,
-                          mocked_handle, mocked_inv_st):
-        # Correct case: paid invoice
-        request = pb.CheckInvoiceRequest(
-            payment_hash=
-            '302cd6bc8dd20437172f48d8693c7099fd4cb6d08e3f8519b406b21880677b28')
-        mocked_command.return_value = fix.LISTINVOICES
-        mocked_inv_st.return_value = pb.PAID
+    @patch('lighter.light_clightning.check_invoice', autospec=True)
+    def test_CheckInvoice(self, mocked_check):
+        request = pb.CheckInvoiceRequest(payment_hash='hash')
         res = MOD.CheckInvoice(request, CTX)
-        mocked_command.assert_called_once_with(CTX, 'listinvoices')
-        assert not mocked_handle.called
-        assert not mocked_err().invoice_not_found.called
-        self.assertEqual(res.settled, True)
-        self.assertEqual(res.state, pb.PAID)
-        # Correct case: unpaid invoice
-        reset_mocks(vars())
-        mocked_inv_st.return_value = pb.PENDING
-        res = MOD.CheckInvoice(request, CTX)
-        mocked_command.assert_called_once_with(CTX, 'listinvoices')
-        assert not mocked_handle.called
-        assert not mocked_err().invoice_not_found.called
-        self.assertEqual(res.settled, False)
-        self.assertEqual(res.state, pb.PENDING)
-        # Correct case: expired invoice
-        reset_mocks(vars())
-        mocked_inv_st.return_value = pb.EXPIRED
-        res = MOD.CheckInvoice(request, CTX)
-        mocked_command.assert_called_once_with(CTX, 'listinvoices')
-        assert not mocked_handle.called
-        assert not mocked_err().invoice_not_found.called
-        self.assertEqual(res.settled, False)
-        self.assertEqual(res.state, pb.EXPIRED)
-        # Missing parameter case
-        reset_mocks(vars())
-        request = pb.CheckInvoiceRequest()
-        mocked_check_par.side_effect = Exception()
-        with self.assertRaises(Exception):
-            res = MOD.CheckInvoice(request, CTX)
-        assert not mocked_command.called
-        assert not mocked_handle.called
-        assert not mocked_err().invoice_not_found.called
-        # Invoice not found case
-        reset_mocks(vars())
-        mocked_check_par.side_effect = None
-        request = pb.CheckInvoiceRequest(payment_hash='unexistent')
-        mocked_command.return_value = fix.LISTINVOICES
-        mocked_err().invoice_not_found.side_effect = Exception()
-        res = 'not set'
-        with self.assertRaises(Exception):
-            res = MOD.CheckInvoice(request, CTX)
-        mocked_command.assert_called_once_with(CTX, 'listinvoices')
-        mocked_handle.assert_called_once_with(
-            CTX, fix.LISTINVOICES, always_abort=False)
-        mocked_err().invoice_not_found.assert_called_once_with(CTX)
-        self.assertEqual(res, 'not set')
-        # Error case
-        reset_mocks(vars())
-        request = pb.CheckInvoiceRequest(payment_hash='random')
-        mocked_command.return_value = fix.BADRESPONSE
-        mocked_handle.side_effect = Exception()
-        with self.assertRaises(Exception):
-            res = MOD.CheckInvoice(request, CTX)
-        mocked_command.assert_called_once_with(CTX, 'listinvoices')
-        mocked_handle.assert_called_once_with(
-            CTX, fix.BADRESPONSE, always_abort=False)
-        assert not mocked_err().invoice_not_found.called
+        mocked_check.assert_called_once_with(
+            request, CTX, MOD._sync_invoices, MOD._lookup_invoice)
+        self.assertEqual(res, mocked_check.return_value)
 
     @patch('lighter.light_clightning._handle_error', autospec=True)
     @patch('lighter.light_clightning.command', autospec=True)
@@ -521,6 +714,90 @@ class LightClightningTests(TestCase):
             CTX, fix.BADRESPONSE, always_abort=False)
         self.assertEqual(res, 'not set')
 
+    @patch('lighter.light_clightning._get_pay_response', autospec=True)
+    @patch('lighter.light_clightning.async_command', autospec=True)
+    @patch('lighter.light_clightning._get_pay_request', autospec=True)
+    def test_pay_invoice_async(self, mocked_get_req, mocked_command,
+                               mocked_get_res):
+        request = pb.PayInvoiceRequest(payment_request='lntb1')
+        mocked_get_req.return_value = ['pay', 'bolt11="lntb1"']
+        res = run(MOD._pay_invoice_async(request, CTX))
+        mocked_get_req.assert_called_once_with(request, CTX)
+        mocked_command.assert_called_once_with(CTX, 'pay', 'bolt11="lntb1"')
+        mocked_get_res.assert_called_once_with(
+            CTX, mocked_command.return_value)
+        self.assertEqual(res, mocked_get_res.return_value)
+
+    @patch('lighter.light_clightning.pay_in_background', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    @patch('lighter.light_clightning._get_pay_request', autospec=True)
+    def test_PayInvoice_no_wait(self, mocked_get_req, mocked_command,
+                                mocked_pay_bg):
+        request = pb.PayInvoiceRequest(payment_request='lntb1', no_wait=True)
+        mocked_get_req.return_value = ['pay', 'bolt11="lntb1"']
+        res = MOD.PayInvoice(request, CTX)
+        assert not mocked_command.called
+        args = mocked_pay_bg.call_args[0]
+        self.assertEqual(args[:2], (CTX, 'lntb1'))
+        self.assertEqual(args[2].func, MOD._pay)
+        self.assertEqual(args[2].args, (['pay', 'bolt11="lntb1"'],))
+        self.assertEqual(args[3], MOD._check_payment)
+        self.assertEqual(res, mocked_pay_bg.return_value)
+        # Asyncio server mode
+        reset_mocks(vars())
+        res = run(MOD._pay_invoice_async(request, CTX))
+        self.assertEqual(mocked_pay_bg.call_args[0][2].func, MOD._pay)
+        self.assertEqual(res, mocked_pay_bg.return_value)
+
+    @patch('lighter.light_clightning._handle_error', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_pay(self, mocked_command, mocked_handle):
+        mocked_command.return_value = fix.PAY
+        res = MOD._pay(['pay', 'bolt11="lntb1"'], Mock())
+        self.assertEqual(
+            mocked_command.call_args[0][1:], ('pay', 'bolt11="lntb1"'))
+        self.assertEqual(
+            mocked_command.call_args[1],
+            {'timeout': settings.PAY_TIMEOUT, 'pooled': False})
+        self.assertEqual(res, fix.PAY['payment_preimage'])
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        mocked_handle.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            MOD._pay(['pay', 'bolt11="lntb1"'], Mock())
+        # Timeout case, outcome is unknown
+        reset_mocks(vars())
+        mocked_command.side_effect = RuntimeError('[node error] Timeout')
+        res = MOD._pay(['pay', 'bolt11="lntb1"'], Mock())
+        self.assertEqual(res, None)
+        assert not mocked_handle.called
+
+    @patch('lighter.light_clightning._handle_error', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_check_payment(self, mocked_command, mocked_handle):
+        mocked_command.return_value = {'payments': [
+            {'status': 'failed'}, {'status': 'pending'}]}
+        res = MOD._check_payment('hash')
+        self.assertEqual(
+            mocked_command.call_args[0][1:],
+            ('listsendpays', 'payment_hash="hash"'))
+        mocked_handle.assert_called_once_with(
+            ANY, mocked_command.return_value, always_abort=False)
+        self.assertEqual(res, pb.GetPaymentResponse(state=pb.IN_FLIGHT))
+        # Succeeded payment case
+        mocked_command.return_value = {'payments': [
+            {'status': 'failed'},
+            {'status': 'complete', 'payment_preimage': 'pre'}]}
+        res = MOD._check_payment('hash')
+        self.assertEqual(res, pb.GetPaymentResponse(
+            state=pb.SUCCEEDED, payment_preimage='pre'))
+        # Failed payment cases
+        for cl_res in ({'payments': [{'status': 'failed'}]}, {}):
+            mocked_command.return_value = cl_res
+            res = MOD._check_payment('hash')
+            self.assertEqual(res, pb.GetPaymentResponse(state=pb.FAILED))
+
     @patch('lighter.light_clightning._handle_error', autospec=True)
     @patch('lighter.light_clightning.command', autospec=True)
     @patch('lighter.light_clightning.Enf.check_value')
@@ -563,6 +840,48 @@ class LightClightningTests(TestCase):
         mocked_handle.assert_called_once_with(
             CTX, fix.BADRESPONSE, always_abort=False)
 
+    @patch('lighter.light_clightning.stream_invoices', autospec=True)
+    def test_StreamInvoices(self, mocked_stream):
+        request = pb.ListInvoicesRequest(paid=True)
+        res = MOD.StreamInvoices(request, CTX)
+        mocked_stream.assert_called_once_with(
+            request, CTX, MOD._sync_invoices)
+        self.assertEqual(res, mocked_stream.return_value)
+
+    @patch('lighter.light_clightning._get_payments_pages', autospec=True)
+    @patch('lighter.light_clightning._list_payments', autospec=True)
+    def test_StreamPayments(self, mocked_list, mocked_pages):
+        request = pb.ListPaymentsRequest()
+        res = MOD.StreamPayments(request, CTX)
+        mocked_list.assert_called_once_with(CTX)
+        mocked_pages.assert_called_once_with(
+            CTX, request, mocked_list.return_value, settings.STREAM_ITEMS)
+        self.assertEqual(res, mocked_pages.return_value)
+
+    @patch('lighter.light_clightning.get_invoices_hub', autospec=True)
+    def test_SubscribeInvoices(self, mocked_hub):
+        request = pb.SubscribeInvoicesRequest(settle_index=7)
+        res = MOD.SubscribeInvoices(request, CTX)
+        mocked_hub.assert_called_once_with(
+            MOD._list_settled_invoices, MOD._wait_settled_invoices)
+        mocked_hub.return_value.subscribe.assert_called_once_with(CTX, 7)
+        self.assertEqual(res, mocked_hub.return_value.subscribe.return_value)
+
+    @patch('lighter.light_clightning.get_payment', autospec=True)
+    def test_GetPayment(self, mocked_get):
+        request = pb.GetPaymentRequest(payment_hash='hash')
+        res = MOD.GetPayment(request, CTX)
+        mocked_get.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_get.return_value)
+
+    @patch('lighter.light_clightning.track_payment', autospec=True)
+    def test_TrackPayment(self, mocked_track):
+        request = pb.TrackPaymentRequest(payment_hash='hash')
+        res = MOD.TrackPayment(request, CTX)
+        mocked_track.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_track.return_value)
+
+    @patch('lighter.light_clightning.decode_invoice', autospec=True)
     @patch('lighter.light_clightning._handle_error', autospec=True)
     @patch('lighter.light_clightning._add_route_hint', autospec=True)
     @patch('lighter.light_clightning.convert', autospec=True)
@@ -570,7 +889,35 @@ class LightClightningTests(TestCase):
     @patch('lighter.light_clightning.Err')
     @patch('lighter.light_clightning.check_req_params', autospec=True)
     def test_DecodeInvoice(self, mocked_check_par, mocked_err, mocked_command,
-                           mocked_conv, mocked_add, mocked_handle):
+                           mocked_conv, mocked_add, mocked_handle,
+                           mocked_decode):
+        # Locally decoded case
+        request = pb.DecodeInvoiceRequest(payment_request='lntb77u1s')
+        res = MOD.DecodeInvoice(request, CTX)
+        mocked_check_par.assert_called_once_with(
+            CTX, request, 'payment_request')
+        mocked_decode.assert_called_once_with(CTX, request)
+        self.assertEqual(res, mocked_decode.return_value)
+        assert not mocked_command.called
+        # Description hash without description case
+        reset_mocks(vars())
+        mocked_decode.return_value = pb.DecodeInvoiceResponse(
+            description_hash='hash')
+        mocked_err().missing_parameter.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD.DecodeInvoice(request, CTX)
+        mocked_err().missing_parameter.assert_called_once_with(
+            CTX, 'description')
+        mocked_err().missing_parameter.side_effect = None
+        # Description hash with description case
+        reset_mocks(vars())
+        request.description = 'd'
+        res = MOD.DecodeInvoice(request, CTX)
+        self.assertEqual(res, mocked_decode.return_value)
+        request.description = ''
+        # Not locally decodable cases
+        reset_mocks(vars())
+        mocked_decode.return_value = None
         # Correct case: simple description, fallback and routes
         request = pb.DecodeInvoiceRequest(
             payment_request='lntb77u1s', description='funny')
@@ -717,39 +1064,38 @@ class LightClightningTests(TestCase):
     @patch('lighter.light_clightning.Err')
     @patch('lighter.light_clightning._handle_error', autospec=True)
     @patch('lighter.light_clightning.get_thread_timeout', autospec=True)
-    @patch('lighter.light_clightning.ThreadPoolExecutor', autospec=True)
+    @patch('lighter.light_clightning.get_jobs', autospec=True)
     @patch('lighter.light_clightning.get_node_timeout', autospec=True)
     @patch('lighter.light_clightning.check_req_params', autospec=True)
     def test_CloseChannel(self, mocked_check_par, mocked_get_time,
-                          mocked_thread, mocked_thread_time, mocked_handle,
+                          mocked_jobs, mocked_thread_time, mocked_handle,
                           mocked_err):
         mocked_err().report_error.side_effect = Exception()
         mocked_thread_time.return_value = 2
         mocked_get_time.return_value = 30
         # Unilateral close
         future = Mock()
-        executor = Mock()
-        future.result.return_value = fix.CLOSE_FORCED
-        executor.submit.return_value = future
-        mocked_thread.return_value = executor
+        future.result.return_value = fix.CLOSE_FORCED['txid']
+        mocked_jobs.return_value.submit.return_value = ('job', future)
         request = pb.CloseChannelRequest(channel_id='777', force=True)
         res = MOD.CloseChannel(request, CTX)
         mocked_check_par.assert_called_once_with(CTX, request, 'channel_id')
+        mocked_jobs.return_value.submit.assert_called_once_with(
+            CTX, 'close', MOD._close_channel,
+            ['close', 'id="777"', 'unilateraltimeout=1'], 30)
+        future.result.assert_called_once_with(timeout=2)
         self.assertEqual(res.closing_txid, fix.CLOSE_FORCED['txid'])
         # Mutual close
         reset_mocks(vars())
-        future.result.return_value = fix.CLOSE_MUTUAL
-        executor.submit.return_value = future
-        mocked_thread.return_value = executor
+        future.result.return_value = fix.CLOSE_MUTUAL['txid']
         request = pb.CloseChannelRequest(channel_id='777')
         res = MOD.CloseChannel(request, CTX)
         self.assertEqual(res.closing_txid, fix.CLOSE_MUTUAL['txid'])
-        # Result times out
+        # Result times out, job ID is returned
         reset_mocks(vars())
         future.result.side_effect = TimeoutFutError()
         res = MOD.CloseChannel(request, CTX)
-        executor.shutdown.assert_called_once_with(wait=False)
-        self.assertEqual(res, pb.CloseChannelResponse())
+        self.assertEqual(res, pb.CloseChannelResponse(job_id='job'))
         # Result throws RuntimeError
         reset_mocks(vars())
         future.result.side_effect = RuntimeError(fix.BADRESPONSE)
@@ -771,7 +1117,7 @@ class LightClightningTests(TestCase):
         response = pb.ListChannelsResponse()
         cl_peer = fix.LISTPEERS['peers'][0]
         cl_chan = cl_peer['channels'][0]
-        res = MOD._add_channel(CTX, response, cl_peer, cl_chan, pb.OPEN, False)
+        res = MOD._add_channel(CTX, response, cl_peer, cl_chan, pb.OPEN)
         self.assertEqual(mocked_conv.call_count, 2)
         self.assertEqual(res, None)
         self.assertEqual(res, None)
@@ -783,13 +1129,126 @@ class LightClightningTests(TestCase):
         self.assertEqual(response.channels[0].capacity, 1.0)
         self.assertEqual(response.channels[0].local_balance, 1.0)
         self.assertEqual(response.channels[0].remote_balance, 0.0)
-        # Skip add of inactive channel case
+        # Inactive channel case
         reset_mocks(vars())
         response = pb.ListChannelsResponse()
         res = MOD._add_channel(
             CTX, response, cl_peer, fix.CHANNEL_AWAITING_LOCKIN,
-            pb.PENDING_OPEN, True)
-        self.assertEqual(response, pb.ListChannelsResponse())
+            pb.PENDING_OPEN)
+        self.assertEqual(response.channels[0].active, False)
+
+    @patch('lighter.light_clightning.get_channels_mirror', autospec=True)
+    def test_get_channels_mirror(self, mocked_get_mirror):
+        res = MOD._get_channels_mirror()
+        mocked_get_mirror.assert_called_once_with(MOD._list_channels)
+        self.assertEqual(res, mocked_get_mirror.return_value)
+
+    @patch('lighter.light_clightning._handle_error', autospec=True)
+    @patch('lighter.light_clightning._add_channel', autospec=True)
+    @patch('lighter.light_clightning._get_channel_state', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_list_channels(self, mocked_command, mocked_state, mocked_add,
+                           mocked_handle):
+        api = 'listpeers'
+        # Correct case
+        mocked_command.return_value = fix.LISTPEERS
+        mocked_state.return_value = pb.OPEN
+        mocked_add.side_effect = \
+            lambda _ctx, res, _peer, _chan, state: res.channels.add(
+                state=state)
+        res = MOD._list_channels(CTX)
+        mocked_command.assert_called_once_with(CTX, api)
+        assert mocked_add.called
+        self.assertEqual(res[0].state, pb.OPEN)
+        mocked_handle.assert_called_once_with(
+            CTX, fix.LISTPEERS, always_abort=False)
+        # No channels case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.LISTPEERS_EMPTY
+        res = MOD._list_channels(CTX)
+        mocked_command.assert_called_once_with(CTX, api)
+        assert not mocked_add.called
+        mocked_handle.assert_called_once_with(
+            CTX, fix.LISTPEERS_EMPTY, always_abort=False)
+        self.assertEqual(len(res), 0)
+        # Negative state case (closed channel)
+        reset_mocks(vars())
+        mocked_command.return_value = fix.LISTPEERS
+        mocked_state.return_value = -1
+        res = MOD._list_channels(CTX)
+        mocked_command.assert_called_once_with(CTX, api)
+        assert not mocked_add.called
+        mocked_handle.assert_called_once_with(
+            CTX, fix.LISTPEERS, always_abort=False)
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        res = MOD._list_channels(CTX)
+        mocked_command.assert_called_once_with(CTX, api)
+        assert not mocked_add.called
+        mocked_handle.assert_called_once_with(
+            CTX, fix.BADRESPONSE, always_abort=False)
+
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_load_nodes(self, mocked_command):
+        mocked_command.return_value = fix.LISTNODES
+        res = MOD._load_nodes(CTX)
+        mocked_command.assert_called_once_with(CTX, 'listnodes')
+        self.assertEqual(res, {
+            fix.LISTNODES['nodes'][0]['nodeid']: ('lighter', '#3399ff')})
+        # Error case
+        mocked_command.return_value = fix.BADRESPONSE
+        res = MOD._load_nodes(CTX)
+        self.assertEqual(res, None)
+
+    @patch('lighter.light_clightning._handle_error', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_lookup_node(self, mocked_command, mocked_handle):
+        pubkey = fix.LISTNODES['nodes'][0]['nodeid']
+        mocked_command.return_value = fix.LISTNODES
+        res = MOD._lookup_node(CTX, pubkey)
+        mocked_command.assert_called_once_with(
+            CTX, 'listnodes', 'id="{}"'.format(pubkey))
+        mocked_handle.assert_called_once_with(
+            CTX, fix.LISTNODES, always_abort=False)
+        self.assertEqual(res, ('lighter', '#3399ff'))
+        # Unknown node case
+        mocked_command.return_value = {'nodes': []}
+        res = MOD._lookup_node(CTX, pubkey)
+        self.assertEqual(res, None)
+
+    @patch('lighter.light_clightning._handle_error', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_list_payments(self, mocked_command, mocked_handle):
+        mocked_command.return_value = fix.PAYMENTS
+        res = MOD._list_payments(CTX)
+        mocked_command.assert_called_once_with(CTX, 'listsendpays')
+        mocked_handle.assert_called_once_with(
+            CTX, fix.PAYMENTS, always_abort=False)
+        self.assertEqual(res, fix.PAYMENTS['payments'][:-1])
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        res = MOD._list_payments(CTX)
+        mocked_handle.assert_called_once_with(
+            CTX, fix.BADRESPONSE, always_abort=False)
+        self.assertEqual(res, [])
+
+    @patch('lighter.light_clightning._add_payment', autospec=True)
+    def test_get_payments_pages(self, mocked_add):
+        cl_payments = list(reversed(fix.PAYMENTS['payments'][:-1]))
+        request = pb.ListPaymentsRequest()
+        pages = list(MOD._get_payments_pages(CTX, request, cl_payments, 2))
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(
+            [args[0][2]['id'] for args in mocked_add.call_args_list],
+            [1, 2, 3])
+        # Cursor case
+        reset_mocks(vars())
+        request.cursor = pages[0].next_cursor
+        pages = list(MOD._get_payments_pages(CTX, request, cl_payments, 2))
+        self.assertEqual(pages[0].next_cursor, '')
+        mocked_add.assert_called_once_with(CTX, pages[0], cl_payments[0])
 
     @patch('lighter.light_clightning.convert', autospec=True)
     def test_add_payment(self, mocked_conv):
@@ -839,6 +1298,13 @@ class LightClightningTests(TestCase):
         self.assertEqual(
             response.route_hints[0].hop_hints[1].cltv_expiry_delta, 4)
 
+    @patch('lighter.light_clightning.get_close_status', autospec=True)
+    def test_GetCloseStatus(self, mocked_get):
+        request = pb.GetCloseStatusRequest(job_id='job')
+        res = MOD.GetCloseStatus(request, CTX)
+        mocked_get.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_get.return_value)
+
     @patch('lighter.light_clightning.LOGGER', autospec=True)
     @patch('lighter.light_clightning.command', autospec=True)
     def test_close_channel(self, mocked_command, mocked_log):
@@ -848,7 +1314,7 @@ class LightClightningTests(TestCase):
         mocked_command.return_value = fix.CLOSE_MUTUAL
         res = MOD._close_channel(cl_req, node_timeout)
         assert mocked_log.debug.called
-        self.assertEqual(res, fix.CLOSE_MUTUAL)
+        self.assertEqual(res, fix.CLOSE_MUTUAL['txid'])
         # Error response case
         reset_mocks(vars())
         mocked_command.return_value = fix.BADRESPONSE
@@ -891,6 +1357,140 @@ class LightClightningTests(TestCase):
         res = MOD._get_channel_state(fix.CHANNEL_UNKNOWN)
         self.assertEqual(res, pb.UNKNOWN)
 
+    @patch('lighter.light_clightning._get_invoice', autospec=True)
+    def test_get_invoice_row(self, mocked_get_inv):
+        mocked_get_inv.return_value = pb.Invoice(
+            payment_hash='hash', state=pb.PENDING)
+        cl_invoice = {'payment_hash': 'hash', 'label': 'lbl',
+                      'status': 'unpaid', 'expires_at': 1530111450}
+        res = MOD._get_invoice_row(CTX, cl_invoice)
+        mocked_get_inv.assert_called_once_with(CTX, cl_invoice)
+        self.assertEqual(res['status'], pb.PENDING)
+        self.assertEqual(res['expires_at'], 1530111450)
+        self.assertEqual(res['node_key'], 'lbl')
+        # Paid invoice case
+        mocked_get_inv.return_value = pb.Invoice(
+            payment_hash='hash', state=pb.PAID)
+        res = MOD._get_invoice_row(CTX, dict(cl_invoice, status='paid'))
+        self.assertEqual(res['status'], pb.PAID)
+
+    @patch('lighter.light_clightning._handle_error', autospec=True)
+    @patch('lighter.light_clightning._get_invoice_row', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_sync_invoices(self, mocked_command, mocked_get_row,
+                           mocked_handle):
+        store = Mock()
+        mocked_get_row.side_effect = lambda _ctx, inv: inv['label']
+        mocked_command.return_value = {'invoices': [
+            {'payment_hash': 'a', 'label': 'a'}, {'label': 'b'}]}
+        MOD._sync_invoices(CTX, store)
+        mocked_command.assert_called_once_with(CTX, 'listinvoices')
+        store.save.assert_called_once_with(['a'])
+        assert not mocked_handle.called
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        mocked_handle.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD._sync_invoices(CTX, store)
+        assert not store.save.called
+
+    @patch('lighter.light_clightning._get_invoice_row', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    @patch('lighter.light_clightning.get_invoices_store', autospec=True)
+    def test_lookup_invoice(self, mocked_store, mocked_command,
+                            mocked_get_row):
+        inv = fix.LISTINVOICES['invoices'][1]
+        mocked_store.return_value.get_node_key.return_value = 'lbl'
+        mocked_command.return_value = {'invoices': [inv]}
+        res = MOD._lookup_invoice(CTX, inv['payment_hash'])
+        mocked_store.return_value.get_node_key.assert_called_once_with(
+            inv['payment_hash'])
+        mocked_command.assert_called_once_with(
+            CTX, 'listinvoices', 'label="lbl"')
+        mocked_get_row.assert_called_once_with(CTX, inv)
+        self.assertEqual(res, mocked_get_row.return_value)
+        # Invoice not found by label case
+        reset_mocks(vars())
+        mocked_command.return_value = {'invoices': []}
+        res = MOD._lookup_invoice(CTX, inv['payment_hash'])
+        self.assertEqual(res, None)
+        # Unknown label case
+        reset_mocks(vars())
+        mocked_store.return_value.get_node_key.return_value = None
+        res = MOD._lookup_invoice(CTX, inv['payment_hash'])
+        assert not mocked_command.called
+        self.assertEqual(res, None)
+
+    @patch('lighter.light_clightning.convert', autospec=True)
+    def test_get_invoice(self, mocked_conv):
+        mocked_conv.return_value = 7
+        cl_invoice = {
+            'payment_hash': 'hash', 'status': 'paid', 'msatoshi': 700,
+            'description': 'desc', 'bolt11': 'lntb7',
+            'msatoshi_received': 700}
+        res = MOD._get_invoice(CTX, cl_invoice)
+        self.assertEqual(res.payment_hash, 'hash')
+        self.assertEqual(res.state, pb.PAID)
+        self.assertEqual(res.amount_bits, 7)
+        self.assertEqual(res.amount_received_bits, 7)
+        self.assertEqual(res.description, 'desc')
+        self.assertEqual(res.payment_request, 'lntb7')
+        self.assertEqual(res.timestamp, 0)
+        # Creation time read from payment request case
+        res = MOD._get_invoice(CTX, fix.INVOICE)
+        self.assertEqual(res.timestamp, 1533232508)
+        self.assertEqual(
+            res.expiry_time, fix.INVOICE['expires_at'] - res.timestamp)
+
+    @patch('lighter.light_clightning._handle_error', autospec=True)
+    @patch('lighter.light_clightning._get_invoice', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_list_settled_invoices(self, mocked_command, mocked_get_inv,
+                                   mocked_handle):
+        mocked_get_inv.side_effect = lambda _ctx, inv: inv['label']
+        mocked_command.return_value = {'invoices': [
+            {'payment_hash': 'a', 'label': 'a', 'pay_index': 3},
+            {'payment_hash': 'b', 'label': 'b'},
+            {'payment_hash': 'c', 'label': 'c', 'pay_index': 1},
+            {'payment_hash': 'd', 'label': 'd', 'pay_index': 2}]}
+        res = MOD._list_settled_invoices(CTX, 1)
+        mocked_command.assert_called_once_with(CTX, 'listinvoices')
+        self.assertEqual(res, [(2, 'd'), (3, 'a')])
+        assert not mocked_handle.called
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        mocked_handle.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD._list_settled_invoices(CTX, 1)
+
+    @patch('lighter.light_clightning._list_settled_invoices', autospec=True)
+    @patch('lighter.light_clightning._get_invoice', autospec=True)
+    @patch('lighter.light_clightning.command', autospec=True)
+    def test_wait_settled_invoices(self, mocked_command, mocked_get_inv,
+                                   mocked_list):
+        mocked_get_inv.side_effect = lambda _ctx, inv: inv['label']
+        mocked_list.return_value = [(1, 'a'), (4, 'b')]
+        mocked_command.side_effect = [
+            RuntimeError('[node error] Timeout'),
+            {'payment_hash': 'c', 'label': 'c', 'pay_index': 5}]
+        stream = MOD._wait_settled_invoices(None)
+        self.assertEqual(next(stream), (5, 'c'))
+        self.assertEqual(mocked_command.call_count, 2)
+        self.assertEqual(
+            mocked_command.call_args[0][1:], ('waitanyinvoice',
+                                              'lastpay_index=4'))
+        # Resuming case, with node error
+        reset_mocks(vars())
+        mocked_command.side_effect = RuntimeError('[node error] Broken')
+        with self.assertRaises(RuntimeError):
+            next(MOD._wait_settled_invoices(5))
+        assert not mocked_list.called
+        self.assertEqual(
+            mocked_command.call_args[0][1:], ('waitanyinvoice',
+                                              'lastpay_index=5'))
+
     def test_get_invoice_state(self):
         # Correct case: paid invoice
         invoice = fix.LISTINVOICES['invoices'][1]
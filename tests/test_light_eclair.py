@@ -14,15 +14,20 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Tests for light_eclair module """
 
+import socket
+
+from asyncio import run, sleep as sleep_async, start_server
 from concurrent.futures import TimeoutError as TimeoutFutError
+from http.client import HTTPException
 from importlib import import_module
 from unittest import TestCase
-from unittest.mock import call, Mock, patch
+from unittest.mock import ANY, call, Mock, patch
 
 from lighter import lighter_pb2 as pb
 from lighter import settings
+from lighter.invoices import invoice_row
 from lighter.utils import Enforcer as Enf
-from tests import fixtures_eclair as fix
+from tests import CoroutineMock, fixtures_eclair as fix
 
 MOD = import_module('lighter.light_eclair')
 CTX = 'context'
@@ -31,9 +36,9 @@ CTX = 'context'
 class LightEclairTests(TestCase):
     """ Tests for light_eclair module """
 
-    @patch('lighter.light_eclair.FileInput', autospec=True)
-    @patch('lighter.light_eclair.path', autospec=True)
-    def test_update_settings(self, mocked_path, mocked_finput):
+    @patch('lighter.light_eclair.HttpPool', autospec=True)
+    @patch('lighter.light_eclair.disconnect', autospec=True)
+    def test_update_settings(self, mocked_disconnect, mocked_pool):
         password = b'password'
         # Correct case
         reset_mocks(vars())
@@ -41,16 +46,319 @@ class LightEclairTests(TestCase):
             'ECL_HOST': 'eclair',
             'ECL_PORT': '8080',
         }
-        ecl_cli_path = '/srv/app/lighter/eclair-cli'
-        mocked_path.abspath.return_value = ecl_cli_path
-        mocked_finput.return_value.__enter__.return_value = \
-            ['api_host', 'api_password=asd']
         with patch.dict('os.environ', values):
             MOD.update_settings(password)
-        self.assertEqual(
-            settings.CMD_BASE,
-            [ecl_cli_path, '-a', '{}:{}'.format(
-                values['ECL_HOST'], values['ECL_PORT'])])
+        mocked_disconnect.assert_called_once_with()
+        mocked_pool.assert_called_once_with(
+            'eclair', 8080, 'password', settings.ECL_POOL_SIZE)
+        self.assertEqual(settings.ECL_POOL, mocked_pool.return_value)
+
+    @patch('lighter.light_eclair.get_nodes_cache', autospec=True)
+    def test_on_connect(self, mocked_cache):
+        MOD.on_connect()
+        mocked_cache.assert_called_once_with(
+            MOD._load_nodes, MOD._lookup_node)
+        mocked_cache.return_value.start.assert_called_once_with()
+
+    def test_disconnect(self):
+        pool = Mock()
+        settings.ECL_POOL = pool
+        MOD.disconnect()
+        pool.close.assert_called_once_with()
+        self.assertEqual(settings.ECL_POOL, None)
+        # No pool
+        MOD.disconnect()
+        self.assertEqual(settings.ECL_POOL, None)
+
+    @patch('lighter.light_eclair.report_node_success', autospec=True)
+    @patch('lighter.light_eclair.report_node_failure', autospec=True)
+    @patch('lighter.light_eclair.timed_node_call', autospec=True)
+    @patch('lighter.light_eclair.LOGGER', autospec=True)
+    @patch('lighter.light_eclair.Err')
+    @patch('lighter.light_eclair.get_node_timeout', autospec=True)
+    def test_command(self, mocked_timeout, mocked_err, mocked_log,
+                     mocked_timed, mocked_failure, mocked_success):
+        mocked_err().node_error.side_effect = Exception()
+        mocked_timeout.return_value = 7
+        pool = Mock()
+        settings.ECL_POOL = pool
+        # JSON case
+        pool.call.return_value = b'{"nodeId": "abc"}'
+        res = MOD.command(CTX, 'getinfo')
+        pool.call.assert_called_once_with('getinfo', [], 7)
+        self.assertEqual(res, {'nodeId': 'abc'})
+        mocked_timed.assert_called_once_with('getinfo')
+        mocked_success.assert_called_once_with()
+        assert not mocked_failure.called
+        # Text case
+        reset_mocks(vars())
+        pool.call.return_value = b'invalid payment request'
+        res = MOD.command(CTX, 'parseinvoice', '--invoice="lntb1"', timeout=3)
+        pool.call.assert_called_once_with(
+            'parseinvoice', [('invoice', 'lntb1')], 3)
+        self.assertEqual(res, 'invalid payment request')
+        # Empty case
+        reset_mocks(vars())
+        pool.call.return_value = b''
+        res = MOD.command(CTX, 'getinfo')
+        self.assertEqual(res, '')
+        assert mocked_log.debug.called
+        # Timeout case
+        reset_mocks(vars())
+        pool.call.side_effect = socket.timeout()
+        with self.assertRaises(Exception):
+            MOD.command(CTX, 'getinfo')
+        mocked_err().node_error.assert_called_once_with(CTX, 'Timeout')
+        # Connection error case
+        reset_mocks(vars())
+        pool.call.side_effect = ConnectionRefusedError(111, 'Refused')
+        with self.assertRaises(Exception):
+            MOD.command(CTX, 'getinfo')
+        mocked_err().node_error.assert_called_once_with(
+            CTX, 'Connecting to eclair: Refused')
+        mocked_failure.assert_called_once_with(
+            'Connecting to eclair: Refused')
+        assert not mocked_success.called
+        # Not configured case
+        reset_mocks(vars())
+        settings.ECL_POOL = None
+        with self.assertRaises(RuntimeError):
+            MOD.command(CTX, 'getinfo')
+
+    @patch('lighter.light_eclair.Err')
+    @patch('lighter.light_eclair.get_node_timeout', autospec=True)
+    def test_async_command(self, mocked_timeout, mocked_err):
+        mocked_err().node_error.side_effect = Exception()
+        mocked_timeout.return_value = 7
+        pool = Mock()
+        pool.async_call = CoroutineMock(return_value=b'{"a": 1}')
+        settings.ECL_POOL = pool
+        res = run(MOD.async_command(CTX, 'getsentinfo', '--id="abc"'))
+        pool.async_call.assert_called_once_with(
+            'getsentinfo', [('id', 'abc')])
+        self.assertEqual(res, {'a': 1})
+        # Timeout case
+        reset_mocks(vars())
+
+        async def slow_call(*_args):
+            await sleep_async(1)
+
+        pool.async_call = slow_call
+        with self.assertRaises(Exception):
+            run(MOD.async_command(CTX, 'getinfo', timeout=0.01))
+        mocked_err().node_error.assert_called_once_with(CTX, 'Timeout')
+        # Connection error case
+        reset_mocks(vars())
+        pool.async_call = CoroutineMock(side_effect=ConnectionRefusedError())
+        with self.assertRaises(Exception):
+            run(MOD.async_command(CTX, 'getinfo'))
+        assert mocked_err().node_error.called
+        # Not configured case
+        settings.ECL_POOL = None
+        with self.assertRaises(RuntimeError):
+            run(MOD.async_command(CTX, 'getinfo'))
+
+    @patch('lighter.light_eclair.LOGGER', autospec=True)
+    def test_get_result(self, mocked_log):
+        res = MOD._get_result(b'{"a": 1}')
+        self.assertEqual(res, {'a': 1})
+        res = MOD._get_result(b'not json')
+        self.assertEqual(res, 'not json')
+        assert not mocked_log.debug.called
+        res = MOD._get_result(b'')
+        self.assertEqual(res, '')
+        assert mocked_log.debug.called
+
+    def test_get_form(self):
+        args = ['--description="a b"', '--uri=id@host:9735', '--empty=""',
+                '--eq="a=b"']
+        res = MOD._get_form(args)
+        self.assertEqual(res, [
+            ('description', 'a b'), ('uri', 'id@host:9735'), ('empty', ''),
+            ('eq', 'a=b')])
+
+    @patch('lighter.light_eclair._is_readable', autospec=True)
+    @patch('lighter.light_eclair.HTTPConnection', autospec=True)
+    def test_HttpPool(self, mocked_conn, mocked_readable):
+        mocked_readable.return_value = False
+        conn = mocked_conn.return_value
+        conn.sock = None
+
+        def _connect(*_args):
+            conn.sock = conn.sock or Mock()
+
+        conn.request.side_effect = _connect
+        response = conn.getresponse.return_value
+        response.will_close = False
+        response.status = 200
+        pool = MOD.HttpPool('eclair', 8080, 'pass', 1)
+        headers = {
+            'Authorization': 'Basic OnBhc3M=',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        # New connection case, body read in chunks
+        response.read.side_effect = [b'{"a"', b': 1}', b'']
+        res = pool.call('getinfo', [('k', 'v w')], 5)
+        mocked_conn.assert_called_once_with('eclair', 8080, timeout=5)
+        conn.request.assert_called_once_with(
+            'POST', '/getinfo', 'k=v+w', headers)
+        self.assertEqual(res, b'{"a": 1}')
+        assert not conn.close.called
+        # Idle connection reused, closed by server after response
+        reset_mocks(vars())
+        conn.sock = Mock()
+        response.read.side_effect = [b'ok', b'']
+        response.will_close = True
+        res = pool.call('close', [], 5)
+        assert not mocked_conn.called
+        conn.close.assert_called_once_with()
+        self.assertEqual(res, b'ok')
+        response.will_close = False
+        # Idle connection closed before sending, request retried once
+        reset_mocks(vars())
+        conn.sock = Mock()
+        response.read.side_effect = [b'ok', b'']
+        conn.request.side_effect = [BrokenPipeError(), None]
+        res = pool.call('channels', [], 5)
+        self.assertEqual(conn.request.call_count, 2)
+        self.assertEqual(res, b'ok')
+        conn.request.side_effect = _connect
+        # Connection reset after sending, not retried
+        reset_mocks(vars())
+        conn.sock = Mock()
+        conn.getresponse.side_effect = ConnectionResetError()
+        with self.assertRaises(ConnectionResetError):
+            pool.call('payinvoice', [], 5)
+        self.assertEqual(conn.request.call_count, 1)
+        conn.close.assert_called_once_with()
+        conn.getresponse.side_effect = None
+        # Idle connection closed by eclair, discarded
+        response.read.side_effect = [b'']
+        pool.call('getinfo', [], 5)
+        reset_mocks(vars())
+        mocked_readable.return_value = True
+        response.read.side_effect = [b'']
+        pool.call('getinfo', [], 5)
+        conn.close.assert_called_once_with()
+        mocked_conn.assert_called_once_with('eclair', 8080, timeout=5)
+        mocked_readable.return_value = False
+        # Connection idle for too long, discarded
+        reset_mocks(vars())
+        pool._idle.get_nowait()
+        response.read.side_effect = [b'']
+        with patch('lighter.light_eclair.time', autospec=True) as mocked_time:
+            mocked_time.return_value = 100
+            pool._idle.put((conn, 100 - settings.ECL_POOL_IDLE_TIME))
+            pool.call('getinfo', [], 5)
+        conn.close.assert_called_once_with()
+        mocked_conn.assert_called_once_with('eclair', 8080, timeout=5)
+        pool._idle.get_nowait()
+        # Failure on a new connection, not retried
+        reset_mocks(vars())
+        conn.sock = None
+        conn.request.side_effect = ConnectionRefusedError()
+        with self.assertRaises(ConnectionRefusedError):
+            pool.call('getinfo', [], 5)
+        self.assertEqual(conn.request.call_count, 1)
+        conn.close.assert_called_once_with()
+        conn.request.side_effect = _connect
+        # Pool exhausted
+        reset_mocks(vars())
+        pool._slots.acquire()
+        with self.assertRaises(socket.timeout):
+            pool.call('getinfo', [], 0.01)
+        assert not conn.request.called
+        pool._slots.release()
+        # Close
+        response.read.side_effect = [b'']
+        pool.call('getinfo', [], 5)
+        reset_mocks(vars())
+        pool.close()
+        conn.close.assert_called_once_with()
+
+    def test_HttpPool_async_call(self):
+        requests = []
+
+        async def handle(reader, writer):
+            head = await reader.readuntil(b'\r\n\r\n')
+            body = await reader.read(6)
+            requests.append((head, body))
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 8\r\n\r\n'
+                         b'{"a": 1}')
+            writer.close()
+
+        async def call():
+            node = await start_server(handle, '127.0.0.1', 0)
+            async with node:
+                port = node.sockets[0].getsockname()[1]
+                pool = MOD.HttpPool('127.0.0.1', port, 'pass', 1)
+                return await pool.async_call('getinfo', [('id', 'a b')])
+
+        res = run(call())
+        self.assertEqual(res, b'{"a": 1}')
+        head, body = requests[0]
+        self.assertEqual(body, b'id=a+b')
+        self.assertIn(b'POST /getinfo HTTP/1.0\r\n', head)
+        self.assertIn(b'Content-Length: 6\r\n', head)
+        self.assertIn(b'Authorization: Basic OnBhc3M=\r\n', head)
+        # Incomplete response case
+
+        async def handle_bad(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\n')
+            writer.close()
+
+        async def call_bad():
+            node = await start_server(handle_bad, '127.0.0.1', 0)
+            async with node:
+                port = node.sockets[0].getsockname()[1]
+                pool = MOD.HttpPool('127.0.0.1', port, 'pass', 1)
+                return await pool.async_call('getinfo', [])
+
+        with self.assertRaises(HTTPException):
+            run(call_bad())
+        # Error status with no body case
+
+        async def handle_error(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\n\r\n')
+            writer.close()
+
+        async def call_error():
+            node = await start_server(handle_error, '127.0.0.1', 0)
+            async with node:
+                port = node.sockets[0].getsockname()[1]
+                pool = MOD.HttpPool('127.0.0.1', port, 'pass', 1)
+                return await pool.async_call('getinfo', [])
+
+        with self.assertRaisesRegex(HTTPException, '503 Service Unavailable'):
+            run(call_error())
+
+    def test_check_body(self):
+        self.assertEqual(MOD._check_body(200, 'OK', b'{}'), b'{}')
+        self.assertEqual(MOD._check_body(200, 'OK', b''), b'')
+        # Error reported in the body case
+        res = MOD._check_body(400, 'Bad Request', b'{"error": "e"}')
+        self.assertEqual(res, b'{"error": "e"}')
+        # Error status with no body case
+        with self.assertRaises(HTTPException):
+            MOD._check_body(500, 'Internal Server Error', b'\n')
+
+    def test_is_readable(self):
+        sock, peer = socket.socketpair()
+        with sock, peer:
+            self.assertFalse(MOD._is_readable(sock))
+            peer.close()
+            self.assertTrue(MOD._is_readable(sock))
+        # Closed socket case
+        self.assertTrue(MOD._is_readable(sock))
+
+    @patch('lighter.light_eclair.time', autospec=True)
+    def test_remaining(self, mocked_time):
+        mocked_time.return_value = 10
+        self.assertEqual(MOD._remaining(12), 2)
+        with self.assertRaises(socket.timeout):
+            MOD._remaining(10)
 
     @patch('lighter.light_eclair._handle_error', autospec=True)
     @patch('lighter.light_eclair.command', autospec=True)
@@ -60,7 +368,7 @@ class LightEclairTests(TestCase):
         reset_mocks(vars())
         mocked_command.return_value = fix.GETINFO_MAINNET
         res = MOD.GetInfo('request', CTX)
-        mocked_command.assert_called_once_with(CTX, cmd, env=settings.ECL_ENV)
+        mocked_command.assert_called_once_with(CTX, cmd)
         mocked_handle.assert_called_once_with(
             CTX, fix.GETINFO_MAINNET, always_abort=False)
         self.assertEqual(res.network, 'mainnet')
@@ -68,7 +376,7 @@ class LightEclairTests(TestCase):
         reset_mocks(vars())
         mocked_command.return_value = fix.GETINFO_UNKNOWN
         res = MOD.GetInfo('request', CTX)
-        mocked_command.assert_called_once_with(CTX, cmd, env=settings.ECL_ENV)
+        mocked_command.assert_called_once_with(CTX, cmd)
         mocked_handle.assert_called_once_with(
             CTX, fix.GETINFO_UNKNOWN, always_abort=False)
         self.assertEqual(res.network, 'regtest')
@@ -76,7 +384,7 @@ class LightEclairTests(TestCase):
         reset_mocks(vars())
         mocked_command.return_value = fix.GETINFO_TESTNET
         res = MOD.GetInfo('request', CTX)
-        mocked_command.assert_called_once_with(CTX, cmd, env=settings.ECL_ENV)
+        mocked_command.assert_called_once_with(CTX, cmd)
         self.assertEqual(res.network, 'testnet')
         self.assertEqual(res.identity_pubkey, fix.GETINFO_TESTNET['nodeId'])
         self.assertEqual(res.alias, fix.GETINFO_TESTNET['alias'])
@@ -85,7 +393,7 @@ class LightEclairTests(TestCase):
         reset_mocks(vars())
         mocked_command.return_value = fix.STRANGERESPONSE
         res = MOD.GetInfo('request', CTX)
-        mocked_command.assert_called_once_with(CTX, cmd, env=settings.ECL_ENV)
+        mocked_command.assert_called_once_with(CTX, cmd)
         mocked_handle.assert_called_once_with(
             CTX, fix.STRANGERESPONSE, always_abort=False)
         self.assertEqual(res, pb.GetInfoResponse())
@@ -96,80 +404,73 @@ class LightEclairTests(TestCase):
         res = 'not set'
         with self.assertRaises(Exception):
             res = MOD.GetInfo('request', CTX)
-        mocked_command.assert_called_once_with(CTX, cmd, env=settings.ECL_ENV)
+        mocked_command.assert_called_once_with(CTX, cmd)
         mocked_handle.assert_called_once_with(
             CTX, fix.BADRESPONSE, always_abort=False)
         self.assertEqual(res, 'not set')
 
-    @patch('lighter.light_eclair.get_channel_balances', autospec=True)
-    @patch('lighter.light_eclair.ListChannels', autospec=True)
-    def test_ChannelBalance(self, mocked_ListChannels, mocked_get_chan_bal):
-        mocked_get_chan_bal.return_value = pb.ChannelBalanceResponse()
+    @patch('lighter.light_eclair._get_channels_mirror', autospec=True)
+    def test_ChannelBalance(self, mocked_mirror):
         res = MOD.ChannelBalance('request', CTX)
-        self.assertEqual(res, pb.ChannelBalanceResponse())
+        mirror = mocked_mirror.return_value
+        mirror.channel_balance.assert_called_once_with(CTX)
+        self.assertEqual(res, mirror.channel_balance.return_value)
 
+    @patch('lighter.light_eclair.get_nodes_cache', autospec=True)
     @patch('lighter.light_eclair._handle_error', autospec=True)
     @patch('lighter.light_eclair.command', autospec=True)
-    def test_ListPeers(self, mocked_command, mocked_handle):
+    def test_ListPeers(self, mocked_command, mocked_handle, mocked_cache):
         peers = 'peers'
-        allnodes = 'allnodes'
-        mocked_command.side_effect = fix.PEERS, fix.ALLNODES
+        nodes = mocked_cache.return_value.get_nodes
+        nodes.return_value = {
+            fix.PEERS[0]['nodeId']: ('cosmicApotheosis', '#33cccc')}
+        mocked_command.return_value = fix.PEERS
         res = MOD.ListPeers('request', CTX)
-        calls = [
-            call(CTX, peers, env=settings.ECL_ENV),
-            call(CTX, allnodes, env=settings.ECL_ENV)
-        ]
-        mocked_command.assert_has_calls(calls)
+        mocked_command.assert_called_once_with(CTX, peers)
         mocked_handle.assert_called_once_with(
             CTX, fix.PEERS, always_abort=False)
+        mocked_cache.assert_called_once_with(MOD._load_nodes, MOD._lookup_node)
+        nodes.assert_called_once_with(
+            CTX, [peer['nodeId'] for peer in fix.PEERS
+                  if peer['state'] != 'DISCONNECTED'])
+        self.assertEqual(len(res.peers), 3)
         self.assertEqual(res.peers[0].pubkey, fix.PEERS[0]['nodeId'])
+        self.assertEqual(res.peers[0].alias, 'cosmicApotheosis')
+        self.assertEqual(res.peers[0].color, '#33cccc')
+        self.assertEqual(res.peers[1].alias, '')
         # Empty case
         reset_mocks(vars())
-        mocked_command.side_effect = [[], fix.ALLNODES]
+        mocked_command.return_value = []
         res = MOD.ListPeers('request', CTX)
-        calls = [
-            call(CTX, peers, env=settings.ECL_ENV),
-            call(CTX, allnodes, env=settings.ECL_ENV)
-        ]
-        mocked_command.assert_has_calls(calls)
+        mocked_command.assert_called_once_with(CTX, peers)
         mocked_handle.assert_called_once_with(CTX, [], always_abort=False)
+        assert not nodes.called
         self.assertEqual(res, pb.ListPeersResponse())
 
-    @patch('lighter.light_eclair._handle_error', autospec=True)
-    @patch('lighter.light_eclair._add_channel', autospec=True)
-    @patch('lighter.light_eclair.command', autospec=True)
-    def test_ListChannels(self, mocked_command, mocked_add, mocked_handle):
-        cmd = 'channels'
-        # List all channels
-        reset_mocks(vars())
-        mocked_command.return_value = fix.CHANNELS
-        request = pb.ListChannelsRequest(active_only=False)
+    @patch('lighter.light_eclair._get_channels_mirror', autospec=True)
+    def test_ListChannels(self, mocked_mirror):
+        request = pb.ListChannelsRequest(active_only=True)
         res = MOD.ListChannels(request, CTX)
-        mocked_command.assert_called_once_with(CTX, cmd, env=settings.ECL_ENV)
-        calls = [
-            call(CTX, pb.ListChannelsResponse(), fix.CHANNEL_NORMAL, False),
-            call(CTX, pb.ListChannelsResponse(), fix.CHANNEL_WAITING_FUNDING,
-                 False)]
-        mocked_add.assert_has_calls(calls)
-        mocked_handle.assert_called_once_with(
-            CTX, fix.CHANNELS, always_abort=False)
-        self.assertEqual(res, pb.ListChannelsResponse())
-        # Error case
-        reset_mocks(vars())
-        mocked_command.return_value = 'badresponse'
-        mocked_handle.side_effect = Exception()
-        with self.assertRaises(Exception):
-            res = MOD.ListChannels('request', CTX)
-        mocked_command.assert_called_once_with(
-            CTX, cmd, env=settings.ECL_ENV)
-        assert not mocked_add.called
+        mirror = mocked_mirror.return_value
+        mirror.list_channels.assert_called_once_with(CTX, True)
+        self.assertEqual(res, mirror.list_channels.return_value)
 
+    @patch('lighter.light_eclair.list_invoices', autospec=True)
+    def test_ListInvoices(self, mocked_list):
+        request = pb.ListInvoicesRequest(paid=True)
+        res = MOD.ListInvoices(request, CTX)
+        mocked_list.assert_called_once_with(
+            request, CTX, MOD._sync_invoices)
+        self.assertEqual(res, mocked_list.return_value)
+
+    @patch('lighter.light_eclair._get_invoice_row', autospec=True)
+    @patch('lighter.light_eclair.get_invoices_store', autospec=True)
     @patch('lighter.light_eclair._handle_error', autospec=True)
     @patch('lighter.light_eclair.command', autospec=True)
     @patch('lighter.light_eclair.convert', autospec=True)
     @patch('lighter.light_eclair.Err')
     def test_CreateInvoice(self, mocked_err, mocked_conv, mocked_command,
-                           mocked_handle):
+                           mocked_handle, mocked_store, mocked_get_row):
         cmd = 'createinvoice'
         mocked_handle.side_effect = Exception()
         pay_req = fix.CREATEINVOICE['serialized']
@@ -188,11 +489,14 @@ class LightEclairTests(TestCase):
             CTX, Enf.MSATS, request.amount_bits, enforce=Enf.LN_PAYREQ)
         mocked_command.assert_called_once_with(
             CTX, cmd, '--description="d"', '--amountMsat="777"',
-            '--expireIn="3000"', '--fallbackAddress="f"', env=settings.ECL_ENV)
+            '--expireIn="3000"', '--fallbackAddress="f"')
         assert not mocked_handle.called
         self.assertEqual(res.payment_request, pay_req)
         self.assertEqual(res.payment_hash, pay_hash)
         self.assertEqual(res.expires_at, expiry_time)
+        mocked_get_row.assert_called_once_with(CTX, fix.CREATEINVOICE)
+        mocked_store.return_value.save.assert_called_once_with(
+            [mocked_get_row.return_value])
         # Empty request case
         reset_mocks(vars())
         request = pb.CreateInvoiceRequest()
@@ -201,8 +505,7 @@ class LightEclairTests(TestCase):
         assert not mocked_err().unsettable.called
         mocked_command.assert_called_once_with(
             CTX, cmd, '--description=""',
-            '--expireIn="{}"'.format(settings.EXPIRY_TIME),
-            env=settings.ECL_ENV)
+            '--expireIn="{}"'.format(settings.EXPIRY_TIME))
         assert not mocked_handle.called
         self.assertEqual(res.payment_request, pay_req)
         self.assertEqual(res.payment_hash, pay_hash)
@@ -226,42 +529,13 @@ class LightEclairTests(TestCase):
         assert not mocked_command.called
         assert not mocked_handle.called
 
-    @patch('lighter.light_eclair.Err')
-    @patch('lighter.light_eclair._get_invoice_state', autospec=True)
-    @patch('lighter.light_eclair.command', autospec=True)
-    @patch('lighter.light_eclair.check_req_params', autospec=True)
-    def test_CheckInvoice(self, mocked_check_par, mocked_command,
-                          mocked_inv_st, mocked_err):
-        cmd = 'getreceivedinfo'
-        # Correct case
-        mocked_inv_st.return_value = pb.PAID
-        request = pb.CheckInvoiceRequest(payment_hash='random')
-        mocked_command.return_value = fix.GETRECEIVEDINFO_PAID
+    @patch('lighter.light_eclair.check_invoice', autospec=True)
+    def test_CheckInvoice(self, mocked_check):
+        request = pb.CheckInvoiceRequest(payment_hash='hash')
         res = MOD.CheckInvoice(request, CTX)
-        mocked_command.assert_called_once_with(
-            CTX, cmd, '--paymentHash="random"', env=settings.ECL_ENV)
-        assert not mocked_err().invalid.called
-        self.assertEqual(res.state, pb.PAID)
-        self.assertEqual(res.settled, True)
-        # Missing parameter case
-        reset_mocks(vars())
-        request = pb.CheckInvoiceRequest()
-        mocked_check_par.side_effect = Exception()
-        with self.assertRaises(Exception):
-            MOD.CheckInvoice(request, CTX)
-        # Error case
-        reset_mocks(vars())
-        mocked_check_par.side_effect = None
-        request = pb.CheckInvoiceRequest(payment_hash='incorrect')
-        mocked_command.return_value = 'Error'
-        mocked_err().invalid.side_effect = Exception()
-        res = 'not set'
-        with self.assertRaises(Exception):
-            res = MOD.CheckInvoice(request, CTX)
-        mocked_command.assert_called_once_with(
-            CTX, cmd, '--paymentHash="incorrect"', env=settings.ECL_ENV)
-        mocked_err().invalid.assert_called_once_with(CTX, 'payment_hash')
-        self.assertEqual(res, 'not set')
+        mocked_check.assert_called_once_with(
+            request, CTX, MOD._sync_invoices, MOD._lookup_invoice)
+        self.assertEqual(res, mocked_check.return_value)
 
     @patch('lighter.light_eclair._handle_error', autospec=True)
     @patch('lighter.light_eclair.command', autospec=True)
@@ -285,10 +559,8 @@ class LightEclairTests(TestCase):
         mocked_conv.assert_called_once_with(
             CTX, Enf.MSATS, request.amount_bits, enforce=Enf.LN_TX)
         calls = [
-            call(CTX, cmd, '--invoice="random"', '--amountMsat="777"',
-                 env=settings.ECL_ENV),
-            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE),
-                 env=settings.ECL_ENV)
+            call(CTX, cmd, '--invoice="random"', '--amountMsat="777"'),
+            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE))
         ]
         mocked_command.assert_has_calls(calls)
         assert not mocked_handle.called
@@ -304,9 +576,8 @@ class LightEclairTests(TestCase):
         assert not mocked_err().unsettable.called
         assert not mocked_conv.called
         calls = [
-            call(CTX, cmd, '--invoice="random"', env=settings.ECL_ENV),
-            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE),
-                 env=settings.ECL_ENV)
+            call(CTX, cmd, '--invoice="random"'),
+            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE))
         ]
         mocked_command.assert_has_calls(calls)
         assert not mocked_handle.called
@@ -374,8 +645,7 @@ class LightEclairTests(TestCase):
         assert not mocked_err().unsettable.called
         assert not mocked_conv.called
         mocked_command.assert_called_once_with(
-            CTX, cmd, '--invoice="{}"'.format(request.payment_request),
-            env=settings.ECL_ENV)
+            CTX, cmd, '--invoice="{}"'.format(request.payment_request))
         mocked_err().invalid.assert_called_once_with(CTX, 'payment_request')
         assert not mocked_handle.called
         # Failed case
@@ -388,9 +658,8 @@ class LightEclairTests(TestCase):
         assert not mocked_err().unsettable.called
         assert not mocked_conv.called
         calls = [
-            call(CTX, cmd, '--invoice="random"', env=settings.ECL_ENV),
-            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE),
-                 env=settings.ECL_ENV)
+            call(CTX, cmd, '--invoice="random"'),
+            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE))
         ]
         mocked_command.assert_has_calls(calls)
         assert not mocked_handle.called
@@ -404,9 +673,8 @@ class LightEclairTests(TestCase):
         assert not mocked_err().unsettable.called
         assert not mocked_conv.called
         calls = [
-            call(CTX, cmd, '--invoice="random"', env=settings.ECL_ENV),
-            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE),
-                 env=settings.ECL_ENV)
+            call(CTX, cmd, '--invoice="random"'),
+            call(CTX, cmd2, '--id="{}"'.format(fix.PAYINVOICE))
         ]
         mocked_command.assert_has_calls(calls)
         assert not mocked_handle.called
@@ -425,6 +693,161 @@ class LightEclairTests(TestCase):
         mocked_handle.assert_called_once_with(
             CTX, fix.STRANGERESPONSE, always_abort=True)
 
+    @patch('lighter.light_eclair._get_pay_response', autospec=True)
+    @patch('lighter.light_eclair.async_command', autospec=True)
+    @patch('lighter.light_eclair.Err')
+    @patch('lighter.light_eclair._get_pay_request', autospec=True)
+    def test_pay_invoice_async(self, mocked_get_req, mocked_err,
+                               mocked_command, mocked_get_res):
+        request = pb.PayInvoiceRequest(payment_request='lntb1')
+        mocked_get_req.return_value = ['payinvoice', '--invoice="lntb1"']
+        mocked_command.side_effect = ['id\n', fix.GETSENTINFO_SUCCESS]
+        res = run(MOD._pay_invoice_async(request, CTX))
+        mocked_get_req.assert_called_once_with(request, CTX)
+        mocked_command.assert_called_with(CTX, 'getsentinfo', '--id="id"')
+        mocked_get_res.assert_called_once_with(
+            CTX, fix.GETSENTINFO_SUCCESS)
+        self.assertEqual(res, mocked_get_res.return_value)
+        # Malformed invoice case
+        reset_mocks(vars())
+        mocked_err().invalid.side_effect = Exception()
+        mocked_command.side_effect = ['malformed invoice']
+        with self.assertRaises(Exception):
+            run(MOD._pay_invoice_async(request, CTX))
+        mocked_err().invalid.assert_called_once_with(CTX, 'payment_request')
+
+    @patch('lighter.light_eclair.pay_in_background', autospec=True)
+    @patch('lighter.light_eclair.async_command', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    @patch('lighter.light_eclair._get_pay_request', autospec=True)
+    def test_PayInvoice_no_wait(self, mocked_get_req, mocked_command,
+                                mocked_async_command, mocked_pay_bg):
+        request = pb.PayInvoiceRequest(payment_request='lntb1', no_wait=True)
+        mocked_get_req.return_value = ['payinvoice', '--invoice="lntb1"']
+        mocked_command.return_value = 'id\n'
+        res = MOD.PayInvoice(request, CTX)
+        mocked_command.assert_called_once_with(
+            CTX, 'payinvoice', '--invoice="lntb1"')
+        args = mocked_pay_bg.call_args[0]
+        self.assertEqual(args[:2], (CTX, 'lntb1'))
+        self.assertEqual(args[2].func, MOD._wait_payment)
+        self.assertEqual(args[2].args, (['getsentinfo', '--id="id"'],))
+        self.assertEqual(args[3].func, MOD._check_payment)
+        self.assertEqual(args[3].args, (['getsentinfo', '--id="id"'],))
+        self.assertEqual(res, mocked_pay_bg.return_value)
+        # Asyncio server mode
+        reset_mocks(vars())
+        mocked_async_command.return_value = 'id\n'
+        res = run(MOD._pay_invoice_async(request, CTX))
+        mocked_async_command.assert_called_once_with(
+            CTX, 'payinvoice', '--invoice="lntb1"')
+        self.assertEqual(
+            mocked_pay_bg.call_args[0][2].args,
+            (['getsentinfo', '--id="id"'],))
+        self.assertEqual(res, mocked_pay_bg.return_value)
+
+    @patch('lighter.light_eclair.sleep', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_wait_payment(self, mocked_command, mocked_sleep):
+        ecl_req = ['getsentinfo', '--id="id"']
+        update = Mock()
+        settings.ECL_POLL_TIME = 0.5
+        mocked_command.side_effect = [
+            [], fix.GETSENTINFO_PENDING, fix.GETSENTINFO_PENDING,
+            fix.GETSENTINFO_SUCCESS]
+        res = MOD._wait_payment(ecl_req, update)
+        self.assertEqual(mocked_command.call_count, 4)
+        self.assertEqual(
+            mocked_command.call_args[0][1:], ('getsentinfo', '--id="id"'))
+        self.assertEqual(
+            mocked_sleep.call_args_list,
+            [call(settings.ECL_PAY_POLL_TIME),
+             call(settings.ECL_PAY_POLL_TIME * 2), call(0.5)])
+        update.assert_called_with(1)
+        self.assertEqual(res, fix.GETSENTINFO_SUCCESS[0]['preimage'])
+        settings.ECL_POLL_TIME = 3
+        # Failed payment case
+        reset_mocks(vars())
+        mocked_command.side_effect = None
+        mocked_command.return_value = fix.GETSENTINFO_FAIL
+        with self.assertRaises(RuntimeError):
+            MOD._wait_payment(ecl_req, update)
+        assert not mocked_sleep.called
+        # Still pending after PAY_TIMEOUT case, outcome is unknown
+        reset_mocks(vars())
+        settings.PAY_TIMEOUT = 0
+        mocked_command.return_value = []
+        self.assertEqual(MOD._wait_payment(ecl_req, update), None)
+        mocked_command.return_value = fix.GETSENTINFO_PENDING
+        self.assertEqual(MOD._wait_payment(ecl_req, update), None)
+        assert not mocked_sleep.called
+        settings.PAY_TIMEOUT = 600
+        # Unreachable node case
+        reset_mocks(vars())
+        mocked_command.side_effect = RuntimeError('Timeout')
+        self.assertEqual(MOD._wait_payment(ecl_req, update), None)
+
+    @patch('lighter.light_eclair._handle_error', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_check_payment(self, mocked_command, mocked_handle):
+        ecl_req = ['getsentinfo', '--id="id"']
+        mocked_command.return_value = fix.GETSENTINFO_PENDING
+        res = MOD._check_payment(ecl_req, 'hash')
+        self.assertEqual(
+            mocked_command.call_args[0][1:], ('getsentinfo', '--id="id"'))
+        self.assertEqual(res, pb.GetPaymentResponse(state=pb.IN_FLIGHT))
+        # Succeeded payment case
+        mocked_command.return_value = fix.GETSENTINFO_SUCCESS
+        res = MOD._check_payment(ecl_req, 'hash')
+        self.assertEqual(res, pb.GetPaymentResponse(
+            state=pb.SUCCEEDED,
+            payment_preimage=fix.GETSENTINFO_SUCCESS[0]['preimage']))
+        # Failed payment cases
+        for ecl_res in (fix.GETSENTINFO_FAIL, []):
+            mocked_command.return_value = ecl_res
+            res = MOD._check_payment(ecl_req, 'hash')
+            self.assertEqual(res, pb.GetPaymentResponse(state=pb.FAILED))
+        assert not mocked_handle.called
+        # Error case
+        mocked_command.return_value = fix.BADRESPONSE
+        mocked_handle.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            MOD._check_payment(ecl_req, 'hash')
+        mocked_handle.assert_called_once_with(
+            ANY, fix.BADRESPONSE, always_abort=True)
+
+    @patch('lighter.light_eclair.stream_invoices', autospec=True)
+    def test_StreamInvoices(self, mocked_stream):
+        request = pb.ListInvoicesRequest(paid=True)
+        res = MOD.StreamInvoices(request, CTX)
+        mocked_stream.assert_called_once_with(
+            request, CTX, MOD._sync_invoices)
+        self.assertEqual(res, mocked_stream.return_value)
+
+    @patch('lighter.light_eclair.get_invoices_hub', autospec=True)
+    def test_SubscribeInvoices(self, mocked_hub):
+        request = pb.SubscribeInvoicesRequest(settle_index=7)
+        res = MOD.SubscribeInvoices(request, CTX)
+        mocked_hub.assert_called_once_with(
+            MOD._list_settled_invoices, MOD._wait_settled_invoices)
+        mocked_hub.return_value.subscribe.assert_called_once_with(CTX, 7)
+        self.assertEqual(res, mocked_hub.return_value.subscribe.return_value)
+
+    @patch('lighter.light_eclair.get_payment', autospec=True)
+    def test_GetPayment(self, mocked_get):
+        request = pb.GetPaymentRequest(payment_hash='hash')
+        res = MOD.GetPayment(request, CTX)
+        mocked_get.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_get.return_value)
+
+    @patch('lighter.light_eclair.track_payment', autospec=True)
+    def test_TrackPayment(self, mocked_track):
+        request = pb.TrackPaymentRequest(payment_hash='hash')
+        res = MOD.TrackPayment(request, CTX)
+        mocked_track.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_track.return_value)
+
+    @patch('lighter.light_eclair.decode_invoice', autospec=True)
     @patch('lighter.light_eclair._handle_error', autospec=True)
     @patch('lighter.light_eclair._is_description_hash', autospec=True)
     @patch('lighter.light_eclair.convert', autospec=True)
@@ -432,7 +855,19 @@ class LightEclairTests(TestCase):
     @patch('lighter.light_eclair.Err')
     @patch('lighter.light_eclair.check_req_params', autospec=True)
     def test_DecodeInvoice(self, mocked_check_par, mocked_err, mocked_command,
-                           mocked_conv, mocked_d_hash, mocked_handle):
+                           mocked_conv, mocked_d_hash, mocked_handle,
+                           mocked_decode):
+        # Locally decoded case
+        request = pb.DecodeInvoiceRequest(payment_request='random')
+        res = MOD.DecodeInvoice(request, CTX)
+        mocked_check_par.assert_called_once_with(
+            CTX, request, 'payment_request')
+        mocked_decode.assert_called_once_with(CTX, request)
+        self.assertEqual(res, mocked_decode.return_value)
+        assert not mocked_command.called
+        # Not locally decodable cases
+        reset_mocks(vars())
+        mocked_decode.return_value = None
         cmd = 'parseinvoice'
         # Correct case: with description hash
         request = pb.DecodeInvoiceRequest(payment_request='random')
@@ -441,7 +876,7 @@ class LightEclairTests(TestCase):
         mocked_d_hash.return_value = True
         res = MOD.DecodeInvoice(request, CTX)
         mocked_command.assert_called_once_with(
-            CTX, cmd, '--invoice="random"', env=settings.ECL_ENV)
+            CTX, cmd, '--invoice="random"')
         assert not mocked_err().invoice_incorrect.called
         assert mocked_conv.called
         assert not mocked_handle.called
@@ -464,7 +899,7 @@ class LightEclairTests(TestCase):
         mocked_conv.return_value = 20000
         res = MOD.DecodeInvoice(request, CTX)
         mocked_command.assert_called_once_with(
-            CTX, cmd, '--invoice="random"', env=settings.ECL_ENV)
+            CTX, cmd, '--invoice="random"')
         assert not mocked_err().invoice_incorrect.called
         mocked_conv.assert_called_once_with(CTX, Enf.MSATS,
                                             fix.PARSEINVOICE['amount'])
@@ -496,7 +931,7 @@ class LightEclairTests(TestCase):
         with self.assertRaises(Exception):
             res = MOD.DecodeInvoice(request, CTX)
         mocked_command.assert_called_once_with(
-            CTX, cmd, '--invoice="random"', env=settings.ECL_ENV)
+            CTX, cmd, '--invoice="random"')
         mocked_err().invalid.assert_called_once_with(CTX, 'payment_request')
         assert not mocked_conv.called
         assert not mocked_handle.called
@@ -509,7 +944,7 @@ class LightEclairTests(TestCase):
         with self.assertRaises(Exception):
             res = MOD.DecodeInvoice(request, CTX)
             mocked_command.assert_called_once_with(
-                CTX, cmd, '--invoice="something"', env=settings.ECL_ENV)
+                CTX, cmd, '--invoice="something"')
         assert not mocked_conv.called
         mocked_handle.assert_called_once_with(
             CTX, fix.ERROR, always_abort=True)
@@ -579,9 +1014,9 @@ class LightEclairTests(TestCase):
     @patch('lighter.light_eclair._handle_error', autospec=True)
     @patch('lighter.light_eclair.get_thread_timeout', autospec=True)
     @patch('lighter.light_eclair.get_node_timeout', autospec=True)
-    @patch('lighter.light_eclair.ThreadPoolExecutor', autospec=True)
+    @patch('lighter.light_eclair.get_jobs', autospec=True)
     @patch('lighter.light_eclair.check_req_params', autospec=True)
-    def test_CloseChannel(self, mocked_check_par, mocked_thread,
+    def test_CloseChannel(self, mocked_check_par, mocked_jobs,
                           mocked_get_time, mocked_thread_time,
                           mocked_handle, mocked_err):
         mocked_err().report_error.side_effect = Exception()
@@ -590,22 +1025,22 @@ class LightEclairTests(TestCase):
         txid = 'txid'
         # Correct case
         future = Mock()
-        executor = Mock()
         future.result.return_value = txid
-        executor.submit.return_value = future
-        mocked_thread.return_value = executor
+        mocked_jobs.return_value.submit.return_value = ('job', future)
         request = pb.CloseChannelRequest(channel_id='777', force=True)
         ctx = Mock()
         ctx.time_remaining.return_value = 10
         res = MOD.CloseChannel(request, ctx)
         self.assertEqual(res.closing_txid, txid)
         mocked_check_par.assert_called_once_with(ctx, request, 'channel_id')
-        # Result times out
+        mocked_jobs.return_value.submit.assert_called_once_with(
+            ctx, 'close', MOD._close_channel,
+            ['forceclose', '--channelId="777"'], 30)
+        # Result times out, job ID is returned
         reset_mocks(vars())
         future.result.side_effect = TimeoutFutError()
         res = MOD.CloseChannel(request, ctx)
-        executor.shutdown.assert_called_once_with(wait=False)
-        self.assertEqual(res, pb.CloseChannelResponse())
+        self.assertEqual(res, pb.CloseChannelResponse(job_id='job'))
         # Result throws RuntimeError
         reset_mocks(vars())
         future.result.side_effect = RuntimeError(fix.BADRESPONSE)
@@ -621,6 +1056,74 @@ class LightEclairTests(TestCase):
         mocked_err().report_error.assert_called_once_with(ctx, err)
         future.result.side_effect = None
 
+    @patch('lighter.light_eclair.get_channels_mirror', autospec=True)
+    def test_get_channels_mirror(self, mocked_get_mirror):
+        res = MOD._get_channels_mirror()
+        mocked_get_mirror.assert_called_once_with(MOD._list_channels)
+        self.assertEqual(res, mocked_get_mirror.return_value)
+
+    @patch('lighter.light_eclair._handle_error', autospec=True)
+    @patch('lighter.light_eclair._add_channel', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_list_channels(self, mocked_command, mocked_add, mocked_handle):
+        cmd = 'channels'
+        # List all channels
+        reset_mocks(vars())
+        mocked_command.return_value = fix.CHANNELS
+        res = MOD._list_channels(CTX)
+        mocked_command.assert_called_once_with(CTX, cmd)
+        calls = [
+            call(CTX, pb.ListChannelsResponse(), fix.CHANNEL_NORMAL),
+            call(CTX, pb.ListChannelsResponse(), fix.CHANNEL_WAITING_FUNDING)]
+        mocked_add.assert_has_calls(calls)
+        assert not mocked_handle.called
+        self.assertEqual(len(res), 0)
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = 'badresponse'
+        mocked_handle.side_effect = Exception()
+        with self.assertRaises(Exception):
+            res = MOD._list_channels(CTX)
+        mocked_command.assert_called_once_with(
+            CTX, cmd)
+        assert not mocked_add.called
+
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_load_nodes(self, mocked_command):
+        mocked_command.return_value = fix.ALLNODES
+        res = MOD._load_nodes(CTX)
+        mocked_command.assert_called_once_with(CTX, 'allnodes')
+        self.assertEqual(
+            res[fix.ALLNODES[0]['nodeId']], ('cosmicApotheosis', '#33cccc'))
+        self.assertEqual(len(res), len(fix.ALLNODES))
+        # Error case
+        mocked_command.return_value = fix.BADRESPONSE
+        res = MOD._load_nodes(CTX)
+        self.assertEqual(res, None)
+
+    @patch('lighter.light_eclair._handle_error', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_lookup_node(self, mocked_command, mocked_handle):
+        pubkey = fix.ALLNODES[0]['nodeId']
+        mocked_command.return_value = fix.ALLNODES[:1]
+        res = MOD._lookup_node(CTX, pubkey)
+        mocked_command.assert_called_once_with(
+            CTX, 'nodes', '--nodeIds={}'.format(pubkey))
+        assert not mocked_handle.called
+        self.assertEqual(res, ('cosmicApotheosis', '#33cccc'))
+        # Unknown node case
+        mocked_command.return_value = []
+        res = MOD._lookup_node(CTX, pubkey)
+        self.assertEqual(res, None)
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        mocked_handle.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD._lookup_node(CTX, pubkey)
+        mocked_handle.assert_called_once_with(
+            CTX, fix.BADRESPONSE, always_abort=True)
+
     def test_def(self):
         """
         This method is so simple that it will not be mocked in other tests
@@ -650,7 +1153,7 @@ class LightEclairTests(TestCase):
         response = pb.ListChannelsResponse()
         mocked_conv.side_effect = [0, 20000]
         mocked_state.return_value = pb.OPEN
-        res = MOD._add_channel(CTX, response, fix.CHANNEL_NORMAL, False)
+        res = MOD._add_channel(CTX, response, fix.CHANNEL_NORMAL)
         calls = [
             call(CTX, Enf.MSATS, 50000000),
             call(CTX, Enf.MSATS, 150000000)
@@ -671,14 +1174,21 @@ class LightEclairTests(TestCase):
         reset_mocks(vars())
         response = pb.ListChannelsResponse()
         mocked_state.return_value = -1
-        res = MOD._add_channel(CTX, response, fix.CHANNEL_NORMAL, False)
+        res = MOD._add_channel(CTX, response, fix.CHANNEL_NORMAL)
         self.assertEqual(response, pb.ListChannelsResponse())
-        # Skip add of inactive channel case
+        # Inactive channel case
         reset_mocks(vars())
         response = pb.ListChannelsResponse()
         mocked_state.return_value = pb.OPEN
-        res = MOD._add_channel(CTX, response, fix.CHANNEL_OFFLINE, True)
-        self.assertEqual(response, pb.ListChannelsResponse())
+        res = MOD._add_channel(CTX, response, fix.CHANNEL_OFFLINE)
+        self.assertEqual(response.channels[0].active, False)
+
+    @patch('lighter.light_eclair.get_close_status', autospec=True)
+    def test_GetCloseStatus(self, mocked_get):
+        request = pb.GetCloseStatusRequest(job_id='job')
+        res = MOD.GetCloseStatus(request, CTX)
+        mocked_get.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_get.return_value)
 
     @patch('lighter.light_eclair.sleep', autospec=True)
     @patch('lighter.light_eclair.LOGGER', autospec=True)
@@ -686,13 +1196,13 @@ class LightEclairTests(TestCase):
     @patch('lighter.light_eclair.time', autospec=True)
     def test_close_channel(self, mocked_time, mocked_command, mocked_log,
                            mocked_sleep):
-        client_time = 1
+        close_timeout = 3
         time = 1563205664.6555452
         mocked_time.return_value = time
         ecl_req = ['close', '--channelId=aa7cc']
         # Correct case
         mocked_command.side_effect = [fix.CLOSE, fix.CHANNEL_MUTUAL]
-        res = MOD._close_channel(ecl_req, client_time, time + 3)
+        res = MOD._close_channel(ecl_req, close_timeout)
         assert mocked_log.debug.called
         self.assertEqual(
             res, fix.CHANNEL_MUTUAL['data']['mutualClosePublished'][0]['txid'])
@@ -701,7 +1211,7 @@ class LightEclairTests(TestCase):
         mocked_command.side_effect = None
         mocked_command.return_value = fix.BADRESPONSE
         with self.assertRaises(RuntimeError):
-            res = MOD._close_channel(ecl_req, client_time, time + 3)
+            res = MOD._close_channel(ecl_req, close_timeout)
             self.assertEqual(res, None)
         assert mocked_log.debug.called
         # RuntimeError case
@@ -709,20 +1219,208 @@ class LightEclairTests(TestCase):
         err = 'err'
         mocked_command.side_effect = RuntimeError(err)
         with self.assertRaises(RuntimeError):
-            res = MOD._close_channel(ecl_req, client_time, time + 3)
+            res = MOD._close_channel(ecl_req, close_timeout)
             self.assertEqual(res, None)
         assert mocked_log.debug.called
         # No data field in first response from channel call
         reset_mocks(vars())
         mocked_command.side_effect = [fix.CLOSE, fix.ERROR,
                                       fix.CHANNEL_UNILATERAL]
-        res = MOD._close_channel(ecl_req, client_time, time + 3)
+        res = MOD._close_channel(ecl_req, close_timeout)
         assert mocked_sleep.called
         self.assertEqual(mocked_command.call_count, 3)
         self.assertEqual(
             res, fix.CHANNEL_UNILATERAL['data']['localCommitPublished']\
                 ['commitTx']['txid'])
 
+    @patch('lighter.light_eclair.command', autospec=True)
+    @patch('lighter.light_eclair.convert', autospec=True)
+    def test_get_invoice(self, mocked_conv, mocked_command):
+        mocked_conv.side_effect = lambda _ctx, _enf, amt: amt // 100
+        mocked_command.return_value = {
+            'serialized': 'lntb7', 'amount': 700, 'timestamp': 1,
+            'expiry': 3600, 'description': 'desc'}
+        ecl_payment = {'paymentHash': 'hash', 'parts': [
+            {'amount': 300, 'timestamp': 5}, {'amount': 400, 'timestamp': 6}]}
+        res = MOD._get_invoice(CTX, ecl_payment)
+        mocked_command.assert_called_once_with(
+            CTX, 'getinvoice', '--paymentHash="hash"')
+        self.assertEqual(res.payment_hash, 'hash')
+        self.assertEqual(res.state, pb.PAID)
+        self.assertEqual(res.amount_received_bits, 7)
+        self.assertEqual(res.amount_bits, 7)
+        self.assertEqual(res.payment_request, 'lntb7')
+        self.assertEqual(res.expiry_time, 3600)
+        self.assertEqual(res.description, 'desc')
+
+    @patch('lighter.light_eclair.convert', autospec=True)
+    def test_get_invoice_row(self, mocked_conv):
+        mocked_conv.side_effect = lambda _ctx, _enf, amt: amt
+        ecl_info = fix.GETRECEIVEDINFO_PAID
+        res = MOD._get_invoice_row(
+            CTX, ecl_info['paymentRequest'], ecl_info['status'])
+        invoice = pb.Invoice.FromString(res['data'])
+        self.assertEqual(res['status'], pb.PAID)
+        self.assertEqual(
+            res['expires_at'], ecl_info['paymentRequest']['timestamp'] +
+            ecl_info['paymentRequest']['expiry'])
+        self.assertEqual(
+            invoice.payment_hash, ecl_info['paymentRequest']['paymentHash'])
+        self.assertEqual(
+            invoice.amount_received_bits, ecl_info['status']['amount'])
+        self.assertEqual(
+            invoice.payment_request, ecl_info['paymentRequest']['serialized'])
+        # Invoice with unknown status case
+        res = MOD._get_invoice_row(CTX, fix.CREATEINVOICE)
+        self.assertEqual(res['status'], pb.PENDING)
+        # Expired invoice case
+        ecl_info = fix.GETRECEIVEDINFO_EXPIRED
+        res = MOD._get_invoice_row(
+            CTX, ecl_info['paymentRequest'], ecl_info['status'])
+        self.assertEqual(res['status'], pb.EXPIRED)
+
+    @patch('lighter.light_eclair._handle_error', autospec=True)
+    @patch('lighter.light_eclair._get_invoice', autospec=True)
+    @patch('lighter.light_eclair._list_received', autospec=True)
+    @patch('lighter.light_eclair._get_invoice_row', autospec=True)
+    @patch('lighter.light_eclair.convert', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_sync_invoices(self, mocked_command, mocked_conv, mocked_get_row,
+                           mocked_list, mocked_get_inv, mocked_handle):
+        mocked_conv.side_effect = lambda _ctx, _enf, amt: amt // 100
+        store = Mock()
+        store.cursor.side_effect = lambda name: {
+            'created': 1557768000, 'received': 1573485250000}[name]
+        store.set_paid.return_value = {'known'}
+        mocked_command.return_value = [fix.CREATEINVOICE]
+        known = {'paymentHash': 'known', 'amount': 500}
+        unknown = {'paymentHash': 'hash', 'amount': 700}
+        mocked_list.return_value = [
+            (1573485250000, known), (1573485250454, unknown)]
+        paid = pb.Invoice(payment_hash='hash', state=pb.PAID)
+        mocked_get_inv.return_value = paid
+        MOD._sync_invoices(CTX, store)
+        mocked_command.assert_called_once_with(
+            CTX, 'listinvoices', '--from=1557768000')
+        mocked_get_row.assert_called_once_with(CTX, fix.CREATEINVOICE)
+        # payments are read again from the last synced one, included
+        mocked_list.assert_called_once_with(CTX, 1573485250000)
+        store.set_paid.assert_called_once_with({'known': 5, 'hash': 7})
+        # only unknown invoices are asked to eclair
+        mocked_get_inv.assert_called_once_with(CTX, unknown)
+        store.save.assert_has_calls([
+            call([mocked_get_row.return_value],
+                 {'created': fix.CREATEINVOICE['timestamp']}),
+            call([invoice_row(paid, False)], {'received': 1573485250454})])
+        assert not mocked_handle.called
+        # Payments are synced in chunks
+        reset_mocks(vars())
+        settings.MAX_INVOICES = 1
+        store.set_paid.return_value = {'known', 'hash'}
+        MOD._sync_invoices(CTX, store)
+        self.assertEqual(store.set_paid.call_args_list, [
+            call({'known': 5}), call({'hash': 7})])
+        store.save.assert_has_calls([
+            call([], {'received': 1573485250000}),
+            call([], {'received': 1573485250454})])
+        assert not mocked_get_inv.called
+        settings.MAX_INVOICES = 200
+        # Nothing paid case
+        reset_mocks(vars())
+        mocked_command.return_value = []
+        mocked_list.return_value = []
+        MOD._sync_invoices(CTX, store)
+        store.save.assert_called_once_with([], {'created': 1557768000})
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        mocked_handle.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD._sync_invoices(CTX, store)
+        assert not store.save.called
+
+    @patch('lighter.light_eclair._get_invoice_row', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_lookup_invoice(self, mocked_command, mocked_get_row):
+        ecl_info = fix.GETRECEIVEDINFO_PENDING
+        mocked_command.return_value = ecl_info
+        res = MOD._lookup_invoice(CTX, 'hash')
+        mocked_command.assert_called_once_with(
+            CTX, 'getreceivedinfo', '--paymentHash="hash"')
+        mocked_get_row.assert_called_once_with(
+            CTX, ecl_info['paymentRequest'], ecl_info['status'])
+        self.assertEqual(res, mocked_get_row.return_value)
+        # Not found case
+        reset_mocks(vars())
+        mocked_command.return_value = 'Not found'
+        res = MOD._lookup_invoice(CTX, 'hash')
+        assert not mocked_get_row.called
+        self.assertEqual(res, None)
+
+    def test_get_received_time(self):
+        res = MOD._get_received_time({'timestamp': 5})
+        self.assertEqual(res, 5)
+        res = MOD._get_received_time(
+            {'parts': [{'timestamp': 5}, {'timestamp': 6}]})
+        self.assertEqual(res, 6)
+
+    @patch('lighter.light_eclair._get_invoice', autospec=True)
+    @patch('lighter.light_eclair._list_received', autospec=True)
+    def test_list_settled_invoices(self, mocked_list, mocked_get_inv):
+        mocked_get_inv.side_effect = lambda _ctx, pay: pay['paymentHash']
+        mocked_list.return_value = [
+            (1500, {'paymentHash': 'b'}), (2500, {'paymentHash': 'c'})]
+        res = MOD._list_settled_invoices(CTX, 1500)
+        mocked_list.assert_called_once_with(CTX, 1500)
+        self.assertEqual(res, [(2500, 'c')])
+
+    @patch('lighter.light_eclair._handle_error', autospec=True)
+    @patch('lighter.light_eclair.command', autospec=True)
+    def test_list_received(self, mocked_command, mocked_handle):
+        mocked_command.return_value = {'received': [
+            {'paymentHash': 'a', 'timestamp': 3000},
+            {'paymentHash': 'd', 'timestamp': 1000},
+            {'paymentHash': 'c', 'timestamp': 1500},
+            {'paymentHash': 'b', 'timestamp': 1500}]}
+        res = MOD._list_received(CTX, 1500)
+        mocked_command.assert_called_once_with(CTX, 'audit', '--from=1')
+        self.assertEqual([(time, pay['paymentHash']) for time, pay in res],
+                         [(1500, 'b'), (1500, 'c'), (3000, 'a')])
+        assert not mocked_handle.called
+        # Error case
+        reset_mocks(vars())
+        mocked_command.return_value = fix.BADRESPONSE
+        mocked_handle.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD._list_received(CTX, 1500)
+
+    @patch('lighter.light_eclair.sleep', autospec=True)
+    @patch('lighter.light_eclair.time', autospec=True)
+    @patch('lighter.light_eclair._get_invoice', autospec=True)
+    @patch('lighter.light_eclair._list_received', autospec=True)
+    def test_wait_settled_invoices(self, mocked_list, mocked_get_inv,
+                                   mocked_time, mocked_sleep):
+        mocked_get_inv.side_effect = lambda _ctx, pay: pay['paymentHash']
+        mocked_time.return_value = 2
+        mocked_list.side_effect = [
+            [], [(2500, {'paymentHash': 'a'})],
+            [(2500, {'paymentHash': 'a'}), (2500, {'paymentHash': 'b'}),
+             (3000, {'paymentHash': 'c'})]]
+        stream = MOD._wait_settled_invoices(None)
+        self.assertEqual(next(stream), (2500, 'a'))
+        self.assertEqual(mocked_list.call_args_list[0][0][1], 2000)
+        # Payment received in the same millisecond as the last one
+        self.assertEqual(next(stream), (2500, 'b'))
+        self.assertEqual(mocked_list.call_args[0][1], 2500)
+        self.assertEqual(next(stream), (3000, 'c'))
+        self.assertEqual(mocked_sleep.call_count, 2)
+        # Resuming case
+        reset_mocks(vars())
+        mocked_list.side_effect = [[(3500, {'paymentHash': 'd'})]]
+        stream = MOD._wait_settled_invoices(3000)
+        self.assertEqual(next(stream), (3500, 'd'))
+        self.assertEqual(mocked_list.call_args[0][1], 3000)
+
     def test_get_channel_state(self):
         res = MOD._get_channel_state(fix.CHANNEL_WAITING_FUNDING)
         self.assertEqual(res, pb.PENDING_OPEN)
@@ -14,20 +14,21 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Tests for light_lnd module """
 
+from asyncio import run
 from codecs import encode
 from concurrent.futures import TimeoutError as TimeoutFutError
 from importlib import import_module
 from unittest import TestCase
-from unittest.mock import call, Mock, mock_open, patch
+from unittest.mock import ANY, call, Mock, mock_open, patch
 
-from grpc import FutureTimeoutError, RpcError
+from grpc import FutureTimeoutError, RpcError, StatusCode
 
 from lighter import rpc_pb2 as ln
 from lighter import lighter_pb2 as pb
 from lighter import settings
 from lighter.light_lnd import LND_LN_TX, LND_PAYREQ
 from lighter.utils import Enforcer as Enf
-from tests import fixtures_lnd as fix
+from tests import CoroutineMock, fixtures_lnd as fix
 
 MOD = import_module('lighter.light_lnd')
 CTX = 'context'
@@ -36,12 +37,15 @@ CTX = 'context'
 class LightLndTests(TestCase):
     """ Tests for light_lnd module """
 
+    @patch('lighter.light_lnd.ChannelPool', autospec=True)
+    @patch('lighter.light_lnd.disconnect', autospec=True)
     @patch('lighter.light_lnd.composite_channel_credentials')
     @patch('lighter.light_lnd.metadata_call_credentials')
     @patch('lighter.light_lnd._metadata_callback')
     @patch('lighter.light_lnd.ssl_channel_credentials')
     def test_update_settings(self, mocked_ssl_chan, mocked_callback,
-                             mocked_meta_call, mocked_comp_chan):
+                             mocked_meta_call, mocked_comp_chan,
+                             mocked_disconnect, mocked_pool):
         # Correct case: with macaroons
         reset_mocks(vars())
         values = {
@@ -66,6 +70,11 @@ class LightLndTests(TestCase):
             settings.LND_ADDR, '{}:{}'.format(values['LND_HOST'],
                                               values['LND_PORT']))
         self.assertEqual(settings.LND_CREDS_FULL, 'combined_creds')
+        mocked_disconnect.assert_called_once_with()
+        mocked_pool.assert_any_call('combined_creds', settings.LND_POOL_SIZE)
+        mocked_pool.assert_any_call('cert_creds', 1)
+        self.assertEqual(settings.LND_POOL_FULL, mocked_pool.return_value)
+        self.assertEqual(settings.LND_POOL_SSL, mocked_pool.return_value)
         # Correct case: without macaroons
         reset_mocks(vars())
         values = {
@@ -115,39 +124,194 @@ class LightLndTests(TestCase):
         self.assertEqual(func.call_count, 1)
         mocked_handle_err.assert_called_once_with('context', error)
 
+    @patch('lighter.light_lnd.get_nodes_cache', autospec=True)
+    def test_on_connect(self, mocked_cache):
+        MOD.on_connect()
+        mocked_cache.assert_called_once_with(
+            MOD._load_nodes, MOD._lookup_node)
+        mocked_cache.return_value.start.assert_called_once_with()
+
+    def test_disconnect(self):
+        pool_full = Mock()
+        pool_ssl = Mock()
+        settings.LND_POOL_FULL = pool_full
+        settings.LND_POOL_SSL = pool_ssl
+        settings.LND_AIO_CHANNEL = Mock()
+        MOD.disconnect()
+        pool_full.close.assert_called_once_with()
+        pool_ssl.close.assert_called_once_with()
+        self.assertEqual(settings.LND_POOL_FULL, None)
+        self.assertEqual(settings.LND_POOL_SSL, None)
+        self.assertEqual(settings.LND_AIO_CHANNEL, None)
+        # Already disconnected case
+        MOD.disconnect()
+        self.assertEqual(settings.LND_POOL_FULL, None)
+
+    @patch('lighter.light_lnd._ChannelSlot', autospec=True)
+    def test_ChannelPool(self, mocked_slot):
+        slots = [Mock(), Mock(), Mock()]
+        mocked_slot.side_effect = slots
+        pool = MOD.ChannelPool('creds', 2)
+        # Round-robin case: channels are opened lazily and reused
+        self.assertEqual(pool.get(), slots[0])
+        self.assertEqual(pool.get(), slots[1])
+        self.assertEqual(pool.get(), slots[0])
+        self.assertEqual(mocked_slot.call_count, 2)
+        mocked_slot.assert_called_with('creds')
+        # Reset case: a new channel replaces the broken one
+        pool.reset(slots[1])
+        slots[1].close.assert_called_once_with()
+        self.assertEqual(pool.get(), slots[2])
+        self.assertEqual(mocked_slot.call_count, 3)
+        # Close case
+        pool.close()
+        slots[0].close.assert_called_once_with()
+        slots[2].close.assert_called_once_with()
+
+    @patch('lighter.light_lnd.intercept_channel', autospec=True)
+    @patch('lighter.light_lnd.secure_channel', autospec=True)
+    def test_ChannelSlot(self, mocked_secure_chan, mocked_intercept):
+        settings.LND_ADDR = 'lnd:10009'
+        channel = mocked_secure_chan.return_value
+        slot = MOD._ChannelSlot('creds')
+        mocked_secure_chan.assert_called_once_with(
+            'lnd:10009', 'creds', options=settings.LND_CHANNEL_OPTIONS)
+        channel.subscribe.assert_called_once_with(
+            slot._update_state, try_to_connect=True)
+        mocked_intercept.assert_called_once_with(channel, ANY)
+        # Connectivity state case
+        self.assertFalse(slot.is_ready())
+        slot._update_state(MOD.ChannelConnectivity.READY)
+        self.assertTrue(slot.is_ready())
+        slot._update_state(MOD.ChannelConnectivity.TRANSIENT_FAILURE)
+        self.assertFalse(slot.is_ready())
+        # Stubs are cached
+        stub_class = Mock()
+        stub = slot.get_stub(stub_class)
+        self.assertEqual(stub, stub_class.return_value)
+        self.assertEqual(slot.get_stub(stub_class), stub)
+        stub_class.assert_called_once_with(mocked_intercept.return_value)
+        # Close case
+        slot.close()
+        channel.unsubscribe.assert_called_once_with(slot._update_state)
+        channel.close.assert_called_once_with()
+
+    @patch('lighter.light_lnd.timed_node_call', autospec=True)
+    def test_NodeCallTimer(self, mocked_timed):
+        continuation = Mock()
+        details = Mock(method='/lnrpc.Lightning/GetInfo')
+        res = MOD._NodeCallTimer().intercept_unary_unary(
+            continuation, details, 'request')
+        mocked_timed.assert_called_once_with('GetInfo')
+        continuation.assert_called_once_with(details, 'request')
+        self.assertEqual(res, continuation.return_value)
+
+    @patch('lighter.light_lnd.report_node_success', autospec=True)
+    @patch('lighter.light_lnd.report_node_failure', autospec=True)
     @patch('lighter.light_lnd.lnrpc.WalletUnlockerStub', autospec=True)
     @patch('lighter.light_lnd.lnrpc.LightningStub', autospec=True)
     @patch('lighter.light_lnd.Err')
     @patch('lighter.light_lnd.get_node_timeout', autospec=True)
     @patch('lighter.light_lnd.channel_ready_future', autospec=True)
-    @patch('lighter.light_lnd.secure_channel', autospec=True)
-    def test_connect(self, mocked_secure_chan, mocked_future, mocked_get_time,
-                     mocked_err, mocked_ln_stub, mocked_wu_stub):
-        settings.LND_ADDR = 'lnd:10009'
-        settings.LND_CREDS_FULL = 'creds'
-        settings.LND_CREDS_SSL = 'cert'
-        # correct case
+    def test_connect(self, mocked_future, mocked_get_time, mocked_err,
+                     mocked_ln_stub, mocked_wu_stub, mocked_failure,
+                     mocked_success):
+        pool_full = Mock()
+        pool_ssl = Mock()
+        slot = pool_full.get.return_value
+        slot.get_stub.side_effect = lambda stub_class: stub_class.return_value
+        pool_ssl.get.return_value = slot
+        settings.LND_POOL_FULL = pool_full
+        settings.LND_POOL_SSL = pool_ssl
+        # correct case: channel already connected
+        slot.is_ready.return_value = True
         with MOD._connect(CTX) as stub:
             self.assertEqual(stub, mocked_ln_stub.return_value)
-        mocked_secure_chan.assert_called_once_with('lnd:10009', 'creds')
-        mocked_ln_stub.assert_called_once_with(mocked_secure_chan.return_value)
-        mocked_secure_chan.return_value.close.assert_called_once_with()
+        pool_full.get.assert_called_once_with()
+        slot.get_stub.assert_called_once_with(mocked_ln_stub)
+        assert not mocked_future.called
+        assert not slot.close.called
+        mocked_success.assert_called_once_with()
+        # unreachable node case
+        reset_mocks(vars())
+        error = UnavailableRpcError()
+        with self.assertRaises(RpcError):
+            with MOD._connect(CTX) as stub:
+                raise error
+        mocked_failure.assert_called_once_with('unavailable')
+        assert not mocked_success.called
+        # slow call case, reachability unknown
+        reset_mocks(vars())
+        with self.assertRaises(RpcError):
+            with MOD._connect(CTX) as stub:
+                raise DeadlineRpcError()
+        assert not mocked_failure.called
+        assert not mocked_success.called
+        # node error case, node is reachable
+        reset_mocks(vars())
+        with self.assertRaises(RpcError):
+            with MOD._connect(CTX) as stub:
+                raise CalledRpcError()
+        assert not mocked_failure.called
+        mocked_success.assert_called_once_with()
+        # correct case: channel not yet connected
+        reset_mocks(vars())
+        slot.is_ready.return_value = False
+        with MOD._connect(CTX) as stub:
+            self.assertEqual(stub, mocked_ln_stub.return_value)
+        mocked_future.assert_called_once_with(slot.channel)
+        mocked_future.return_value.result.assert_called_once_with(
+            timeout=mocked_get_time.return_value)
         # with different stub_class and force_no_macaroon=True case
         reset_mocks(vars())
+        slot.is_ready.return_value = True
         with MOD._connect(CTX, stub_class=MOD.lnrpc.WalletUnlockerStub,
                 force_no_macaroon=True) as stub:
             self.assertEqual(stub, mocked_wu_stub.return_value)
-        mocked_secure_chan.assert_called_once_with('lnd:10009', 'cert')
-        assert not mocked_ln_stub.called
-        mocked_secure_chan.return_value.close.assert_called_once_with()
+        pool_ssl.get.assert_called_once_with()
+        assert not pool_full.get.called
         # error case
-        stub_class = Mock(return_value='stub')
         reset_mocks(vars())
+        slot.is_ready.return_value = False
         mocked_future.return_value.result.side_effect = FutureTimeoutError()
         mocked_err().node_error.side_effect = Exception()
         with self.assertRaises(Exception):
             with MOD._connect(CTX) as stub:
-                self.assertEqual(stub, 'stub')
+                pass
+        pool_full.reset.assert_called_once_with(slot)
+        mocked_failure.assert_called_once_with('Failed to dial server')
+        # not configured case
+        reset_mocks(vars())
+        settings.LND_POOL_FULL = None
+        with self.assertRaises(Exception):
+            with MOD._connect(CTX) as stub:
+                pass
+        assert mocked_err().node_error.called
+
+    @patch('lighter.light_lnd.lnrpc.LightningStub', autospec=True)
+    @patch('lighter.light_lnd.Err')
+    @patch('lighter.light_lnd.aio')
+    def test_get_aio_stub(self, mocked_aio, mocked_err, mocked_stub):
+        settings.LND_ADDR = 'lnd:10009'
+        settings.LND_CREDS_FULL = 'creds'
+        settings.LND_AIO_CHANNEL = None
+        res = MOD._get_aio_stub(CTX)
+        mocked_aio.secure_channel.assert_called_once_with(
+            'lnd:10009', 'creds', options=settings.LND_CHANNEL_OPTIONS)
+        mocked_stub.assert_called_once_with(
+            mocked_aio.secure_channel.return_value)
+        self.assertEqual(res, mocked_stub.return_value)
+        # Channel reused case
+        reset_mocks(vars())
+        MOD._get_aio_stub(CTX)
+        assert not mocked_aio.secure_channel.called
+        # Not configured case
+        reset_mocks(vars())
+        settings.LND_CREDS_FULL = ''
+        mocked_err().node_error.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD._get_aio_stub(CTX)
+        settings.LND_AIO_CHANNEL = None
 
     @patch('lighter.light_lnd._handle_error', autospec=True)
     @patch('lighter.light_lnd.LOGGER', autospec=True)
@@ -294,189 +458,86 @@ class LightLndTests(TestCase):
         assert not mocked_handle.called
         self.assertEqual(res.balance, 777)
 
-    @patch('lighter.light_lnd.get_channel_balances', autospec=True)
-    @patch('lighter.light_lnd.ListChannels', autospec=True)
-    def test_ChannelBalance(self, mocked_ListChannels, mocked_get_chan_bal):
-        mocked_get_chan_bal.return_value = pb.ChannelBalanceResponse()
+    @patch('lighter.light_lnd._get_channels_mirror', autospec=True)
+    def test_ChannelBalance(self, mocked_mirror):
         res = MOD.ChannelBalance('request', CTX)
-        self.assertEqual(res, pb.ChannelBalanceResponse())
+        mirror = mocked_mirror.return_value
+        mirror.channel_balance.assert_called_once_with(CTX)
+        self.assertEqual(res, mirror.channel_balance.return_value)
 
-    @patch('lighter.light_lnd._handle_error', autospec=True)
-    @patch('lighter.light_lnd._add_channel', autospec=True)
-    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
-    @patch('lighter.light_lnd._connect', autospec=True)
-    def test_ListChannels(self, mocked_connect, mocked_get_time, mocked_add,
-                          mocked_handle):
-        stub = mocked_connect.return_value.__enter__.return_value
-        time = 10
-        mocked_get_time.return_value = 10
-        # Correct case: request.active_only = False
-        request = pb.ListChannelsRequest()
-        lnd_res_act = ln.ListChannelsResponse()
-        lnd_res_act.channels.add()
-        stub.ListChannels.return_value = lnd_res_act
-        lnd_res_pen = ln.PendingChannelsResponse()
-        lnd_res_pen.pending_open_channels.add()
-        lnd_res_pen.pending_closing_channels.add()
-        lnd_res_pen.pending_force_closing_channels.add()
-        lnd_res_pen.waiting_close_channels.add()
-        stub.PendingChannels.return_value = lnd_res_pen
-        res = MOD.ListChannels(request, CTX)
-        calls = [
-            call(
-                CTX, pb.ListChannelsResponse(), lnd_res_act.channels[0],
-                pb.OPEN, active_only=False, open_chan=True),
-            call(CTX, pb.ListChannelsResponse(),
-                 lnd_res_pen.pending_open_channels[0].channel,
-                 pb.PENDING_OPEN),
-            call(CTX, pb.ListChannelsResponse(),
-                 lnd_res_pen.pending_closing_channels[0].channel,
-                 pb.PENDING_MUTUAL_CLOSE),
-            call(CTX, pb.ListChannelsResponse(),
-                 lnd_res_pen.pending_force_closing_channels[0].channel,
-                 pb.PENDING_FORCE_CLOSE),
-            call(CTX, pb.ListChannelsResponse(),
-                 lnd_res_pen.waiting_close_channels[0].channel,
-                 pb.UNKNOWN)
-        ]
-        mocked_add.assert_has_calls(calls)
-        stub.ListChannels.assert_called_once_with(
-            ln.ListChannelsRequest(), timeout=time)
-        lnd_req = ln.PendingChannelsRequest()
-        stub.PendingChannels.assert_called_once_with(
-            lnd_req, timeout=time)
-        assert not mocked_handle.called
-        self.assertEqual(res, pb.ListChannelsResponse())
-        # Correct case: request.active_only = True
-        reset_mocks(vars())
+    @patch('lighter.light_lnd._get_channels_mirror', autospec=True)
+    def test_ListChannels(self, mocked_mirror):
         request = pb.ListChannelsRequest(active_only=True)
-        lnd_res = ln.ListChannelsResponse()
-        lnd_res.channels.add(active=True)
-        stub.ListChannels.return_value = lnd_res
         res = MOD.ListChannels(request, CTX)
-        stub.ListChannels.assert_called_once_with(
-            ln.ListChannelsRequest(), timeout=time)
-        mocked_add.assert_called_once_with(
-            CTX, pb.ListChannelsResponse(), lnd_res.channels[0], pb.OPEN,
-            active_only=True, open_chan=True)
-        assert not stub.PendingChannels.called
-        assert not mocked_handle.called
-        self.assertEqual(res, pb.ListChannelsResponse())
+        mirror = mocked_mirror.return_value
+        mirror.list_channels.assert_called_once_with(CTX, True)
+        self.assertEqual(res, mirror.list_channels.return_value)
 
-    @patch('lighter.light_lnd._handle_error', autospec=True)
-    @patch('lighter.light_lnd._parse_invoices', autospec=True)
-    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
-    @patch('lighter.light_lnd._connect', autospec=True)
-    def test_ListInvoices(self, mocked_connect, mocked_get_time, mocked_parse,
-                          mocked_handle):
-        stub = mocked_connect.return_value.__enter__.return_value
-        time = 10
-        mocked_get_time.return_value = 10
-        # Correct case: with max_items, search_order 1
-        max_invoices = 50
-        request = pb.ListInvoicesRequest(max_items=max_invoices, search_order=1)
-        lnd_res = fix.get_invoices_response(request)
-        stub.ListInvoices.return_value = lnd_res
-        mocked_parse.side_effect = [False, True]
+    @patch('lighter.light_lnd.list_invoices', autospec=True)
+    def test_ListInvoices(self, mocked_list):
+        request = pb.ListInvoicesRequest(paid=True)
         res = MOD.ListInvoices(request, CTX)
-        self.assertEqual(request.max_items, max_invoices)
-        req = ln.ListInvoiceRequest(
-            num_max_invoices=max_invoices * settings.INVOICES_TIMES,
-            reversed=True,
-            index_offset=1)
-        stub.ListInvoices.assert_called_with(req, timeout=time)
-        self.assertEqual(stub.ListInvoices.call_count, 2)
-        assert not mocked_handle.called
-        # Correct case: without max_items, search_order 0
-        reset_mocks(vars())
-        request = pb.ListInvoicesRequest()
-        mocked_parse.side_effect = [False, True]
-        MOD.ListInvoices(request, CTX)
-        self.assertEqual(request.max_items, settings.MAX_INVOICES)
-        req = ln.ListInvoiceRequest(
-            num_max_invoices=settings.MAX_INVOICES * settings.INVOICES_TIMES,
-            index_offset=3)
-        stub.ListInvoices.assert_called_with(req, timeout=time)
-        self.assertEqual(stub.ListInvoices.call_count, 2)
-        assert not mocked_handle.called
-        # Empty response case
-        reset_mocks(vars())
-        request = pb.ListInvoicesRequest()
-        stub.ListInvoices.return_value = ln.ListInvoiceResponse()
-        MOD.ListInvoices(request, CTX)
-        assert not mocked_parse.called
-        assert not mocked_handle.called
+        mocked_list.assert_called_once_with(
+            request, CTX, MOD._sync_invoices)
+        self.assertEqual(res, mocked_list.return_value)
 
-    @patch('lighter.light_lnd._handle_error', autospec=True)
-    @patch('lighter.light_lnd._add_payment', autospec=True)
-    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
-    @patch('lighter.light_lnd._connect', autospec=True)
-    def test_ListPayments(self, mocked_connect, mocked_get_time, mocked_add,
-                          mocked_handle):
-        stub = mocked_connect.return_value.__enter__.return_value
-        time = 10
-        mocked_get_time.return_value = 10
-        # Correct case
-        request = pb.ListPaymentsRequest()
-        lnd_res = fix.get_listpayments_response()
-        stub.ListPayments.return_value = lnd_res
+    @patch('lighter.light_lnd._get_payments_pages', autospec=True)
+    @patch('lighter.light_lnd._list_payments', autospec=True)
+    def test_ListPayments(self, mocked_list, mocked_pages):
+        request = pb.ListPaymentsRequest(max_items=2)
+        mocked_pages.return_value = iter(['page'])
         res = MOD.ListPayments(request, CTX)
-        response = pb.ListPaymentsResponse()
-        calls = []
-        for lnd_payment in lnd_res.payments:
-            calls.append(call(CTX, response, lnd_payment))
-        mocked_add.assert_has_calls(calls)
+        mocked_list.assert_called_once_with(CTX)
+        mocked_pages.assert_called_once_with(
+            CTX, request, mocked_list.return_value, 2)
+        self.assertEqual(res, 'page')
 
-    @patch('lighter.light_lnd._handle_error', autospec=True)
+    @patch('lighter.light_lnd.get_nodes_cache', autospec=True)
     @patch('lighter.light_lnd.get_node_timeout', autospec=True)
     @patch('lighter.light_lnd._connect', autospec=True)
-    def test_ListPeers(self, mocked_connect, mocked_get_time, mocked_handle):
+    def test_ListPeers(self, mocked_connect, mocked_get_time, mocked_cache):
         stub = mocked_connect.return_value.__enter__.return_value
         time = 10
         mocked_get_time.return_value = 10
+        nodes = mocked_cache.return_value.get_nodes
+        nodes.return_value = {'pubkey': ('alias', '#3399ff')}
         # Filled case
         lnd_res = ln.ListPeersResponse()
         lnd_res.peers.add(pub_key='pubkey', address='address')
+        lnd_res.peers.add(pub_key='unknown', address='address2')
         stub.ListPeers.return_value = lnd_res
-        lnd_res = ln.NodeInfo(node=ln.LightningNode(alias='alias'))
-        stub.GetNodeInfo.return_value = lnd_res
         res = MOD.ListPeers('request', CTX)
         stub.ListPeers.assert_called_once_with(
             ln.ListPeersRequest(), timeout=time)
-        assert not mocked_handle.called
+        mocked_cache.assert_called_once_with(MOD._load_nodes, MOD._lookup_node)
+        nodes.assert_called_once_with(CTX, ['pubkey', 'unknown'])
         self.assertEqual(res.peers[0].pubkey, 'pubkey')
         self.assertEqual(res.peers[0].address, 'address')
         self.assertEqual(res.peers[0].alias, 'alias')
-        assert not mocked_handle.called
+        self.assertEqual(res.peers[0].color, '#3399ff')
+        self.assertEqual(res.peers[1].alias, '')
         # Empty case
         reset_mocks(vars())
         stub.ListPeers.return_value = pb.ListPeersResponse()
         res = MOD.ListPeers('request', CTX)
         stub.ListPeers.assert_called_once_with(
             ln.ListPeersRequest(), timeout=time)
-        assert not mocked_handle.called
+        assert not nodes.called
         self.assertEqual(res, pb.ListPeersResponse())
 
-    @patch('lighter.light_lnd._handle_error', autospec=True)
-    @patch('lighter.light_lnd._add_transaction', autospec=True)
-    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
-    @patch('lighter.light_lnd._connect', autospec=True)
-    def test_ListTransactions(self, mocked_connect, mocked_get_time,
-                              mocked_add, mocked_handle):
-        stub = mocked_connect.return_value.__enter__.return_value
-        time = 10
-        mocked_get_time.return_value = 10
-        # Correct case
+    @patch('lighter.light_lnd._get_transactions_pages', autospec=True)
+    @patch('lighter.light_lnd._list_transactions', autospec=True)
+    def test_ListTransactions(self, mocked_list, mocked_pages):
         request = pb.ListTransactionsRequest()
-        lnd_res = fix.get_transactions_response()
-        stub.GetTransactions.return_value = lnd_res
+        mocked_pages.return_value = iter(['page'])
         res = MOD.ListTransactions(request, CTX)
-        response = pb.ListTransactionsResponse()
-        calls = []
-        for lnd_transaction in lnd_res.transactions:
-            calls.append(call(CTX, response, lnd_transaction))
-        mocked_add.assert_has_calls(calls)
+        mocked_list.assert_called_once_with(CTX)
+        mocked_pages.assert_called_once_with(
+            CTX, request, mocked_list.return_value, 0)
+        self.assertEqual(res, 'page')
 
+    @patch('lighter.light_lnd._get_invoice_row', autospec=True)
+    @patch('lighter.light_lnd.get_invoices_store', autospec=True)
     @patch('lighter.light_lnd._handle_error', autospec=True)
     @patch('lighter.light_lnd.convert', autospec=True)
     @patch('lighter.light_lnd.get_node_timeout', autospec=True)
@@ -484,7 +545,8 @@ class LightLndTests(TestCase):
     @patch('lighter.light_lnd.Err')
     @patch('lighter.light_lnd.Enf.check_value')
     def test_CreateInvoice(self, mocked_check_val, mocked_err, mocked_connect,
-                           mocked_get_time, mocked_conv, mocked_handle):
+                           mocked_get_time, mocked_conv, mocked_handle,
+                           mocked_store, mocked_get_row):
         stub = mocked_connect.return_value.__enter__.return_value
         time = 10
         mocked_get_time.return_value = 10
@@ -519,6 +581,9 @@ class LightLndTests(TestCase):
         assert not mocked_handle.called
         self.assertEqual(res.payment_hash, '725f68617368')
         self.assertEqual(res.expires_at, 1534974910)
+        mocked_get_row.assert_called_once_with(CTX, lnd_res)
+        mocked_store.return_value.save.assert_called_once_with(
+            [mocked_get_row.return_value])
         # Correct case: empty request
         reset_mocks(vars())
         mocked_conv.return_value = None
@@ -532,6 +597,7 @@ class LightLndTests(TestCase):
             ln.Invoice(expiry=settings.EXPIRY_TIME), timeout=time)
         assert not stub.LookupInvoice.called
         assert not mocked_handle.called
+        assert not mocked_store.return_value.save.called
         self.assertEqual(res, pb.CreateInvoiceResponse())
         # min_final_cltv_expiry out of range case
         reset_mocks(vars())
@@ -543,39 +609,13 @@ class LightLndTests(TestCase):
             res = MOD.CreateInvoice(request, CTX)
         assert not mocked_connect.called
 
-    @patch('lighter.light_lnd._get_invoice_state', autospec=True)
-    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
-    @patch('lighter.light_lnd._connect', autospec=True)
-    @patch('lighter.light_lnd.check_req_params', autospec=True)
-    def test_CheckInvoice(self, mocked_check_par, mocked_connect,
-                          mocked_get_time, mocked_inv_st):
-        stub = mocked_connect.return_value.__enter__.return_value
-        time = 10
-        mocked_get_time.return_value = 10
-        # Correct case: paid invoice
-        mocked_inv_st.return_value = pb.PAID
-        request = pb.CheckInvoiceRequest(payment_hash='a_payment_hash')
-        lnd_res = ln.Invoice(state=ln.Invoice.SETTLED)
-        stub.LookupInvoice.return_value = lnd_res
-        res = MOD.CheckInvoice(request, CTX)
-        lnd_req = ln.PaymentHash(r_hash_str='a_payment_hash')
-        stub.LookupInvoice.assert_called_once_with(
-            lnd_req, timeout=time)
-        self.assertEqual(res.settled, True)
-        # Correct case: unpaid invoice
-        mocked_inv_st.return_value = pb.PENDING
-        res = MOD.CheckInvoice(request, CTX)
-        self.assertEqual(res.settled, False)
-        # Correct case: expired invoice
-        mocked_inv_st.return_value = pb.EXPIRED
+    @patch('lighter.light_lnd.check_invoice', autospec=True)
+    def test_CheckInvoice(self, mocked_check):
+        request = pb.CheckInvoiceRequest(payment_hash='hash')
         res = MOD.CheckInvoice(request, CTX)
-        self.assertEqual(res.settled, False)
-        # Missing parameter case
-        reset_mocks(vars())
-        request = pb.CheckInvoiceRequest()
-        mocked_check_par.side_effect = Exception()
-        with self.assertRaises(Exception):
-            MOD.CheckInvoice(request, CTX)
+        mocked_check.assert_called_once_with(
+            request, CTX, MOD._sync_invoices, MOD._lookup_invoice)
+        self.assertEqual(res, mocked_check.return_value)
 
     @patch('lighter.light_lnd._handle_error', autospec=True)
     @patch('lighter.light_lnd.get_node_timeout', autospec=True)
@@ -684,6 +724,133 @@ class LightLndTests(TestCase):
             lnd_req, timeout=time)
         self.assertEqual(res, pb.PayInvoiceResponse())
 
+    @patch('lighter.light_lnd._handle_error', autospec=True)
+    @patch('lighter.light_lnd._get_pay_response', autospec=True)
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._get_aio_stub', autospec=True)
+    @patch('lighter.light_lnd._get_send_request', autospec=True)
+    def test_pay_invoice_async(self, mocked_get_req, mocked_get_stub,
+                               mocked_get_time, mocked_get_res,
+                               mocked_handle):
+        request = pb.PayInvoiceRequest(payment_request='lntb1')
+        mocked_get_time.return_value = 10
+        stub = mocked_get_stub.return_value
+        stub.SendPaymentSync = CoroutineMock(return_value=ln.SendResponse())
+        res = run(MOD._pay_invoice_async(request, CTX))
+        mocked_get_req.assert_called_once_with(request, CTX)
+        stub.SendPaymentSync.assert_called_once_with(
+            mocked_get_req.return_value, timeout=10)
+        mocked_get_res.assert_called_once_with(CTX, ln.SendResponse())
+        self.assertEqual(res, mocked_get_res.return_value)
+        # Error case
+        reset_mocks(vars())
+        error = CalledRpcError()
+        stub.SendPaymentSync = CoroutineMock(side_effect=error)
+        mocked_handle.side_effect = Exception()
+        with self.assertRaises(Exception):
+            run(MOD._pay_invoice_async(request, CTX))
+        mocked_handle.assert_called_once_with(CTX, error)
+
+    @patch('lighter.light_lnd.pay_in_background', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    @patch('lighter.light_lnd._get_send_request', autospec=True)
+    def test_PayInvoice_no_wait(self, mocked_get_req, mocked_connect,
+                                mocked_pay_bg):
+        request = pb.PayInvoiceRequest(payment_request='lntb1', no_wait=True)
+        res = MOD.PayInvoice(request, CTX)
+        assert not mocked_connect.called
+        args = mocked_pay_bg.call_args[0]
+        self.assertEqual(args[:2], (CTX, 'lntb1'))
+        self.assertEqual(args[2].func, MOD._send_payment)
+        self.assertEqual(args[2].args, (mocked_get_req.return_value,))
+        self.assertEqual(args[3], MOD._check_payment)
+        self.assertEqual(res, mocked_pay_bg.return_value)
+        # Asyncio server mode
+        reset_mocks(vars())
+        res = run(MOD._pay_invoice_async(request, CTX))
+        self.assertEqual(mocked_pay_bg.call_args[0][2].func, MOD._send_payment)
+        self.assertEqual(res, mocked_pay_bg.return_value)
+
+    @patch('lighter.light_lnd._handle_error', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_send_payment(self, mocked_connect, mocked_handle):
+        lnd_req = ln.SendRequest(payment_request='lntb1')
+        stub = mocked_connect.return_value.__enter__.return_value
+        preimage = b'\x12\x34'
+
+        def send_payment(requests, timeout):
+            self.assertEqual(timeout, settings.PAY_TIMEOUT)
+            self.assertEqual(next(requests), lnd_req)
+            yield ln.SendResponse(payment_preimage=preimage)
+            # request stream is kept open until a response is received
+            next(requests, None)
+
+        stub.SendPayment.side_effect = send_payment
+        res = MOD._send_payment(lnd_req, Mock())
+        self.assertEqual(res, '1234')
+        # Payment error case
+        reset_mocks(vars())
+        stub.SendPayment.side_effect = None
+        stub.SendPayment.return_value = iter(
+            [ln.SendResponse(payment_error='unable to find a path')])
+        mocked_handle.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            MOD._send_payment(lnd_req, Mock())
+        # RPC error case
+        reset_mocks(vars())
+        error = CalledRpcError()
+        stub.SendPayment.side_effect = error
+        with self.assertRaises(RuntimeError):
+            MOD._send_payment(lnd_req, Mock())
+        self.assertEqual(mocked_handle.call_args[0][1], error)
+        # Unavailable node case, outcome is unknown
+        reset_mocks(vars())
+        stub.SendPayment.side_effect = UnavailableRpcError()
+        res = MOD._send_payment(lnd_req, Mock())
+        self.assertEqual(res, None)
+        assert not mocked_handle.called
+
+    @patch('lighter.light_lnd._handle_error', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_check_payment(self, mocked_connect, mocked_handle):
+        stub = mocked_connect.return_value.__enter__.return_value
+        other = ln.Payment(payment_hash='other', payment_preimage='00')
+        payment = ln.Payment(
+            payment_hash='hash', status=ln.Payment.IN_FLIGHT)
+        stub.ListPayments.return_value = ln.ListPaymentsResponse(
+            payments=[other, payment])
+        res = MOD._check_payment('hash')
+        self.assertEqual(
+            stub.ListPayments.call_args[0][0],
+            ln.ListPaymentsRequest(include_incomplete=True))
+        self.assertEqual(res, pb.GetPaymentResponse(state=pb.IN_FLIGHT))
+        # Succeeded payment case
+        payment.status = ln.Payment.SUCCEEDED
+        payment.payment_preimage = '1234'
+        stub.ListPayments.return_value = ln.ListPaymentsResponse(
+            payments=[other, payment])
+        res = MOD._check_payment('hash')
+        self.assertEqual(res, pb.GetPaymentResponse(
+            state=pb.SUCCEEDED, payment_preimage='1234'))
+        # Failed payment case
+        payment.status = ln.Payment.FAILED
+        stub.ListPayments.return_value = ln.ListPaymentsResponse(
+            payments=[other, payment])
+        res = MOD._check_payment('hash')
+        self.assertEqual(res, pb.GetPaymentResponse(state=pb.FAILED))
+        # Payment unknown to lnd case
+        stub.ListPayments.return_value = ln.ListPaymentsResponse(
+            payments=[other])
+        res = MOD._check_payment('hash')
+        self.assertEqual(res, pb.GetPaymentResponse(state=pb.FAILED))
+        # Error case
+        error = CalledRpcError()
+        stub.ListPayments.side_effect = error
+        mocked_handle.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            MOD._check_payment('hash')
+        self.assertEqual(mocked_handle.call_args[0][1], error)
+
     @patch('lighter.light_lnd._handle_error', autospec=True)
     @patch('lighter.light_lnd.Err')
     @patch('lighter.light_lnd.Enf.check_value')
@@ -722,6 +889,58 @@ class LightLndTests(TestCase):
         MOD.PayOnChain(request, CTX)
         mocked_err().out_of_range.assert_called_once_with(CTX, 'fee_sat_byte')
 
+    @patch('lighter.light_lnd.stream_invoices', autospec=True)
+    def test_StreamInvoices(self, mocked_stream):
+        request = pb.ListInvoicesRequest(paid=True)
+        res = MOD.StreamInvoices(request, CTX)
+        mocked_stream.assert_called_once_with(
+            request, CTX, MOD._sync_invoices)
+        self.assertEqual(res, mocked_stream.return_value)
+
+    @patch('lighter.light_lnd._get_payments_pages', autospec=True)
+    @patch('lighter.light_lnd._list_payments', autospec=True)
+    def test_StreamPayments(self, mocked_list, mocked_pages):
+        request = pb.ListPaymentsRequest()
+        res = MOD.StreamPayments(request, CTX)
+        mocked_list.assert_called_once_with(CTX)
+        mocked_pages.assert_called_once_with(
+            CTX, request, mocked_list.return_value, settings.STREAM_ITEMS)
+        self.assertEqual(res, mocked_pages.return_value)
+
+    @patch('lighter.light_lnd._get_transactions_pages', autospec=True)
+    @patch('lighter.light_lnd._list_transactions', autospec=True)
+    def test_StreamTransactions(self, mocked_list, mocked_pages):
+        request = pb.ListTransactionsRequest(max_items=5)
+        res = MOD.StreamTransactions(request, CTX)
+        mocked_list.assert_called_once_with(CTX)
+        mocked_pages.assert_called_once_with(
+            CTX, request, mocked_list.return_value, 5)
+        self.assertEqual(res, mocked_pages.return_value)
+
+    @patch('lighter.light_lnd.get_invoices_hub', autospec=True)
+    def test_SubscribeInvoices(self, mocked_hub):
+        request = pb.SubscribeInvoicesRequest(settle_index=7)
+        res = MOD.SubscribeInvoices(request, CTX)
+        mocked_hub.assert_called_once_with(
+            MOD._list_settled_invoices, MOD._wait_settled_invoices)
+        mocked_hub.return_value.subscribe.assert_called_once_with(CTX, 7)
+        self.assertEqual(res, mocked_hub.return_value.subscribe.return_value)
+
+    @patch('lighter.light_lnd.get_payment', autospec=True)
+    def test_GetPayment(self, mocked_get):
+        request = pb.GetPaymentRequest(payment_hash='hash')
+        res = MOD.GetPayment(request, CTX)
+        mocked_get.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_get.return_value)
+
+    @patch('lighter.light_lnd.track_payment', autospec=True)
+    def test_TrackPayment(self, mocked_track):
+        request = pb.TrackPaymentRequest(payment_hash='hash')
+        res = MOD.TrackPayment(request, CTX)
+        mocked_track.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_track.return_value)
+
+    @patch('lighter.light_lnd.decode_invoice', autospec=True)
     @patch('lighter.light_lnd._handle_error', autospec=True)
     @patch('lighter.light_lnd._add_route_hint', autospec=True)
     @patch('lighter.light_lnd.convert', autospec=True)
@@ -731,7 +950,18 @@ class LightLndTests(TestCase):
     @patch('lighter.light_lnd.check_req_params', autospec=True)
     def test_DecodeInvoice(self, mocked_check_par, mocked_connect,
                            mocked_get_time, mocked_err, mocked_conv,
-                           mocked_add, mocked_handle):
+                           mocked_add, mocked_handle, mocked_decode):
+        # Locally decoded case
+        request = pb.DecodeInvoiceRequest(payment_request='pay_req')
+        res = MOD.DecodeInvoice(request, CTX)
+        mocked_check_par.assert_called_once_with(
+            CTX, request, 'payment_request')
+        mocked_decode.assert_called_once_with(CTX, request, int_scid=True)
+        self.assertEqual(res, mocked_decode.return_value)
+        assert not mocked_connect.called
+        # Not locally decodable cases
+        reset_mocks(vars())
+        mocked_decode.return_value = None
         stub = mocked_connect.return_value.__enter__.return_value
         time = 10
         mocked_get_time.return_value = 10
@@ -853,12 +1083,12 @@ class LightLndTests(TestCase):
     @patch('lighter.light_lnd._handle_error', autospec=True)
     @patch('lighter.light_lnd.get_thread_timeout', autospec=True)
     @patch('lighter.light_lnd.get_node_timeout', autospec=True)
-    @patch('lighter.light_lnd.ThreadPoolExecutor', autospec=True)
+    @patch('lighter.light_lnd.get_jobs', autospec=True)
     @patch('lighter.light_lnd._connect', autospec=True)
     @patch('lighter.light_lnd.Err')
     @patch('lighter.light_lnd.check_req_params', autospec=True)
     def test_CloseChannel(self, mocked_check_par, mocked_err, mocked_connect,
-                          mocked_thread, mocked_get_time, mocked_thread_time,
+                          mocked_jobs, mocked_get_time, mocked_thread_time,
                           mocked_handle):
         mocked_err().invalid.side_effect = Exception()
         mocked_get_time.return_value = 30
@@ -868,16 +1098,18 @@ class LightLndTests(TestCase):
         stub = mocked_connect.return_value.__enter__.return_value
         stub.GetChanInfo.return_value = ln.ChannelEdge(chan_point='1rtfm:0')
         future = Mock()
-        executor = Mock()
-        future.result.return_value = txid.encode()
-        executor.submit.return_value = future
-        mocked_thread.return_value = executor
+        future.result.return_value = txid
+        mocked_jobs.return_value.submit.return_value = ('job', future)
         request = pb.CloseChannelRequest(channel_id='777')
         ctx = Mock()
         ctx.time_remaining.return_value = 300
         res = MOD.CloseChannel(request, ctx)
         self.assertEqual(res.closing_txid, txid)
         mocked_check_par.assert_called_once_with(ctx, request, 'channel_id')
+        chan_point = ln.ChannelPoint(funding_txid_str='1rtfm', output_index=0)
+        mocked_jobs.return_value.submit.assert_called_once_with(
+            ctx, 'close', MOD._close_channel,
+            ln.CloseChannelRequest(channel_point=chan_point), 30)
         # Invalid channel_id case
         reset_mocks(vars())
         bad_request = pb.CloseChannelRequest(channel_id='aa7')
@@ -888,8 +1120,7 @@ class LightLndTests(TestCase):
         reset_mocks(vars())
         future.result.side_effect = TimeoutFutError()
         res = MOD.CloseChannel(request, ctx)
-        executor.shutdown.assert_called_once_with(wait=False)
-        self.assertEqual(res, pb.CloseChannelResponse())
+        self.assertEqual(res, pb.CloseChannelResponse(job_id='job'))
         # Result throws RuntimeError
         # (could be triggered by _connect in _close_channel)
         reset_mocks(vars())
@@ -904,6 +1135,13 @@ class LightLndTests(TestCase):
         MOD.CloseChannel(request, ctx)
         mocked_handle.assert_called_once_with(ctx, error)
 
+    @patch('lighter.light_lnd.get_close_status', autospec=True)
+    def test_GetCloseStatus(self, mocked_get):
+        request = pb.GetCloseStatusRequest(job_id='job')
+        res = MOD.GetCloseStatus(request, CTX)
+        mocked_get.assert_called_once_with(request, CTX)
+        self.assertEqual(res, mocked_get.return_value)
+
     @patch('lighter.light_lnd._txid_bytes_to_str', autospec=True)
     @patch('lighter.light_lnd.LOGGER', autospec=True)
     @patch('lighter.light_lnd._connect', autospec=True)
@@ -922,6 +1160,12 @@ class LightLndTests(TestCase):
         res = MOD._close_channel(lnd_req, 15)
         self.assertEqual(mocked_log.debug.call_count, 1)
         self.assertEqual(res, ptxid)
+        # No pending update case
+        reset_mocks(vars())
+        stub.CloseChannel.return_value = [
+            ln.CloseStatusUpdate(chan_close=channel_close_update)]
+        res = MOD._close_channel(lnd_req, 15)
+        self.assertEqual(res, None)
         # stub throws RpcError
         reset_mocks(vars())
         stub.CloseChannel.side_effect = CalledRpcError()
@@ -980,102 +1224,78 @@ class LightLndTests(TestCase):
         ]
         mocked_conv.assert_has_calls(calls)
         self.assertEqual(response.channels[0].remote_pubkey, 'abc')
-        # Skip add of inactive channel case
-        reset_mocks(vars())
-        response = pb.ListChannelsResponse()
-        lnd_chan = ln.Channel(
-            chan_id=123,
-            capacity=7777777,
-            local_balance=6666666,
-            remote_balance=1111111,
-            active=False)
-        MOD._add_channel(CTX, response, lnd_chan, pb.OPEN, True)
-        self.assertEqual(response, pb.ListChannelsResponse())
 
-    def test_check_timestamp(self):
-        # list_order 1, search_order 1: search_timestamp lower than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW - 1, list_order=1, search_order=1)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, True)
-        # list_order 1, search_order 1: search_timestamp higher than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW + 1, list_order=1, search_order=1)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, False)
-        # list_order 1, search_order 0: search_timestamp lower than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW - 1, list_order=1, search_order=0)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, False)
-        # list_order 1, search_order 0: search_timestamp higher than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW + 1, list_order=1, search_order=0)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, True)
-        # list_order 0, search_order 1: search_timestamp lower than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW - 1, list_order=0, search_order=1)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, True)
-        # list_order 0, search_order 1: search_timestamp higher than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW + 1, list_order=0, search_order=1)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, False)
-        # list_order 0, search_order 0: search_timestamp lower than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW - 1, list_order=0, search_order=0)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, False)
-        # list_order 0, search_order 0: search_timestamp higher than creation_date
-        request = pb.ListInvoicesRequest(
-            search_timestamp=fix.NOW + 1, list_order=0, search_order=0)
-        lnd_invoice = ln.Invoice(creation_date=fix.NOW)
-        res = MOD._check_timestamp(request, lnd_invoice)
-        self.assertEqual(res, True)
-        # Empty request
-        request = pb.ListInvoicesRequest()
-        res = MOD._check_timestamp(request, 'lnd_invoice')
-        self.assertEqual(res, False)
-
-    @patch('lighter.light_lnd._add_invoice', autospec=True)
-    @patch('lighter.light_lnd._get_invoice_state', autospec=True)
-    @patch('lighter.light_lnd._check_timestamp', autospec=True)
-    def test_parse_invoices(self, mocked_check, mocked_inv_st, mocked_add):
-        # Correct case: every state is requested
-        mocked_inv_st.side_effect = [pb.PAID, pb.PENDING, pb.EXPIRED]
-        response = pb.ListInvoicesResponse()
-        invoices = fix.INVOICES
-        mocked_check.side_effect = [False] * len(invoices)
-        request = pb.ListInvoicesRequest(
-            paid=True, pending=True, expired=True, max_items=10)
-        res = MOD._parse_invoices(CTX, response, invoices, request)
-        self.assertEqual(res, False)
-        self.assertEqual(mocked_add.call_count, len(invoices))
-        # Correct case: no state is requested, should return an empty response
-        reset_mocks(vars())
-        mocked_inv_st.side_effect = [pb.PAID, pb.PENDING, pb.EXPIRED]
-        response = pb.ListInvoicesResponse()
-        request = pb.ListInvoicesRequest(paid=True, pending=True, expired=True)
-        mocked_check.side_effect = [False] * len(invoices)
-        res = MOD._parse_invoices(CTX, response, invoices, request)
-        self.assertEqual(res, True)
-        # _check_timestamp true
+    @patch('lighter.light_lnd._get_invoice', autospec=True)
+    def test_get_invoice_row(self, mocked_get_inv):
+        mocked_get_inv.return_value = pb.Invoice(
+            payment_hash='hash', timestamp=1000, expiry_time=60)
+        lnd_invoice = ln.Invoice(
+            state=ln.Invoice.OPEN, creation_date=1000, expiry=60,
+            add_index=7)
+        res = MOD._get_invoice_row(CTX, lnd_invoice)
+        mocked_get_inv.assert_called_once_with(
+            CTX, lnd_invoice, MOD._get_invoice_state(lnd_invoice))
+        self.assertEqual(res['status'], pb.PENDING)
+        self.assertEqual(res['expires_at'], 1060)
+        self.assertEqual(res['node_index'], 7)
+        # Settled invoice case
+        mocked_get_inv.return_value.state = pb.PAID
+        lnd_invoice.state = ln.Invoice.SETTLED
+        res = MOD._get_invoice_row(CTX, lnd_invoice)
+        self.assertEqual(res['status'], pb.PAID)
+
+    @patch('lighter.light_lnd._get_invoice_row', autospec=True)
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_sync_invoices(self, mocked_connect, mocked_get_time,
+                           mocked_get_row):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        store = Mock()
+        store.cursor.return_value = 5
+        store.get_oldest_open_index.return_value = None
+        lnd_res = fix.get_invoices_response(None)
+        offsets = []
+
+        def list_invoices(lnd_req, timeout):
+            offsets.append(lnd_req.index_offset)
+            self.assertEqual(lnd_req.num_max_invoices, settings.MAX_INVOICES)
+            self.assertEqual(timeout, 10)
+            if len(offsets) > 1:
+                return ln.ListInvoiceResponse()
+            return lnd_res
+
+        stub.ListInvoices.side_effect = list_invoices
+        MOD._sync_invoices(CTX, store)
+        store.cursor.assert_called_once_with('add_index')
+        self.assertEqual(offsets, [5, lnd_res.last_index_offset])
+        store.save.assert_called_once_with(
+            [mocked_get_row.return_value] * len(lnd_res.invoices),
+            {'add_index': 5})
+        # Pending invoices case, syncing from the oldest one
         reset_mocks(vars())
-        mocked_inv_st.side_effect = [pb.PAID, pb.PENDING, pb.EXPIRED]
-        mocked_check.side_effect = [True] * len(invoices)
-        res = MOD._parse_invoices(CTX, response, invoices, request)
-        self.assertEqual(mocked_check.call_count, len(invoices))
-        self.assertEqual(mocked_add.call_count, 0)
-        self.assertEqual(res, False)
+        offsets.clear()
+        store.cursor.return_value = 1
+        store.get_oldest_open_index.return_value = 1
+        MOD._sync_invoices(CTX, store)
+        self.assertEqual(offsets, [0, lnd_res.last_index_offset])
+        store.save.assert_called_once_with(
+            [mocked_get_row.return_value] * len(lnd_res.invoices),
+            {'add_index': lnd_res.last_index_offset})
+
+    @patch('lighter.light_lnd._get_invoice_row', autospec=True)
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_lookup_invoice(self, mocked_connect, mocked_get_time,
+                            mocked_get_row):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        res = MOD._lookup_invoice(CTX, 'hash')
+        stub.LookupInvoice.assert_called_once_with(
+            ln.PaymentHash(r_hash_str='hash'), timeout=10)
+        mocked_get_row.assert_called_once_with(
+            CTX, stub.LookupInvoice.return_value)
+        self.assertEqual(res, mocked_get_row.return_value)
 
     @patch('lighter.light_lnd._add_route_hint', autospec=True)
     @patch('lighter.light_lnd.convert', autospec=True)
@@ -1102,6 +1322,229 @@ class LightLndTests(TestCase):
         MOD._add_invoice(CTX, response, invoice, 2)
         assert not mocked_conv.called
 
+    @patch('lighter.light_lnd.convert', autospec=True)
+    def test_get_invoice(self, mocked_conv):
+        mocked_conv.return_value = 7
+        lnd_invoice = ln.Invoice(memo='m', value=7, settle_index=3)
+        res = MOD._get_invoice(CTX, lnd_invoice, pb.PAID)
+        self.assertEqual(res.description, 'm')
+        self.assertEqual(res.amount_bits, 7)
+        self.assertEqual(res.state, pb.PAID)
+
+    @patch('lighter.light_lnd._handle_error', autospec=True)
+    @patch('lighter.light_lnd._get_invoice', autospec=True)
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_list_settled_invoices(self, mocked_connect, mocked_get_time,
+                                   mocked_get_inv, mocked_handle):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        mocked_get_inv.side_effect = lambda _ctx, inv, _st: inv.memo
+        page = ln.ListInvoiceResponse(last_index_offset=3)
+        page.invoices.add(memo='a', state=ln.Invoice.SETTLED, settle_index=2)
+        page.invoices.add(memo='b', state=ln.Invoice.OPEN)
+        page.invoices.add(memo='c', state=ln.Invoice.SETTLED, settle_index=1)
+        page2 = ln.ListInvoiceResponse(last_index_offset=4)
+        page2.invoices.add(memo='d', state=ln.Invoice.SETTLED, settle_index=3)
+        stub.ListInvoices.side_effect = [
+            page, page2, ln.ListInvoiceResponse()]
+        res = MOD._list_settled_invoices(CTX, 1)
+        self.assertEqual(res, [(2, 'a'), (3, 'd')])
+        self.assertEqual(stub.ListInvoices.call_count, 3)
+        self.assertEqual(
+            stub.ListInvoices.call_args[0][0].index_offset, 4)
+        assert not mocked_handle.called
+        # Error case
+        reset_mocks(vars())
+        stub.ListInvoices.side_effect = CalledRpcError()
+        MOD._list_settled_invoices(CTX, 1)
+        assert mocked_handle.called
+
+    @patch('lighter.light_lnd._get_invoice', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_wait_settled_invoices(self, mocked_connect, mocked_get_inv):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_inv.side_effect = lambda _ctx, inv, _st: inv.memo
+        lnd_res = stub.SubscribeInvoices.return_value
+        lnd_res.__iter__ = Mock(return_value=iter([
+            ln.Invoice(memo='a', state=ln.Invoice.OPEN, add_index=9),
+            ln.Invoice(memo='b', state=ln.Invoice.SETTLED, settle_index=5),
+            ln.Invoice(memo='c', state=ln.Invoice.SETTLED, settle_index=6)]))
+        stream = MOD._wait_settled_invoices(4)
+        self.assertEqual(next(stream), (5, 'b'))
+        self.assertEqual(
+            stub.SubscribeInvoices.call_args[0][0].settle_index, 4)
+        # Subscription closed case
+        stream.close()
+        lnd_res.cancel.assert_called_once_with()
+        # From now on case
+        reset_mocks(vars())
+        lnd_res.__iter__ = Mock(return_value=iter([]))
+        list(MOD._wait_settled_invoices(None))
+        self.assertEqual(
+            stub.SubscribeInvoices.call_args[0][0].settle_index, 0)
+        lnd_res.cancel.assert_called_once_with()
+
+    @patch('lighter.light_lnd.get_channels_mirror', autospec=True)
+    def test_get_channels_mirror(self, mocked_get_mirror):
+        res = MOD._get_channels_mirror()
+        mocked_get_mirror.assert_called_once_with(
+            MOD._list_channels, MOD._watch_channels)
+        self.assertEqual(res, mocked_get_mirror.return_value)
+
+    @patch('lighter.light_lnd._handle_error', autospec=True)
+    @patch('lighter.light_lnd._add_channel', autospec=True)
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_list_channels(self, mocked_connect, mocked_get_time, mocked_add,
+                           mocked_handle):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        mocked_add.side_effect = \
+            lambda _ctx, res, _chan, state, **_kw: res.channels.add(
+                state=state)
+        lnd_res_act = ln.ListChannelsResponse()
+        lnd_res_act.channels.add()
+        stub.ListChannels.return_value = lnd_res_act
+        lnd_res_pen = ln.PendingChannelsResponse()
+        lnd_res_pen.pending_open_channels.add()
+        lnd_res_pen.pending_closing_channels.add()
+        lnd_res_pen.pending_force_closing_channels.add()
+        lnd_res_pen.waiting_close_channels.add()
+        stub.PendingChannels.return_value = lnd_res_pen
+        res = MOD._list_channels(CTX)
+        calls = [
+            call(CTX, ANY, lnd_res_act.channels[0], pb.OPEN, open_chan=True),
+            call(CTX, ANY, lnd_res_pen.pending_open_channels[0].channel,
+                 pb.PENDING_OPEN),
+            call(CTX, ANY, lnd_res_pen.pending_closing_channels[0].channel,
+                 pb.PENDING_MUTUAL_CLOSE),
+            call(CTX, ANY,
+                 lnd_res_pen.pending_force_closing_channels[0].channel,
+                 pb.PENDING_FORCE_CLOSE),
+            call(CTX, ANY, lnd_res_pen.waiting_close_channels[0].channel,
+                 pb.UNKNOWN)
+        ]
+        mocked_add.assert_has_calls(calls)
+        stub.ListChannels.assert_called_once_with(
+            ln.ListChannelsRequest(), timeout=10)
+        stub.PendingChannels.assert_called_once_with(
+            ln.PendingChannelsRequest(), timeout=10)
+        assert not mocked_handle.called
+        self.assertEqual(
+            [chan.state for chan in res],
+            [pb.OPEN, pb.PENDING_OPEN, pb.PENDING_MUTUAL_CLOSE,
+             pb.PENDING_FORCE_CLOSE, pb.UNKNOWN])
+        # Error case
+        reset_mocks(vars())
+        stub.ListChannels.side_effect = CalledRpcError()
+        MOD._list_channels(CTX)
+        assert mocked_handle.called
+
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_watch_channels(self, mocked_connect):
+        stub = mocked_connect.return_value.__enter__.return_value
+        stub.SubscribeChannelEvents.return_value = [
+            ln.ChannelEventUpdate(type=ln.ChannelEventUpdate.ACTIVE_CHANNEL),
+            ln.ChannelEventUpdate(type=ln.ChannelEventUpdate.CLOSED_CHANNEL)]
+        res = list(MOD._watch_channels())
+        self.assertEqual(len(res), 2)
+        stub.SubscribeChannelEvents.assert_called_once_with(
+            ln.ChannelEventSubscription())
+
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_load_nodes(self, mocked_connect, mocked_get_time):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        lnd_res = ln.ChannelGraph()
+        lnd_res.nodes.add(pub_key='pubkey', alias='alias', color='#3399ff')
+        stub.DescribeGraph.return_value = lnd_res
+        res = MOD._load_nodes(CTX)
+        mocked_get_time.assert_called_once_with(
+            CTX, min_time=settings.IMPL_MAX_TIMEOUT)
+        stub.DescribeGraph.assert_called_once_with(
+            ln.ChannelGraphRequest(), timeout=10)
+        self.assertEqual(res, {'pubkey': ('alias', '#3399ff')})
+        # Error case
+        stub.DescribeGraph.side_effect = CalledRpcError()
+        res = MOD._load_nodes(CTX)
+        self.assertEqual(res, None)
+
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_lookup_node(self, mocked_connect, mocked_get_time):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        lnd_res = ln.NodeInfo()
+        lnd_res.node.alias = 'alias'
+        lnd_res.node.color = '#3399ff'
+        stub.GetNodeInfo.return_value = lnd_res
+        res = MOD._lookup_node(CTX, 'pubkey')
+        mocked_connect.assert_called_once_with(CTX)
+        mocked_get_time.assert_called_once_with(CTX)
+        stub.GetNodeInfo.assert_called_once_with(
+            ln.NodeInfoRequest(pub_key='pubkey'), timeout=10)
+        self.assertEqual(res, ('alias', '#3399ff'))
+        # Unknown node case
+        stub.GetNodeInfo.side_effect = NotFoundRpcError()
+        res = MOD._lookup_node(CTX, 'pubkey')
+        self.assertEqual(res, None)
+        # Error case
+        stub.GetNodeInfo.side_effect = CalledRpcError()
+        with self.assertRaises(CalledRpcError):
+            MOD._lookup_node(CTX, 'pubkey')
+
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_list_payments(self, mocked_connect, mocked_get_time):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        stub.ListPayments.return_value = fix.get_listpayments_response()
+        res = MOD._list_payments(CTX)
+        stub.ListPayments.assert_called_once_with(
+            ln.ListPaymentsRequest(), timeout=10)
+        self.assertEqual(list(res), fix.PAYMENTS)
+
+    @patch('lighter.light_lnd._add_payment', autospec=True)
+    def test_get_payments_pages(self, mocked_add):
+        request = pb.ListPaymentsRequest()
+        pages = list(MOD._get_payments_pages(CTX, request, fix.PAYMENTS, 2))
+        self.assertEqual(len(pages), 2)
+        self.assertNotEqual(pages[0].next_cursor, '')
+        self.assertEqual(pages[1].next_cursor, '')
+        self.assertEqual(
+            [args[0][2] for args in mocked_add.call_args_list],
+            [fix.PAYMENT2, fix.PAYMENT1, fix.PAYMENT3])
+        # Cursor case
+        reset_mocks(vars())
+        request.cursor = pages[0].next_cursor
+        pages = list(MOD._get_payments_pages(CTX, request, fix.PAYMENTS, 2))
+        self.assertEqual(len(pages), 1)
+        mocked_add.assert_called_once_with(CTX, pages[0], fix.PAYMENT3)
+
+    @patch('lighter.light_lnd.get_node_timeout', autospec=True)
+    @patch('lighter.light_lnd._connect', autospec=True)
+    def test_list_transactions(self, mocked_connect, mocked_get_time):
+        stub = mocked_connect.return_value.__enter__.return_value
+        mocked_get_time.return_value = 10
+        lnd_res = fix.get_transactions_response()
+        stub.GetTransactions.return_value = lnd_res
+        res = MOD._list_transactions(CTX)
+        stub.GetTransactions.assert_called_once_with(
+            ln.GetTransactionsRequest(), timeout=10)
+        self.assertEqual(res, lnd_res.transactions)
+
+    @patch('lighter.light_lnd._add_transaction', autospec=True)
+    def test_get_transactions_pages(self, mocked_add):
+        request = pb.ListTransactionsRequest()
+        lnd_transactions = fix.get_transactions_response().transactions
+        pages = list(MOD._get_transactions_pages(
+            CTX, request, lnd_transactions, 0))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(pages[0].next_cursor, '')
+        self.assertEqual(mocked_add.call_count, 2)
+
     @patch('lighter.light_lnd.convert', autospec=True)
     def test_add_payment(self, mocked_conv):
         # Correct case
@@ -1206,6 +1649,30 @@ class CalledRpcError(RpcError):
         return 'no error message'
 
 
+class UnavailableRpcError(RpcError):
+    def code(self):
+        return StatusCode.UNAVAILABLE
+
+    def details(self):
+        return 'unavailable'
+
+
+class DeadlineRpcError(RpcError):
+    def code(self):
+        return StatusCode.DEADLINE_EXCEEDED
+
+    def details(self):
+        return 'Deadline Exceeded'
+
+
+class NotFoundRpcError(RpcError):
+    def code(self):
+        return StatusCode.NOT_FOUND
+
+    def details(self):
+        return 'unable to find node'
+
+
 class ConnectRpcError(RpcError):
     def details(self):
         return 'already connected to peer'
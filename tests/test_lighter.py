@@ -20,7 +20,7 @@ from grpc import ssl_server_credentials, StatusCode
 from importlib import import_module
 from inspect import unwrap
 from unittest import TestCase, skip
-from unittest.mock import Mock, mock_open, patch
+from unittest.mock import ANY, Mock, mock_open, patch
 
 from lighter import lighter_pb2 as pb
 from lighter import settings, utils
@@ -110,55 +110,153 @@ class LighterTests(TestCase):
         assert not executor.shutdown.called
         assert not mocked_log.called
 
+    @patch('lighter.lighter.close_payments_tracker', autospec=True)
+    @patch('lighter.lighter.close_invoices_hub', autospec=True)
+    @patch('lighter.lighter.close_channels_mirror', autospec=True)
+    @patch('lighter.lighter.close_node_health', autospec=True)
+    @patch('lighter.lighter.close_health_servicer', autospec=True)
+    @patch('lighter.lighter.import_module')
     @patch('lighter.lighter.Thread', autospec=True)
     @patch('lighter.lighter.check_password', autospec=True)
     @patch('lighter.lighter.session_scope', autospec=True)
     @patch('lighter.lighter.check_req_params', autospec=True)
     def test_LockLighter(self, mocked_check_par, mocked_ses,
-                         mocked_check_password, mocked_thread):
+                         mocked_check_password, mocked_thread,
+                         mocked_import, mocked_close_servicer,
+                         mocked_close_health,
+                         mocked_close_mirror, mocked_close_hub,
+                         mocked_close_tracker):
         password = 'password'
         settings.RUNTIME_SERVER = Mock()
+        settings.MAC_CACHE = Mock()
+        settings.RESPONSE_CACHE = Mock()
         request = pb.LockLighterRequest(password=password)
         lock_self = MOD.LockerServicer()
         lock_func = unwrap(lock_self.LockLighter)
         res = lock_func(lock_self, request, CTX)
         settings.RUNTIME_SERVER.stop.assert_called_once_with(
             settings.GRPC_GRACE_TIME)
+        settings.MAC_CACHE.clear.assert_called_once_with()
+        settings.RESPONSE_CACHE.clear.assert_called_once_with()
+        mocked_import.return_value.disconnect.assert_called_once_with()
+        mocked_close_servicer.assert_called_once_with()
+        mocked_close_health.assert_called_once_with()
+        mocked_close_mirror.assert_called_once_with()
+        mocked_close_hub.assert_called_once_with()
+        mocked_close_tracker.assert_called_once_with()
+        self.assertEqual(res, pb.LockLighterResponse())
+        # implementation without connections to close
+        reset_mocks(vars())
+        mocked_import.return_value = object()
+        settings.MAC_CACHE = None
+        settings.RESPONSE_CACHE = None
+        res = lock_func(lock_self, request, CTX)
         self.assertEqual(res, pb.LockLighterResponse())
 
 
-    @patch('lighter.lighter.Err')
-    @patch('lighter.lighter.getattr')
+    @patch('lighter.lighter.SingleFlight', autospec=True)
+    @patch('lighter.lighter.NodeHealth', autospec=True)
+    @patch('lighter.lighter.ResponseCache', autospec=True)
+    @patch('lighter.lighter._method_handler', autospec=True)
+    @patch('lighter.lighter._unimplemented_method', autospec=True)
+    @patch('lighter.lighter.handle_logs', autospec=True)
     @patch('lighter.lighter.import_module')
-    def test_dispatcher(self, mocked_import, mocked_getattr, mocked_err):
-        lightning_self = MOD.LightningServicer()
-        lightning_func = unwrap(lightning_self.unexistent)
-        request = pb.GetInfoRequest()
-        response = pb.GetInfoResponse()
-        # Correct case
-        settings.IMPLEMENTATION = ''
-        mocked_import.return_value = 'module'
-        grpc_server = MOD.LightningServicer()
-        func = Mock()
-        func.return_value = response
-        mocked_getattr.return_value = func
-        res = lightning_func(request, CTX)
-        mocked_import.assert_called_once_with('lighter.light_')
-        mocked_getattr.assert_called_once_with('module', 'unexistent')
-        assert not mocked_err().unimplemented_method.called
-        self.assertEqual(res, response)
-        # Error case
+    def test_LightningServicer(self, mocked_import, mocked_handle_logs,
+                               mocked_unimpl, mocked_handler, mocked_cache,
+                               mocked_health, mocked_flight):
+        settings.IMPLEMENTATION = 'impl'
+        module = Mock(spec=['GetInfo', 'PayInvoice', 'SubscribeInvoices',
+                            'GetPayment'])
+        mocked_import.return_value = module
+        mocked_handler.side_effect = lambda method, _func: method.name
+        cache = mocked_cache.return_value
+        flights = mocked_flight.return_value
+        health = mocked_health.return_value
+        health.guarded.side_effect = lambda func: func
+        servicer = MOD.LightningServicer()
+        mocked_import.assert_called_once_with('lighter.light_impl')
+        mocked_cache.assert_called_once_with(
+            settings.CACHE_TTLS, settings.CACHE_STALE_TIME,
+            listeners=[MOD.invalidate_channels_mirror],
+            no_stale=settings.CACHE_NO_STALE)
+        self.assertEqual(settings.RESPONSE_CACHE, cache)
+        self.assertEqual(settings.SINGLE_FLIGHT, flights)
+        self.assertEqual(settings.NODE_HEALTH, health)
+        mocked_health.assert_called_once_with(
+            ANY, listeners=[MOD.update_serving_status])
+        health.start.assert_called_once_with()
+        methods = pb.DESCRIPTOR.services_by_name['Lightning'].methods
+        self.assertEqual(mocked_handler.call_count, len(methods))
+        self.assertEqual(health.guarded.call_count, 3)
+        self.assertEqual(flights.coalesced.call_count, 2)
+        flights.coalesced.assert_any_call('GetInfo', module.GetInfo)
+        # not calling the node, not guarded
+        flights.coalesced.assert_any_call('GetPayment', module.GetPayment)
+        cache.cached.assert_any_call(
+            'GetInfo', flights.coalesced.return_value)
+        cache.invalidating.assert_called_once_with(module.PayInvoice)
+        mocked_handle_logs.assert_any_call(cache.cached.return_value)
+        mocked_handle_logs.assert_any_call(cache.invalidating.return_value)
+        mocked_handle_logs.assert_any_call(module.SubscribeInvoices)
+        mocked_handle_logs.assert_any_call(MOD.GetNodeHealth)
+        mocked_handle_logs.assert_any_call(MOD.GetMetrics)
+        mocked_handle_logs.assert_any_call(MOD.ProfileLighter)
+        mocked_unimpl.assert_any_call('ListPeers')
+        self.assertEqual(mocked_unimpl.call_count, len(methods) - 7)
+        # Method dispatching
+        details = Mock(method='/lighter.Lightning/GetInfo')
+        self.assertEqual(servicer.service(details), 'GetInfo')
+        details = Mock(method='/lighter.Lightning/Unexistent')
+        self.assertEqual(servicer.service(details), None)
+        # Asyncio server mode, with a coroutine variant
         reset_mocks(vars())
-        grpc_server = MOD.LightningServicer()
-        mocked_import.return_value = 'module'
-        mocked_getattr.side_effect = AttributeError()
-        mocked_err().unimplemented_method.side_effect = Exception()
-        with self.assertRaises(Exception):
-            res = lightning_func(request, CTX)
-        mocked_import.assert_called_once_with('lighter.light_')
-        mocked_getattr.assert_called_once_with('module', 'unexistent')
+        settings.GRPC_ASYNC = 1
+        module = Mock(spec=['GetInfo', 'ASYNC_APIS', '_get_info_async'])
+        module.ASYNC_APIS = {'GetInfo': '_get_info_async'}
+        mocked_import.return_value = module
+        with patch('lighter.aio.async_method') as mocked_async:
+            servicer = MOD.LightningServicer()
+        mocked_async.assert_called_once_with(module._get_info_async)
+        self.assertEqual(mocked_async.return_value.__name__, 'GetInfo')
+        flights.coalesced.assert_called_once_with(
+            'GetInfo', mocked_async.return_value)
+        settings.GRPC_ASYNC = 0
+        settings.RESPONSE_CACHE = None
+        settings.SINGLE_FLIGHT = None
+        settings.NODE_HEALTH = None
+
+    def test_probe_node(self):
+        module = Mock()
+        MOD._probe_node(module)
+        module.GetInfo.assert_called_once_with(pb.GetInfoRequest(), ANY)
+
+    @patch('lighter.lighter.Err')
+    def test_unimplemented_method(self, mocked_err):
+        func = MOD._unimplemented_method('GetInfo')
+        self.assertEqual(func.__name__, 'GetInfo')
+        func(pb.GetInfoRequest(), CTX)
         mocked_err().unimplemented_method.assert_called_once_with(
-            CTX, 'unexistent')
+            CTX, 'GetInfo')
+
+    @patch('lighter.lighter.unary_stream_rpc_method_handler')
+    @patch('lighter.lighter.unary_unary_rpc_method_handler')
+    def test_method_handler(self, mocked_unary, mocked_stream):
+        methods = pb.DESCRIPTOR.services_by_name['Lightning'].methods_by_name
+        res = MOD._method_handler(methods['GetInfo'], 'func')
+        mocked_unary.assert_called_once_with(
+            'func', request_deserializer=pb.GetInfoRequest.FromString,
+            response_serializer=pb.GetInfoResponse.SerializeToString)
+        self.assertEqual(res, mocked_unary.return_value)
+        assert not mocked_stream.called
+        # Server streaming method
+        reset_mocks(vars())
+        res = MOD._method_handler(methods['SubscribeInvoices'], 'func')
+        mocked_stream.assert_called_once_with(
+            'func',
+            request_deserializer=pb.SubscribeInvoicesRequest.FromString,
+            response_serializer=pb.SubscribeInvoicesResponse.SerializeToString)
+        self.assertEqual(res, mocked_stream.return_value)
+        assert not mocked_unary.called
 
     @patch('lighter.lighter.check_macaroons', autospec=True)
     @patch('lighter.lighter.unary_unary_rpc_method_handler')
@@ -177,7 +275,9 @@ class LighterTests(TestCase):
         mocked_check_mac.return_value = True
         res = interceptor.intercept_service(continuation, handler_call_details)
         continuation.assert_called_once_with(handler_call_details)
-        mocked_check_mac.assert_called_once_with(md, method)
+        mocked_check_mac.assert_called_once_with(
+            md, method, settings.MAC_CACHE)
+        self.assertIsInstance(settings.MAC_CACHE, MOD.MacaroonCache)
         self.assertEqual(res, ok)
         # Unaccepted request
         reset_mocks(vars())
@@ -195,6 +295,20 @@ class LighterTests(TestCase):
         self.assertEqual(res, None)
         ctx.abort.assert_called_once_with(StatusCode.UNAUTHENTICATED,
                                           'Access denied')
+        # Accepted request, timed
+        reset_mocks(vars())
+        handler_call_details.method = method
+        with patch('lighter.lighter.timed_handler') as mocked_timed:
+            res = interceptor.intercept_service(
+                continuation, handler_call_details)
+        mocked_timed.assert_called_once_with(ok, method, ANY, ANY)
+        self.assertEqual(res, mocked_timed.return_value)
+        # Health check, without macaroons
+        reset_mocks(vars())
+        handler_call_details.method = '/grpc.health.v1.Health/Check'
+        res = interceptor.intercept_service(continuation, handler_call_details)
+        self.assertEqual(res, ok)
+        assert not mocked_check_mac.called
         # Macaroons disabled
         reset_mocks(vars())
         settings.DISABLE_MACAROONS = True
@@ -217,6 +331,12 @@ class LighterTests(TestCase):
         res = interceptor.intercept_service(continuation, handler_call_details)
         continuation.assert_called_once_with(handler_call_details)
         self.assertEqual(res, ok)
+        # Health check
+        reset_mocks(vars())
+        handler_call_details.method = '/grpc.health.v1.Health/Watch'
+        res = interceptor.intercept_service(continuation, handler_call_details)
+        continuation.assert_called_once_with(handler_call_details)
+        self.assertEqual(res, ok)
         # Wrong API
         reset_mocks(vars())
         ign_req = 'ignored_request'
@@ -243,7 +363,11 @@ class LighterTests(TestCase):
         settings.INSECURE_CONNECTION = 1
         mocked_server.return_value = grpc_server
         res = MOD._create_server(interceptors)
-        assert mocked_server.called
+        mocked_server.assert_called_once_with(
+            settings.GRPC_EXECUTOR, interceptors=interceptors)
+        self.assertEqual(
+            settings.GRPC_EXECUTOR._max_workers,
+            settings.GRPC_WORKERS + settings.MAX_STREAMS)
         mocked_server.return_value.add_insecure_port.assert_called_with(
             settings.LIGHTER_ADDR)
         self.assertEqual(res, grpc_server)
@@ -270,17 +394,39 @@ class LighterTests(TestCase):
             m.read.assert_called_once_with()
         mocked_server.return_value.add_secure_port.assert_called_with(
             settings.LIGHTER_ADDR, creds)
+        # Asyncio server case
+        reset_mocks(vars())
+        settings.INSECURE_CONNECTION = 1
+        settings.GRPC_ASYNC = 1
+        with patch('lighter.aio.AioServer') as mocked_aio_server:
+            res = MOD._create_server(interceptors)
+        mocked_aio_server.assert_called_once_with(interceptors)
+        assert not mocked_server.called
+        self.assertEqual(res, mocked_aio_server.return_value)
+        res.add_insecure_port.assert_called_with(settings.LIGHTER_ADDR)
+        # Asyncio server unsupported case
+        with patch.dict('sys.modules', {'lighter.aio': None}):
+            with self.assertRaises(RuntimeError):
+                MOD._create_server(interceptors)
+        settings.GRPC_ASYNC = 0
+        settings.GRPC_EXECUTOR = None
 
     @patch('lighter.lighter._unlocker_wait', autospec=True)
     @patch('lighter.lighter.LOGGER', autospec=True)
     @patch('lighter.lighter._log_listening', autospec=True)
+    @patch('lighter.lighter.get_health_servicer', autospec=True)
+    @patch('lighter.lighter.add_HealthServicer_to_server', autospec=True)
     @patch('lighter.lighter.pb_grpc.add_UnlockerServicer_to_server')
     @patch('lighter.lighter._create_server')
     def test_serve_unlocker(self, mocked_create_srv, mocked_add_unlocker,
-                            mocked_log, mocked_logger, mocked_wait):
+                            mocked_add_health, mocked_get_health, mocked_log,
+                            mocked_logger, mocked_wait):
         grpc_server = Mock()
         mocked_create_srv.return_value = grpc_server
         MOD._serve_unlocker()
+        mocked_get_health.assert_called_once_with(True)
+        mocked_add_health.assert_called_once_with(
+            mocked_get_health.return_value, grpc_server)
         mocked_log.assert_called_once_with('Unlocker service')
         mocked_logger.info.assert_called_once_with(
             'Waiting for password to unlock Lightning service...')
@@ -288,14 +434,22 @@ class LighterTests(TestCase):
 
     @patch('lighter.lighter._lightning_wait', autospec=True)
     @patch('lighter.lighter._log_listening', autospec=True)
+    @patch('lighter.lighter.get_health_servicer', autospec=True)
+    @patch('lighter.lighter.add_HealthServicer_to_server', autospec=True)
     @patch('lighter.lighter.pb_grpc.add_LockerServicer_to_server')
-    @patch('lighter.lighter.pb_grpc.add_LightningServicer_to_server')
+    @patch('lighter.lighter.LightningServicer', autospec=True)
     @patch('lighter.lighter._create_server')
-    def test_serve_runtime(self, mocked_create_srv, mocked_add_lightning,
-                           mocked_add_locker, mocked_log, mocked_wait):
+    def test_serve_runtime(self, mocked_create_srv, mocked_lightning,
+                           mocked_add_locker, mocked_add_health,
+                           mocked_get_health, mocked_log, mocked_wait):
         grpc_server = Mock()
         mocked_create_srv.return_value = grpc_server
         MOD._serve_runtime()
+        mocked_get_health.assert_called_once_with(False)
+        mocked_add_health.assert_called_once_with(
+            mocked_get_health.return_value, grpc_server)
+        grpc_server.add_generic_rpc_handlers.assert_called_once_with(
+            (mocked_lightning.return_value,))
         mocked_log.assert_called_once_with('Lightning service')
         mocked_wait.assert_called_once_with(grpc_server)
 
@@ -312,8 +466,9 @@ class LighterTests(TestCase):
         MOD._log_listening(s_name)
         assert mocked_logger.info.called
 
+    @patch('lighter.lighter.close_health_servicer', autospec=True)
     @patch('lighter.lighter.sleep', autospec=True)
-    def test_unlocker_wait(self, mocked_sleep):
+    def test_unlocker_wait(self, mocked_sleep, mocked_close_servicer):
         settings.UNLOCKER_STOP = False
         grpc_server = Mock()
 
@@ -322,6 +477,7 @@ class LighterTests(TestCase):
 
         mocked_sleep.side_effect = unlock
         MOD._unlocker_wait(grpc_server)
+        mocked_close_servicer.assert_called_once_with()
         grpc_server.stop.assert_called_once_with(0)
 
     @patch('lighter.lighter.sleep', autospec=True)
@@ -338,19 +494,30 @@ class LighterTests(TestCase):
     @patch('lighter.lighter.import_module')
     @patch('lighter.lighter.is_db_ok', autospec=True)
     @patch('lighter.lighter.session_scope', autospec=True)
+    @patch('lighter.lighter.start_metrics_server', autospec=True)
     @patch('lighter.lighter.init_db', autospec=True)
     @patch('lighter.lighter.get_start_options', autospec=True)
-    def test_start(self, mocked_get_start_opt, mocked_init_db, mocked_ses,
-                   mocked_db_ok, mocked_import, mocked_thread,
-                   mocked_serve_unlocker, mocked_serve_runtime, mocked_log):
+    def test_start(self, mocked_get_start_opt, mocked_init_db,
+                   mocked_metrics, mocked_ses, mocked_db_ok, mocked_import,
+                   mocked_thread, mocked_serve_unlocker, mocked_serve_runtime,
+                   mocked_log):
         # with secrets case
         mocked_db_ok.return_value = True
         MOD.start()
         mocked_get_start_opt.assert_called_once_with(warning=True)
+        mocked_metrics.assert_called_once_with()
         mocked_serve_unlocker.assert_called_once_with()
         mocked_serve_runtime.assert_called_once_with()
         assert not mocked_log.error.called
         mocked_init_db.assert_called_once_with()
+        self.assertEqual(settings.PROFILER, None)
+        # profiling enabled case
+        reset_mocks(vars())
+        settings.PROFILING = True
+        MOD.start()
+        assert isinstance(settings.PROFILER, MOD.Profiler)
+        settings.PROFILING = False
+        settings.PROFILER = None
         # no secrets case
         reset_mocks(vars())
         settings.IMPLEMENTATION = 'asd'
@@ -16,8 +16,10 @@
 """ Tests for macaroons module """
 
 from codecs import decode, encode
+from datetime import datetime, timedelta, timezone
 from importlib import import_module
 from macaroonbakery.bakery import Bakery
+from macaroonbakery.checkers import time_before_caveat
 from os import urandom
 from pymacaroons import Macaroon
 from unittest import TestCase, skip
@@ -55,6 +57,14 @@ class MacaroonsTests(TestCase):
         res = MOD.check_macaroons(metadata, method)
         assert mocked_logger.error.called
         self.assertEqual(res, False)
+        # Empty value case
+        reset_mocks(vars())
+        md.value = ''
+        cache = MOD.MacaroonCache(2)
+        res = MOD.check_macaroons((md,), method, cache)
+        assert mocked_logger.error.called
+        self.assertEqual(res, False)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
         # Wrong value case
         reset_mocks(vars())
         md.value = 'lighter'
@@ -62,6 +72,75 @@ class MacaroonsTests(TestCase):
         res = MOD.check_macaroons(metadata, method)
         assert mocked_logger.error.called
         self.assertEqual(res, False)
+        # Unauthorized macaroon case
+        reset_mocks(vars())
+        md.value = fix.ADMIN_MAC
+        mocked_validate.return_value = False
+        cache = MOD.MacaroonCache(2)
+        res = MOD.check_macaroons(metadata, method, cache)
+        self.assertEqual(res, False)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # Cached verification case
+        reset_mocks(vars())
+        mocked_validate.return_value = True
+        settings.RUNTIME_BAKER = MOD.get_baker(root_key)
+        res = MOD.check_macaroons(metadata, method, cache)
+        self.assertEqual(res, True)
+        self.assertEqual(mocked_validate.call_count, 1)
+        res = MOD.check_macaroons(metadata, method, cache)
+        self.assertEqual(res, True)
+        self.assertEqual(mocked_validate.call_count, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        # Same macaroon, different permission case
+        res = MOD.check_macaroons(
+            metadata, '/lighter.Lightning/PayInvoice', cache)
+        self.assertEqual(mocked_validate.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    @patch('lighter.macaroons.datetime')
+    def test_MacaroonCache(self, mocked_datetime):
+        now = datetime(2020, 1, 1)
+        mocked_datetime.utcnow.return_value = now
+        cache = MOD.MacaroonCache(2)
+        self.assertEqual(cache.is_verified('a'), False)
+        cache.add('a', None)
+        cache.add('b', now + timedelta(seconds=1))
+        self.assertEqual(cache.is_verified('a'), True)
+        self.assertEqual(cache.is_verified('b'), True)
+        # Least recently used entry eviction
+        cache.add('c', None)
+        self.assertEqual(cache.is_verified('a'), False)
+        self.assertEqual(cache.is_verified('c'), True)
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+        # Expired entry case
+        mocked_datetime.utcnow.return_value = now + timedelta(seconds=1)
+        self.assertEqual(cache.is_verified('b'), False)
+        self.assertEqual(cache.is_verified('b'), False)
+        # Clear case
+        cache.clear()
+        self.assertEqual(cache.is_verified('c'), False)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # Disabled cache case
+        cache = MOD.MacaroonCache(0)
+        cache.add('a', None)
+        self.assertEqual(cache.is_verified('a'), False)
+
+    def test_MacaroonCache_expiry(self):
+        root_key = urandom(32)
+        settings.RUNTIME_BAKER = MOD.get_baker(root_key, put_ops=True)
+        expiry = datetime.now(tz=timezone.utc) + timedelta(days=1)
+        mac = settings.RUNTIME_BAKER.oven.macaroon(
+            MOD.MAC_VERSION, expiry, None, MACAROONS[settings.MAC_ADMIN])
+        mac.add_caveat(time_before_caveat(expiry))
+        md = Mock(key='macaroon')
+        md.value = encode(mac.macaroon.serialize().encode(), 'hex')
+        cache = MOD.MacaroonCache(2)
+        res = MOD.check_macaroons((md,), '/lighter.Lightning/GetInfo', cache)
+        self.assertEqual(res, True)
+        key = (md.value, 'info', 'read')
+        self.assertEqual(
+            cache._entries[key].replace(microsecond=0),
+            expiry.replace(microsecond=0, tzinfo=None))
 
     def test_validate_macaroon(self):
         method = '/lighter.Lightning/PayInvoice'
@@ -0,0 +1,285 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for metrics module """
+
+from asyncio import run
+from importlib import import_module
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from grpc import StatusCode, unary_stream_rpc_method_handler, \
+    unary_unary_rpc_method_handler
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+
+MOD = import_module('lighter.metrics')
+CTX = 'context'
+
+
+class MetricsTests(TestCase):
+    """ Tests for metrics module """
+
+    def test_MetricsRegistry(self):
+        registry = MOD.MetricsRegistry()
+        self.assertEqual(registry.render(), '\n')
+        # Counters and gauges
+        registry.inc('lighter_requests_total', method='GetInfo')
+        registry.inc('lighter_requests_total', 2, method='GetInfo')
+        registry.inc('lighter_requests_in_flight', -1, method='GetInfo')
+        registry.inc(
+            'lighter_request_errors_total', method='Pay"\\', code='INTERNAL')
+        res = registry.render()
+        self.assertIn('# TYPE lighter_requests_total counter\n', res)
+        self.assertIn(
+            'lighter_requests_total{method="GetInfo"} 3\n', res)
+        self.assertIn(
+            'lighter_requests_in_flight{method="GetInfo"} -1\n', res)
+        self.assertIn(
+            'lighter_request_errors_total{code="INTERNAL",method="Pay\\"\\\\"}'
+            ' 1\n', res)
+        # Histograms
+        for value in (0.003, 0.01, 0.3, 100):
+            registry.observe(
+                'lighter_request_duration_seconds', value, method='GetInfo')
+        res = registry.render()
+        self.assertIn('# TYPE lighter_request_duration_seconds histogram', res)
+        self.assertIn('lighter_request_duration_seconds_bucket{'
+                      'method="GetInfo",le="0.005"} 1\n', res)
+        self.assertIn('lighter_request_duration_seconds_bucket{'
+                      'method="GetInfo",le="0.01"} 2\n', res)
+        self.assertIn('lighter_request_duration_seconds_bucket{'
+                      'method="GetInfo",le="0.5"} 3\n', res)
+        self.assertIn('lighter_request_duration_seconds_bucket{'
+                      'method="GetInfo",le="+Inf"} 4\n', res)
+        self.assertIn('lighter_request_duration_seconds_sum{'
+                      'method="GetInfo"} 100.313\n', res)
+        self.assertIn('lighter_request_duration_seconds_count{'
+                      'method="GetInfo"} 4\n', res)
+        # Collectors
+        registry.add_collector(
+            lambda: [('lighter_jobs_running', {}, 7)])
+        self.assertIn('lighter_jobs_running 7\n', registry.render())
+        # Clear case
+        registry.clear()
+        self.assertNotIn('lighter_requests_total', registry.render())
+
+    def test_collect_jobs(self):
+        settings.JOBS = None
+        self.assertEqual(MOD._collect_jobs(), [])
+        settings.JOBS = Mock()
+        settings.JOBS.get_load.return_value = {
+            'payment': (5, 1), 'close': (1, 0)}
+        res = MOD._collect_jobs()
+        self.assertEqual(res, [
+            ('lighter_jobs_running', {'kind': 'close'}, 1),
+            ('lighter_jobs_queued', {'kind': 'close'}, 0),
+            ('lighter_jobs_running', {'kind': 'payment'}, 5),
+            ('lighter_jobs_queued', {'kind': 'payment'}, 1)])
+        settings.JOBS = None
+
+    def test_collect_executor(self):
+        settings.GRPC_EXECUTOR = None
+        self.assertEqual(MOD._collect_executor(), [])
+        settings.GRPC_EXECUTOR = Mock()
+        settings.GRPC_EXECUTOR._work_queue.qsize.return_value = 3
+        res = MOD._collect_executor()
+        self.assertEqual(res, [('lighter_grpc_queued', {}, 3)])
+        settings.GRPC_EXECUTOR = None
+
+    def test_collect_components(self):
+        settings.MAC_CACHE = Mock(hits=3, misses=1)
+        res = MOD._collect_components()
+        self.assertEqual(res, [
+            ('lighter_component_events_total',
+             {'component': 'mac_cache', 'event': 'hits'}, 3),
+            ('lighter_component_events_total',
+             {'component': 'mac_cache', 'event': 'misses'}, 1)])
+        settings.MAC_CACHE = None
+
+    @patch('lighter.metrics.REGISTRY', autospec=True)
+    def test_call_started_ended(self, mocked_registry):
+        started = MOD.call_started('GetInfo')
+        mocked_registry.inc.assert_any_call(
+            'lighter_requests_total', method='GetInfo')
+        mocked_registry.inc.assert_any_call(
+            'lighter_requests_in_flight', method='GetInfo')
+        self.assertEqual(MOD.get_abort_code(), 'UNKNOWN')
+        # Successful call case
+        reset_mocks(vars())
+        stages = {}
+        MOD._STAGES.set(stages)
+        MOD.call_ended('GetInfo', started)
+        MOD._STAGES.set(None)
+        self.assertEqual(list(stages), ['handler'])
+        mocked_registry.inc.assert_called_once_with(
+            'lighter_requests_in_flight', -1, method='GetInfo')
+        self.assertEqual(mocked_registry.observe.call_count, 1)
+        # Failed call case
+        reset_mocks(vars())
+        MOD.call_ended('GetInfo', started, 'UNAVAILABLE')
+        mocked_registry.inc.assert_called_with(
+            'lighter_request_errors_total', method='GetInfo',
+            code='UNAVAILABLE')
+
+    def test_abort_code(self):
+        MOD.set_abort_code(StatusCode.NOT_FOUND)
+        self.assertEqual(MOD.get_abort_code(), 'NOT_FOUND')
+        # Call not aborted case
+        MOD.set_abort_code(None)
+        self.assertEqual(MOD.get_abort_code(), 'UNKNOWN')
+
+    @patch('lighter.metrics.REGISTRY', autospec=True)
+    def test_timed_node_call(self, mocked_registry):
+        settings.IMPLEMENTATION = 'lnd'
+        with MOD.timed_node_call('GetInfo'):
+            pass
+        args, kwargs = mocked_registry.observe.call_args
+        self.assertEqual(args[0], 'lighter_node_call_duration_seconds')
+        self.assertEqual(kwargs, {'implementation': 'lnd', 'call': 'GetInfo'})
+        # Failed call case, still observed
+        reset_mocks(vars())
+        with self.assertRaises(RuntimeError):
+            with MOD.timed_node_call('GetInfo'):
+                raise RuntimeError()
+        self.assertEqual(mocked_registry.observe.call_count, 1)
+
+    def test_add_stage(self):
+        # No call being timed case
+        MOD.add_stage('node', 1)
+        stages = {}
+        MOD._STAGES.set(stages)
+        MOD.add_stage('node', 1)
+        MOD.add_stage('node', 0.5)
+        self.assertEqual(stages, {'node': 1.5})
+        MOD._STAGES.set(None)
+
+    @patch('lighter.metrics.LOGGER', autospec=True)
+    def test_timed_handler(self, mocked_log):
+        ctx = Mock()
+        ctx.invocation_metadata.return_value = ((MOD.TIMING_HEADER, '1'),)
+
+        def behavior(request, context):
+            MOD.add_stage('node', 0.002)
+            return pb.GetInfoResponse(alias='a')
+
+        handler = unary_unary_rpc_method_handler(
+            behavior,
+            response_serializer=pb.GetInfoResponse.SerializeToString)
+        timed = MOD.timed_handler(handler, 'GetInfo', 0.001, 0)
+        self.assertEqual(timed.response_serializer, None)
+        res = timed.unary_unary('request', ctx)
+        self.assertEqual(
+            res, pb.GetInfoResponse(alias='a').SerializeToString())
+        timing = ctx.set_trailing_metadata.call_args[0][0][0]
+        self.assertEqual(timing[0], MOD.TIMING_TRAILER)
+        self.assertEqual(
+            [stage.split(';')[0] for stage in timing[1].split(', ')],
+            ['auth', 'dispatch', 'node', 'serialize'])
+        self.assertIn('auth;dur=1.000', timing[1])
+        self.assertIn('node;dur=2.000', timing[1])
+        mocked_log.debug.assert_called_once_with(
+            'Timing of %s: %s', 'GetInfo', timing[1])
+        self.assertEqual(MOD._STAGES.get(), None)
+        # Timing not requested, failed call case
+        reset_mocks(vars())
+        ctx.invocation_metadata.return_value = (('user-agent', 'x'),)
+
+        def failing(request, context):
+            raise RuntimeError()
+
+        timed = MOD.timed_handler(
+            unary_unary_rpc_method_handler(failing), 'GetInfo', 0, 0)
+        with self.assertRaises(RuntimeError):
+            timed.unary_unary('request', ctx)
+        assert not ctx.set_trailing_metadata.called
+        self.assertEqual(mocked_log.debug.call_count, 1)
+        # Coroutine case
+        reset_mocks(vars())
+
+        async def coro(request, context):
+            return pb.GetInfoResponse()
+
+        timed = MOD.timed_handler(
+            unary_unary_rpc_method_handler(coro), 'GetInfo', 0, 0)
+        self.assertEqual(run(timed.unary_unary('request', ctx)),
+                         pb.GetInfoResponse())
+        self.assertEqual(mocked_log.debug.call_count, 1)
+        # Server-streaming case
+        reset_mocks(vars())
+        ctx.invocation_metadata.return_value = ((MOD.TIMING_HEADER, '1'),)
+
+        def stream(request, context):
+            yield pb.GetInfoResponse(alias='a')
+            yield pb.GetInfoResponse(alias='b')
+
+        handler = unary_stream_rpc_method_handler(
+            stream, response_serializer=pb.GetInfoResponse.SerializeToString)
+        timed = MOD.timed_handler(handler, 'StreamInfo', 0, 0)
+        res = list(timed.unary_stream('request', ctx))
+        self.assertEqual(len(res), 2)
+        assert not isinstance(res[0], pb.GetInfoResponse)
+        timing = ctx.set_trailing_metadata.call_args[0][0][0][1]
+        self.assertIn('serialize', timing)
+        # Not a handler (asyncio server interceptor) case
+        self.assertEqual(MOD.timed_handler('handler', 'GetInfo', 0, 0),
+                         'handler')
+
+    @patch('lighter.metrics.REGISTRY', autospec=True)
+    def test_GetMetrics(self, mocked_registry):
+        mocked_registry.render.return_value = 'metrics\n'
+        res = MOD.GetMetrics(pb.GetMetricsRequest(), CTX)
+        self.assertEqual(res, pb.GetMetricsResponse(metrics='metrics\n'))
+
+    def test_start_metrics_server(self):
+        # Disabled case
+        settings.METRICS_PORT = ''
+        MOD.start_metrics_server()
+        self.assertEqual(settings.METRICS_SERVER, None)
+        # Invalid port case
+        settings.METRICS_PORT = 'x'
+        with self.assertRaises(RuntimeError):
+            MOD.start_metrics_server()
+        # Enabled case, on a free port
+        settings.METRICS_PORT = '0'
+        MOD.start_metrics_server()
+        httpd = settings.METRICS_SERVER
+        self.assertNotEqual(httpd, None)
+        # Already serving case
+        MOD.start_metrics_server()
+        self.assertEqual(settings.METRICS_SERVER, httpd)
+        url = 'http://{}:{}'.format(*httpd.server_address)
+        MOD.REGISTRY.inc('lighter_requests_total', method='GetInfo')
+        with urlopen(url + '/metrics') as response:
+            body = response.read().decode()
+        self.assertIn('lighter_requests_total{method="GetInfo"}', body)
+        with self.assertRaises(HTTPError):
+            urlopen(url + '/other')
+        httpd.shutdown()
+        httpd.server_close()
+        MOD.REGISTRY.clear()
+        settings.METRICS_SERVER = None
+        settings.METRICS_PORT = ''
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
@@ -0,0 +1,244 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for payments module """
+
+from importlib import import_module
+from threading import Event
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+
+MOD = import_module('lighter.payments')
+CTX = 'context'
+
+
+class PaymentsTests(TestCase):
+    """ Tests for payments module """
+
+    @patch('lighter.payments.PaymentsTracker', autospec=True)
+    def test_get_payments_tracker(self, mocked_tracker):
+        settings.PAYMENTS_TRACKER = None
+        res = MOD.get_payments_tracker()
+        mocked_tracker.assert_called_once_with()
+        self.assertEqual(res, mocked_tracker.return_value)
+        # Running tracker case
+        reset_mocks(vars())
+        res = MOD.get_payments_tracker()
+        assert not mocked_tracker.called
+        self.assertEqual(res, mocked_tracker.return_value)
+        settings.PAYMENTS_TRACKER = None
+
+    def test_close_payments_tracker(self):
+        tracker = Mock()
+        settings.PAYMENTS_TRACKER = tracker
+        MOD.close_payments_tracker()
+        tracker.close.assert_called_once_with()
+        self.assertEqual(settings.PAYMENTS_TRACKER, None)
+        # No tracker case
+        MOD.close_payments_tracker()
+        self.assertEqual(settings.PAYMENTS_TRACKER, None)
+
+    @patch('lighter.payments.get_payments_tracker', autospec=True)
+    @patch('lighter.payments.Err')
+    @patch('lighter.payments.decode', autospec=True)
+    def test_pay_in_background(self, mocked_decode, mocked_err,
+                               mocked_get_tracker):
+        mocked_decode.return_value.payment_hash = 'hash'
+        res = MOD.pay_in_background(CTX, 'lntb1', 'job', 'check')
+        mocked_decode.assert_called_once_with('lntb1')
+        mocked_get_tracker.return_value.submit.assert_called_once_with(
+            CTX, 'hash', 'job', 'check')
+        self.assertEqual(res, pb.PayInvoiceResponse(payment_hash='hash'))
+        # Undecodable payment request case
+        reset_mocks(vars())
+        mocked_decode.side_effect = ValueError()
+        mocked_err().invalid.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD.pay_in_background(CTX, 'lntb1', 'job', 'check')
+        mocked_err().invalid.assert_called_once_with(CTX, 'payment_request')
+        assert not mocked_get_tracker.return_value.submit.called
+
+    @patch('lighter.payments.get_payments_tracker', autospec=True)
+    @patch('lighter.payments.Err')
+    @patch('lighter.payments.check_req_params', autospec=True)
+    def test_get_payment(self, mocked_check_par, mocked_err,
+                         mocked_get_tracker):
+        tracker = mocked_get_tracker.return_value
+        request = pb.GetPaymentRequest(payment_hash='hash')
+        res = MOD.get_payment(request, CTX)
+        mocked_check_par.assert_called_once_with(CTX, request, 'payment_hash')
+        tracker.get.assert_called_once_with('hash')
+        self.assertEqual(res, tracker.get.return_value)
+        # Unknown payment case
+        reset_mocks(vars())
+        tracker.get.return_value = None
+        mocked_err().payment_not_found.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD.get_payment(request, CTX)
+        mocked_err().payment_not_found.assert_called_once_with(CTX)
+
+    @patch('lighter.payments.get_payments_tracker', autospec=True)
+    @patch('lighter.payments.Err')
+    @patch('lighter.payments.check_req_params', autospec=True)
+    def test_track_payment(self, mocked_check_par, mocked_err,
+                           mocked_get_tracker):
+        tracker = mocked_get_tracker.return_value
+        request = pb.TrackPaymentRequest(payment_hash='hash')
+        res = MOD.track_payment(request, CTX)
+        mocked_check_par.assert_called_once_with(CTX, request, 'payment_hash')
+        tracker.track.assert_called_once_with(CTX, 'hash')
+        self.assertEqual(res, tracker.track.return_value)
+        # Unknown payment case
+        reset_mocks(vars())
+        tracker.get.return_value = None
+        mocked_err().payment_not_found.side_effect = Exception()
+        with self.assertRaises(Exception):
+            MOD.track_payment(request, CTX)
+        assert not tracker.track.called
+
+    def test_PaymentsTracker(self):
+        started = Event()
+        release = Event()
+
+        def job(update):
+            update(1)
+            started.set()
+            release.wait(5)
+            return 'preimage'
+
+        settings.RESPONSE_CACHE = Mock()
+        context = Mock()
+        tracker = MOD.PaymentsTracker()
+        self.assertEqual(tracker.get('hash'), None)
+        # Submitted payment is in flight
+        self.assertEqual(tracker.submit(CTX, 'hash', job, None), True)
+        started.wait(5)
+        stream = tracker.track(context, 'hash')
+        res = next(stream)
+        self.assertEqual(res.state, pb.IN_FLIGHT)
+        self.assertEqual(res.attempts, 1)
+        self.assertEqual(tracker.get('hash'), res)
+        # Payment already in flight is not submitted again
+        self.assertEqual(tracker.submit(CTX, 'hash', job, None), False)
+        # Completed payment
+        release.set()
+        res = next(stream)
+        self.assertEqual(res.state, pb.SUCCEEDED)
+        self.assertEqual(res.payment_preimage, 'preimage')
+        with self.assertRaises(StopIteration):
+            next(stream)
+        settings.RESPONSE_CACHE.invalidate.assert_called_once_with()
+        settings.RESPONSE_CACHE = None
+        tracker.close()
+
+    def test_PaymentsTracker_failure(self):
+        def failing_job(_update):
+            raise RuntimeError('no route')
+
+        tracker = MOD.PaymentsTracker()
+        tracker.submit(CTX, 'hash', failing_job, None)
+        res = list(tracker.track(Mock(), 'hash'))[-1]
+        self.assertEqual(res.state, pb.FAILED)
+        self.assertEqual(res.failure, 'no route')
+        # Failed payment can be retried
+        self.assertEqual(
+            tracker.submit(CTX, 'hash', failing_job, None), True)
+        tracker.close()
+
+    @patch('lighter.payments.get_jobs', autospec=True)
+    def test_PaymentsTracker_rejected(self, mocked_get_jobs):
+        mocked_get_jobs.return_value.run.side_effect = RuntimeError()
+        tracker = MOD.PaymentsTracker()
+        with self.assertRaises(RuntimeError):
+            tracker.submit(CTX, 'hash', 'job', 'check')
+        self.assertEqual(
+            mocked_get_jobs.return_value.run.call_args[0][:3],
+            (CTX, 'payment', tracker._run))
+        self.assertEqual(tracker.get('hash'), None)
+        tracker.close()
+
+    def test_PaymentsTracker_unknown(self):
+        settings.PAYMENTS_CHECK_TIME = 0.01
+        checks = []
+
+        def check(payment_hash):
+            checks.append(payment_hash)
+            if len(checks) == 1:
+                raise RuntimeError('node unreachable')
+            if len(checks) == 2:
+                return pb.GetPaymentResponse(state=pb.IN_FLIGHT)
+            return pb.GetPaymentResponse(state=pb.FAILED)
+
+        tracker = MOD.PaymentsTracker()
+        # Payment of unknown outcome stays in flight until checked
+        tracker.submit(CTX, 'hash', lambda _update: None, check)
+        states = [res.state for res in tracker.track(Mock(), 'hash')]
+        self.assertEqual(states, [pb.IN_FLIGHT, pb.FAILED])
+        self.assertEqual(checks, ['hash'] * 3)
+        res = tracker.get('hash')
+        self.assertEqual(res.failure, 'Invoice payment has failed')
+        # Succeeded payment case
+        succeeded = pb.GetPaymentResponse(
+            state=pb.SUCCEEDED, payment_preimage='pre')
+        tracker.submit(
+            CTX, 'hash', lambda _update: '', lambda _hash: succeeded)
+        res = list(tracker.track(Mock(), 'hash'))[-1]
+        self.assertEqual(res.state, pb.SUCCEEDED)
+        self.assertEqual(res.payment_preimage, 'pre')
+        settings.PAYMENTS_CHECK_TIME = 30
+        tracker.close()
+
+    @patch('lighter.streams.Err')
+    def test_PaymentsTracker_slots(self, mocked_err):
+        settings.MAX_STREAMS = 0
+        mocked_err().too_many_streams.side_effect = Exception()
+        tracker = MOD.PaymentsTracker()
+        tracker.submit(CTX, 'hash', lambda _update: 'preimage', None)
+        with self.assertRaises(Exception):
+            next(tracker.track(Mock(), 'hash'))
+        settings.MAX_STREAMS = 5
+        tracker.close()
+
+    def test_PaymentsTracker_kept(self):
+        settings.PAYMENTS_KEPT = 2
+        tracker = MOD.PaymentsTracker()
+        for payment_hash in ('a', 'b', 'c'):
+            tracker.submit(
+                CTX, payment_hash, lambda _update: 'preimage', None)
+            list(tracker.track(Mock(), payment_hash))
+        self.assertEqual(tracker.get('a'), None)
+        self.assertEqual(tracker.get('b').state, pb.SUCCEEDED)
+        self.assertEqual(tracker.get('c').state, pb.SUCCEEDED)
+        settings.PAYMENTS_KEPT = 1000
+        # Closed tracker ends streams
+        release = Event()
+        tracker.submit(CTX, 'd', lambda _update: release.wait(5), None)
+        stream = tracker.track(Mock(), 'd')
+        next(stream)
+        tracker.close()
+        with self.assertRaises(StopIteration):
+            next(stream)
+        release.set()
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
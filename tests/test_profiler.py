@@ -0,0 +1,193 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for profiler module """
+
+from importlib import import_module
+from os import path
+from pstats import Stats
+from sys import _getframe
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+
+MOD = import_module('lighter.profiler')
+CTX = 'context'
+
+
+class ProfilerTests(TestCase):
+    """ Tests for profiler module """
+
+    @patch('lighter.profiler.Err')
+    def test_ProfileLighter(self, mocked_err):
+        mocked_err().profiling_disabled.side_effect = Exception()
+        mocked_err().invalid.side_effect = Exception()
+        mocked_err().out_of_range.side_effect = Exception()
+        mocked_err().profiling_running.side_effect = Exception()
+        # Profiling disabled case
+        settings.PROFILER = None
+        with self.assertRaises(Exception):
+            MOD.ProfileLighter(pb.ProfileLighterRequest(), CTX)
+        mocked_err().profiling_disabled.assert_called_once_with(CTX)
+        # Sampling case, with default seconds
+        settings.PROFILER = Mock()
+        settings.PROFILER.sample.return_value = 'stacks'
+        res = MOD.ProfileLighter(pb.ProfileLighterRequest(), CTX)
+        settings.PROFILER.sample.assert_called_once_with(settings.PROFILE_TIME)
+        self.assertEqual(res, pb.ProfileLighterResponse(file='stacks'))
+        # Too many seconds case
+        req = pb.ProfileLighterRequest(seconds=settings.PROFILE_MAX_TIME + 1)
+        with self.assertRaises(Exception):
+            MOD.ProfileLighter(req, CTX)
+        mocked_err().out_of_range.assert_called_once_with(CTX, 'seconds')
+        # Profiling calls case
+        settings.PROFILER.profile_calls.return_value = 'stats'
+        req = pb.ProfileLighterRequest(method='GetInfo', calls=3)
+        res = MOD.ProfileLighter(req, CTX)
+        settings.PROFILER.profile_calls.assert_called_once_with(
+            'GetInfo', 3, settings.PROFILE_TIME)
+        self.assertEqual(res, pb.ProfileLighterResponse(file='stats'))
+        # Unknown and streaming methods case
+        for method in ('Unknown', 'StreamInvoices'):
+            req = pb.ProfileLighterRequest(method=method)
+            with self.assertRaises(Exception):
+                MOD.ProfileLighter(req, CTX)
+        self.assertEqual(mocked_err().invalid.call_count, 2)
+        # Already running case
+        settings.PROFILER.sample.return_value = None
+        with self.assertRaises(Exception):
+            MOD.ProfileLighter(pb.ProfileLighterRequest(seconds=1), CTX)
+        mocked_err().profiling_running.assert_called_once_with(CTX)
+        settings.PROFILER = None
+
+    @patch('lighter.profiler.LOGGER', autospec=True)
+    def test_profile_on_signal(self, mocked_log):
+        # Profiling disabled case
+        settings.PROFILER = None
+        MOD.profile_on_signal(10, None)
+        self.assertEqual(mocked_log.warning.call_count, 1)
+        # Enabled case
+        settings.PROFILER = Mock()
+        MOD.profile_on_signal(10, None)
+        settings.PROFILER.sample.assert_called_once_with(settings.PROFILE_TIME)
+        self.assertEqual(mocked_log.warning.call_count, 1)
+        settings.PROFILER = None
+
+    def test_profiled_call(self):
+        func = Mock(return_value='response')
+        # Profiling disabled case
+        settings.PROFILER = None
+        res = MOD.profiled_call('GetInfo', func, ('req', CTX), {})
+        self.assertEqual(res, 'response')
+        func.assert_called_once_with('req', CTX)
+        # Other method being profiled case
+        settings.PROFILER = Mock(method='PayInvoice')
+        res = MOD.profiled_call('GetInfo', func, ('req', CTX), {})
+        self.assertEqual(res, 'response')
+        assert not settings.PROFILER.call.called
+        # Method being profiled case
+        settings.PROFILER.method = 'GetInfo'
+        MOD.profiled_call('GetInfo', func, ('req', CTX), {})
+        settings.PROFILER.call.assert_called_once_with(
+            'GetInfo', func, ('req', CTX), {})
+        settings.PROFILER = None
+
+    @patch('lighter.profiler.Timer', autospec=True)
+    @patch('lighter.profiler.LOGGER', autospec=True)
+    def test_Profiler_calls(self, mocked_log, mocked_timer):
+        logs_dir_sett = settings.LOGS_DIR
+        with TemporaryDirectory() as logs_dir:
+            settings.LOGS_DIR = logs_dir
+            profiler = MOD.Profiler()
+
+            def func(request, context):
+                return sum(range(100))
+
+            file_path = profiler.profile_calls('GetInfo', 2, 30)
+            self.assertEqual(path.dirname(file_path), logs_dir)
+            self.assertEqual(profiler.method, 'GetInfo')
+            mocked_timer.assert_called_once_with(30, profiler._expire)
+            mocked_timer.return_value.start.assert_called_once_with()
+            # Already profiling case
+            self.assertEqual(profiler.profile_calls('ListPeers', 1, 30), None)
+            self.assertEqual(
+                profiler.call('GetInfo', func, ('req', CTX), {}), 4950)
+            assert not path.exists(file_path)
+            # Last call, stats are written
+            profiler.call('GetInfo', func, ('req', CTX), {})
+            self.assertEqual(profiler.method, None)
+            stats = Stats(file_path)
+            self.assertEqual(
+                [entry for entry in stats.stats if entry[2] == 'func'][0][1],
+                func.__code__.co_firstlineno)
+            # Profiling ended case, func is just called
+            self.assertEqual(
+                profiler.call('GetInfo', func, ('req', CTX), {}), 4950)
+            # Expired case, profiled calls are written
+            file_path = profiler.profile_calls('GetInfo', 2, 30)
+            profiler.call('GetInfo', func, ('req', CTX), {})
+            profiler._expire()
+            self.assertEqual(profiler.method, 'GetInfo')
+            profiler._until = 0
+            profiler._expire()
+            self.assertEqual(profiler.method, None)
+            assert path.exists(file_path)
+            # Expired with no calls case, next call is not profiled
+            reset_mocks(vars())
+            file_path = profiler.profile_calls('ListPeers', 2, 0)
+            self.assertEqual(
+                profiler.call('ListPeers', func, ('req', CTX), {}), 4950)
+            self.assertEqual(profiler.method, None)
+            assert not path.exists(file_path)
+            self.assertEqual(mocked_log.info.call_args[0][1], 'ListPeers')
+        settings.LOGS_DIR = logs_dir_sett
+
+    @patch('lighter.profiler.LOGGER', autospec=True)
+    def test_Profiler_sample(self, mocked_log):
+        logs_dir_sett = settings.LOGS_DIR
+        with TemporaryDirectory() as logs_dir:
+            settings.LOGS_DIR = logs_dir
+            profiler = MOD.Profiler()
+            file_path = profiler.sample(0.05)
+            self.assertEqual(path.dirname(file_path), logs_dir)
+            # Already sampling case
+            self.assertEqual(profiler.sample(1), None)
+            profiler._sampler.join()
+            with open(file_path) as file:
+                lines = file.read().splitlines()
+            assert lines
+            stack, count = lines[0].rsplit(' ', 1)
+            assert int(count) > 0
+            assert 'MainThread;' in ''.join(lines)
+        settings.LOGS_DIR = logs_dir_sett
+
+    def test_collapse(self):
+        res = MOD._collapse('Thread 1', _getframe())
+        frames = res.split(';')
+        self.assertEqual(frames[0], 'Thread_1')
+        self.assertEqual(
+            frames[-1], 'test_collapse (test_profiler.py:{})'.format(
+                self.test_collapse.__code__.co_firstlineno))
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
@@ -0,0 +1,119 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Smoke tests of the node simulators, called by Lighter """
+
+from importlib import import_module
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+from lighter.channels import close_channels_mirror
+from lighter.invoices import close_invoices_store
+from lighter.payments import close_payments_tracker
+from lighter.utils import FakeContext
+from tests.simulators import Behavior, clightning, eclair, lnd, NodeData, \
+    PAY_REQS
+
+INVOICES = 20
+
+
+class SimulatorsTests(TestCase):
+    """ Starts each simulator on a free port and calls it through Lighter """
+
+    def setUp(self):
+        self.db_dir_sett = settings.DB_DIR
+        self.implementation_sett = settings.IMPLEMENTATION
+        self.work_dir = TemporaryDirectory()
+        settings.DB_DIR = self.work_dir.name
+        self.data = NodeData(
+            channels=3, invoices=INVOICES, payments=3, transactions=3,
+            nodes=10)
+
+    def tearDown(self):
+        settings.NODES_CACHE = None
+        close_channels_mirror()
+        close_invoices_store()
+        close_payments_tracker()
+        settings.DB_DIR = self.db_dir_sett
+        settings.IMPLEMENTATION = self.implementation_sett
+        self.work_dir.cleanup()
+
+    def test_lnd(self):
+        grpc_server, port = lnd.serve(
+            self.data, Behavior(), 'localhost', 0, self.work_dir.name)
+        env = {'LND_HOST': 'localhost', 'LND_PORT': str(port),
+               'LND_CERT_DIR': self.work_dir.name, 'LND_CERT': lnd.CERT}
+        try:
+            self._check_calls('lnd', env, b'macaroon')
+        finally:
+            grpc_server.stop(None)
+
+    def test_clightning(self):
+        rpc_server = clightning.serve(
+            self.data, Behavior(), self.work_dir.name)
+        env = {'CL_RPC_DIR': self.work_dir.name,
+               'CL_RPC': clightning.RPC_FILE}
+        try:
+            self._check_calls('clightning', env, None)
+        finally:
+            rpc_server.shutdown()
+            rpc_server.server_close()
+
+    def test_eclair(self):
+        httpd = eclair.serve(
+            self.data, Behavior(), 'localhost', 0, 'simulator')
+        env = {'ECL_HOST': 'localhost',
+               'ECL_PORT': str(httpd.server_address[1])}
+        try:
+            self._check_calls('eclair', env, b'simulator')
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def _check_calls(self, implementation, env, secret):
+        """ Calls the simulator through the implementation module """
+        settings.IMPLEMENTATION = implementation
+        module = import_module('lighter.light_{}'.format(implementation))
+        with patch.dict('os.environ', env):
+            module.update_settings(secret)
+        context = FakeContext()
+        try:
+            res = module.GetInfo(pb.GetInfoRequest(), context)
+            self.assertEqual(res.identity_pubkey, self.data.pubkey)
+            res = module.ListInvoices(
+                pb.ListInvoicesRequest(max_items=5, paid=True), context)
+            self.assertEqual(len(res.invoices), 5)
+            assert all(invoice.state == pb.PAID for invoice in res.invoices)
+            res = module.ListInvoices(
+                pb.ListInvoicesRequest(
+                    max_items=INVOICES, paid=True, pending=True,
+                    expired=True),
+                context)
+            self.assertEqual(len(res.invoices), INVOICES)
+            # peers are looked up one at a time, graph is not loaded
+            res = module.ListPeers(pb.ListPeersRequest(), context)
+            assert res.peers
+            for peer in res.peers:
+                self.assertEqual(
+                    peer.alias,
+                    'node{}'.format(self.data.nodes.index(peer.pubkey)))
+            res = module.PayInvoice(
+                pb.PayInvoiceRequest(payment_request=PAY_REQS[0]), context)
+            assert res.payment_preimage
+            self.assertEqual(len(self.data.payments), 4)
+        finally:
+            module.disconnect()
@@ -0,0 +1,184 @@
+# Copyright (C) 2018 inbitcoin s.r.l.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for streams module """
+
+from importlib import import_module
+from threading import Event
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from lighter import lighter_pb2 as pb
+from lighter import settings
+
+MOD = import_module('lighter.streams')
+CTX = 'context'
+
+
+def _invoice(index):
+    return pb.Invoice(payment_hash=str(index), state=pb.PAID)
+
+
+class StreamsTests(TestCase):
+    """ Tests for streams module """
+
+    @patch('lighter.streams.InvoicesHub', autospec=True)
+    def test_get_invoices_hub(self, mocked_hub):
+        settings.INVOICES_HUB = None
+        res = MOD.get_invoices_hub('list', 'wait')
+        mocked_hub.assert_called_once_with('list', 'wait')
+        self.assertEqual(res, mocked_hub.return_value)
+        # Running hub case
+        reset_mocks(vars())
+        res = MOD.get_invoices_hub('list', 'wait')
+        assert not mocked_hub.called
+        self.assertEqual(res, mocked_hub.return_value)
+        settings.INVOICES_HUB = None
+
+    def test_close_invoices_hub(self):
+        hub = Mock()
+        settings.INVOICES_HUB = hub
+        MOD.close_invoices_hub()
+        hub.close.assert_called_once_with()
+        self.assertEqual(settings.INVOICES_HUB, None)
+        # No hub case
+        MOD.close_invoices_hub()
+        self.assertEqual(settings.INVOICES_HUB, None)
+
+    def test_InvoicesHub(self):
+        waiting = Event()
+        release = Event()
+        published = Event()
+
+        def wait_settled(settle_index):
+            self.assertEqual(settle_index, None)
+            waiting.wait()
+            for index in (5, 6):
+                yield index, _invoice(index)
+            published.set()
+            release.wait()
+
+        list_settled = Mock(return_value=[(3, _invoice(3)), (4, _invoice(4))])
+        context = Mock()
+        hub = MOD.InvoicesHub(list_settled, wait_settled)
+        # New subscriber only gets new invoices
+        stream = hub.subscribe(context, 0)
+        waiting.set()
+        res = next(stream)
+        self.assertEqual(res.settle_index, 5)
+        self.assertEqual(res.invoice, _invoice(5))
+        self.assertEqual(next(stream).settle_index, 6)
+        assert not list_settled.called
+        published.wait()
+        # Resuming subscriber covered by the buffer
+        resumed = hub.subscribe(context, 5)
+        self.assertEqual(next(resumed).settle_index, 6)
+        assert not list_settled.called
+        # Resuming subscriber not covered by the buffer
+        resumed = hub.subscribe(context, 2)
+        res = [next(resumed).settle_index for _ in range(4)]
+        self.assertEqual(res, [3, 4, 5, 6])
+        list_settled.assert_called_once_with(context, 2)
+        # Inactive client case
+        context.add_callback.call_args[0][0]()
+        with self.assertRaises(StopIteration):
+            next(resumed)
+        self.assertEqual(len(hub._subscribers), 1)
+        hub.close()
+        release.set()
+
+    @patch('lighter.streams.LOGGER', autospec=True)
+    def test_run(self, mocked_log):
+        calls = []
+
+        def wait_settled(settle_index):
+            calls.append(settle_index)
+            if len(calls) == 1:
+                yield 7, _invoice(7)
+                raise RuntimeError('node error')
+            hub.close()
+            yield 8, _invoice(8)
+
+        settings.SUBSCRIBE_RETRY = 0
+        hub = MOD.InvoicesHub(Mock(), wait_settled)
+        hub._run()
+        self.assertEqual(calls, [None, 7])
+        assert mocked_log.error.called
+        self.assertEqual(list(hub._events), [(7, _invoice(7)),
+                                             (8, _invoice(8))])
+        settings.SUBSCRIBE_RETRY = 3
+
+    def test_publish(self):
+        hub = MOD.InvoicesHub(Mock(), Mock())
+        queue = Mock()
+        hub._subscribers.append(queue)
+        hub._publish(2, _invoice(2))
+        queue.put.assert_called_once_with((2, _invoice(2)))
+        self.assertEqual(hub._last_key, (2, '2'))
+        # Already published case
+        reset_mocks(vars())
+        hub._publish(2, _invoice(2))
+        assert not queue.put.called
+        self.assertEqual(len(hub._events), 1)
+        # Other invoice paid with the same settle_index case
+        invoice = pb.Invoice(payment_hash='3', state=pb.PAID)
+        hub._publish(2, invoice)
+        queue.put.assert_called_once_with((2, invoice))
+        self.assertEqual(hub._last_key, (2, '3'))
+
+    @patch('lighter.streams.Err')
+    def test_stream_slot(self, mocked_err):
+        mocked_err.return_value.too_many_streams.side_effect = Exception()
+        settings.MAX_STREAMS = 2
+        with MOD.stream_slot(CTX):
+            self.assertEqual(MOD.STREAM_SLOTS.used, 1)
+            with MOD.stream_slot(CTX):
+                self.assertEqual(MOD.STREAM_SLOTS.used, 2)
+                # All slots in use case
+                with self.assertRaises(Exception):
+                    with MOD.stream_slot(CTX):
+                        pass
+                mocked_err.return_value.too_many_streams.\
+                    assert_called_once_with(CTX)
+            self.assertEqual(MOD.STREAM_SLOTS.used, 1)
+        self.assertEqual(MOD.STREAM_SLOTS.used, 0)
+        # Slots not capped by GRPC_WORKERS case
+        reset_mocks(vars())
+        workers = settings.GRPC_WORKERS
+        settings.GRPC_WORKERS = 1
+        with MOD.stream_slot(CTX):
+            with MOD.stream_slot(CTX):
+                self.assertEqual(MOD.STREAM_SLOTS.used, 2)
+        self.assertEqual(MOD.STREAM_SLOTS.used, 0)
+        settings.GRPC_WORKERS = workers
+        settings.MAX_STREAMS = 5
+
+    @patch('lighter.streams.stream_slot', autospec=True)
+    def test_subscribe_slot(self, mocked_slot):
+        hub = MOD.InvoicesHub(Mock(), Mock())
+        hub._stop.set()
+        context = Mock()
+        list(hub.subscribe(context, 0))
+        mocked_slot.assert_called_once_with(context)
+        assert mocked_slot.return_value.__exit__.called
+        self.assertEqual(hub._subscribers, [])
+
+
+def reset_mocks(params):
+    for _key, value in params.items():
+        try:
+            if type(value.call_count) is int:
+                value.reset_mock()
+        except:
+            pass
@@ -14,12 +14,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Tests for utils module """
 
+from asyncio import run, sleep as sleep_async
 from codecs import encode
 from decimal import InvalidOperation
 from importlib import import_module
+from inspect import iscoroutinefunction
+from io import StringIO
+from json import loads
+from logging import Logger, makeLogRecord, StreamHandler
+from logging.handlers import QueueHandler
 from os import urandom
 from subprocess import PIPE, TimeoutExpired
 
+from grpc import StatusCode
 from nacl.exceptions import CryptoError
 from unittest import TestCase
 from unittest.mock import Mock, mock_open, patch
@@ -27,8 +34,9 @@ from unittest.mock import Mock, mock_open, patch
 from lighter import lighter_pb2 as pb
 from lighter import settings
 from lighter.db import ImplementationSecret
+from lighter.metrics import set_abort_code
 from lighter.utils import Enforcer as Enf
-from tests import fixtures_utils as fix
+from tests import CoroutineMock, fixtures_utils as fix
 
 MOD = import_module('lighter.utils')
 CTX = 'context'
@@ -61,6 +69,108 @@ class UtilsTests(TestCase):
         self.assertIn('file', settings.LOGGING['loggers']['']['handlers'])
         self.assertEqual(settings.LOGGING['handlers']['file']['filename'],
                          log_path)
+        # JSON format, queued case
+        reset_mocks(vars())
+        values = {'LOGS_FORMAT': 'JSON'}
+        with patch.dict('os.environ', values), \
+                patch('lighter.utils._start_log_listener') as mocked_start:
+            MOD.update_logger(queued=True)
+        mocked_start.assert_called_once_with()
+        self.assertEqual(settings.LOGS_FORMAT, 'json')
+        for handler in settings.LOGGING['handlers'].values():
+            self.assertEqual(handler['formatter'], 'json')
+        settings.LOGGING['handlers']['console']['formatter'] = 'simple'
+        settings.LOGGING['handlers']['file']['formatter'] = 'verbose'
+        settings.LOGS_FORMAT = 'text'
+        # Unsupported format case
+        reset_mocks(vars())
+        values = {'LOGS_FORMAT': 'xml'}
+        with patch.dict('os.environ', values):
+            with self.assertRaises(RuntimeError):
+                MOD.update_logger()
+        assert not mocked_dictConfig.called
+        settings.LOGS_FORMAT = 'text'
+
+    @patch('lighter.utils.register', autospec=True)
+    @patch('lighter.utils.getLogger', autospec=True)
+    def test_start_log_listener(self, mocked_getLogger, mocked_register):
+        stream = StringIO()
+        root = Logger('root')
+        root.addHandler(StreamHandler(stream))
+        mocked_getLogger.return_value = root
+        MOD._start_log_listener()
+        mocked_register.assert_called_once_with(MOD.stop_log_listener)
+        self.assertEqual(len(root.handlers), 1)
+        assert isinstance(root.handlers[0], QueueHandler)
+        try:
+            raise RuntimeError('boom')
+        except RuntimeError:
+            root.exception('Failed %s', MOD.LogDump('a\nb'))
+        MOD.stop_log_listener()
+        self.assertEqual(settings.LOG_LISTENER, None)
+        output = stream.getvalue()
+        self.assertIn('Failed a b\n', output)
+        self.assertIn('RuntimeError: boom', output)
+        # No listener case
+        MOD.stop_log_listener()
+
+    def test_RecordQueueHandler(self):
+        queue = Mock()
+        handler = MOD._RecordQueueHandler(queue)
+        response = pb.GetInfoResponse(alias='a')
+        record = makeLogRecord({'msg': 'Response: %s', 'args': (response,)})
+        handler.handle(record)
+        queued = queue.put_nowait.call_args[0][0]
+        # Message is formatted when logged
+        response.alias = 'b'
+        self.assertEqual(queued.getMessage(), 'Response: alias: "a"\n')
+        self.assertEqual(queued.args, None)
+        # Dump case, message is left to be formatted by the listener
+        dump = MOD.LogDump(response)
+        record = makeLogRecord({'msg': 'Response: %s', 'args': (dump,)})
+        handler.handle(record)
+        queued = queue.put_nowait.call_args[0][0]
+        self.assertEqual(queued.args, (dump,))
+        self.assertEqual(queued.msg, 'Response: %s')
+
+    def test_JsonFormatter(self):
+        formatter = MOD.JsonFormatter()
+        record = makeLogRecord({
+            'msg': 'Call %s', 'args': ('GetInfo',), 'levelname': 'INFO',
+            'name': 'lighter', 'lineno': 7})
+        res = loads(formatter.format(record))
+        self.assertEqual(res['message'], 'Call GetInfo')
+        self.assertEqual(res['level'], 'INFO')
+        self.assertEqual(res['line'], 7)
+        assert 'exception' not in res
+        # Exception case
+        try:
+            raise RuntimeError('boom')
+        except RuntimeError as err:
+            record.exc_info = (RuntimeError, err, err.__traceback__)
+        res = loads(formatter.format(record))
+        self.assertIn('RuntimeError: boom', res['exception'])
+
+    def test_LogDump(self):
+        response = pb.GetInfoResponse(alias='a', identity_pubkey='b')
+        self.assertEqual(
+            str(MOD.LogDump(response)), 'identity_pubkey: "b" alias: "a" ')
+        self.assertEqual(str(MOD.LogDump('a\nb')), 'a b')
+        settings.LOG_DUMP_MAX = 10
+        self.assertEqual(
+            str(MOD.LogDump(response)), 'identity_p... (truncated)')
+        self.assertEqual(
+            str(MOD.LogDump('a' * 11)), 'aaaaaaaaaa... (truncated)')
+        # Formatting stops once LOG_DUMP_MAX characters are written
+        response = pb.ListInvoicesResponse(
+            invoices=[pb.Invoice(payment_hash='h')] * 1000)
+        write = MOD._DumpWriter.write
+        with patch.object(MOD._DumpWriter, 'write', autospec=True,
+                          side_effect=write) as mocked_write:
+            res = str(MOD.LogDump(response))
+        self.assertEqual(res, 'invoices {... (truncated)')
+        self.assertLess(mocked_write.call_count, 10)
+        settings.LOG_DUMP_MAX = 4096
 
     @patch('lighter.utils.LOGGER', autospec=True)
     def test_log_intro(self, mocked_logger):
@@ -83,10 +193,12 @@ class UtilsTests(TestCase):
         mocked_import.return_value = 'mod'
         func = Mock()
         func.return_value = pb.GetInfoResponse(
-            identity_pubkey='777', version='v1')
+            identity_pubkey='777', version='v1', network='testnet')
         mocked_getattr.return_value = func
         MOD.check_connection()
         mocked_import.assert_called_once_with('lighter.light_imp')
+        self.assertEqual(settings.NODE_NETWORK, 'testnet')
+        settings.NODE_NETWORK = None
         # Correct case (no version)
         reset_mocks(vars())
         settings.IMPLEMENTATION = 'imp'
@@ -99,9 +211,20 @@ class UtilsTests(TestCase):
         mocked_import.assert_called_once_with('lighter.light_imp')
         # No response case
         reset_mocks(vars())
-        mocked_getattr.side_effect = [RuntimeError(), func]
+        mocked_getattr.side_effect = [RuntimeError(), func, func]
         MOD.check_connection()
         assert mocked_logger.error.called
+        # Implementation with on_connect hook case
+        reset_mocks(vars())
+        hook = Mock()
+        mocked_getattr.side_effect = [func, hook]
+        MOD.check_connection()
+        mocked_getattr.assert_called_with('mod', 'on_connect', None)
+        hook.assert_called_once_with()
+        # Implementation without on_connect hook case
+        reset_mocks(vars())
+        mocked_getattr.side_effect = [func, None]
+        MOD.check_connection()
 
     def test_FakeContext(self):
         # abort test
@@ -126,14 +249,18 @@ class UtilsTests(TestCase):
             MOD.get_start_options()
         self.assertEqual(settings.INSECURE_CONNECTION, False)
         self.assertEqual(settings.IMPL_SEC_TYPE, 'macaroon')
+        self.assertEqual(settings.METRICS_PORT, '')
         # Insecure connection case
         settings.IMPLEMENTATION_SECRETS = False
         values = {
             'IMPLEMENTATION': 'eclair',
             'INSECURE_CONNECTION': '1',
+            'METRICS_PORT': '9708',
         }
         with patch.dict('os.environ', values):
             MOD.get_start_options()
+        self.assertEqual(settings.METRICS_PORT, '9708')
+        settings.METRICS_PORT = ''
         self.assertEqual(settings.INSECURE_CONNECTION, True)
         self.assertEqual(settings.DISABLE_MACAROONS, True)
         self.assertEqual(settings.IMPL_SEC_TYPE, 'password')
@@ -146,6 +273,41 @@ class UtilsTests(TestCase):
         }
         with patch.dict('os.environ', values):
             MOD.get_start_options(warning=True)
+        # Response cache TTLs case
+        ttls = settings.CACHE_TTLS
+        values = {
+            'IMPLEMENTATION': 'lnd',
+            'CACHE_TTLS': 'GetInfo:60, ListPeers:0',
+        }
+        with patch.dict('os.environ', values):
+            MOD.get_start_options()
+        self.assertEqual(settings.CACHE_TTLS['GetInfo'], 60)
+        self.assertEqual(settings.CACHE_TTLS['ListPeers'], 0)
+        self.assertEqual(
+            settings.CACHE_TTLS['WalletBalance'], ttls['WalletBalance'])
+        settings.CACHE_TTLS = ttls
+        # Max streams case
+        values = {'IMPLEMENTATION': 'lnd', 'MAX_STREAMS': '8'}
+        with patch.dict('os.environ', values):
+            MOD.get_start_options()
+        self.assertEqual(settings.MAX_STREAMS, 8)
+        values['MAX_STREAMS'] = 'eight'
+        with patch.dict('os.environ', values):
+            with self.assertRaises(RuntimeError):
+                MOD.get_start_options()
+        settings.MAX_STREAMS = 5
+
+    def test_get_cache_ttls(self):
+        res = MOD._get_cache_ttls('WalletBalance:1,')
+        self.assertEqual(res['WalletBalance'], 1)
+        self.assertEqual(res['GetInfo'], settings.CACHE_TTLS['GetInfo'])
+        self.assertIsNot(res, settings.CACHE_TTLS)
+        # Not cacheable method case
+        with self.assertRaises(RuntimeError):
+            MOD._get_cache_ttls('PayInvoice:10')
+        # Invalid TTL case
+        with self.assertRaises(RuntimeError):
+            MOD._get_cache_ttls('GetInfo:ten')
 
     @patch('lighter.utils.get_secret_from_db', autospec=True)
     def test_detect_impl_secret(self, mocked_db_sec):
@@ -265,6 +427,38 @@ class UtilsTests(TestCase):
             CMD, env=None, stdout=PIPE, stderr=PIPE, universal_newlines=False)
         mocked_popen.return_value.kill.assert_called_with()
         mocked_err().node_error.assert_called_once_with(CTX, 'Timeout')
+
+    @patch('lighter.utils._get_cli_response', autospec=True)
+    @patch('lighter.utils.Err')
+    @patch('lighter.utils.create_subprocess_exec', new_callable=CoroutineMock)
+    @patch('lighter.utils.get_node_timeout', autospec=True)
+    def test_async_command(self, mocked_get_time, mocked_exec, mocked_err,
+                           mocked_get_res):
+        mocked_get_time.return_value = 10
+        proc = mocked_exec.return_value = Mock()
+        proc.communicate = CoroutineMock(return_value=(b'out', b'err'))
+        settings.CMD_BASE = ['lightning-cli']
+        res = run(MOD.async_command(CTX, 'getinfo'))
+        mocked_exec.assert_called_once_with(
+            'lightning-cli', 'getinfo', env=None, stdout=PIPE, stderr=PIPE)
+        mocked_get_res.assert_called_once_with(CTX, b'out', b'err')
+        self.assertEqual(res, mocked_get_res.return_value)
+        # Timeout case
+        reset_mocks(vars())
+        mocked_err().node_error.side_effect = Exception()
+
+        async def slow_func():
+            await sleep_async(1)
+
+        proc.communicate = slow_func
+        with self.assertRaises(Exception):
+            run(MOD.async_command(CTX, 'getinfo', timeout=0.01))
+        proc.kill.assert_called_once_with()
+        mocked_err().node_error.assert_called_once_with(CTX, 'Timeout')
+        # No command case
+        settings.CMD_BASE = []
+        with self.assertRaises(RuntimeError):
+            run(MOD.async_command(CTX, 'getinfo'))
         # Command empty case
         reset_mocks(vars())
         settings.CMD_BASE = []
@@ -352,6 +546,45 @@ class UtilsTests(TestCase):
             MOD.check_req_params(CTX, request, 'node_uri', 'funding_bits')
         mocked_err().missing_parameter.assert_called_once_with(CTX, 'node_uri')
 
+    @patch('lighter.utils.Err')
+    def test_decode_cursor(self, mocked_err):
+        res = MOD.decode_cursor(CTX, MOD.encode_cursor((7, 'hash')))
+        self.assertEqual(res, (7, 'hash'))
+        # Invalid cursor case
+        mocked_err().invalid.side_effect = Exception()
+        for cursor in ('not a cursor', 'Nw==', '\u00e8'):
+            reset_mocks(vars())
+            with self.assertRaises(Exception):
+                MOD.decode_cursor(CTX, cursor)
+            mocked_err().invalid.assert_called_once_with(CTX, 'cursor')
+
+    @patch('lighter.utils.Err')
+    def test_paginate(self, mocked_err):
+        request = pb.ListPaymentsRequest()
+        entries = [5, 3, 1, 4, 2]
+        key = lambda entry: (entry,)
+        pages = list(MOD.paginate(CTX, request, entries, key, 2))
+        self.assertEqual([page for page, _ in pages], [[1, 2], [3, 4], [5]])
+        self.assertEqual(
+            [cursor for _, cursor in pages],
+            [MOD.encode_cursor((2,)), MOD.encode_cursor((4,)), ''])
+        # All entries case
+        pages = list(MOD.paginate(CTX, request, entries, key, 0))
+        self.assertEqual(pages, [([1, 2, 3, 4, 5], '')])
+        # No entries case
+        pages = list(MOD.paginate(CTX, request, [], key, 2))
+        self.assertEqual(pages, [([], '')])
+        # Cursor case
+        request.cursor = MOD.encode_cursor((3,))
+        pages = list(MOD.paginate(CTX, request, entries, key, 2))
+        self.assertEqual(pages, [([4, 5], '')])
+        # Cursor of another list case
+        request.cursor = MOD.encode_cursor(('hash',))
+        mocked_err().invalid.side_effect = Exception()
+        with self.assertRaises(Exception):
+            list(MOD.paginate(CTX, request, entries, key, 2))
+        mocked_err().invalid.assert_called_once_with(CTX, 'cursor')
+
     def test_get_node_timeout(self):
         # Client without timeout
         ctx = Mock()
@@ -386,8 +619,7 @@ class UtilsTests(TestCase):
         res = MOD.get_thread_timeout(ctx)
         self.assertEqual(res, 0)
 
-    @patch('lighter.utils.sleep', autospec=True)
-    def test_handle_keyboardinterrupt(self, mocked_sleep):
+    def test_handle_keyboardinterrupt(self):
         grpc_server = Mock()
         # Correct case
         func = Mock()
@@ -399,60 +631,125 @@ class UtilsTests(TestCase):
         reset_mocks(vars())
         func.side_effect = KeyboardInterrupt()
         close_event = Mock()
-        close_event.is_set.side_effect = [False, True]
         grpc_server.stop.return_value = close_event
+        settings.JOBS = Mock()
         wrapped = MOD.handle_keyboardinterrupt(func)
         with self.assertRaises(RuntimeError):
             res = wrapped(grpc_server)
-        assert mocked_sleep.called
+        close_event.wait.assert_called_once_with()
+        settings.JOBS.drain.assert_called_once_with(settings.GRPC_GRACE_TIME)
         self.assertEqual(res, None)
         self.assertEqual(func.call_count, 1)
         grpc_server.stop.assert_called_once_with(settings.GRPC_GRACE_TIME)
+        settings.JOBS = None
 
-    def test_handle_logs(self):
+    @patch('lighter.utils.call_ended', autospec=True)
+    @patch('lighter.utils.call_started', autospec=True)
+    def test_handle_logs(self, mocked_started, mocked_ended):
         req = pb.GetInfoRequest()
         ctx = Mock()
         ctx.peer.return_value = 'ipv4:0.0.0.0'
         ctx.invocation_metadata.return_value = fix.METADATA
+        started = mocked_started.return_value
         response = pb.GetInfoResponse()
         func = Mock(return_value=response)
+        func.__name__ = 'GetInfo'
         wrapped = MOD.handle_logs(func)
         res = wrapped('self', req, ctx)
         self.assertEqual(res, response)
         self.assertEqual(func.call_count, 1)
+        mocked_started.assert_called_once_with('GetInfo')
+        mocked_ended.assert_called_once_with('GetInfo', started)
+        # Error case
+        reset_mocks(vars())
+        def failing_func(*_args):
+            set_abort_code(StatusCode.UNAVAILABLE)
+            raise RuntimeError()
 
-    def test_handle_thread(self):
-        # return case
-        response = 'response'
-        func = Mock(return_value=response)
-        req = 'request'
-        wrapped = MOD.handle_thread(func)
-        res = wrapped(req)
+        func.side_effect = failing_func
+        with self.assertRaises(RuntimeError):
+            wrapped('self', req, ctx)
+        mocked_ended.assert_called_once_with('GetInfo', started, 'UNAVAILABLE')
+        # Server-streaming case
+        reset_mocks(vars())
+        responses = [pb.GetInfoResponse(alias='a'), pb.GetInfoResponse()]
+        func = Mock(return_value=(res for res in responses))
+        func.__name__ = 'StreamInfo'
+        wrapped = MOD.handle_logs(func)
+        res = wrapped('self', req, ctx)
+        assert not mocked_ended.called
+        self.assertEqual(list(res), responses)
+        mocked_ended.assert_called_once_with('StreamInfo', started, None)
+        # Coroutine case
+        reset_mocks(vars())
+        async def coro(request, context):
+            return response
+
+        wrapped = MOD.handle_logs(coro)
+        self.assertEqual(iscoroutinefunction(wrapped), True)
+        res = run(wrapped(req, ctx))
         self.assertEqual(res, response)
-        self.assertEqual(func.call_count, 1)
-        # raise case
-        func.side_effect = RuntimeError()
+        mocked_ended.assert_called_once_with('coro', started)
+        # Coroutine error case
+        reset_mocks(vars())
+        async def failing_coro(request, context):
+            set_abort_code(StatusCode.NOT_FOUND)
+            raise RuntimeError()
+
+        wrapped = MOD.handle_logs(failing_coro)
         with self.assertRaises(RuntimeError):
-            wrapped = MOD.handle_thread(func)
-            res = wrapped(req)
-            self.assertEqual(res, None)
-
-    @patch('lighter.utils._has_numbers', autospec=True)
-    def test_has_amount_encoded(self, mocked_has_num):
-        pay_req = 'lntb5n1pw3mupk'
-        mocked_has_num.return_value = True
-        res = MOD.has_amount_encoded(pay_req)
-        self.assertEqual(res, True)
-        pay_req = 'lntb1pw3mumupk'
-        mocked_has_num.return_value = False
-        res = MOD.has_amount_encoded(pay_req)
-        self.assertEqual(res, False)
+            run(wrapped(req, ctx))
+        mocked_ended.assert_called_once_with(
+            'failing_coro', started, 'NOT_FOUND')
 
-    def test_has_numbers(self):
-        res = MOD._has_numbers('light3r')
-        self.assertEqual(res, True)
-        res = MOD._has_numbers('lighter')
-        self.assertEqual(res, False)
+    @patch('lighter.utils.LOGGER', autospec=True)
+    def test_log_response(self, mocked_log):
+        response = pb.GetInfoResponse()
+        MOD._log_response(response, 'peer', 0)
+        self.assertEqual(len(mocked_log.info.call_args[0]), 4)
+        # Call with a note case
+        reset_mocks(vars())
+        MOD.set_log_note('cached')
+        MOD._log_response(response, 'peer', 0)
+        self.assertEqual(mocked_log.info.call_args[0][4], 'cached')
+        # Note is reset by the next request
+        reset_mocks(vars())
+        ctx = Mock()
+        ctx.peer.return_value = 'ipv4:0.0.0.0'
+        ctx.invocation_metadata.return_value = fix.METADATA
+        MOD._log_request((pb.GetInfoRequest(), ctx))
+        MOD._log_response(response, 'peer', 0)
+        self.assertEqual(len(mocked_log.info.call_args[0]), 4)
+
+    @patch('lighter.utils.call_ended', autospec=True)
+    @patch('lighter.utils.LOGGER', autospec=True)
+    def test_log_stream(self, mocked_log, mocked_ended):
+        call = ('StreamInfo', 1)
+        responses = [pb.GetInfoResponse(alias='a')]
+        res = MOD._log_stream(iter(responses), 'peer', 0, call)
+        assert not mocked_log.info.called
+        self.assertEqual(list(res), responses)
+        self.assertEqual(mocked_log.info.call_args[0][1], 'Stream of 1')
+        mocked_ended.assert_called_once_with('StreamInfo', 1, None)
+        # Interrupted stream case
+        reset_mocks(vars())
+        res = MOD._log_stream(iter(responses * 2), 'peer', 0, call)
+        next(res)
+        res.close()
+        self.assertEqual(mocked_log.info.call_args[0][1], 'Stream of 1')
+        mocked_ended.assert_called_once_with('StreamInfo', 1, 'CANCELLED')
+        # Failing stream case
+        reset_mocks(vars())
+
+        def failing():
+            yield responses[0]
+            raise RuntimeError()
+
+        set_abort_code(None)
+        res = MOD._log_stream(failing(), 'peer', 0, call)
+        with self.assertRaises(RuntimeError):
+            list(res)
+        mocked_ended.assert_called_once_with('StreamInfo', 1, 'UNKNOWN')
 
     def test_get_channel_balances(self):
         # Full channel list case
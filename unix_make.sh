@@ -50,11 +50,6 @@ ERROR_COLOR='\033[0;31m'
 OK_STRING='[OK]'
 ERROR_STRING='[ERROR]'
 
-# Eclair variables
-ECL_REF=${ECL_REF:-'v0.3.2'}
-ECL_URL='https://raw.githubusercontent.com/ACINQ/eclair'
-ECL_CLI='eclair-cli'
-
 # Lnd variables
 LND_REF=${LND_REF:-'v0.8.0-beta'}
 LND_URL='https://raw.githubusercontent.com/lightningnetwork/lnd'
@@ -132,14 +127,6 @@ setup_common() {
 	$PROG _install_pips $params
 }
 
-setup_eclair() {
-	# Downloads correct version of eclair's cli and makes it executable
-	cd "$L_DIR" || _die "Directory '$L_DIR' is missing"
-	curl -s -o "$ECL_CLI" "$ECL_URL/$ECL_REF/eclair-core/$ECL_CLI"
-	chmod +x "$ECL_CLI"
-	cd - > /dev/null || _die "Error, check project structure"
-}
-
 setup_lnd() {
 	# Downloads rpc.proto and googleapis, which are needed by lnd
 	. "$ENV/bin/activate"
@@ -468,8 +455,6 @@ _clean_autogenerated() {
 	rm -rfv "$COMPLETION_SCRIPT" $TMP_BASHRC $TMP_ZSHRC cliter.egg-info
 	# Lint files
 	rm -fv .coverage "$LINT_DIR/pycodestyle.report" "$LINT_DIR/pylint.report"
-	# Eclair files
-	rm -fv "$L_DIR/$ECL_CLI"
 	# Lnd files
 	rm -fv $L_DIR/rpc_pb2*.py "$L_DIR/$LND_PROTO" "$GOOGLEAPIS_ZIP"
 	rm -rfv "$L_DIR/google/" | tail -1